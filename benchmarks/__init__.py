@@ -0,0 +1,7 @@
+#--------------------------------------------------------------
+#
+# Benchmarks of the knowledge graph converters on synthetic MIMIC IV FHIR data
+#
+# synthetic_data.py generates the documents, run_benchmarks.py runs the converters and stores the results
+#
+#----------------------------------------------------------------
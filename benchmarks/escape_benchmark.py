@@ -0,0 +1,91 @@
+#--------------------------------------------------------------
+#
+# This python file measures the literal escaping of the converters (escape_string in kg_triples.py) against the chain of
+# replace calls the converters used before it, on strings like the ones in MIMIC IV FHIR documents
+#
+#   python -m benchmarks.escape_benchmark
+#   python -m benchmarks.escape_benchmark --number 500000
+#
+# The time of every string is the best of a few repeats in nanoseconds per call, the last rows add up the values that need
+# no escaping, which are almost all of them in the data, and the ones that do
+#
+#----------------------------------------------------------------
+
+import argparse
+import timeit
+
+from kg_triples import escape_string
+
+
+#label -> a value the converters write as a literal, most of them need no escaping at all
+SAMPLES = {
+    "status": "final",
+    "dateTime": "2150-02-11T01:11:00-04:00",
+    "system": "http://mimic.mit.edu/fhir/mimic/CodeSystem/mimic-d-labitems",
+    "display": "Sodium Chloride 0.9%  Flush Syringe",
+    "code": "50912",
+    "unit": "mg/dL",
+    "decimal": 1.4,
+    "id": "7f3b1c2e-1a2b-5c3d-9e4f-0a1b2c3d4e5f",
+    "accented": "Pneumonie à pneumocoque",
+    "long text": "patient tolerated the procedure well, no complications " * 6,
+    "quotes": 'take with "food"',
+    "backslash": "C:\\orders\\PO/NG",
+    "newline": "hemolyzed specimen\nrepeat ordered",
+    "control": "tab\tseparated\x0bvalue",
+}
+
+
+def replace_chain(text):
+    """
+    This fuction is the escaping the converters did before escape_string, four replace passes over every string
+    Args:
+        text (string): a string of text
+    Returns:
+        str: the escaped text, control characters other than newlines are left in it
+    """
+    if not isinstance(text, str):
+        text = str(text)
+    text = text.replace('\\', '\\\\')
+    text = text.replace('"', '\\"')
+    text = text.replace('\n', '\\n').replace('\r', '\\r')
+    return text
+
+def time_call(function, value, number, repeat):
+    """
+    This fuction times a function on one value
+    Args:
+        function (function): the escaping function
+        value (object): the value passed to it
+        number (int): calls per repeat
+        repeat (int): repeats, the fastest one is kept
+    Returns:
+        float: nanoseconds per call
+    """
+    timer = timeit.Timer(lambda: function(value))
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e9
+
+def main():
+    """
+    This fuction reads the command line and prints the time of both routines on every sample
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the turtle literal escaping of the converters")
+    parser.add_argument("--number", type=int, default=200000, help="calls per repeat")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    print(f"{'value':14}{'replace ns':>12}{'escape ns':>12}{'change':>9}")
+    #plain or escaped -> [replace ns, escape ns]
+    totals = {"plain": [0.0, 0.0], "escaped": [0.0, 0.0]}
+    for label, value in SAMPLES.items():
+        old = time_call(replace_chain, value, args.number, args.repeat)
+        new = time_call(escape_string, value, args.number, args.repeat)
+        total = totals["plain" if escape_string(value) == str(value) else "escaped"]
+        total[0] += old
+        total[1] += new
+        print(f"{label:14}{old:>12.1f}{new:>12.1f}{(new / old - 1) * 100:>+8.1f}%")
+    for name, (old, new) in totals.items():
+        print(f"{'all ' + name:14}{old:>12.1f}{new:>12.1f}{(new / old - 1) * 100:>+8.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+#--------------------------------------------------------------
+#
+# This python file measures how the fhir and flattened converters scale on synthetic data (see synthetic_data.py)
+#
+#   python -m benchmarks.run_benchmarks --scales 1 10 --source ndjson
+#   python -m benchmarks.run_benchmarks --scales 1 --source mongo --mongo-uri mongodb://localhost:27017/
+#   python -m benchmarks.run_benchmarks --output-format nq --graph patient
+#   python -m benchmarks.run_benchmarks --compare
+#
+# Every converter run records docs/sec, bytes/sec and peak memory per resource type and appends it, with the git commit
+# it ran on, to benchmarks/results/results.jsonl, --compare shows the change between the last two commits measured
+#
+# The mongo source loads the synthetic documents into the mimic_benchmark database, never into the mimic database
+#
+#----------------------------------------------------------------
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(REPO_DIR, "benchmarks", "data")
+RESULTS_PATH = os.path.join(REPO_DIR, "benchmarks", "results", "results.jsonl")
+
+#converter name -> (module, ontology header it needs in the working directory)
+CONVERTERS = {
+    "fhir": ("fhir_kg_creation", "fhir_kg_script.ttl"),
+    "flattened": ("flattened_kg_creation", "flattened_kg_script.ttl"),
+}
+
+BENCHMARK_DATABASE = "mimic_benchmark"
+
+
+def main():
+    """
+    This fuction reads the command line and runs the benchmarks, or compares the stored results
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the knowledge graph converters on synthetic MIMIC IV FHIR data")
+    parser.add_argument("--scales", type=float, nargs="+", default=[1], help="multiples of the demo size (100 patients)")
+    parser.add_argument("--source", choices=["ndjson", "mongo"], default="ndjson")
+    parser.add_argument("--converters", choices=list(CONVERTERS), nargs="+", default=list(CONVERTERS))
+    parser.add_argument("--workers", type=int, default=1, help="workers argument of create_ttl_script")
+    parser.add_argument("--output-format", choices=["ttl", "nt", "nq"], default="ttl", help="output_format argument of create_ttl_script")
+    parser.add_argument("--graph", choices=["resource_type", "patient"], default="resource_type", help="graph argument of create_ttl_script")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--mongo-uri", default=None)
+    parser.add_argument("--skip-load", action="store_true", help="reuse the documents already in the benchmark database")
+    parser.add_argument("--results", default=RESULTS_PATH)
+    parser.add_argument("--compare", action="store_true", help="only compare the last two commits in the results")
+    args = parser.parse_args()
+    if args.compare:
+        compare_results(args.results)
+        return
+    from benchmarks.synthetic_data import SEED
+    seed = SEED if args.seed is None else args.seed
+    mongo_settings = {"database": BENCHMARK_DATABASE}
+    if args.mongo_uri:
+        mongo_settings["uri"] = args.mongo_uri
+    for scale in args.scales:
+        data_path = prepare_data(scale, seed, args.source, mongo_settings, args.skip_load)
+        for converter in args.converters:
+            record = run_benchmark(converter, scale, seed, args.source, data_path, mongo_settings, args.workers, args.output_format, args.graph)
+            save_result(record, args.results)
+            print_result(record)
+
+def prepare_data(scale, seed, source, mongo_settings, skip_load=False):
+    """
+    This fuction makes the synthetic documents of a scale available to the converters
+    Args:
+        scale (float): multiple of the demo size
+        seed (int): seed of the generator
+        source (string): "ndjson" writes the files once and reuses them, "mongo" loads the benchmark database
+        mongo_settings (dict): configure_mongo settings of the benchmark database
+        skip_load (bool): keep the documents already in the benchmark database
+    Returns:
+        string: the ndjson folder, None for the mongo source
+    """
+    from benchmarks.synthetic_data import load_mongo, write_ndjson
+    if source == "ndjson":
+        data_path = os.path.join(DATA_DIR, f"seed_{seed}_scale_{scale:g}")
+        #the marker is written last, a folder without it was left behind by an interrupted run
+        marker = os.path.join(data_path, "complete")
+        if not os.path.exists(marker):
+            print(f"writing scale {scale:g} ndjson files to {data_path}")
+            write_ndjson(data_path, scale, seed)
+            open(marker, "w").close()
+        return data_path
+    if not skip_load:
+        import fhir_kg_creation
+        fhir_kg_creation.configure_mongo(**mongo_settings)
+        print(f"loading scale {scale:g} into the {BENCHMARK_DATABASE} database")
+        load_mongo(fhir_kg_creation.get_mongo_collection(), scale, seed)
+        fhir_kg_creation.close_mongo()
+    return None
+
+def run_benchmark(converter, scale, seed, source, data_path, mongo_settings, workers=1, output_format="ttl", graph="resource_type"):
+    """
+    This fuction runs one converter in a fresh process, so its peak memory is its own
+    Args:
+        converter (string): a key of CONVERTERS
+        scale (float): multiple of the demo size
+        seed (int): seed of the generator
+        source (string): "ndjson" or "mongo"
+        data_path (string): the ndjson folder, None for the mongo source
+        mongo_settings (dict): configure_mongo settings of the benchmark database
+        workers (int): workers argument of create_ttl_script
+        output_format (string): output_format argument of create_ttl_script
+        graph (string): graph argument of create_ttl_script
+    Returns:
+        dict: the result record with the metrics of every resource type
+    """
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        run = pool.submit(run_converter, converter, data_path, mongo_settings, workers, output_format, graph).result()
+    commit, dirty = get_commit()
+    passes = []
+    for pass_metrics in run["passes"]:
+        seconds = pass_metrics["seconds"]
+        passes.append({
+            "name": pass_metrics["name"],
+            "documents": pass_metrics["documents"],
+            "bytes": pass_metrics["bytes"],
+            "seconds": seconds,
+            "docs_per_second": pass_metrics["documents"] / seconds if seconds else None,
+            "bytes_per_second": pass_metrics["bytes"] / seconds if seconds else None,
+            "peak_rss_kb": pass_metrics["peak_rss_kb"],
+        })
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "converter": converter,
+        "scale": scale,
+        "seed": seed,
+        "source": source,
+        "workers": workers,
+        "output_format": output_format,
+        "graph": graph,
+        "seconds": run["seconds"],
+        "bytes": run["bytes"],
+        "peak_rss_kb": run["peak_rss_kb"],
+        "peak_worker_rss_kb": run["peak_worker_rss_kb"],
+        "passes": passes,
+    }
+
+def run_converter(converter, data_path, mongo_settings, workers=1, output_format="ttl", graph="resource_type"):
+    """
+    This fuction runs create_ttl_script of a converter in a temporary folder, it is the body of the benchmark process
+    Args:
+        converter (string): a key of CONVERTERS
+        data_path (string): the ndjson folder, None to read the benchmark database
+        mongo_settings (dict): configure_mongo settings of the benchmark database
+        workers (int): workers argument of create_ttl_script
+        output_format (string): output_format argument of create_ttl_script
+        graph (string): graph argument of create_ttl_script
+    Returns:
+        dict: RunMetrics.to_dict() with the peak memory when each pass finished added to the passes
+    """
+    import importlib
+    import fhir_kg_creation
+    from ndjson_source import NdjsonSource
+    module_name, header_name = CONVERTERS[converter]
+    module = importlib.import_module(module_name)
+    fhir_kg_creation.configure_mongo(**mongo_settings)
+    source = NdjsonSource(data_path, one_type_per_file=True) if data_path else None
+    #the high-water mark of the process when a pass is done, so a pass that needs a lot of memory shows as a jump
+    peaks = {}
+
+    def record_peak(pass_metrics):
+        peaks[pass_metrics["name"]] = fhir_kg_creation.get_peak_rss()[0]
+
+    workdir = tempfile.mkdtemp(prefix="benchmark_")
+    try:
+        shutil.copy(os.path.join(REPO_DIR, header_name), workdir)
+        os.chdir(workdir)
+        metrics = module.create_ttl_script(workers=workers, source=source, callback=record_peak, output_format=output_format, graph=graph)
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+    result = metrics.to_dict()
+    for pass_metrics in result["passes"]:
+        pass_metrics["peak_rss_kb"] = peaks.get(pass_metrics["name"])
+    return result
+
+def get_commit():
+    """
+    This fuction finds the git commit the benchmark runs on
+    Returns:
+        tuple: the commit hash ("unknown" outside git) and True when tracked files have uncommitted changes
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+    return commit, bool(status.strip())
+
+def save_result(record, path=RESULTS_PATH):
+    """
+    This fuction appends a result record to the results file
+    Args:
+        record (dict): the record run_benchmark returned
+        path (string): the results file, one json record per line
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a", encoding="utf-8") as file:
+        file.write(json.dumps(record) + "\n")
+
+def print_result(record):
+    """
+    This fuction prints a result record as a table
+    Args:
+        record (dict): the record run_benchmark returned
+    """
+    print(f"{record['converter']} scale {record['scale']:g} ({record['source']}, {record.get('output_format', 'ttl')}, commit {record['commit'][:10]}{' dirty' if record['dirty'] else ''})")
+    print(f"{'resource type':28}{'documents':>12}{'docs/sec':>12}{'MB/sec':>10}{'peak MB':>10}")
+    for pass_metrics in record["passes"]:
+        docs_per_second = pass_metrics["docs_per_second"] or 0
+        megabytes_per_second = (pass_metrics["bytes_per_second"] or 0) / 1e6
+        peak = (pass_metrics["peak_rss_kb"] or 0) / 1024
+        print(f"{pass_metrics['name']:28}{pass_metrics['documents']:>12}{docs_per_second:>12.0f}{megabytes_per_second:>10.2f}{peak:>10.1f}")
+    print(f"total {record['seconds']:.2f} seconds, {record['bytes'] / 1e6:.1f} MB written")
+
+def compare_results(path=RESULTS_PATH):
+    """
+    This fuction prints the docs/sec change per resource type between the last two commits in the results file
+    The newest record of every converter, scale, source, workers and output format is compared
+    Args:
+        path (string): the results file
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        records = [json.loads(line) for line in file if line.strip()]
+    commits = []
+    for record in records:
+        if record["commit"] in commits:
+            commits.remove(record["commit"])
+        commits.append(record["commit"])
+    if len(commits) < 2:
+        print("the results hold only one commit, nothing to compare")
+        return
+    old_commit, new_commit = commits[-2], commits[-1]
+
+    def latest(commit):
+        runs = {}
+        for record in records:
+            if record["commit"] == commit:
+                #records written before the output format was measured are turtle runs
+                output = record.get("output_format", "ttl") + ("+patient" if record.get("graph") == "patient" else "")
+                runs[(record["converter"], record["scale"], record["source"], record["workers"], output)] = record
+        return runs
+
+    old_runs = latest(old_commit)
+    new_runs = latest(new_commit)
+    print(f"docs/sec of {new_commit[:10]} compared to {old_commit[:10]}")
+    for key in sorted(new_runs.keys() & old_runs.keys()):
+        converter, scale, source, workers, output = key
+        print(f"{converter} scale {scale:g} ({source}, workers {workers}, {output})")
+        old_passes = {pass_metrics["name"]: pass_metrics for pass_metrics in old_runs[key]["passes"]}
+        for pass_metrics in new_runs[key]["passes"]:
+            old = old_passes.get(pass_metrics["name"])
+            if not old or not old["docs_per_second"] or not pass_metrics["docs_per_second"]:
+                continue
+            change = (pass_metrics["docs_per_second"] / old["docs_per_second"] - 1) * 100
+            print(f"    {pass_metrics['name']:28}{old['docs_per_second']:>12.0f}{pass_metrics['docs_per_second']:>12.0f}{change:>+9.1f}%")
+
+
+if __name__ == "__main__":
+    main()
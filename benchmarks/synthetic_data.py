@@ -0,0 +1,411 @@
+#--------------------------------------------------------------
+#
+# This python file generates synthetic MIMIC IV FHIR documents for the benchmarks
+#
+# The documents have the shapes the create_*resource_type*_entities() functions expect (nested coding, extension,
+# referenceRange, dosageInstruction, ...) and roughly the resource counts per patient of the MIMIC IV FHIR demo,
+# scale 1 is the size of the demo (100 patients), scale 10 and 100 multiply the patients
+#
+# The same seed and scale always give the same documents, they can be written to ndjson files or loaded into mongoDB
+#
+#----------------------------------------------------------------
+
+import os
+import random
+
+
+SEED = 7
+
+#patients in the MIMIC IV FHIR demo, scale 1
+DEMO_PATIENTS = 100
+
+#approximate counts of the demo, per patient and per encounter, fractions are rounded at random
+ENCOUNTERS_PER_PATIENT = 10
+CONDITIONS_PER_ENCOUNTER = 4.5
+PROCEDURES_PER_ENCOUNTER = 0.7
+MEDICATION_REQUESTS_PER_ENCOUNTER = 17
+DISPENSES_PER_REQUEST = 0.8
+ADMINISTRATIONS_PER_REQUEST = 3.3
+SPECIMENS_PER_ENCOUNTER = 11
+OBSERVATIONS_PER_SPECIMEN = 73
+
+#resources that do not grow with the number of patients
+LOCATIONS = 31
+MEDICATIONS = 1800
+
+ORGANIZATION_ID = "ee172322-118b-5716-abbc-18e4c5437e15"
+MIMIC_SYSTEM = "http://mimic.mit.edu/fhir/mimic"
+UNITS_SYSTEM = "http://unitsofmeasure.org"
+
+#resource type -> ndjson file name, the names of the MIMIC IV FHIR export
+NDJSON_FILES = {
+    "Organization": "MimicOrganization.ndjson",
+    "Location": "MimicLocation.ndjson",
+    "Patient": "MimicPatient.ndjson",
+    "Encounter": "MimicEncounter.ndjson",
+    "Procedure": "MimicProcedure.ndjson",
+    "Condition": "MimicCondition.ndjson",
+    "MedicationDispense": "MimicMedicationDispense.ndjson",
+    "MedicationRequest": "MimicMedicationRequest.ndjson",
+    "Specimen": "MimicSpecimen.ndjson",
+    "Medication": "MimicMedication.ndjson",
+    "MedicationAdministration": "MimicMedicationAdministration.ndjson",
+    "Observation": "MimicObservation.ndjson",
+}
+
+
+def generate_documents(scale=1, seed=SEED):
+    """
+    This fuction generates the synthetic fhir documents one at a time so even scale 100 never sits in memory
+    Args:
+        scale (int or float): multiple of the demo size, the number of patients is DEMO_PATIENTS * scale
+        seed (int): seed of the random choices
+    Returns:
+        iterator: fhir documents (dictionaries)
+    """
+    rnd = random.Random(seed)
+
+    def count(average):
+        whole = int(average)
+        return whole + (1 if rnd.random() < average - whole else 0)
+
+    def ts(day):
+        return f"2150-{1 + day % 12:02d}-{1 + day % 28:02d}T{day % 24:02d}:{(day * 7) % 60:02d}:00-04:00"
+
+    def meta(kind):
+        return {"lastUpdated": ts(rnd.randint(0, 365)), "profile": [f"{MIMIC_SYSTEM}/StructureDefinition/{kind}"]}
+
+    yield make_organization(meta)
+    for index in range(LOCATIONS):
+        yield make_location(index, meta)
+    for index in range(MEDICATIONS):
+        yield make_medication(index, meta)
+    for patient_index in range(int(DEMO_PATIENTS * scale)):
+        patient_id = f"pat-{patient_index}"
+        yield make_patient(patient_index, meta, ts)
+        for encounter_index in range(ENCOUNTERS_PER_PATIENT):
+            encounter_id = f"enc-{patient_index}-{encounter_index}"
+            day = rnd.randint(0, 3000)
+            yield make_encounter(encounter_id, patient_id, patient_index, encounter_index, day, meta, ts)
+            for index in range(count(CONDITIONS_PER_ENCOUNTER)):
+                yield make_condition(f"cond-{patient_index}-{encounter_index}-{index}", patient_id, encounter_id, index, meta)
+            for index in range(count(PROCEDURES_PER_ENCOUNTER)):
+                yield make_procedure(f"proc-{patient_index}-{encounter_index}-{index}", patient_id, encounter_id, index, day, meta, ts)
+            for request_index in range(count(MEDICATION_REQUESTS_PER_ENCOUNTER)):
+                request_id = f"mr-{patient_index}-{encounter_index}-{request_index}"
+                dosage = make_dosage_instruction(request_index)
+                yield make_medication_request(request_id, patient_id, encounter_id, request_index, dosage, day, meta, ts)
+                if rnd.random() < DISPENSES_PER_REQUEST:
+                    yield make_medication_dispense(f"md-{patient_index}-{encounter_index}-{request_index}", patient_id, encounter_id, request_id, dosage, meta)
+                for index in range(count(ADMINISTRATIONS_PER_REQUEST)):
+                    yield make_medication_administration(f"ma-{patient_index}-{encounter_index}-{request_index}-{index}", patient_id, encounter_id, request_id, index, day, meta, ts)
+            for specimen_index in range(count(SPECIMENS_PER_ENCOUNTER)):
+                specimen_id = f"spec-{patient_index}-{encounter_index}-{specimen_index}"
+                yield make_specimen(specimen_id, patient_id, specimen_index, day, meta, ts)
+                for index in range(count(OBSERVATIONS_PER_SPECIMEN)):
+                    observation_id = f"obs-{patient_index}-{encounter_index}-{specimen_index}-{index}"
+                    yield make_observation(observation_id, patient_id, encounter_id, specimen_id, index, day, meta, ts)
+
+def write_ndjson(directory, scale=1, seed=SEED):
+    """
+    This fuction writes the synthetic documents to one ndjson file per resource type, named like the MIMIC IV FHIR export
+    Args:
+        directory (string): the folder the files are written to, created when missing
+        scale (int or float): multiple of the demo size
+        seed (int): seed of the random choices
+    Returns:
+        dict: resource type -> number of documents written
+    """
+    import json
+    os.makedirs(directory, exist_ok=True)
+    files = {resource_type: open(os.path.join(directory, name), "w", encoding="utf-8") for resource_type, name in NDJSON_FILES.items()}
+    counts = dict.fromkeys(NDJSON_FILES, 0)
+    try:
+        for doc in generate_documents(scale, seed):
+            files[doc["resourceType"]].write(json.dumps(doc, separators=(",", ":")) + "\n")
+            counts[doc["resourceType"]] += 1
+    finally:
+        for file in files.values():
+            file.close()
+    return counts
+
+def load_mongo(collection, scale=1, seed=SEED, batch_size=10000):
+    """
+    This fuction replaces the contents of a mongoDB collection with the synthetic documents
+    Args:
+        collection (Collection): the collection to fill, everything already in it is deleted
+        scale (int or float): multiple of the demo size
+        seed (int): seed of the random choices
+        batch_size (int): documents per insert_many call
+    Returns:
+        int: the number of documents inserted
+    """
+    collection.drop()
+    inserted = 0
+    batch = []
+    for doc in generate_documents(scale, seed):
+        batch.append(doc)
+        if len(batch) == batch_size:
+            collection.insert_many(batch, ordered=False)
+            inserted += len(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+        inserted += len(batch)
+    collection.create_index("resourceType")
+    return inserted
+
+
+#the documents of every resource type, the variants rotate with the index so every optional field the converters read shows up
+
+def coding(system, code, display=None):
+    """
+    This fuction builds one coding entry of a CodeableConcept
+    Returns:
+        dict: system, code and display when one is given
+    """
+    if display is None:
+        return {"system": system, "code": code}
+    return {"system": system, "code": code, "display": display}
+
+def make_organization(meta):
+    """
+    This fuction builds the single Organization document
+    Returns:
+        dict: the Organization
+    """
+    return {"resourceType": "Organization", "id": ORGANIZATION_ID, "meta": meta("mimic-organization"),
+            "identifier": [{"system": "http://hl7.org/fhir/sid/us-npi", "value": "1194052720"}], "active": True,
+            "type": [{"coding": [coding("http://terminology.hl7.org/CodeSystem/organization-type", "prov", "Healthcare Provider")]}],
+            "name": "Beth Israel Deaconess Medical Center"}
+
+def make_location(index, meta):
+    """
+    This fuction builds one Location document, every location is managed by the Organization
+    Returns:
+        dict: the Location
+    """
+    return {"resourceType": "Location", "id": f"loc-{index}", "meta": meta("mimic-location"), "status": "active", "name": f"Unit {index}",
+            "physicalType": {"coding": [coding("http://terminology.hl7.org/CodeSystem/location-physical-type", "wa", "Ward")]},
+            "managingOrganization": {"reference": f"Organization/{ORGANIZATION_ID}"}}
+
+def make_medication(index, meta):
+    """
+    This fuction builds one Medication document, every tenth one has ingredients
+    Returns:
+        dict: the Medication
+    """
+    doc = {"resourceType": "Medication", "id": f"med-{index}", "meta": meta("mimic-medication"),
+           "identifier": [{"system": f"{MIMIC_SYSTEM}/CodeSystem/mimic-medication-ndc", "value": f"{index:011d}"},
+                          {"system": f"{MIMIC_SYSTEM}/CodeSystem/mimic-medication-name", "value": f"Drug {index}"}],
+           "code": {"coding": [coding(f"{MIMIC_SYSTEM}/CodeSystem/mimic-medication-ndc", f"{index:011d}")]}}
+    if index % 10 == 9:
+        doc["ingredient"] = [{"itemReference": {"reference": f"Medication/med-{index - 1}"}}, {"itemReference": {"reference": f"Medication/med-{index - 2}"}}]
+    return doc
+
+def make_patient(index, meta, ts):
+    """
+    This fuction builds one Patient document with the race, ethnicity and birthsex extensions
+    Returns:
+        dict: the Patient
+    """
+    extension = [{"url": "http://hl7.org/fhir/us/core/StructureDefinition/us-core-race",
+                  "extension": [{"url": "ombCategory", "valueCoding": coding("urn:oid:2.16.840.1.113883.6.238", "2106-3", "White")},
+                                {"url": "text", "valueString": "White"}]},
+                 {"url": "http://hl7.org/fhir/us/core/StructureDefinition/us-core-ethnicity",
+                  "extension": [{"url": "ombCategory", "valueCoding": coding("urn:oid:2.16.840.1.113883.6.238", "2186-5", "Not Hispanic or Latino")},
+                                {"url": "text", "valueString": "Not Hispanic or Latino"}]},
+                 {"url": "http://hl7.org/fhir/us/core/StructureDefinition/us-core-birthsex", "valueCode": "F" if index % 2 else "M"}]
+    doc = {"resourceType": "Patient", "id": f"pat-{index}", "meta": meta("mimic-patient"), "extension": extension,
+           "identifier": [{"system": f"{MIMIC_SYSTEM}/identifier/patient", "value": str(10000000 + index)}],
+           "gender": "female" if index % 2 else "male", "birthDate": f"20{50 + index % 40}-{1 + index % 12:02d}-{1 + index % 28:02d}",
+           "maritalStatus": {"coding": [coding("http://terminology.hl7.org/CodeSystem/v3-MaritalStatus", "MSWDU"[index % 5])]},
+           "communication": [{"language": {"coding": [coding("urn:ietf:bcp:47", "en")]}}],
+           "managingOrganization": {"reference": f"Organization/{ORGANIZATION_ID}"}}
+    if index % 3 == 0:
+        doc["deceasedDateTime"] = ts(index)
+    return doc
+
+def make_encounter(encounter_id, patient_id, patient_index, index, day, meta, ts):
+    """
+    This fuction builds one Encounter document, the first encounter of a patient has hospitalization details and the later ones are partOf it
+    Returns:
+        dict: the Encounter
+    """
+    organization = f"Organization/{ORGANIZATION_ID}"
+    doc = {"resourceType": "Encounter", "id": encounter_id, "meta": meta("mimic-encounter"), "status": "finished",
+           "class": {"system": "http://terminology.hl7.org/CodeSystem/v3-ActCode", "code": "IMP"},
+           "type": [{"coding": [coding("http://snomed.info/sct", "308335008", "Patient encounter procedure")]}],
+           "subject": {"reference": f"Patient/{patient_id}"}, "period": {"start": ts(day), "end": ts(day + 2)},
+           "identifier": [{"system": f"{MIMIC_SYSTEM}/identifier/encounter-hosp", "value": str(20000000 + patient_index * 100 + index),
+                           "use": "usual", "assigner": {"reference": organization}}],
+           "serviceProvider": {"reference": organization},
+           "location": [{"location": {"reference": f"Location/loc-{(patient_index + index) % LOCATIONS}"}, "period": {"start": ts(day), "end": ts(day + 1)}}]}
+    if index == 0:
+        doc["hospitalization"] = {"admitSource": {"coding": [coding(f"{MIMIC_SYSTEM}/CodeSystem/mimic-admit-source", "EMERGENCY ROOM")]},
+                                  "dischargeDisposition": {"coding": [coding(f"{MIMIC_SYSTEM}/CodeSystem/mimic-discharge-disposition", "HOME")]}}
+        doc["priority"] = {"coding": [coding("http://terminology.hl7.org/CodeSystem/v3-ActPriority", "EM")]}
+        doc["serviceType"] = {"coding": [coding(f"{MIMIC_SYSTEM}/CodeSystem/mimic-services", "MED")]}
+    else:
+        doc["partOf"] = {"reference": f"Encounter/enc-{patient_id[4:]}-0"}
+    return doc
+
+def make_condition(condition_id, patient_id, encounter_id, index, meta):
+    """
+    This fuction builds one Condition document
+    Returns:
+        dict: the Condition
+    """
+    return {"resourceType": "Condition", "id": condition_id, "meta": meta("mimic-condition"),
+            "identifier": [{"system": f"{MIMIC_SYSTEM}/identifier/condition", "value": condition_id[5:]}],
+            "category": [{"coding": [coding("http://terminology.hl7.org/CodeSystem/condition-category", "encounter-diagnosis")]}],
+            "code": {"coding": [coding(f"{MIMIC_SYSTEM}/CodeSystem/mimic-diagnosis-icd9", str(4019 + index), "Unspecified essential hypertension")]},
+            "subject": {"reference": f"Patient/{patient_id}"}, "encounter": {"reference": f"Encounter/{encounter_id}"}}
+
+def make_procedure(procedure_id, patient_id, encounter_id, index, day, meta, ts):
+    """
+    This fuction builds one Procedure document with either a performedDateTime or a performedPeriod
+    Returns:
+        dict: the Procedure
+    """
+    doc = {"resourceType": "Procedure", "id": procedure_id, "meta": meta("mimic-procedure"), "status": "completed",
+           "subject": {"reference": f"Patient/{patient_id}"}, "encounter": {"reference": f"Encounter/{encounter_id}"},
+           "identifier": [{"system": f"{MIMIC_SYSTEM}/identifier/procedure", "value": procedure_id[5:]}],
+           "code": {"coding": [coding(f"{MIMIC_SYSTEM}/CodeSystem/mimic-procedure-icd9", "3893", "Venous cath NEC")]},
+           "category": {"coding": [coding("http://snomed.info/sct", "387713003")]},
+           "bodySite": [{"coding": [coding(f"{MIMIC_SYSTEM}/CodeSystem/mimic-bodysite", "Left Arm")]}]}
+    if index % 2:
+        doc["performedDateTime"] = ts(day)
+    else:
+        doc["performedPeriod"] = {"start": ts(day), "end": ts(day + 1)}
+    return doc
+
+def make_dosage_instruction(index):
+    """
+    This fuction builds the dosageInstruction shared by a MedicationRequest and its MedicationDispense
+    Returns:
+        list: the dosageInstruction
+    """
+    timing = {"code": {"coding": [coding(f"{MIMIC_SYSTEM}/CodeSystem/mimic-medication-frequency", "Q8H")]}}
+    if index % 2:
+        timing["repeat"] = {"duration": 3, "durationUnit": "d"}
+    dosage = {"route": {"coding": [coding(f"{MIMIC_SYSTEM}/CodeSystem/mimic-medication-route", "PO")]}, "timing": timing,
+              "doseAndRate": [{"doseQuantity": {"system": UNITS_SYSTEM, "unit": "mg", "value": 5 * (1 + index % 4), "code": "mg"}}],
+              "text": "take with food"}
+    if index % 3 == 0:
+        dosage["maxDosePerPeriod"] = {"denominator": {"system": UNITS_SYSTEM, "unit": "d", "value": 1}, "numerator": {"value": 40}}
+    return [dosage]
+
+def make_medication_request(request_id, patient_id, encounter_id, index, dosage, day, meta, ts):
+    """
+    This fuction builds one MedicationRequest document with either a medicationReference or a medicationCodeableConcept
+    Returns:
+        dict: the MedicationRequest
+    """
+    doc = {"resourceType": "MedicationRequest", "id": request_id, "meta": meta("mimic-medication-request"),
+           "identifier": [{"system": f"{MIMIC_SYSTEM}/identifier/medrequest", "value": request_id[3:],
+                           "type": {"coding": [coding(f"{MIMIC_SYSTEM}/CodeSystem/mimic-medrequest-type", "POE", "Provider order entry")]}}],
+           "authoredOn": ts(day), "subject": {"reference": f"Patient/{patient_id}"}, "encounter": {"reference": f"Encounter/{encounter_id}"},
+           "dispenseRequest": {"validityPeriod": {"start": ts(day), "end": ts(day + 3)}}, "dosageInstruction": dosage,
+           "intent": "order", "status": "completed"}
+    if index % 2 == 0:
+        doc["medicationReference"] = {"reference": f"Medication/med-{index % MEDICATIONS}"}
+    else:
+        doc["medicationCodeableConcept"] = {"coding": [coding(f"{MIMIC_SYSTEM}/CodeSystem/mimic-medication-name", "Acetaminophen")]}
+    return doc
+
+def make_medication_dispense(dispense_id, patient_id, encounter_id, request_id, dosage, meta):
+    """
+    This fuction builds one MedicationDispense document for a MedicationRequest
+    Returns:
+        dict: the MedicationDispense
+    """
+    return {"resourceType": "MedicationDispense", "id": dispense_id, "meta": meta("mimic-medication-dispense"),
+            "identifier": [{"system": f"{MIMIC_SYSTEM}/identifier/meddispense", "value": dispense_id[3:]}],
+            "context": {"reference": f"Encounter/{encounter_id}"}, "subject": {"reference": f"Patient/{patient_id}"},
+            "authorizingPrescription": [{"reference": f"MedicationRequest/{request_id}"}],
+            "medicationCodeableConcept": {"coding": [coding(f"{MIMIC_SYSTEM}/CodeSystem/mimic-medication-name", "Acetaminophen")]},
+            "status": "completed", "dosageInstruction": dosage}
+
+def make_medication_administration(administration_id, patient_id, encounter_id, request_id, index, day, meta, ts):
+    """
+    This fuction builds one MedicationAdministration document, the variant (index % 3) decides the dosage fields and the effective time
+    Returns:
+        dict: the MedicationAdministration
+    """
+    variant = index % 3
+    dose = {"system": UNITS_SYSTEM, "value": 1.5 + variant}
+    if variant != 1:
+        dose.update({"code": "mL", "unit": "mL"})
+    dosage = {"dose": dose}
+    if variant == 0:
+        dosage["text"] = "bolus"
+    elif variant == 1:
+        dosage["method"] = {"coding": [coding(f"{MIMIC_SYSTEM}/CodeSystem/mimic-medadmin-method", "IV Push")]}
+    else:
+        dosage["rateQuantity"] = {"system": UNITS_SYSTEM, "unit": "mL/hour", "value": 100, "code": "mL/h"}
+    medication = coding(f"{MIMIC_SYSTEM}/CodeSystem/mimic-medication-itemid", str(225000 + index % 50), *(["NaCl 0.9%"] if variant else []))
+    doc = {"resourceType": "MedicationAdministration", "id": administration_id, "meta": meta("mimic-medication-administration"),
+           "status": "completed", "subject": {"reference": f"Patient/{patient_id}"}, "context": {"reference": f"Encounter/{encounter_id}"},
+           "request": {"reference": f"MedicationRequest/{request_id}"},
+           "category": {"coding": [coding(f"{MIMIC_SYSTEM}/CodeSystem/mimic-medadmin-category", "Intravenous")]},
+           "identifier": [{"system": f"{MIMIC_SYSTEM}/identifier/medadmin", "value": administration_id[3:],
+                           "type": {"coding": [coding(f"{MIMIC_SYSTEM}/CodeSystem/mimic-medadmin-type", "MAR", "Medication Administration Record")]}}],
+           "medicationCodeableConcept": {"coding": [medication]}, "dosage": dosage}
+    if variant == 2:
+        doc["effectivePeriod"] = {"start": ts(day), "end": ts(day + 1)}
+    else:
+        doc["effectiveDateTime"] = ts(day)
+    return doc
+
+def make_specimen(specimen_id, patient_id, index, day, meta, ts):
+    """
+    This fuction builds one Specimen document
+    Returns:
+        dict: the Specimen
+    """
+    doc = {"resourceType": "Specimen", "id": specimen_id, "meta": meta("mimic-specimen"),
+           "identifier": [{"system": f"{MIMIC_SYSTEM}/identifier/specimen", "value": specimen_id[5:]}],
+           "type": {"coding": [coding(f"{MIMIC_SYSTEM}/CodeSystem/mimic-specimen-type", "Blood", *(["Blood"] if index % 2 else []))]},
+           "subject": {"reference": f"Patient/{patient_id}"}}
+    if index % 2 == 0:
+        doc["collection"] = {"collectedDateTime": ts(day)}
+    return doc
+
+def make_observation(observation_id, patient_id, encounter_id, specimen_id, index, day, meta, ts):
+    """
+    This fuction builds one Observation document, the variant (index % 6) decides which value, range and reference fields it has
+    Returns:
+        dict: the Observation
+    """
+    variant = index % 6
+    doc = {"resourceType": "Observation", "id": observation_id, "meta": meta("mimic-observation-labevents"),
+           "status": "final", "subject": {"reference": f"Patient/{patient_id}"},
+           "category": [{"coding": [coding("http://terminology.hl7.org/CodeSystem/observation-category", "laboratory")]}],
+           "code": {"coding": [coding(f"{MIMIC_SYSTEM}/CodeSystem/mimic-d-labitems", str(50800 + index % 200), f"Lab {index % 200}")]},
+           "identifier": [{"system": f"{MIMIC_SYSTEM}/identifier/observation-labevents", "value": observation_id[4:]}],
+           "effectiveDateTime": ts(day), "issued": ts(day + 1)}
+    if variant % 2 == 0:
+        doc["encounter"] = {"reference": f"Encounter/{encounter_id}"}
+        doc["specimen"] = {"reference": f"Specimen/{specimen_id}"}
+    first = f"Observation/{observation_id.rsplit('-', 1)[0]}-{index - variant}"
+    if variant == 0:
+        doc["valueQuantity"] = {"system": UNITS_SYSTEM, "value": 4.2, "code": "mg/dL", "comparator": "<"}
+        doc["referenceRange"] = [{"low": {"system": UNITS_SYSTEM, "value": 1, "unit": "mg/dL", "code": "mg/dL"},
+                                  "high": {"system": UNITS_SYSTEM, "value": 5, "unit": "mg/dL", "code": "mg/dL"}}]
+        doc["interpretation"] = [{"coding": [coding("http://terminology.hl7.org/CodeSystem/v3-ObservationInterpretation", "H")]}]
+    elif variant == 1:
+        doc["valueString"] = "pos trace"
+        doc["note"] = [{"text": "hemolyzed specimen"}]
+    elif variant == 2:
+        doc["valueCodeableConcept"] = {"coding": [coding("http://snomed.info/sct", "260385009", "Negative")]}
+        doc["extension"] = [{"url": f"{MIMIC_SYSTEM}/StructureDefinition/lab-priority", "valueString": "ROUTINE"}]
+        doc["referenceRange"] = [{"high": {"system": UNITS_SYSTEM, "value": 9}}]
+    elif variant == 3:
+        doc["valueDateTime"] = ts(day)
+        doc["hasMember"] = [{"reference": first}]
+    elif variant == 4:
+        doc["derivedFrom"] = [{"reference": first}]
+        doc["valueQuantity"] = {"system": UNITS_SYSTEM, "value": 7}
+        doc["referenceRange"] = [{"low": {"system": UNITS_SYSTEM, "value": 2}}]
+    return doc
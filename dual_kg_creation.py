@@ -0,0 +1,229 @@
+#--------------------------------------------------------------
+#
+# This python file creates the fhir knowledge graph and the flattened knowledge graph in a single pass over the data
+#
+# Every document is read from mongoDB (or an NdjsonSource) once and rendered by both the fhir_kg_creation.py renderer
+# and the flattened_kg_creation.py renderer, the output is the same as running both create_ttl_script functions
+#
+#   create_both_ttl_scripts()
+#   create_both_ttl_scripts(concepts=True, shared_dosages=True, output_format="nt", compression="gzip", report="dual.csv")
+#
+# The output options of create_ttl_script are taken by both writers, the flattened only ones (shared_dosages, id_scheme)
+# by the flattened writer. The dual pass runs in one process and reads every pass once for both outputs, so it has no
+# workers, partitions, checkpoint, resume or incremental, run create_ttl_script of each module for those
+#
+# You need the fhir_kg_script.ttl and flattened_kg_script.ttl files
+#
+#----------------------------------------------------------------
+
+import os
+import time
+import fhir_kg_creation as fhir
+import flattened_kg_creation as flattened
+from fhir_kg_creation import ConceptNodes, DefinedNodes, RunMetrics, RunOptions, WRITE_BUFFER_SIZE, aggregate_resources, get_cohort
+from kg_compression import COMPRESSION_EXTENSIONS
+from kg_integrity import INTEGRITY_EXTENSION, IntegrityCheck, print_integrity_report
+from kg_patient_index import PATIENT_INDEX_EXTENSION, subject_patient
+from kg_triples import OUTPUT_FORMATS, TripleConverter, read_prefixes
+
+
+#(name printed in the terminal, fhir pipeline, fhir renderer, flattened pipeline, flattened renderer)
+#the entity templates are built from the writer they write to, the same way the create_*_entities functions of each module do
+#in the order the entities are written to both scripts, comment out any pass you do not want for test purposes
+DUAL_PASSES = [
+    ("organization", fhir.ORGANIZATION_PIPELINE, lambda writer: fhir.organization_renderer(writer.concepts),
+        flattened.ORGANIZATION_PIPELINE, lambda writer: flattened.organization_renderer(writer.concepts)),
+    ("location", fhir.LOCATION_PIPELINE, lambda writer: fhir.location_renderer(writer.concepts),
+        flattened.LOCATION_PIPELINE, lambda writer: flattened.location_renderer(writer.concepts)),
+    ("patient", fhir.PATIENT_PIPELINE, lambda writer: fhir.patient_renderer(),
+        flattened.PATIENT_PIPELINE, lambda writer: flattened.patient_renderer()),
+    ("encounter", fhir.ENCOUNTER_PIPELINE, lambda writer: fhir.encounter_renderer(writer.concepts),
+        flattened.ENCOUNTER_PIPELINE, lambda writer: flattened.encounter_renderer(writer.concepts, writer.id_scheme)),
+    ("procedure", fhir.PROCEDURE_PIPELINE, lambda writer: fhir.procedure_renderer(writer.concepts),
+        flattened.PROCEDURE_PIPELINE, lambda writer: flattened.procedure_renderer(writer.concepts)),
+    ("condition", fhir.CONDITION_PIPELINE, lambda writer: fhir.condition_renderer(writer.concepts),
+        flattened.CONDITION_PIPELINE, lambda writer: flattened.condition_renderer(writer.concepts)),
+    ("medication dispense", fhir.MEDICATION_DISPENSE_PIPELINE, lambda writer: fhir.medicationDispense_renderer(writer.concepts),
+        flattened.MEDICATION_DISPENSE_PIPELINE, lambda writer: flattened.medicationDispense_renderer(writer.concepts, writer.dosages, writer.id_scheme)),
+    ("medication request", fhir.MEDICATION_REQUEST_PIPELINE, lambda writer: fhir.medicationRequest_renderer(),
+        flattened.MEDICATION_REQUEST_PIPELINE, lambda writer: flattened.medicationRequest_renderer(writer.concepts, writer.dosages, writer.id_scheme)),
+    ("specimen", fhir.SPECIMEN_PIPELINE, lambda writer: fhir.specimen_renderer(writer.specimens),
+        flattened.SPECIMEN_PIPELINE, lambda writer: flattened.specimen_renderer(writer.specimens)),
+    ("medication", fhir.MEDICATION_PIPELINE, lambda writer: fhir.medication_renderer(),
+        flattened.MEDICATION_PIPELINE, lambda writer: flattened.medication_renderer(writer.concepts)),
+    ("medication administration", fhir.MEDICATION_ADMINISTRATION_PIPELINE, lambda writer: fhir.medicationAdministration_renderer(writer.compact, writer.concepts),
+        flattened.MEDICATION_ADMINISTRATION_PIPELINE, lambda writer: flattened.medicationAdministration_renderer(writer.compact, writer.concepts)),
+    ("observation", fhir.OBSERVATION_PIPELINE, lambda writer: fhir.observation_renderer(writer.compact, writer.concepts),
+        flattened.OBSERVATION_PIPELINE, lambda writer: flattened.observation_renderer(writer.compact, writer.concepts)),
+]
+
+
+def create_both_ttl_scripts(buffer_size=WRITE_BUFFER_SIZE, source=None, cohort=None, report=None, callback=None, compact=False, output_format="ttl", graph="resource_type", compression=None, concepts=False, shared_dosages=False, id_scheme="uuid5", patient_index=False, integrity=False):
+    """
+    This calls all needed functions to create fhir_final_script.ttl and flattened_final_script.ttl while reading every document once
+    Args:
+        buffer_size (int): size in bytes of the write buffer in front of each output file
+        source (object): where the fhir documents are read from, the mongoDB collection when None or an NdjsonSource to convert the ndjson files directly
+        cohort (object): only convert these Patient ids, or the Patients matching this mongoDB filter, and the documents they
+            reach through their references (see kg_cohort.py)
+        report (string): a .json or .csv file name, the RunMetrics of each output are written to it with _fhir or _flattened
+            added in front of the extension
+        callback (function): called with the metrics of every entity pass of each output as soon as the pass is done
+        compact (bool): leave the cosmetic whitespace out of the entities that are rendered from templates
+        output_format (string): "ttl", "nt" or "nq" for both outputs (see create_ttl_script)
+        graph (string): the named graphs of "nq", "resource_type" or "patient"
+        compression (string): "gzip" or "zstd" to compress both outputs while they are written
+        concepts (bool): link the codings of both outputs to concept nodes, each output defines its own
+        shared_dosages (bool): share the dosage instruction nodes of the flattened output
+        id_scheme (string): the generate_id scheme of the generated nodes of the flattened output
+        patient_index (bool): write the PatientIndex of both outputs next to them
+        integrity (bool): check the links of both outputs and write their reports next to them
+    Returns:
+        tuple: the RunMetrics of the fhir output and of the flattened output
+    """
+    time_start = time.time()
+    print("writing to files")
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"unknown output format {output_format}, use one of {', '.join(OUTPUT_FORMATS)}")
+    if id_scheme not in flattened.ID_SCHEMES:
+        raise ValueError(f"unknown id scheme {id_scheme}, use one of {', '.join(flattened.ID_SCHEMES)}")
+    with open('fhir_kg_script.ttl', 'r', encoding='utf-8') as file:
+        fhir_header = file.read()
+    with open('flattened_kg_script.ttl', 'r', encoding='utf-8') as file:
+        flattened_header = file.read()
+    def options(header, definition, dosages=None):
+        converter = TripleConverter(output_format, graph, read_prefixes(header)) if output_format != "ttl" else None
+        return RunOptions(buffer_size=buffer_size, source=source, compression=compression, compact=compact, converter=converter,
+                          concepts=ConceptNodes(definition) if concepts else None, dosages=dosages, id_scheme=id_scheme,
+                          patient_index=patient_index, integrity=integrity)
+    fhir_options = options(fhir_header, fhir.CONCEPT_DEFINITION)
+    flattened_options = options(flattened_header, flattened.CONCEPT_DEFINITION, DefinedNodes("dosage-", flattened.DOSAGE_INSTRUCTION) if shared_dosages else None)
+    #both outputs take the same settings, the checks of one hold for the other
+    fhir_options.check()
+    fhir_options.cohort = flattened_options.cohort = get_cohort(cohort, source)
+    extension = f"{OUTPUT_FORMATS[output_format]}{COMPRESSION_EXTENSIONS.get(compression, '')}"
+    fhir_metrics = RunMetrics(f"fhir_final_script{extension}", callback)
+    flattened_metrics = RunMetrics(f"flattened_final_script{extension}", callback)
+    outputs = [(fhir_options, fhir_metrics, fhir_header), (flattened_options, flattened_metrics, flattened_header)]
+    writers = []
+    for run_options, metrics, header in outputs:
+        writer = run_options.writer(metrics.output_path)
+        if patient_index:
+            writer.index_patients(metrics.output_path + PATIENT_INDEX_EXTENSION)
+        if integrity:
+            writer.integrity = IntegrityCheck(metrics.output_path + INTEGRITY_EXTENSION)
+        writers.append(writer)
+    fhir_writer, flattened_writer = writers
+    with fhir_writer, flattened_writer:
+        fhir_writer.write_header(fhir_header)
+        flattened_writer.write_header(flattened_header)
+        for name, fhir_pipeline, fhir_renderer, flattened_pipeline, flattened_renderer in DUAL_PASSES:
+            fhir_writer.start_section()
+            flattened_writer.start_section()
+            run_dual_entity_pass(fhir_writer, flattened_writer, name, merge_pipelines(fhir_pipeline, flattened_pipeline), fhir_renderer(fhir_writer), flattened_renderer(flattened_writer), source)
+            for writer, (run_options, metrics, header) in zip(writers, outputs):
+                for pass_metrics in writer.pass_metrics:
+                    metrics.add_pass(pass_metrics)
+                writer.pass_metrics = []
+        for writer, (run_options, metrics, header) in zip(writers, outputs):
+            metrics.add_output(writer.summary())
+    time_end = time.time()
+    for writer, (run_options, metrics, header) in zip(writers, outputs):
+        if writer.patients is not None:
+            writer.patients.save()
+        if writer.integrity is not None:
+            print_integrity_report(writer.integrity.finish())
+        metrics.finish(time_end - time_start)
+        print(f"{metrics.output_path}: {metrics.characters} characters, {metrics.line_count()} lines")
+    if report:
+        root, report_extension = os.path.splitext(report)
+        fhir_metrics.write_report(f"{root}_fhir{report_extension}")
+        flattened_metrics.write_report(f"{root}_flattened{report_extension}")
+    print(f"Scripts completed in {time_end - time_start:.4f} seconds")
+    return fhir_metrics, flattened_metrics
+
+def run_dual_entity_pass(fhir_writer, flattened_writer, name, pipeline, fhir_entity, flattened_entity, source=None):
+    """
+    This fuction runs one entity pass and writes every document to both knowledge graphs
+    The metrics of the pass are added to the pass_metrics of both writers, the read time is spent once and counted in both
+    Args:
+        fhir_writer (TtlWriter): where the fhir entities are written
+        flattened_writer (TtlWriter): where the flattened entities are written
+        name (string): the resource type as it is printed in the terminal
+        pipeline (list): the mongoDB pipeline that returns every field both renderers need
+        fhir_entity (Template): the template of the fhir knowledge graph entity of one document
+        flattened_entity (Template): the template of the flattened knowledge graph entity of one document
+        source (object): the document source, the mongoDB collection when None
+    """
+    time_start = time.perf_counter()
+    print(f"creating {name} entities")
+    writers = ((fhir_writer, fhir_entity), (flattened_writer, flattened_entity))
+    starts = [(writer.characters, writer.lines, writer.tell()) for writer, entity in writers]
+    documents = 0
+    entities = [0, 0]
+    read_seconds = 0.0
+    render_seconds = [0.0, 0.0]
+    write_seconds = [0.0, 0.0]
+    index_patients = fhir_writer.patients is not None or flattened_writer.patients is not None
+    #a Patient entity belongs to its own patient, the others to the patient of their subject
+    patient_pass = pipeline[0]["$match"].get("resourceType") == "Patient"
+    patient = None
+    cohort = fhir_writer.cohort
+    query = cohort.query(pipeline) if cohort is not None else None
+    read_start = time.perf_counter()
+    for result in aggregate_resources(pipeline, query, source):
+        read_end = time.perf_counter()
+        read_seconds += read_end - read_start
+        if index_patients:
+            patient = result.get("id") if patient_pass else subject_patient(result)
+        for index, (writer, entity) in enumerate(writers):
+            render_start = time.perf_counter()
+            insertion = writer.render(entity, result)
+            write_start = time.perf_counter()
+            render_seconds[index] += write_start - render_start
+            writer.write(insertion, patient)
+            write_seconds[index] += time.perf_counter() - write_start
+            if insertion:
+                entities[index] += 1
+        documents += 1
+        read_start = time.perf_counter()
+    read_seconds += time.perf_counter() - read_start
+    time_end = time.perf_counter()
+    for index, (writer, entity) in enumerate(writers):
+        characters_start, lines_start, bytes_start = starts[index]
+        writer.pass_metrics.append({
+            "name": name,
+            "documents": documents,
+            "entities": entities[index],
+            "characters": writer.characters - characters_start,
+            "lines": writer.lines - lines_start,
+            "bytes": writer.tell() - bytes_start,
+            "read_seconds": read_seconds,
+            "render_seconds": render_seconds[index],
+            "write_seconds": write_seconds[index],
+            "seconds": time_end - time_start,
+        })
+    print(f"{name} entity creation took {time_end - time_start:.4f} seconds")
+
+def merge_pipelines(fhir_pipeline, flattened_pipeline):
+    """
+    This fuction combines the pipelines of the same pass in both scripts, the $project fields are joined so one query serves both renderers
+    Args:
+        fhir_pipeline (list): the $match / $project pipeline of the fhir pass
+        flattened_pipeline (list): the $match / $project pipeline of the flattened pass
+    Returns:
+        list: a pipeline returning the documents and fields both renderers need
+    """
+    if fhir_pipeline == flattened_pipeline:
+        return fhir_pipeline
+    merged = []
+    for fhir_stage, flattened_stage in zip(fhir_pipeline, flattened_pipeline):
+        if "$project" in fhir_stage and "$project" in flattened_stage:
+            merged.append({"$project": {**fhir_stage["$project"], **flattened_stage["$project"]}})
+        elif fhir_stage == flattened_stage:
+            merged.append(fhir_stage)
+        else:
+            raise ValueError(f"the pipelines select different documents and cannot share a pass: {fhir_stage} {flattened_stage}")
+    if len(fhir_pipeline) != len(flattened_pipeline):
+        raise ValueError("the pipelines have a different number of stages and cannot share a pass")
+    return merged
@@ -6,58 +6,218 @@
 #
 # I query a local mongoDB database with the MIMIC IV FHIR Demo on it, to use my code you will need to upload a combined ndjson file into your local database 
 #
+# Or skip mongoDB and read the ndjson files directly with create_ttl_script(source=NdjsonSource(*folder of ndjson files*)) (see ndjson_source.py)
+#
+# To create this script and the flattened script in one read of the data use create_both_ttl_scripts() in dual_kg_creation.py
+#
+# The mongoDB connection (uri, database, pool size, read preference, timeouts) is set with configure_mongo()
+#
+# create_ttl_script(output_format="nt") or "nq" writes N-Triples or N-Quads instead of turtle (see kg_triples.py)
+# and create_ttl_script(compression="gzip") or "zstd" compresses the output while it is written (see kg_compression.py)
+# create_ttl_script(concepts=True) writes every coding system and code once as a concept node the entities link to (see ConceptNodes)
+#
+# create_ttl_script(patient_index=True) indexes the entities of every patient, extract_patient() in kg_patient_index.py cuts one out
+# create_ttl_script(integrity=True) reports the links to se: nodes that are never defined, check_integrity() in kg_integrity.py checks a written file
+# create_ttl_script(cohort=[*patient ids*]) converts only those patients and the documents they refer to (see kg_cohort.py)
+# get_schema_census() counts the resource types and fields in one scan, the exploration functions answer from its snapshot (see schema_census.py)
+#
 #----------------------------------------------------------------
 
 
-from pymongo import MongoClient
-import json 
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+import hashlib
+import multiprocessing
+import json
+import os
+import shutil
+import sys
+import tempfile
 import time
+from kg_compression import COMPRESSION_EXTENSIONS, compress_text, get_compression, open_output
+from kg_integrity import INTEGRITY_EXTENSION, IntegrityCheck, print_integrity_report
+from kg_patient_index import PATIENT_INDEX_EXTENSION, PatientIndex, subject_patient
+from kg_templates import Each, Section, Template, path_steps
+from kg_triples import OUTPUT_FORMATS, TripleBuilder, TripleConverter, escape_string, read_prefixes
+from ndjson_source import source_fingerprint
+
+
+#mongoDB connection settings, change them with configure_mongo() before the first query
+#nothing connects at import, the client is created the first time a query needs it
+MONGO_SETTINGS = {
+    "uri": "mongodb://localhost:27017/",
+    "database": "mimic",
+    "collection": "fhir",
+    "max_pool_size": 100,
+    "read_preference": "primary",
+    "server_selection_timeout_ms": 30000,
+    "connect_timeout_ms": 20000,
+    "socket_timeout_ms": None,
+    #entity passes read RawBSONDocuments, only the fields a renderer touches are ever decoded
+    "raw_bson": False,
+    #documents per cursor batch for the entity passes, None leaves it to the server
+    "batch_size": None,
+}
+
+#the shared client and the process it was created in, a worker process never reuses the pool of its parent
+mongo_client = None
+mongo_client_pid = None
+
+#size of the write buffer held in front of the output file, entities are flushed to disk in chunks of this size
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+#worker processes are spawned so they start from a clean interpreter, each one opens its own MongoClient on first use
+PROCESS_START_METHOD = "spawn"
+
+#the extension of the file next to a shard that holds the statements of the shared nodes its worker defined
+SHARED_STATEMENTS_EXTENSION = ".shared"
+
+#the largest passes, in parallel mode these are split into _id ranges that are converted on separate workers
+PARTITIONED_RESOURCE_TYPES = {
+    "create_medicationAdministration_entities": "MedicationAdministration",
+    "create_observation_entities": "Observation",
+}
+
+#documents written between two checkpoints when checkpointing is turned on
+CHECKPOINT_INTERVAL = 10000
+
+#the field incremental runs compare against the newest value of the last run, "_id" picks up inserted documents only
+WATERMARK_FIELD = "meta.lastUpdated"
 
-
-# Connect to MongoDB
-client = MongoClient("mongodb://localhost:27017/")
-
-# Access a database
-db = client["mimic"]
-collection = db["fhir"]
-
-
-#comment out any entity functions you do not want in the final script for test purposes
 #it takes roughly a minute to create the full script
-def create_ttl_script():
+def create_ttl_script(buffer_size=WRITE_BUFFER_SIZE, workers=1, partitions=None, source=None, checkpoint=False, resume=False, incremental=False, report=None, callback=None, compact=False, output_format="ttl", graph="resource_type", compression=None, concepts=False, cohort=None, patient_index=False, integrity=False):
     """
     This calls all needed functions to create the full knowledge graph and output it to fhir_final_script.ttl
+    Args:
+        buffer_size (int): size in bytes of the write buffer in front of fhir_final_script.ttl
+        workers (int): number of processes the entity passes are spread over, 1 runs them one after another
+        partitions (int): number of _id ranges the Observation and MedicationAdministration passes are split into in parallel mode, defaults to workers
+        source (object): where the fhir documents are read from, the mongoDB collection when None or an NdjsonSource to convert the ndjson files directly
+        checkpoint (bool): record progress in fhir_final_script.ttl.checkpoint.json so a failed run can be resumed (workers must be 1)
+        resume (bool): continue a failed run from its last checkpoint instead of starting over, starts over when there is no checkpoint
+        incremental (bool): only convert the documents whose WATERMARK_FIELD is newer than in the last incremental run and write them
+            to a fhir_final_script_delta_*time*.ttl file, the first incremental run writes the full fhir_final_script.ttl (workers must be 1)
+        report (string): a .json or .csv file the RunMetrics of the run are written to
+        callback (function): called with the metrics of every entity pass as soon as the pass is done
+        compact (bool): leave the indentation and blank lines out of the entities that are rendered from templates (Observation and MedicationAdministration)
+        output_format (string): "ttl" for turtle, "nt" for N-Triples or "nq" for N-Quads, the line based formats go to fhir_final_script.nt or .nq,
+            skolemize the blank nodes and can be split at any newline
+        graph (string): the named graphs of "nq", "resource_type" for one per resource type or "patient" for one per patient
+        compression (string): "gzip" or "zstd" to compress the output while it is written, to fhir_final_script.ttl.gz or .zst
+            (zstd needs the zstandard package), checkpoint and resume need an uncompressed output
+        concepts (bool): write every coding system and code once as a se:concept_*hash* node and link the entities to it instead of
+            repeating the coding in every entity (see ConceptNodes), parallel runs write every concept once as well
+        cohort (object): only convert these Patient ids, or the Patients matching this mongoDB filter, and the documents they
+            reach through their references (see kg_cohort.py)
+        patient_index (bool): write the byte ranges of the entities of every patient to fhir_final_script.ttl.patients so
+            extract_patient() can cut the graph of one patient out of the output (see kg_patient_index.py)
+        integrity (bool): check that every se: node the entities link to is defined in the output and report the dangling
+            links per predicate to fhir_final_script.ttl.integrity.json (see kg_integrity.py, workers must be 1)
+    Returns:
+        RunMetrics: documents, entities, bytes and timings of every entity pass and of the whole run
     """
     time_start = time.time()
-    with open("fhir_final_script.ttl", "w") as f:
-        f.write("")
     print("writing to file")
     with open('fhir_kg_script.ttl', 'r', encoding='utf-8') as file:
         ttl_string = file.read()
-    with open("fhir_final_script.ttl", "w") as f:
-        f.write(ttl_string)
-    create_organization_entities()
-    create_location_entities()
-    create_patient_entities()
-    create_encounter_entities()
-    create_procedure_entities()
-    create_condition_entities()
-    create_medicationDispense_entities()
-    create_medicationRequest_entities()
-    create_specimen_entities()
-    create_medication_entities()
-    create_medicationAdministration_entities()
-    create_observation_entities()
-    char_count = 0
-    line_count = 0
-    with open("fhir_final_script.ttl", "r", encoding="utf-8") as f:
-        for line in f:
-            line_count += 1
-            char_count += len(line)
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"unknown output format {output_format}, use one of {', '.join(OUTPUT_FORMATS)}")
+    converter = None
+    if output_format != "ttl":
+        converter = TripleConverter(output_format, graph, read_prefixes(ttl_string))
+    options = RunOptions(buffer_size=buffer_size, workers=workers, partitions=partitions, source=source, checkpoint=checkpoint, resume=resume,
+                         incremental=incremental, compression=compression, compact=compact, converter=converter, concepts=ConceptNodes(CONCEPT_DEFINITION) if concepts else None,
+                         patient_index=patient_index, integrity=integrity)
+    options.check()
+    options.cohort = get_cohort(cohort, source)
+    metrics = RunMetrics(f"fhir_final_script{OUTPUT_FORMATS[output_format]}{COMPRESSION_EXTENSIONS.get(compression, '')}", callback)
+    if workers > 1:
+        run_entity_passes_in_parallel(ENTITY_PASSES, metrics.output_path, ttl_string, options, metrics)
+    else:
+        metrics.output_path = run_entity_passes(ENTITY_PASSES, metrics.output_path, ttl_string, options, metrics)
     time_end = time.time()
+    metrics.finish(time_end - time_start)
     print(f"Script completed in {time_end - time_start:.4f} seconds")   
-    print(f"Character count: {char_count}")
-    print(f"Line count: {line_count}")
+    print(f"Character count: {metrics.characters}")
+    print(f"Line count: {metrics.line_count()}")
+    if report:
+        metrics.write_report(report)
+    return metrics
+
+
+#mongoDB connection functions
+
+def configure_mongo(**settings):
+    """
+    This fuction changes the mongoDB connection settings, the next query connects with the new settings
+    Args:
+        settings: any of the MONGO_SETTINGS keys (uri, database, collection, max_pool_size, read_preference,
+            server_selection_timeout_ms, connect_timeout_ms, socket_timeout_ms, raw_bson, batch_size)
+    """
+    unknown = settings.keys() - MONGO_SETTINGS.keys()
+    if unknown:
+        raise ValueError(f"unknown mongoDB settings: {', '.join(sorted(unknown))}")
+    MONGO_SETTINGS.update(settings)
+    close_mongo()
+
+def configure_mongo_from(settings):
+    """
+    This fuction applies a whole MONGO_SETTINGS dictionary, used to hand the settings to worker processes
+    Args:
+        settings (dict): the MONGO_SETTINGS of the parent process
+    """
+    configure_mongo(**settings)
+
+def get_mongo_client():
+    """
+    This fuction returns the MongoClient shared by everything in this process, creating it on first use
+    Returns:
+        MongoClient: the shared client
+    """
+    global mongo_client, mongo_client_pid
+    if mongo_client is None or mongo_client_pid != os.getpid():
+        from pymongo import MongoClient
+        mongo_client = MongoClient(
+            MONGO_SETTINGS["uri"],
+            maxPoolSize=MONGO_SETTINGS["max_pool_size"],
+            readPreference=MONGO_SETTINGS["read_preference"],
+            serverSelectionTimeoutMS=MONGO_SETTINGS["server_selection_timeout_ms"],
+            connectTimeoutMS=MONGO_SETTINGS["connect_timeout_ms"],
+            socketTimeoutMS=MONGO_SETTINGS["socket_timeout_ms"],
+        )
+        mongo_client_pid = os.getpid()
+    return mongo_client
+
+def get_mongo_collection():
+    """
+    This fuction returns the collection holding the fhir documents
+    Returns:
+        Collection: the mongoDB collection named in MONGO_SETTINGS
+    """
+    return get_mongo_client()[MONGO_SETTINGS["database"]][MONGO_SETTINGS["collection"]]
+
+def get_entity_collection():
+    """
+    This fuction returns the collection the entity passes read from, with lazily decoded RawBSONDocuments when raw_bson is set
+    Returns:
+        Collection: the mongoDB collection named in MONGO_SETTINGS
+    """
+    collection = get_mongo_collection()
+    if MONGO_SETTINGS["raw_bson"]:
+        from bson.codec_options import CodecOptions
+        from bson.raw_bson import RawBSONDocument
+        collection = collection.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+    return collection
+
+def close_mongo():
+    """
+    This fuction closes the shared MongoClient if this process opened one
+    """
+    global mongo_client, mongo_client_pid
+    if mongo_client is not None and mongo_client_pid == os.getpid():
+        mongo_client.close()
+    mongo_client = None
+    mongo_client_pid = None
 
 
 #database specific functions
@@ -71,16 +231,38 @@ def get_sample_from_resource_type(resource_type):
     Returns:
         str: sample json document
     """
-    sample = collection.find_one({
+    sample = get_mongo_collection().find_one({
         "resourceType": resource_type
     })
     print(json.dumps(sample, indent=2, default=str))
     return sample
 
+def get_schema_census(source=None):
+    """
+    This fuction counts the resource types and the fields of every resource type in one scan and saves them in a snapshot
+    that get_resource_type_list, get_fields_in_all_documents and get_distinct_fields answer from (see schema_census.py)
+    Args:
+        source (NdjsonSource): take the census of ndjson files instead of the mongoDB collection
+    Returns:
+        dict: the census
+    """
+    from schema_census import CENSUS_PATH, take_census
+    census = take_census(source)
+    print(f"Census of {census['documents']} documents saved in {CENSUS_PATH}")
+    for entry in census["types"]:
+        print(f"{entry['resource_type']}, Count: {entry['documents']}, Fields: {len(entry['fields'])}")
+    return census
+
 def get_resource_type_list():
     """
-    This function prints all resource types and the count in the mongoDB database
+    This function prints all resource types and the count in the mongoDB database, from the census when one was taken
     """
+    from schema_census import cached_census
+    census = cached_census()
+    if census is not None:
+        for entry in census["types"]:
+            print(f"{entry['resource_type']}, Count: {entry['documents']}")
+        return
     pipeline = [
         {
             "$group": {
@@ -93,15 +275,21 @@ def get_resource_type_list():
         }
     ]
     
-    results = collection.aggregate(pipeline)
+    results = get_mongo_collection().aggregate(pipeline)
     for result in results:
         print(f"{result['_id']}, Count: {result['count']}")
 
 def get_fields_in_all_documents():
     """
-    This function outputs fields in all documents in the mongoDB database
+    This function outputs fields in all documents in the mongoDB database, from the census when one was taken
     """
-    total_docs = collection.count_documents({})
+    from schema_census import cached_census, fields_in_all_documents
+    census = cached_census()
+    if census is not None:
+        for x in fields_in_all_documents(census):
+            print(x)
+        return
+    total_docs = get_mongo_collection().count_documents({})
     pipeline = [
     {
         "$project": {
@@ -125,123 +313,1312 @@ def get_fields_in_all_documents():
     ]
 
     # Step 3: Run pipeline and print results
-    fields_in_all_docs = collection.aggregate(pipeline)
+    fields_in_all_docs = get_mongo_collection().aggregate(pipeline)
     for x in fields_in_all_docs:
         print(x)
 
-def get_distinct_fields(resource_type):
+def get_distinct_fields(resource_type, sample=None, limit=None, source=None, workers=None):
     """
     This function prints all distinct fields in a given resource_type (fields become properties in the knowledge graph)
+    The paths are found inside mongoDB, or by worker processes for ndjson files (see field_profiling.py), a whole resource
+    type is answered from the census when one was taken (see schema_census.py)
     Args:
         resource_type (string): a value each document has that turns into classes in the knowledge graph
+        sample (int or float): profile a random sample of this many documents, or of this fraction of them when below 1,
+            and print the confidence bounds of the percentages, ndjson files are sampled by fraction only
+        limit (int): profile only the first documents, up to this many
+        source (NdjsonSource): profile ndjson files instead of the mongoDB collection
+        workers (int): number of processes profiling the ndjson files, defaults to the number of cpus
+    Returns:
+        dict: the profile, the number of documents and the count of every field path
     """
-    def extract_all_paths(doc, prefix=""):
-        paths = set()
-        if isinstance(doc, dict):
-            for key, value in doc.items():
-                current_path = f"{prefix}.{key}" if prefix else key
-                paths.add(current_path)
-            
-                if isinstance(value, (dict, list)):
-                    paths.update(extract_all_paths(value, current_path))
-                    
-        elif isinstance(doc, list):
-            for i, item in enumerate(doc):
-                current_path = f"{prefix}.{i}" if prefix else str(i)
-                if isinstance(item, (dict, list)):
-                    paths.update(extract_all_paths(item, current_path))
-                    
-        return paths
-
-    documents = collection.find({"resourceType": resource_type})
-    
-    field_counts = {}
-    total_docs = 0
-    
-    for doc in documents:
-        total_docs += 1
-        paths = extract_all_paths(doc)
-        for path in paths:
-            field_counts[path] = field_counts.get(path, 0) + 1
-
-    print(f"Field analysis for resourceType: {resource_type}")
-    print(f"Total documents analyzed: {total_docs}")
-    print("-" * 60)
-    
-    for field_path in sorted(field_counts.keys()):
-        count = field_counts[field_path]
-        percentage = (count / total_docs * 100) if total_docs > 0 else 0
-        print(f"{field_path:<40} | Count: {count:>4} | {percentage:>5.1f}%")
+    from field_profiling import print_field_table, profile_fields, profile_ndjson_fields
+    from schema_census import cached_census, census_profile
+    census = cached_census(source) if sample is None and limit is None else None
+    if census is not None:
+        profile = census_profile(census, resource_type)
+    elif source is None:
+        profile = profile_fields(resource_type, sample, limit)
+    else:
+        profile = profile_ndjson_fields(source, resource_type, sample, limit, workers)
+    print_field_table(profile)
+    return profile
 
 def collect_one_pipeline():
     """
     This fuction prints a document from a collect one pipeline. Use this to define specific fields you want to exist and see the json output.
     """
-    result = collection.find_one({"resourceType":"MedicationDispense","authorizingPrescription":{"$exists":True}})
+    result = get_mongo_collection().find_one({"resourceType":"MedicationDispense","authorizingPrescription":{"$exists":True}})
 
     print(json.dumps(result, indent=2, default=str))
 
-def get_unique_values_by_field(resource_type, field_path, collection):
-
-    documents = collection.find({"resourceType": resource_type})
-    keys = field_path.split(".")
-    unique_values = set()
-    count = 0
-
-    for doc in documents:
-        count += 1
-        value = doc
-        for key in keys:
-            if isinstance(value, list):
-                try:
-                    key = int(key)
-                except ValueError:
-                    value = None
-                    break
-            try:
-                value = value[key]
-            except (KeyError, IndexError, TypeError):
-                value = None
-                break
-        if value is not None:
-            unique_values.add(value)
+def get_unique_values_by_field(resource_type, field_path, collection=None, approximate=False, top=10):
+    """
+    This fuction prints the unique values of a field in a given resource_type, grouped inside mongoDB (see field_profiling.py)
+    Args:
+        resource_type (string): a value each document has that turns into classes in the knowledge graph
+        field_path (string): dotted path of the field, numbers index into lists (code.coding.0.code)
+        collection (object): the mongoDB collection, the one in MONGO_SETTINGS when None, or an NdjsonSource
+        approximate (bool): only estimate the number of distinct values and print the most frequent ones, in fixed memory
+            for fields like valueQuantity.value that have too many values to keep
+        top (int): the number of most frequent values of the approximate mode
+    Returns:
+        set: the unique values, or the approximate profile dict in approximate mode
+    """
+    from field_profiling import print_value_table, profile_values
+    profile = profile_values(resource_type, field_path, collection, approximate, top)
+    print_value_table(profile)
+    if approximate:
+        return profile
+    return set(profile["values"])
+
+
+#file writing and sanatization functions
+
+class RunOptions:
+    """
+    This class holds the settings of one conversion run, one object is handed from create_ttl_script to the entity passes, the
+    worker processes and the writers they open
+    Args:
+        buffer_size (int): size in bytes of the write buffer in front of the output and of every shard
+        workers (int): number of processes the entity passes are spread over, 1 runs them one after another
+        partitions (int): number of _id ranges the passes in PARTITIONED_RESOURCE_TYPES are split into in parallel mode, defaults to workers
+        source (object): the document source, the mongoDB collection when None
+        checkpoint (bool): save a Checkpoint every CHECKPOINT_INTERVAL documents and after every pass
+        resume (bool): continue from the checkpoint of a failed run, the output is cut back to the size it had at that checkpoint
+        incremental (bool): keep Watermarks next to the output, once they exist only newer documents are converted into a delta file
+        compression (string): "gzip" or "zstd" when the output is compressed while it is written, None otherwise
+        compact (bool): render the entities without cosmetic whitespace
+        converter (TripleConverter): writes N-Triples or N-Quads lines instead of turtle, None writes turtle
+        concepts (ConceptNodes): link the codings to concept nodes, None writes them inline
+        dosages (DefinedNodes): share the dosage instruction nodes of the flattened graph, None writes one per resource
+        id_scheme (string): the generate_id scheme of the generated nodes of the flattened graph
+        cohort (Cohort): only convert the documents of this cohort, None converts every document
+        patient_index (bool): write the PatientIndex of the output next to it
+        integrity (bool): check the links of the output with an IntegrityCheck and write its report next to it
+    """
+    def __init__(self, buffer_size=WRITE_BUFFER_SIZE, workers=1, partitions=None, source=None, checkpoint=False, resume=False, incremental=False,
+                 compression=None, compact=False, converter=None, concepts=None, dosages=None, id_scheme="uuid5", cohort=None, patient_index=False, integrity=False):
+        self.buffer_size = buffer_size
+        self.workers = workers
+        self.partitions = partitions or workers
+        self.source = source
+        self.checkpoint = checkpoint
+        self.resume = resume
+        self.incremental = incremental
+        self.compression = compression
+        self.compact = compact
+        self.converter = converter
+        self.concepts = concepts
+        self.dosages = dosages
+        self.id_scheme = id_scheme
+        self.cohort = cohort
+        self.patient_index = patient_index
+        self.integrity = integrity
+
+    def check(self):
+        """
+        This fuction raises a ValueError for settings that do not work together, before anything is written
+        """
+        if self.compression is not None and self.compression not in COMPRESSION_EXTENSIONS:
+            raise ValueError(f"unknown compression {self.compression}, use gzip or zstd")
+        if self.patient_index and self.compression is not None:
+            raise ValueError("the patient index holds byte ranges, it needs an uncompressed output")
+        if self.workers > 1:
+            if self.checkpoint or self.resume or self.incremental:
+                raise ValueError("checkpoint, resume and incremental need workers=1")
+            if self.integrity:
+                raise ValueError("the integrity check needs workers=1, check the output of a parallel run with check_integrity()")
+        if self.incremental:
+            if self.checkpoint or self.resume:
+                raise ValueError("incremental runs cannot be checkpointed or resumed")
+            if self.integrity:
+                raise ValueError("a delta file links to entities of earlier runs, check the links of a full run instead")
+        if self.patient_index and self.resume:
+            raise ValueError("the patient index is built while the output is written from the start, it cannot be resumed")
+        if self.integrity and self.resume:
+            raise ValueError("the integrity check reads the output while it is written from the start, check a resumed run with check_integrity()")
+
+    def writer(self, path, mode="w"):
+        """
+        This fuction opens a TtlWriter with the settings of the run
+        Args:
+            path (string): the output or shard file
+            mode (string): "w" to start a new file or "a" to append to an existing one
+        Returns:
+            TtlWriter: the writer, its cohort is set as well
+        """
+        writer = TtlWriter(path, mode=mode, buffer_size=self.buffer_size, compact=self.compact, converter=self.converter, concepts=self.concepts,
+                           dosages=self.dosages, id_scheme=self.id_scheme)
+        writer.cohort = self.cohort
+        return writer
 
-    print(f"\nUnique values for '{field_path}' (found in {count} documents):")
-    for v in unique_values:
-        print(f"  - {v}")
+class TtlWriter:
+    """
+    This class holds a single open handle on the output ttl file so every entity is written straight to the final script
+    Args:
+        path (string): the ttl file the knowledge graph is written to, compressed while it is written when it ends in .gz or .zst
+        mode (string): "w" to start a new file or "a" to append to an existing one
+        buffer_size (int): size in bytes of the write buffer in front of the file
+        compact (bool): the renderers of the passes written through this writer leave out cosmetic whitespace
+        converter (TripleConverter): writes the triples of the entity templates as N-Triples or N-Quads lines, None writes the turtle of their layouts
+        concepts (ConceptNodes): the concept nodes the renderers of the passes link codings to, None writes the codings inline
+        dosages (DefinedNodes): the nodes the flattened renderers give dosage instructions with the same contents, None writes one per resource
+        id_scheme (string): the generate_id scheme of the nodes the flattened renderers make ids for (see flattened_kg_creation.py)
+    """
+    def __init__(self, path, mode="w", buffer_size=WRITE_BUFFER_SIZE, compact=False, converter=None, concepts=None, dosages=None, id_scheme="uuid5"):
+        self.path = path
+        self.file = open_output(path, mode, buffer_size)
+        self.compact = compact
+        self.converter = converter
+        self.concepts = concepts
+        self.dosages = dosages
+        self.id_scheme = id_scheme
+        #the DefinedNodes whose new nodes are written behind the entities, in the order their statements are written
+        self.defined = [nodes for nodes in (dosages, concepts) if nodes is not None]
+        #the Checkpoint recording the progress of this file, None when checkpointing is off
+        self.checkpoint = None
+        #the Watermarks of an incremental run, None otherwise
+        self.watermarks = None
+        #the Cohort the passes are kept to, None converts every document
+        self.cohort = None
+        #the PatientIndex recording the entities of every patient, None when no index is built
+        self.patients = None
+        #the SharedStatements the statements of new shared nodes go to instead of the output, set for the shards of a parallel run
+        self.shared = None
+        #the IntegrityCheck taking the triples of the entities, None when the links are not checked
+        self.integrity = None
+        #the TripleBuilder the triples of a turtle output are emitted with for the IntegrityCheck, made by write_header
+        self.builder = None
+        #the Specimen ids written so far, the Specimen pass writes every id once
+        self.specimens = SharedNodes("specimen-")
+        #counted as the text is written, so the output never has to be read again
+        self.characters = 0
+        self.lines = 0
+        self.last_character = ""
+        #the metrics of every entity pass written through this writer, added by run_entity_pass
+        self.pass_metrics = []
+
+    def render(self, entity, document):
+        """
+        This fuction converts one document into the output format, the turtle of the layout of its template or the lines of its triples
+        Args:
+            entity (Template): the entity template of the pass
+            document (dict): the document
+        Returns:
+            str: the entity, empty when the document has none
+        """
+        if self.converter is None:
+            if self.integrity is not None:
+                #the turtle keeps its layout, the check takes the triples the same template emits
+                self.integrity.scan(self.builder.emit(entity, document))
+            return entity.render(document)
+        triples = self.converter.triples(entity, document)
+        if self.integrity is not None:
+            self.integrity.scan(triples)
+        return self.converter.convert(triples)
+
+    def write(self, insertion, patient=None):
+        """
+        This fuction writes a string to the output file through the buffer, the shared nodes the entity linked to for the first
+        time are written behind it
+        Args:
+            insertion (string): a string of text in the output format, whole statements or lines
+            patient (string): the patient id the text belongs to, recorded when the writer builds a patient index
+        """
+        self.write_output(insertion, patient)
+        for nodes in self.defined:
+            if nodes.definitions and self.shared is not None:
+                #the shard is cut here, the parent puts the statements of the nodes no earlier shard defined in the cut
+                position, file_position = self.cut()
+                for document in nodes.take_definitions():
+                    self.shared.add(position, file_position, document["node"], self.render(nodes.definition, document))
+            elif nodes.definitions:
+                #a shared node is written on its own, the fragment of every patient that links to it takes its statement
+                for document in nodes.take_definitions():
+                    self.write_output(self.render(nodes.definition, document), node=document["node"])
+            if nodes.links is not None:
+                self.patients.link(patient, nodes.take_links())
+
+    def index_patients(self, path=None):
+        """
+        This fuction starts the PatientIndex of the output, the shared nodes start recording the entities that link to them
+        Args:
+            path (string): the index file, None for a shard whose index is merged into the index of the output
+        """
+        self.patients = PatientIndex(path)
+        for nodes in self.defined:
+            nodes.links = []
 
-    return unique_values
+    def write_header(self, header):
+        """
+        This fuction writes the ontology header to the output file
+        Args:
+            header (string): the ontology header
+        """
+        if self.integrity is not None:
+            self.integrity.header(header)
+            if self.converter is None:
+                self.builder = TripleBuilder(read_prefixes(header))
+        if self.converter is not None:
+            header = self.converter.convert_header(header)
+        if self.patients is not None:
+            self.patients.header(header)
+        self.write_output(header)
+
+    def write_output(self, insertion, patient=None, node=None):
+        """
+        This fuction writes text that is already in the output format and counts it
+        Args:
+            insertion (string): a string of text
+            patient (string): the patient id the text belongs to
+            node (string): the shared node the text defines
+        """
+        if insertion:
+            self.file.write(insertion)
+            self.characters += len(insertion)
+            self.lines += insertion.count("\n")
+            self.last_character = insertion[-1]
+            if self.patients is not None:
+                self.patients.advance(insertion, patient, node)
+
+    def start_section(self):
+        """
+        This fuction starts the block of a new resource type in the output file, with a blank line in turtle
+        """
+        if self.converter is None:
+            self.write("\n")
+
+    def cut(self):
+        """
+        This fuction ends what is written so far where the file can be cut, after a complete member or frame when it is compressed
+        Returns:
+            tuple: the number of bytes written before compression and the size of the file
+        """
+        self.file.flush()
+        return self.file.tell(), os.fstat(self.file.fileno()).st_size
 
+    def tell(self):
+        """
+        This fuction returns the number of bytes written to the output file so far, before compression
+        Returns:
+            int: the size in bytes
+        """
+        return self.file.tell()
 
-#file writing and sanatization functions
+    def summary(self):
+        """
+        This fuction returns what has been written through this writer
+        Returns:
+            dict: characters, newlines, the last character, bytes and the metrics of the entity passes
+        """
+        return {"characters": self.characters, "lines": self.lines, "last_character": self.last_character, "bytes": self.tell(), "passes": self.pass_metrics}
+
+    def sync(self):
+        """
+        This fuction pushes everything written so far to disk
+        Returns:
+            int: the size in bytes of the output file
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def close(self):
+        """
+        This fuction flushes the buffer and closes the output file
+        """
+        self.file.close()
+        if self.shared is not None:
+            self.shared.close()
+
+    def __enter__(self):
+        return self
 
-def write_to_middle(insertion):
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class SharedStatements:
     """
-    appends string to middle_man.txt
+    This class keeps the statements of the shared nodes a parallel worker defines out of its shard, in a file next to it, so
+    the parent writes every node once, in the shard that defines it first and where a serial run would (see merge_shards)
+    Every statement is a line *position*<tab>*file position*<tab>*node*<tab>*size* followed by its text, the position is where
+    the text belongs in the shard before compression and the file position where the shard file is cut for it
     Args:
-        insertion (string): a string of text
+        path (string): the file of the statements
     """
-    with open("middle_man.txt", "a") as f:
-            f.write(insertion)
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb")
+
+    def add(self, position, file_position, node, text):
+        """
+        This fuction records the statement of a node
+        Args:
+            position (int): where the statement belongs in the shard, in bytes before compression
+            file_position (int): where the shard file is cut for it
+            node (string): the node the statement defines
+            text (string): the statement in the output format
+        """
+        data = text.encode("utf-8")
+        self.file.write(f"{position}\t{file_position}\t{node}\t{len(data)}\n".encode("utf-8") + data)
+
+    def close(self):
+        """
+        This fuction closes the file
+        """
+        self.file.close()
 
-def clear_middle():
+def read_shared_statements(path):
     """
-    This fuction empties the text file middle_man.txt
+    This fuction reads the statements a SharedStatements wrote
+    Args:
+        path (string): the file of the statements
+    Returns:
+        iterator: position, file position, node and text of every statement, in the order they were written
     """
-    with open("middle_man.txt", "w") as f:
-            f.write("")
+    with open(path, "rb") as file:
+        for line in file:
+            position, file_position, node, size = line.decode("utf-8").split("\t")
+            yield int(position), int(file_position), node, file.read(int(size)).decode("utf-8")
 
-def move_to_final():
+class SharedNodes:
     """
-    This function appends middle_man.txt to fhir_final_script.ttl then clears middle_man.txt
+    This class gives every distinct content one node, so content repeated by many entities is written once and the entities link to it
+    The node is *prefix**hash of the content*, the same in every run and in every worker, and only the 8 byte hash of the content
+    already written is kept, as an int, so millions of nodes fit in little memory
+    Args:
+        prefix (string): start of the node ids
     """
-    with open("middle_man.txt", "r", encoding="utf-8") as txt_file:
-        content = txt_file.read()
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.seen = set()
+        #the hashes added since the Checkpoint last saved them, None when no checkpoint keeps them
+        self.journal = None
 
-    with open("fhir_final_script.ttl", "a", encoding="utf-8") as ttl_file:
-        ttl_file.write("\n")
-        ttl_file.write(content)
-    clear_middle()
+    def node(self, content):
+        """
+        This fuction returns the node id of a content
+        Args:
+            content (string): the content, equal contents get the same node
+        Returns:
+            tuple: the node id and True when the content is new, so its statement still has to be written
+        """
+        digest = hashlib.blake2b(content.encode("utf-8"), digest_size=8).digest()
+        key = int.from_bytes(digest, "big")
+        if key in self.seen:
+            return f"{self.prefix}{digest.hex()}", False
+        self.seen.add(key)
+        if self.journal is not None:
+            self.journal.append(key)
+        return f"{self.prefix}{digest.hex()}", True
+
+class DefinedNodes(SharedNodes):
+    """
+    This class is a SharedNodes whose nodes are defined by a statement of their own, the writer writes the statement of a new
+    node behind the entity that linked to it first, outside the byte range of the patient of that entity (see kg_patient_index.py)
+    Args:
+        prefix (string): start of the node ids
+        definition (Template): the statement of a new node, rendered by the writer on a document with its node
+    """
+    def __init__(self, prefix, definition):
+        super().__init__(prefix)
+        self.definition = definition
+        #documents of the nodes minted since the writer last took them
+        self.definitions = []
+        #the nodes linked to since the writer last took them, None when no patient index asks for them
+        self.links = None
+
+    def define(self, content, document):
+        """
+        This fuction returns the node of a content, the statement of the node is queued for the writer when the content is new
+        Args:
+            content (string): the content, equal contents get the same node
+            document (dict): the document the definition is rendered on, the node is added to it
+        Returns:
+            str: the node id
+        """
+        node, new = self.node(content)
+        if new:
+            self.definitions.append(dict(document, node=node))
+        if self.links is not None:
+            self.links.append(node)
+        return node
+
+    def take_definitions(self):
+        """
+        This fuction hands over the nodes minted since the last call
+        Returns:
+            list: the documents the definition template is rendered on
+        """
+        definitions = self.definitions
+        self.definitions = []
+        return definitions
+
+    def take_links(self):
+        """
+        This fuction hands over the nodes linked to since the last call
+        Returns:
+            list: the node ids, empty when the links are not recorded
+        """
+        links = self.links or []
+        if self.links is not None:
+            self.links = []
+        return links
+
+class ConceptNodes(DefinedNodes):
+    """
+    This class mints one node per coding system and code, so a code shared by many entities is written once and the entities link to it
+    The node of a concept is se:concept_*hash of system and code* (see SharedNodes)
+    Args:
+        definition (Template): the statement of a new concept node, rendered by the writer on a document with its node, system,
+            code and display
+    """
+    def __init__(self, definition):
+        super().__init__("concept_", definition)
+
+    def link(self, coding):
+        """
+        This fuction returns the node of the concept of a coding, defining the node when the concept is new
+        Args:
+            coding (dict): a fhir coding with system, code and display
+        Returns:
+            str: the node, se:concept_*hash*
+        """
+        system = str(coding.get('system', ''))
+        code = str(coding.get('code', ''))
+        return "se:" + self.define(f"{system}\n{code}", {"system": system, "code": code, "display": coding.get('display')})
+
+#the columns of a RunMetrics csv report, one row per entity pass and a total row
+PASS_METRIC_FIELDS = ["name", "documents", "entities", "characters", "lines", "bytes", "read_seconds", "render_seconds", "write_seconds", "seconds"]
+
+class RunMetrics:
+    """
+    This class collects what one create_ttl_script run did, per entity pass and for the whole output file
+    Every pass records documents read, entities emitted, characters, lines and bytes written, and the seconds spent
+    reading from the source (mongoDB wait), rendering and writing; passes split into _id ranges are added up
+    Args:
+        output_path (string): the ttl file being written
+        callback (function): called with the metrics of every entity pass as soon as the pass is done
+    """
+    def __init__(self, output_path, callback=None):
+        self.output_path = output_path
+        self.callback = callback
+        #pass name -> metrics, in the order the passes finished
+        self.passes = {}
+        self.characters = 0
+        self.lines = 0
+        self.last_character = ""
+        self.bytes = 0
+        self.seconds = 0.0
+        self.peak_rss_kb = None
+        self.peak_worker_rss_kb = None
+
+    def add_pass(self, pass_metrics):
+        """
+        This fuction adds the metrics of one entity pass (or one _id range of it)
+        Args:
+            pass_metrics (dict): the PASS_METRIC_FIELDS of the pass
+        """
+        name = pass_metrics["name"]
+        if name in self.passes:
+            total = self.passes[name]
+            for field in PASS_METRIC_FIELDS[1:]:
+                total[field] += pass_metrics[field]
+        else:
+            self.passes[name] = dict(pass_metrics)
+        if self.callback is not None:
+            self.callback(pass_metrics)
+
+    def add_output(self, summary):
+        """
+        This fuction adds the text written by one writer, in the order it appears in the output file
+        Args:
+            summary (dict): characters, lines, last_character and bytes like TtlWriter.summary() returns
+        """
+        self.characters += summary["characters"]
+        self.lines += summary["lines"]
+        self.bytes += summary["bytes"]
+        if summary["last_character"]:
+            self.last_character = summary["last_character"]
+
+    def finish(self, seconds):
+        """
+        This fuction records the run time and the peak memory of the run
+        Args:
+            seconds (float): how long the run took
+        """
+        self.seconds = seconds
+        self.peak_rss_kb, self.peak_worker_rss_kb = get_peak_rss()
+
+    def line_count(self):
+        """
+        This fuction counts the lines of the output file the way reading it line by line would
+        Returns:
+            int: the number of lines
+        """
+        if self.last_character and self.last_character != "\n":
+            return self.lines + 1
+        return self.lines
+
+    def to_dict(self):
+        """
+        This fuction returns the metrics as plain values
+        Returns:
+            dict: the whole run with a list of the entity passes
+        """
+        return {
+            "output": self.output_path,
+            "seconds": self.seconds,
+            "characters": self.characters,
+            "lines": self.line_count(),
+            "bytes": self.bytes,
+            "peak_rss_kb": self.peak_rss_kb,
+            "peak_worker_rss_kb": self.peak_worker_rss_kb,
+            "passes": list(self.passes.values()),
+        }
+
+    def write_report(self, path):
+        """
+        This fuction writes the metrics to a .json file, or to a .csv file with one row per entity pass and a total row
+        Args:
+            path (string): the report file
+        """
+        if path.endswith(".csv"):
+            import csv
+            with open(path, "w", encoding="utf-8", newline="") as file:
+                report = csv.DictWriter(file, fieldnames=PASS_METRIC_FIELDS)
+                report.writeheader()
+                for pass_metrics in self.passes.values():
+                    report.writerow(pass_metrics)
+                total = {field: sum(pass_metrics[field] for pass_metrics in self.passes.values()) for field in PASS_METRIC_FIELDS[1:]}
+                total.update({"name": "total", "characters": self.characters, "lines": self.line_count(), "bytes": self.bytes, "seconds": self.seconds})
+                report.writerow(total)
+        else:
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump(self.to_dict(), file, indent=2)
+
+def get_peak_rss():
+    """
+    This fuction reads the peak resident memory of this process and of its finished worker processes
+    Returns:
+        tuple: (this process, the largest worker) in kilobytes, None where the platform does not report it
+    """
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    #linux reports kilobytes, macOS bytes
+    scale = 1024 if sys.platform == "darwin" else 1
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale
+    workers = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale
+    return own, workers or None
+
+class Checkpoint:
+    """
+    This class records how far a serial run got, so a run that died can be resumed instead of started over
+    The checkpoint holds the pass in progress, the _id of the last document written by it and the byte size of the output at that point
+    The hashes of the SharedNodes of the writer (concepts, dosage instructions, Specimens) are appended to a file per set at
+    every checkpoint, a resumed run reads them back so the nodes written before the checkpoint are not written again
+    Args:
+        output_path (string): the ttl file being written, the checkpoint is kept next to it
+        pass_names (list): names of the entity passes of the run, a checkpoint of a different list of passes is not resumed
+        interval (int): documents written between two checkpoints
+        fingerprint (list): the NdjsonSource fingerprint the _ids belong to, a checkpoint of other files is not resumed
+    """
+    def __init__(self, output_path, pass_names, interval=CHECKPOINT_INTERVAL, fingerprint=None):
+        self.path = output_path + ".checkpoint.json"
+        self.pass_names = pass_names
+        self.interval = interval
+        self.fingerprint = fingerprint
+        self.pass_index = 0
+        self.last_id = None
+        self.offset = 0
+        #the writer counters at the checkpoint, a resumed writer continues from them
+        self.written = {}
+        #name of a SharedNodes of the writer -> hashes of it saved in its file
+        self.seen = {}
+        self.count = 0
+
+    def load(self):
+        """
+        This fuction reads the checkpoint left behind by a failed run
+        Returns:
+            bool: True when there is a checkpoint to resume from
+        """
+        from bson import json_util
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, "r", encoding="utf-8") as file:
+            state = json_util.loads(file.read())
+        if state["passes"] != self.pass_names:
+            raise ValueError(f"{self.path} was written by a run with different entity passes, remove it to start over")
+        #the _ids of ndjson documents are positions in the files, they point somewhere else once the files change
+        if state.get("fingerprint") != self.fingerprint:
+            raise ValueError(f"{self.path} was written by a run on other ndjson files, remove it to start over")
+        self.pass_index = state["pass_index"]
+        self.last_id = state["last_id"]
+        self.offset = state["offset"]
+        self.written = state["written"]
+        self.seen = state.get("seen", {})
+        return True
+
+    def shared_nodes(self, writer):
+        """
+        This fuction names the SharedNodes of a writer whose hashes the checkpoint keeps
+        Args:
+            writer (TtlWriter): the writer of the output file
+        Returns:
+            dict: name -> SharedNodes
+        """
+        shared = {"specimens": writer.specimens}
+        if writer.concepts is not None:
+            shared["concepts"] = writer.concepts
+        if writer.dosages is not None:
+            shared["dosages"] = writer.dosages
+        return shared
+
+    def seen_path(self, name):
+        """
+        This fuction names the file the hashes of a SharedNodes are saved in
+        Args:
+            name (string): the name shared_nodes() gives the set
+        Returns:
+            string: *output name*.checkpoint.*name*
+        """
+        return f"{self.path[:-len('.json')]}.{name}"
+
+    def attach(self, writer, resumed=False):
+        """
+        This fuction starts keeping the hashes of the SharedNodes of a writer, a resumed run first reads back the saved ones
+        Args:
+            writer (TtlWriter): the writer of the output file
+            resumed (bool): the checkpoint was loaded, otherwise the files of an earlier run are emptied
+        """
+        shared = self.shared_nodes(writer)
+        if resumed and set(self.seen) != set(shared):
+            raise ValueError(f"{self.path} was written by a run with other shared nodes (concepts or shared dosages), remove it to start over")
+        for name, nodes in shared.items():
+            path = self.seen_path(name)
+            count = self.seen.get(name, 0) if resumed else 0
+            with open(path, "a+b") as file:
+                #hashes saved after the last checkpoint belong to output that was cut off
+                file.truncate(count * 8)
+                file.seek(0)
+                hashes = array("Q")
+                hashes.fromfile(file, count)
+            nodes.seen.update(hashes)
+            nodes.journal = array("Q")
+            self.seen[name] = count
+        writer.checkpoint = self
+
+    def save(self, writer):
+        """
+        This fuction syncs the output and then replaces the checkpoint file in one step, so it never points past what is on disk
+        Args:
+            writer (TtlWriter): the writer of the output file
+        """
+        from bson import json_util
+        self.offset = writer.sync()
+        self.written = {"characters": writer.characters, "lines": writer.lines, "last_character": writer.last_character}
+        for name, nodes in self.shared_nodes(writer).items():
+            if nodes.journal:
+                with open(self.seen_path(name), "ab") as file:
+                    nodes.journal.tofile(file)
+                    file.flush()
+                    os.fsync(file.fileno())
+                self.seen[name] += len(nodes.journal)
+                nodes.journal = array("Q")
+        state = {"passes": self.pass_names, "pass_index": self.pass_index, "last_id": self.last_id, "offset": self.offset, "written": self.written,
+                 "fingerprint": self.fingerprint, "seen": self.seen}
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            file.write(json_util.dumps(state))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+
+    def document_written(self, writer, document_id):
+        """
+        This fuction notes a document of the current pass as written, every interval documents a checkpoint is saved
+        Args:
+            writer (TtlWriter): the writer of the output file
+            document_id (object): the _id of the document
+        """
+        self.last_id = document_id
+        self.count += 1
+        if self.count % self.interval == 0:
+            self.save(writer)
+
+    def finish_pass(self, writer):
+        """
+        This fuction saves a checkpoint at the start of the next pass
+        Args:
+            writer (TtlWriter): the writer of the output file
+        """
+        self.pass_index += 1
+        self.last_id = None
+        self.count = 0
+        self.save(writer)
+
+    def resume_query(self):
+        """
+        This fuction returns the condition that skips the documents the current pass already wrote
+        Returns:
+            dict: {"_id": {"$gt": last _id}}, or None when the pass has not written anything yet
+        """
+        if self.last_id is None:
+            return None
+        return {"_id": {"$gt": self.last_id}}
+
+    def remove(self):
+        """
+        This fuction deletes the checkpoint and its files of hashes once the run has finished
+        """
+        for name in self.seen:
+            if os.path.exists(self.seen_path(name)):
+                os.remove(self.seen_path(name))
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class Watermarks:
+    """
+    This class keeps, for every entity pass, the newest WATERMARK_FIELD value converted so far
+    An incremental run only converts the documents newer than the watermarks of the run before it
+    Args:
+        output_path (string): the full ttl file, the watermarks are kept next to it and delta files are named after it
+        field (string): the dotted path that is compared, meta.lastUpdated or _id
+        fingerprint (list): the NdjsonSource fingerprint the _ids belong to, _id watermarks are only used on the same files or
+            on files that were added behind them
+    """
+    def __init__(self, output_path, field=WATERMARK_FIELD, fingerprint=None):
+        self.output_path = output_path
+        self.path = output_path + ".watermarks.json"
+        self.field = field
+        self.fingerprint = fingerprint
+        #pass name -> newest value of the last run, what this run filters on
+        self.previous = {}
+        #pass name -> newest value seen so far, saved at the end of the run
+        self.marks = {}
+
+    def load(self):
+        """
+        This fuction reads the watermarks of the last incremental run
+        Returns:
+            bool: True when there are watermarks, False on the first incremental run
+        """
+        from bson import json_util
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, "r", encoding="utf-8") as file:
+            state = json_util.loads(file.read())
+        if state["field"] != self.field:
+            raise ValueError(f"{self.path} holds {state['field']} watermarks, remove it to convert everything again with {self.field}")
+        #a file added behind the others gives its documents larger _ids, any other change moves the _ids of converted documents
+        previous_files = state.get("fingerprint")
+        if self.field == "_id" and (previous_files is None) != (self.fingerprint is None):
+            raise ValueError(f"{self.path} holds _id watermarks of another source, remove it to convert everything again")
+        if self.field == "_id" and previous_files is not None and self.fingerprint[:len(previous_files)] != previous_files:
+            raise ValueError(f"{self.path} holds _id watermarks of ndjson files that changed since, remove it to convert everything again")
+        self.previous = state["marks"]
+        self.marks = dict(self.previous)
+        return True
+
+    def save(self):
+        """
+        This fuction replaces the watermark file in one step
+        """
+        from bson import json_util
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            file.write(json_util.dumps({"field": self.field, "marks": self.marks, "fingerprint": self.fingerprint}))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+
+    def query(self, name):
+        """
+        This fuction returns the condition that skips the documents the last run already converted
+        Args:
+            name (string): the entity pass
+        Returns:
+            dict: {field: {"$gt": watermark}}, or None when the pass has no watermark yet
+        """
+        if name not in self.previous:
+            return None
+        #lastUpdated values compare as strings, which orders them correctly as long as they share one time zone
+        return {self.field: {"$gt": self.previous[name]}}
+
+    def observe(self, name, document):
+        """
+        This fuction moves the watermark of a pass forward when a document is newer than it
+        Args:
+            name (string): the entity pass
+            document (dict): a converted document
+        """
+        value = document
+        for key in self.field.split("."):
+            value = value.get(key) if hasattr(value, "get") else None
+        if value is not None and (name not in self.marks or value > self.marks[name]):
+            self.marks[name] = value
+
+    def delta_path(self):
+        """
+        This fuction names the delta file of this run after the full output file
+        Returns:
+            string: *output name*_delta_*time*.ttl
+        """
+        root, extension = os.path.splitext(self.output_path)
+        #a compressed output keeps the extension of its text as well, *output name*_delta_*time*.ttl.gz
+        if get_compression(self.output_path):
+            root, text_extension = os.path.splitext(root)
+            extension = text_extension + extension
+        return f"{root}_delta_{time.strftime('%Y%m%dT%H%M%S')}{extension}"
+
+def run_entity_passes(entity_passes, output_path, header, options=None, metrics=None):
+    """
+    This fuction runs the entity passes one after another and writes their entities behind the header
+    Args:
+        entity_passes (list): create_*resource_type*_entities functions in the order they belong in the final script
+        output_path (string): the final ttl file
+        header (string): the ontology header the entities are written behind
+        options (RunOptions): the settings of the run, the defaults when None
+        metrics (RunMetrics): collects the metrics of every pass and the size of the output, nothing is collected when None
+    Returns:
+        string: the file the entities were written to
+    """
+    def forward_pass_metrics(writer):
+        if metrics is not None:
+            for pass_metrics in writer.pass_metrics:
+                metrics.add_pass(pass_metrics)
+        writer.pass_metrics = []
+
+    def forward_output(writer):
+        if metrics is not None:
+            metrics.add_output(writer.summary())
+
+    def finish_integrity(writer):
+        if writer.integrity is not None:
+            print_integrity_report(writer.integrity.finish())
+
+    if options is None:
+        options = RunOptions()
+    options.check()
+    source = options.source
+    watermarks = None
+    if options.incremental:
+        watermarks = Watermarks(output_path, fingerprint=source_fingerprint(source))
+        if watermarks.load():
+            output_path = watermarks.delta_path()
+            print(f"writing the documents changed since the last run to {output_path}")
+    if not options.checkpoint and not options.resume:
+        with options.writer(output_path) as writer:
+            writer.watermarks = watermarks
+            if options.patient_index:
+                writer.index_patients(output_path + PATIENT_INDEX_EXTENSION)
+            if options.integrity:
+                writer.integrity = IntegrityCheck(output_path + INTEGRITY_EXTENSION)
+            writer.write_header(header)
+            for entity_function in entity_passes:
+                writer.start_section()
+                entity_function(writer, source=source)
+                forward_pass_metrics(writer)
+            forward_output(writer)
+        #the watermarks only move once the whole run is on disk
+        if watermarks is not None:
+            watermarks.save()
+        if writer.patients is not None:
+            writer.patients.save()
+        finish_integrity(writer)
+        return output_path
+    if get_compression(output_path):
+        #a checkpoint cuts the output back to a byte offset, which a compressed file does not have
+        raise ValueError("checkpoint and resume need an uncompressed output")
+    progress = Checkpoint(output_path, [entity_function.__name__ for entity_function in entity_passes], fingerprint=source_fingerprint(source))
+    if options.resume and progress.load():
+        if os.path.getsize(output_path) < progress.offset:
+            raise ValueError(f"{output_path} is shorter than its checkpoint, remove {progress.path} to start over")
+        print(f"resuming at {progress.pass_names[progress.pass_index] if progress.pass_index < len(entity_passes) else 'the end'} after _id {progress.last_id}")
+        with open(output_path, "r+b") as file:
+            file.truncate(progress.offset)
+        writer = options.writer(output_path, mode="a")
+        writer.characters = progress.written["characters"]
+        writer.lines = progress.written["lines"]
+        writer.last_character = progress.written["last_character"]
+        progress.attach(writer, resumed=True)
+    else:
+        writer = options.writer(output_path)
+        if options.patient_index:
+            writer.index_patients(output_path + PATIENT_INDEX_EXTENSION)
+        if options.integrity:
+            writer.integrity = IntegrityCheck(output_path + INTEGRITY_EXTENSION)
+        progress.attach(writer)
+        writer.write_header(header)
+        progress.save(writer)
+    with writer:
+        for index in range(progress.pass_index, len(entity_passes)):
+            query = progress.resume_query()
+            #a pass that was cut off already wrote its section break
+            if query is None:
+                writer.start_section()
+            entity_passes[index](writer, query, source)
+            forward_pass_metrics(writer)
+            progress.finish_pass(writer)
+        forward_output(writer)
+    if writer.patients is not None:
+        writer.patients.save()
+    finish_integrity(writer)
+    progress.remove()
+    return output_path
+
+#parallel mode, every entity pass runs in its own worker process and writes a shard that is merged behind the header
+
+def write_entity_shard(entity_function, shard_path, query=None, start_section=True, options=None):
+    """
+    This fuction runs a single entity pass (or one _id range of it) in a worker process and writes its entities to a shard file
+    Args:
+        entity_function (function): a create_*resource_type*_entities function
+        shard_path (string): the file the entities of this pass are written to
+        query (dict): extra conditions for the pass, for example an _id range
+        start_section (bool): False for the later _id ranges of a pass so the joined ranges read as one block
+        options (RunOptions): the settings of the run, with patient_index the PatientIndex of the shard is returned in the summary
+    Returns:
+        tuple: the shard path and the TtlWriter summary of the shard, with the SharedStatements file of the shared nodes
+            it defined when the run has any
+    """
+    if options is None:
+        options = RunOptions()
+    with options.writer(shard_path) as writer:
+        if writer.defined:
+            writer.shared = SharedStatements(shard_path + SHARED_STATEMENTS_EXTENSION)
+        if options.patient_index:
+            writer.index_patients()
+        if start_section:
+            writer.start_section()
+        entity_function(writer, query, options.source)
+        summary = writer.summary()
+        if writer.patients is not None:
+            summary["patients"] = writer.patients
+        if writer.shared is not None:
+            summary["shared"] = writer.shared.path
+        return shard_path, summary
+
+def append_shard(shard_path, output, start=0, end=None):
+    """
+    This fuction appends a shard file to the open output file, copying in the kernel with copy_file_range or sendfile when it can
+    Args:
+        shard_path (string): the shard file to append
+        output (file): the output file opened in binary write mode
+        start (int): the byte of the shard file the copy starts at
+        end (int): the byte of the shard file the copy stops before, None copies to the end
+    """
+    def copy_file_range(shard_fd, output_fd, offset, count):
+        return os.copy_file_range(shard_fd, output_fd, count, offset)
+
+    def sendfile(shard_fd, output_fd, offset, count):
+        return os.sendfile(output_fd, shard_fd, offset, count)
+
+    output.flush()
+    with open(shard_path, "rb") as shard:
+        size = os.fstat(shard.fileno()).st_size if end is None else end
+        offset = start
+        for copy_range in (copy_file_range, sendfile):
+            try:
+                while offset < size:
+                    copied = copy_range(shard.fileno(), output.fileno(), offset, size - offset)
+                    if copied == 0:
+                        break
+                    offset += copied
+            except (AttributeError, OSError):
+                continue
+            if offset >= size:
+                return
+        shard.seek(offset)
+        while offset < size:
+            data = shard.read(min(WRITE_BUFFER_SIZE, size - offset))
+            if not data:
+                break
+            output.write(data)
+            offset += len(data)
+
+def merge_shards(output_path, header, shard_paths, insertions=None):
+    """
+    This fuction writes the header followed by every shard, in the given order, to the output file
+    The shards of a compressed output are compressed already, the header and the inserted text are compressed on their own
+    Args:
+        output_path (string): the final ttl file
+        header (string): the ontology header the entities are written behind
+        shard_paths (list): shard files in the order they belong in the final script
+        insertions (list): for every shard the (file position, text) to put into it where it was cut (see TtlWriter.cut), by
+            position, None inserts nothing
+    """
+    compression = get_compression(output_path)
+    with open(output_path, "wb") as output:
+        output.write(compress_text(header, compression))
+        for index, shard_path in enumerate(shard_paths):
+            start = 0
+            for file_position, text in insertions[index] if insertions else []:
+                append_shard(shard_path, output, start, file_position)
+                output.write(compress_text(text, compression))
+                start = file_position
+            append_shard(shard_path, output, start)
+
+def take_first_statements(path, written):
+    """
+    This fuction reads the statements of the shared nodes a shard defined and keeps the ones of nodes no earlier shard defined
+    Args:
+        path (string): the SharedStatements file of the shard, None when the shard has none
+        written (set): the nodes the earlier shards defined, the kept nodes are added to it
+    Returns:
+        list: position, file position, node and text of the kept statements, in the order they were written
+    """
+    statements = []
+    if path is not None:
+        for position, file_position, node, text in read_shared_statements(path):
+            if node not in written:
+                written.add(node)
+                statements.append((position, file_position, node, text))
+    return statements
+
+def get_id_partitions(resource_type, partitions):
+    """
+    This fuction splits the documents of a resource type into _id ranges of roughly equal size using $bucketAuto
+    Args:
+        resource_type (string): a value each document has that turns into classes in the knowledge graph
+        partitions (int): the number of ranges wanted
+    Returns:
+        list: one query per _id range, in _id order (the first and last ranges are open ended)
+    """
+    pipeline = [
+        {"$match": {"resourceType": resource_type}},
+        {"$project": {"_id": 1}},
+        {"$bucketAuto": {"groupBy": "$_id", "buckets": partitions}}
+    ]
+    split_points = [bucket["_id"]["min"] for bucket in get_mongo_collection().aggregate(pipeline)][1:]
+    if len(split_points) == 0:
+        return [None]
+    queries = [{"_id": {"$lt": split_points[0]}}]
+    for low, high in zip(split_points, split_points[1:]):
+        queries.append({"_id": {"$gte": low, "$lt": high}})
+    queries.append({"_id": {"$gte": split_points[-1]}})
+    return queries
+
+def run_entity_passes_in_parallel(entity_passes, output_path, header, options=None, metrics=None):
+    """
+    This fuction runs the entity passes in a process pool, each pass writing its own shard, then joins the shards behind the header
+    The workers keep the statements of the concept and dosage instruction nodes they define out of their shards (see
+    SharedStatements), the statement of every node is put into the first shard that defines it, where a serial run writes it,
+    so no node is defined twice. The shards of an _id range split pass are only joined, and the ranges of a patient index are
+    moved to where the shards and statements end up
+    Args:
+        entity_passes (list): create_*resource_type*_entities functions in the order they belong in the final script
+        output_path (string): the final ttl file
+        header (string): the ontology header the entities are written behind
+        options (RunOptions): the settings of the run, the workers and partitions of the pool among them
+        metrics (RunMetrics): collects the metrics of every pass and the size of the output, nothing is collected when None
+    """
+    if options is None:
+        options = RunOptions()
+    options.check()
+    converter = options.converter
+    #the lines of a converted file stand on their own, so the shards are converted by the workers and only the header here
+    if converter is not None:
+        header = converter.convert_header(header)
+    #the workers compress their own shards, the compressed shards are joined like plain ones
+    extension = COMPRESSION_EXTENSIONS.get(get_compression(output_path), "")
+    tasks = []
+    for index, entity_function in enumerate(entity_passes):
+        resource_type = PARTITIONED_RESOURCE_TYPES.get(entity_function.__name__)
+        split = resource_type and options.partitions > 1 and options.source is None and options.cohort is None
+        queries = get_id_partitions(resource_type, options.partitions) if split else [None]
+        for part, query in enumerate(queries):
+            shard_name = f"{index:02d}_{part:03d}_{entity_function.__name__}.ttl{extension}"
+            tasks.append((entity_function, shard_name, query, part == 0))
+
+    shard_dir = tempfile.mkdtemp(prefix="shards_", dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        context = multiprocessing.get_context(PROCESS_START_METHOD)
+        #spawned workers start from the default settings, so the settings of this process are handed to them
+        with ProcessPoolExecutor(max_workers=options.workers, mp_context=context, initializer=configure_mongo_from, initargs=(dict(MONGO_SETTINGS),)) as pool:
+            futures = {}
+            #the biggest passes sit at the end of the list, submitting them first keeps them from becoming the tail of the run
+            for index in reversed(range(len(tasks))):
+                entity_function, shard_name, query, start_section = tasks[index]
+                shard_path = os.path.join(shard_dir, shard_name)
+                futures[index] = pool.submit(write_entity_shard, entity_function, shard_path, query=query, start_section=start_section, options=options)
+            shard_paths = []
+            if metrics is not None:
+                metrics.add_output({"characters": len(header), "lines": header.count("\n"), "last_character": header[-1:], "bytes": len(header.encode("utf-8"))})
+            patients = None
+            if options.patient_index:
+                patients = PatientIndex(output_path + PATIENT_INDEX_EXTENSION)
+                patients.header(header)
+            offset = len(header.encode("utf-8"))
+            #the shared nodes defined so far, the first shard that defines a node keeps its statement
+            written = set()
+            insertions = []
+            for index in range(len(tasks)):
+                shard_path, summary = futures[index].result()
+                shard_paths.append(shard_path)
+                statements = take_first_statements(summary.get("shared"), written)
+                #the statements are joined per cut, the bytes of the shard and the statements in front of them move the later ones
+                cuts = []
+                inserted = {"characters": 0, "lines": 0, "last_character": "", "bytes": 0}
+                for position, file_position, node, text in statements:
+                    size = len(text.encode("utf-8"))
+                    if patients is not None:
+                        start = offset + position + inserted["bytes"]
+                        patients.definitions.setdefault(node, (start, start + size))
+                    if cuts and cuts[-1][0] == position:
+                        cuts[-1][2].append(text)
+                        cuts[-1][3] += size
+                    else:
+                        cuts.append([position, file_position, [text], size])
+                    inserted["characters"] += len(text)
+                    inserted["lines"] += text.count("\n")
+                    inserted["bytes"] += size
+                    #text inserted at the end of the shard is the end of it
+                    inserted["last_character"] = text[-1:] if position == summary["bytes"] else ""
+                insertions.append([(file_position, "".join(texts)) for _, file_position, texts, _ in cuts])
+                if patients is not None:
+                    patients.merge(summary["patients"], offset, [(position, size) for position, _, _, size in cuts])
+                offset += summary["bytes"] + inserted["bytes"]
+                if metrics is not None:
+                    passes = [dict(pass_metrics) for pass_metrics in summary["passes"]]
+                    if passes:
+                        #the statements count for the pass of the shard, like they do in a serial run
+                        for field in ("characters", "lines", "bytes"):
+                            passes[-1][field] += inserted[field]
+                    for pass_metrics in passes:
+                        metrics.add_pass(pass_metrics)
+                    metrics.add_output(summary)
+                    metrics.add_output(inserted)
+        merge_shards(output_path, header, shard_paths, insertions)
+        if patients is not None:
+            patients.save()
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+def add_query(pipeline, query):
+    """
+    This fuction adds extra conditions to the $match stage at the front of an entity pipeline
+    Args:
+        pipeline (list): a mongoDB pipeline that starts with a $match stage
+        query (dict): extra conditions, for example an _id range
+    Returns:
+        list: the pipeline with the extra conditions added
+    """
+    if not query:
+        return pipeline
+    match = pipeline[0]["$match"]
+    if match.keys() & query.keys():
+        match = {"$and": [match, query]}
+    else:
+        match = {**match, **query}
+    return [{"$match": match}] + pipeline[1:]
+
+def get_cohort(cohort, source=None):
+    """
+    This fuction finds the documents of a cohort before the entity passes run (see kg_cohort.py)
+    Args:
+        cohort (object): a list of Patient ids, a mongoDB filter the Patients match, a Cohort that was resolved already or None
+        source (object): the document source, the mongoDB collection when None
+    Returns:
+        Cohort: the documents of the cohort, None when there is no cohort
+    """
+    from kg_cohort import Cohort, resolve_cohort
+    if cohort is None or isinstance(cohort, Cohort):
+        return cohort
+    time_start = time.time()
+    cohort = resolve_cohort(cohort, source)
+    counts = ", ".join(f"{resource_type} {count}" for resource_type, count in cohort.counts().items() if count)
+    print(f"cohort resolved in {time.time() - time_start:.4f} seconds: {counts}")
+    return cohort
+
+def aggregate_resources(pipeline, query=None, source=None):
+    """
+    This fuction runs an entity pipeline against the document source, the mongoDB collection unless another source is given
+    Args:
+        pipeline (list): a mongoDB pipeline that starts with a $match stage
+        query (dict): extra conditions for the $match stage
+        source (object): anything with a mongoDB style aggregate(), for example an NdjsonSource
+    Returns:
+        iterator: the matching documents
+    """
+    if source is None:
+        source = get_entity_collection()
+    if MONGO_SETTINGS["batch_size"]:
+        return source.aggregate(add_query(pipeline, query), batchSize=MONGO_SETTINGS["batch_size"])
+    return source.aggregate(add_query(pipeline, query))
+
+def run_entity_pass(writer, name, pipeline, entity, query=None, source=None):
+    """
+    This fuction runs one entity pass, every document the pipeline returns is converted by the entity template and written to the output
+    Args:
+        writer (TtlWriter): where the entities are written
+        name (string): the resource type as it is printed in the terminal
+        pipeline (list): the mongoDB pipeline of the pass
+        entity (Template): the template of the knowledge graph entity of one document
+        query (dict): extra conditions for the $match stage
+        source (object): the document source, the mongoDB collection when None
+    """
+    time_start = time.perf_counter()
+    print(f"creating {name} entities")
+    characters_start, lines_start, bytes_start = writer.characters, writer.lines, writer.tell()
+    documents = 0
+    entities = 0
+    read_seconds = 0.0
+    render_seconds = 0.0
+    write_seconds = 0.0
+    checkpoint = writer.checkpoint
+    patients = writer.patients
+    #a Patient entity belongs to its own patient, the others to the patient of their subject
+    patient_pass = pipeline[0]["$match"].get("resourceType") == "Patient"
+    patient = None
+    if checkpoint is not None and source is None:
+        #a checkpoint resumes after the last _id written, so the collection is read in _id order (an NdjsonSource already reads in _id order)
+        pipeline = pipeline[:1] + [{"$sort": {"_id": 1}}] + pipeline[1:]
+    watermarks = writer.watermarks
+    if watermarks is not None:
+        pipeline = add_query(pipeline, watermarks.query(name))
+    if writer.cohort is not None:
+        pipeline = add_query(pipeline, writer.cohort.query(pipeline))
+    #the time spent waiting on the cursor (mongoDB round trips and BSON decoding, or ndjson parsing) is read time
+    read_start = time.perf_counter()
+    results = iter(aggregate_resources(pipeline, query, source))
+    for result in results:
+        render_start = time.perf_counter()
+        read_seconds += render_start - read_start
+        insertion = writer.render(entity, result)
+        write_start = time.perf_counter()
+        render_seconds += write_start - render_start
+        if patients is not None:
+            patient = result.get("id") if patient_pass else subject_patient(result)
+        writer.write(insertion, patient)
+        documents += 1
+        if insertion:
+            entities += 1
+        if checkpoint is not None:
+            checkpoint.document_written(writer, result["_id"])
+        if watermarks is not None:
+            watermarks.observe(name, result)
+        read_start = time.perf_counter()
+        write_seconds += read_start - write_start
+    read_seconds += time.perf_counter() - read_start
+    time_end = time.perf_counter()
+    writer.pass_metrics.append({
+        "name": name,
+        "documents": documents,
+        "entities": entities,
+        "characters": writer.characters - characters_start,
+        "lines": writer.lines - lines_start,
+        "bytes": writer.tell() - bytes_start,
+        "read_seconds": read_seconds,
+        "render_seconds": render_seconds,
+        "write_seconds": write_seconds,
+        "seconds": time_end - time_start,
+    })
+    print(f"{name} entity creation took {time_end - time_start:.4f} seconds")
 
 def split_refrence(refrence):
     """
@@ -255,11 +1632,31 @@ def split_refrence(refrence):
 
 def escape_turtle_string(s):
     """
-    This fuction sanatizes text with slashes so that it compiles under python and rdf rules
+    This fuction sanatizes text with slashes so that it compiles under python and rdf rules, kept for callers of the old name
     Returns:
         str: sanatized text
     """
-    return s.replace('\\', '\\\\').replace('"', '\\"')
+    return escape_string(s)
+
+def sanatize_quotes(s):
+    """
+    This fuction sanatizes quotes in a string for python and rdf compliance, kept for callers of the old name
+    Args:
+        s (string): a string of text
+    Returns:
+        str: sanatized string
+    """
+    return escape_string(s)
+
+def sanitize_for_kg_literal(text):
+    """
+    This fuction sanatizes text for both slashes and quotes, kept for callers of the old name
+    Args:
+        text (string): a string of text
+    Returns:
+        str: the sanatized text 
+    """
+    return escape_string(text)
 
 def get_meta(meta):
     """
@@ -284,60 +1681,72 @@ def get_meta(meta):
     clean_profiles.strip("[]'\"")
     
     meta_line = f"""fhir:meta [
-                fhir:versionId [ fhir:v "{meta_version}" ] ;
-                fhir:lastUpdated [ fhir:v "{meta_lastUpdated}"^^xsd:dateTime ] ;
-                fhir:source [ fhir:v "{meta_source}" ] ;
-                fhir:profile [ fhir:v "{clean_profiles}" ]
+                fhir:versionId [ fhir:v "{escape_string(meta_version)}" ] ;
+                fhir:lastUpdated [ fhir:v "{escape_string(meta_lastUpdated)}"^^xsd:dateTime ] ;
+                fhir:source [ fhir:v "{escape_string(meta_source)}" ] ;
+                fhir:profile [ fhir:v "{escape_string(clean_profiles)}" ]
             ] ;"""
     return meta_line
 
-def sanatize_quotes(s):
-    """
-    This fuction sanatizes quotes in a string for python and rdf compliance
-    Args:
-        s (string): a string of text
-    Returns:
-        str: sanatized string
-    """
-    return s.replace('"', '\\"')
-
-def get_coding(coding):
+def get_coding(coding, concepts=None):
     """
     This fuction converts coding information into knowledge graph format
     Args:
         coding (dict): a dictionary holding coding information
+        concepts (ConceptNodes): link to the concept node of the coding instead of writing it out, None writes it out
     Returns:
         str: the converted coding property 
     """
     if len(coding)==0:
         return ""
-    typeCodingSystem = coding[0].get('system', '')
-    typeCodingCode = coding[0].get('code', '')
-    typeCodingDisplay = coding[0].get('display', '')
-    coding_line =f"""\t\t\t\tfhir:coding [
-                    fhir:system  [ fhir:v "{typeCodingSystem}"^^xsd:anyURI ] ;
-                    fhir:code    [ fhir:v "{typeCodingCode}" ] ;
-                    fhir:display [ fhir:v "{typeCodingDisplay}" ]
-                ] """
-    return coding_line
-
-def get_small_coding(coding):
+    if concepts is not None:
+        return f"\t\t\t\tfhir:coding {concepts.link(coding[0])} "
+    return CODING.render(coding)
+
+def get_small_coding(coding, concepts=None):
     """
     This fuction converts coding information into knowledge graph format without display
     Args:
         coding (dict): a dictionary holding coding information
+        concepts (ConceptNodes): link to the concept node of the coding instead of writing it out, None writes it out
     Returns:
         str: the converted coding property 
     """
     if len(coding)==0:
         return ""
-    typeCodingSystem = coding[0].get('system', '')
-    typeCodingCode = coding[0].get('code', '')
-    coding_line =f"""fhir:coding [
-                        fhir:system  [ fhir:v "{typeCodingSystem}"^^xsd:anyURI ] ;
-                        fhir:code    [ fhir:v "{typeCodingCode}" ] 
-                    ] """
-    return coding_line
+    if concepts is not None:
+        return f"fhir:coding {concepts.link(coding[0])} "
+    return SMALL_CODING.render(coding)
+
+def define_concept(node, system, code, display=None):
+    """
+    This fuction writes the concept node of a coding, the entities that use the coding link to it with fhir:coding (see ConceptNodes)
+    Args:
+        node (string): the node of the concept
+        system (string): the code system
+        code (string): the code
+        display (string): the display of the first coding seen with the code
+    Returns:
+        str: the statement of the concept node
+    """
+    return CONCEPT_DEFINITION.render({"node": node.partition(":")[2], "system": system, "code": code, "display": display})
+
+def concept_link(concepts, path):
+    """
+    This fuction builds a template field that links to the concept node of the coding at a path of the document
+    Args:
+        concepts (ConceptNodes): the concept nodes of the run
+        path (string): dotted path of the coding, like coding.0
+    Returns:
+        function: field(document) that returns the node
+    """
+    steps = path_steps(path)
+
+    def link(document):
+        for step in steps:
+            document = document[step]
+        return concepts.link(document)
+    return link
 
 def get_identifier(identifier):
     """
@@ -349,675 +1758,590 @@ def get_identifier(identifier):
     """
     if len(identifier)==0:
         return ""
-    identifierSystem=identifier[0].get('system',"")  if identifier else ""
-    identifierValue=identifier[0].get('value',"")  if identifier else ""
-    identifier_line=f"""fhir:identifier [
-                fhir:system [ fhir:v "{identifierSystem}"^^xsd:anyURI ] ;
-                fhir:value  [ fhir:v "{sanatize_quotes(identifierValue)}" ]
-            ] ;"""
-    return identifier_line
+    return IDENTIFIER.template.render(identifier)
     
-def sanitize_for_kg_literal(text):
+#the filters the entity templates can apply to a value, {path|filter} (see kg_templates.py)
+FILTERS = {
+    "ref": split_refrence,
+    "literal": escape_string,
+}
+
+#the statement of a concept node, the writer renders it on the documents ConceptNodes collects, the entities link to it with fhir:coding
+CONCEPT_DEFINITION = Template("""se:{node} a fhir:Coding ;
+\t\t\tfhir:system [ fhir:v "{system|literal}"^^xsd:anyURI ] ;
+\t\t\tfhir:code [ fhir:v "{code|literal}" ]{display} .
+
+""", {
+    "display": Section("display", Template(""" ;\n\t\t\tfhir:display [ fhir:v "{.|literal}" ]""", filters=FILTERS)),
+}, FILTERS)
+
+#the blocks the renderers share, the turtle get_identifier, get_coding and get_small_coding write
+IDENTIFIER = Section("identifier", Template("""fhir:identifier [
+                fhir:system [ fhir:v "{system|literal}"^^xsd:anyURI ] ;
+                fhir:value  [ fhir:v "{value|literal}" ]
+            ] ;""", {
+    "system": lambda identifier: identifier[0].get('system', ""),
+    "value": lambda identifier: identifier[0].get('value', ""),
+}, FILTERS))
+
+CODING = Template("""\t\t\t\tfhir:coding [
+                    fhir:system  [ fhir:v "{system|literal}"^^xsd:anyURI ] ;
+                    fhir:code    [ fhir:v "{code|literal}" ] ;
+                    fhir:display [ fhir:v "{display|literal}" ]
+                ] """, {
+    "system": lambda coding: coding[0].get('system', ''),
+    "code": lambda coding: coding[0].get('code', ''),
+    "display": lambda coding: coding[0].get('display', ''),
+}, FILTERS)
+
+SMALL_CODING = Template("""fhir:coding [
+                        fhir:system  [ fhir:v "{system|literal}"^^xsd:anyURI ] ;
+                        fhir:code    [ fhir:v "{code|literal}" ] 
+                    ] """, {
+    "system": lambda coding: coding[0].get('system', ''),
+    "code": lambda coding: coding[0].get('code', ''),
+}, FILTERS)
+
+def coding_section(path, concepts=None, small=False):
     """
-    This fuction sanatizes text for both slashes and quotes
+    This fuction builds the block of the first coding of the coding list at a path of the document
     Args:
-        text (string): a string of text
+        path (string): dotted path of the coding list, the block is empty when it is missing or empty
+        concepts (ConceptNodes): link to the concept node of the coding instead of writing it out, None writes it out
+        small (bool): leave out the display, like get_small_coding
     Returns:
-        str: the sanatized text 
+        Section: the block
     """
-    if not isinstance(text, str):
-        text = str(text)
-
-    # Escape backslashes first
-    text = text.replace('\\', '\\\\')
-    # Escape double quotes
-    text = text.replace('"', '\\"')
-    # Escape newlines and carriage returns
-    text = text.replace('\n', '\\n').replace('\r', '\\r')
-
-    return text
+    if concepts is not None:
+        indent = "" if small else "\t\t\t\t"
+        return Section(path, Template(indent + "fhir:coding {concept} ", {"concept": concept_link(concepts, "0")}, FILTERS))
+    return Section(path, SMALL_CODING if small else CODING)
 
 #these functions create the entities, note this is the general structure below
-# create_*resource_type*_entities():
-#     
-#     collection of functions to convert specific nested fields
-#
-#     mongoDB pipeline to query the database
+# *RESOURCE_TYPE*_PIPELINE = mongoDB pipeline to query the database
 #
-#     for result in results:
-#         iterates through each document
-#
-#         creates a string of a single entity in the knowledge graph
+# *resource_type*_renderer():
+#     
+#     builds the kg_templates.Template of a single entity in the knowledge graph, optional blocks are Sections and repeated
+#     blocks are Each, the blocks shared between renderers are kept above
 #
-#         appends this single entity to middle_man.txt
+# create_*resource_type*_entities(writer):
+#     runs the pipeline and writes every entity to fhir_final_script.ttl through the TtlWriter, which renders the template as turtle or
+#     emits its triples for the N-Triples and N-Quads outputs
 #
-#     appends middle_man.txt to fhir_final_script.ttl then clears middle_man.txt
+# the Observation and MedicationAdministration templates take the compact argument too, it leaves out the cosmetic whitespace
 
 
 
-def create_organization_entities():
-    time_start = time.time()
-    print("creating organization entities")
-    pipeline = [
-        {"$match":{"resourceType":"Organization"}},
-        {"$project":{"_id":1,"id":1,"identifier":1,"active":1,"type":1,"name":1,"meta":1}}
-    ]
-    results = collection.aggregate(pipeline)
-    for result in results:
-        fhirID=result.get('id')
-        identifier = get_identifier(result.get('identifier', []))
-        name=result.get('name')
-        active=result.get('active')
-        meta = get_meta(result.get('meta', {}))
-        type_list = result.get('type', [])
-        coding_list=get_coding(type_list[0].get('coding', [])) if type_list else []
-        insert =f"""se:{fhirID} a fhir:Organization ;
-            fhir:id [ fhir:v "{fhirID}" ] ;
+ORGANIZATION_PIPELINE = [
+    {"$match":{"resourceType":"Organization"}},
+    {"$project":{"_id":1,"id":1,"identifier":1,"active":1,"type":1,"name":1,"meta":1}}
+]
+
+def organization_renderer(concepts=None):
+    """
+    This fuction builds the template that converts one Organization document into its knowledge graph entity
+    Args:
+        concepts (ConceptNodes): link the codings to concept nodes, None writes them inline
+    Returns:
+        Template: the entity template
+    """
+    def template(layout, **fields):
+        return Template(layout, fields, FILTERS)
+    return template("""se:{id} a fhir:Organization ;
+            fhir:id [ fhir:v "{id|literal}" ] ;
             {identifier}
-            fhir:name   [ fhir:v "{name}" ] ;
-            fhir:active [ fhir:v "{str(active).lower()}"^^xsd:boolean ] ;
+            fhir:name   [ fhir:v "{name|literal}" ] ;
+            fhir:active [ fhir:v "{active|literal}"^^xsd:boolean ] ;
             fhir:type [
-{coding_list}
+{coding}
             ] .
 
-"""
-        write_to_middle(insert)
-    time_end = time.time()
-    move_to_final()
-    print(f"organization entity creation took {time_end - time_start:.4f} seconds")
+""",
+        id=lambda result: str(result.get('id')),
+        name=lambda result: result.get('name'),
+        active=lambda result: str(result.get('active')).lower(),
+        identifier=IDENTIFIER,
+        coding=coding_section("type.0.coding", concepts))
 
-def create_location_entities():
-    print("creating location entities")
-    time_start = time.time()
-    pipeline = [
-        {"$match":{"resourceType":"Location"}},
-        {"$project":{"_id":1,"id":1,"status":1,"name":1,"physicalType":1,"managingOrganization":1,"meta":1}}
-    ]
-    results = collection.aggregate(pipeline)
-    for result in results:
-        fhirID=result.get('id')
-        status=result.get('status')
-        name=result.get('name')
-        meta = get_meta(result.get('meta', {}))
-        type_list = result.get('physicalType', [])
-        coding_list=get_coding(type_list.get('coding', [])) if type_list else []
-        managingOrganization=split_refrence(result['managingOrganization']['reference'])
-        insert =f"""se:{fhirID} a fhir:Location ;
-            fhir:id [ fhir:v "{fhirID}" ] ;
-            fhir:status [ fhir:v "{status}" ] ;
-            fhir:name [ fhir:v "{name}" ] ;
+def create_organization_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "organization", ORGANIZATION_PIPELINE, organization_renderer(writer.concepts), query, source)
+
+LOCATION_PIPELINE = [
+    {"$match":{"resourceType":"Location"}},
+    {"$project":{"_id":1,"id":1,"status":1,"name":1,"physicalType":1,"managingOrganization":1,"meta":1}}
+]
+
+def location_renderer(concepts=None):
+    """
+    This fuction builds the template that converts one Location document into its knowledge graph entity
+    Args:
+        concepts (ConceptNodes): link the codings to concept nodes, None writes them inline
+    Returns:
+        Template: the entity template
+    """
+    def template(layout, **fields):
+        return Template(layout, fields, FILTERS)
+    return template("""se:{id} a fhir:Location ;
+            fhir:id [ fhir:v "{id|literal}" ] ;
+            fhir:status [ fhir:v "{status|literal}" ] ;
+            fhir:name [ fhir:v "{name|literal}" ] ;
             fhir:type [
-{coding_list}
+{coding}
             ] ;
-            fhir:managingOrganization se:{managingOrganization} .
+            fhir:managingOrganization se:{managingOrganization.reference|ref} .
 
-"""
-        write_to_middle(insert)
-    time_end = time.time()
-    move_to_final()
-    print(f"location entity creation took {time_end - time_start:.4f} seconds")
+""",
+        id=lambda result: str(result.get('id')),
+        status=lambda result: result.get('status'),
+        name=lambda result: result.get('name'),
+        coding=coding_section("physicalType.coding", concepts))
 
-def create_patient_entities():
-    print("creating patient entities")
-    time_start = time.time()
-    
-    def get_communication(communication):
-        if len(communication) == 0:
-            return ""
-        
-        code = communication[0]['language']['coding'][0]['code']
-        system = communication[0]['language']['coding'][0]['system']
-        com_line = f"""fhir:communication [
+def create_location_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "location", LOCATION_PIPELINE, location_renderer(writer.concepts), query, source)
+
+PATIENT_PIPELINE = [
+    {"$match": {"resourceType": "Patient"}},
+    {"$project": {"_id": 1, "id": 1, "birthDate": 1, "deceasedDateTime": 1, "extension": 1, 
+                 "identifier": 1, "gender": 1, "maritalStatus": 1, "communication": 1, 
+                 "managingOrganization": 1, "meta": 1}}
+]
+
+def patient_renderer():
+    """
+    This fuction builds the template that converts one Patient document into its knowledge graph entity
+    Returns:
+        Template: the entity template
+    """
+    def template(layout, **fields):
+        return Template(layout, fields, FILTERS)
+    communication = Section("communication", template("""fhir:communication [
                 fhir:language [
                     fhir:coding [
-                        fhir:system  [ fhir:v "{system}"^^xsd:anyURI ] ;
-                        fhir:code    [ fhir:v "{code}" ] ;
+                        fhir:system  [ fhir:v "{0.language.coding.0.system|literal}"^^xsd:anyURI ] ;
+                        fhir:code    [ fhir:v "{0.language.coding.0.code|literal}" ] ;
                     ]
                 ]
             ] ;
-            """
-        return com_line
-    
-    def get_extension(extension):
-        extensionZero = f"""
+            """))
+    #the valueCode of the second extension closes its blank node, it used to end with a dot which is not turtle there
+    extension_one = template("""
             fhir:extension [
                 fhir:extension [
-                    fhir:url  [ fhir:v "{extension[0]['extension'][0]['url']}"^^xsd:anyURI ] ; 
-                    fhir:valueCoding [
-                        fhir:system  [ fhir:v "{extension[0]['extension'][0]['valueCoding']['system']}"^^xsd:anyURI ] ;
-                        fhir:code    [ fhir:v "{extension[0]['extension'][0]['valueCoding']['code']}" ] ;
-                        fhir:display [ fhir:v "{extension[0]['extension'][0]['valueCoding']['display']}" ]
+                    fhir:url  [ fhir:v "{1.extension.0.url|literal}"^^xsd:anyURI ] ; 
+                    fhir:valueCoding [ 
+                        fhir:system  [ fhir:v "{1.extension.0.valueCoding.system|literal}"^^xsd:anyURI ] ;
+                        fhir:code    [ fhir:v "{1.extension.0.valueCoding.code|literal}" ] ;
+                        fhir:display [ fhir:v "{1.extension.0.valueCoding.display|literal}" ]
                     ]
                 ] ;
                 fhir:extension [
-                    fhir:url  [ fhir:v "{extension[0]['extension'][1]['url']}"^^xsd:anyURI ] ;
-                    fhir:valueString [ fhir:v "{extension[0]['extension'][1]['valueString']}"^^xsd:string ] 
+                    fhir:url  [ fhir:v "{1.extension.1.url|literal}"^^xsd:anyURI ] ;
+                    fhir:valueString [ fhir:v "{1.extension.1.valueString|literal}"^^xsd:string ]
                 ] ;
-                fhir:url  [ fhir:v "{extension[0]['url']}"^^xsd:anyURI ] 
+                fhir:url  [ fhir:v "{1.url|literal}"^^xsd:anyURI ] {valueLine} 
             ] ;
-"""
-        
-        valueLine = f";\n\t\t\t\tfhir:valueCode [ fhir:v \"{extension[1]['valueCode']}\" ] ." if len(extension) > 1 and extension[1].get('valueCode') else ""
+            fhir:extension [
+                fhir:url  [ fhir:v "{2.url|literal}"^^xsd:anyURI ] ;
+                fhir:valueCode [ fhir:v "{2.valueCode|literal}"^^xsd:string ]
+            ] ; 
         
-        extensionOne = f"""
+""",
+        valueLine=Section("1.valueCode", template(""";\n\t\t\t\tfhir:valueCode [ fhir:v "{.|literal}" ]""")))
+    extension = Section("extension", template("""
             fhir:extension [
                 fhir:extension [
-                    fhir:url  [ fhir:v "{extension[1]['extension'][0]['url']}"^^xsd:anyURI ] ; 
-                    fhir:valueCoding [ 
-                        fhir:system  [ fhir:v "{extension[1]['extension'][0]['valueCoding']['system']}"^^xsd:anyURI ] ;
-                        fhir:code    [ fhir:v "{extension[1]['extension'][0]['valueCoding']['code']}" ] ;
-                        fhir:display [ fhir:v "{extension[1]['extension'][0]['valueCoding']['display']}" ]
+                    fhir:url  [ fhir:v "{0.extension.0.url|literal}"^^xsd:anyURI ] ; 
+                    fhir:valueCoding [
+                        fhir:system  [ fhir:v "{0.extension.0.valueCoding.system|literal}"^^xsd:anyURI ] ;
+                        fhir:code    [ fhir:v "{0.extension.0.valueCoding.code|literal}" ] ;
+                        fhir:display [ fhir:v "{0.extension.0.valueCoding.display|literal}" ]
                     ]
                 ] ;
                 fhir:extension [
-                    fhir:url  [ fhir:v "{extension[1]['extension'][1]['url']}"^^xsd:anyURI ] ;
-                    fhir:valueString [ fhir:v "{extension[1]['extension'][1]['valueString']}"^^xsd:string ]
+                    fhir:url  [ fhir:v "{0.extension.1.url|literal}"^^xsd:anyURI ] ;
+                    fhir:valueString [ fhir:v "{0.extension.1.valueString|literal}"^^xsd:string ] 
                 ] ;
-                fhir:url  [ fhir:v "{extension[1]['url']}"^^xsd:anyURI ] {valueLine} 
+                fhir:url  [ fhir:v "{0.url|literal}"^^xsd:anyURI ] 
             ] ;
-            fhir:extension [
-                fhir:url  [ fhir:v "{extension[2]['url']}"^^xsd:anyURI ] ;
-                fhir:valueCode [ fhir:v "{extension[2]['valueCode']}"^^xsd:string ]
-            ] ; 
-        
-""" if extension and 'extension' in extension[1] else ""
-        return extensionZero + extensionOne
-
-    pipeline = [
-        {"$match": {"resourceType": "Patient"}},
-        {"$project": {"_id": 1, "id": 1, "birthDate": 1, "deceasedDateTime": 1, "extension": 1, 
-                     "identifier": 1, "gender": 1, "maritalStatus": 1, "communication": 1, 
-                     "managingOrganization": 1, "meta": 1}}
-    ]
-    
-    results = collection.aggregate(pipeline)
-    
-    for result in results:
-        meta = get_meta(result.get('meta', {}))
-        fhirID = result.get('id')
-        identifier = get_identifier(result.get('identifier', []))
-        maritalStatusCode = result['maritalStatus']['coding'][0]['code']
-        maritalStatusSystem = result['maritalStatus']['coding'][0]['system']
-        managingOrganization = split_refrence(result['managingOrganization']['reference'])
-        communication = get_communication(result.get('communication', []))
-        gender = result.get('gender')
-        birthDate = result.get('birthDate')
-        deceased = result.get('deceasedDateTime')
-        deceasedDateTime = f"fhir:deceasedDateTime [ fhir:v \"{deceased}\"^^xsd:dateTime ] ;" if deceased else ""
-        extension = get_extension(result.get('extension', []))
-        
-        insert = f"""se:{fhirID} a fhir:Patient ;
-            fhir:id [ fhir:v "{fhirID}" ] ;
+{extension_one}""",
+        extension_one=Section(lambda extension: extension if 'extension' in extension[1] else None, extension_one)))
+    return template("""se:{id} a fhir:Patient ;
+            fhir:id [ fhir:v "{id|literal}" ] ;
 {extension}
             {communication}{identifier}
             {deceasedDateTime}
-            fhir:gender [ fhir:v "{gender}" ] ;
-            fhir:birthDate [ fhir:v "{birthDate}"^^xsd:date ] ;
-            fhir:managingOrganization se:{managingOrganization} ;
+            fhir:gender [ fhir:v "{gender|literal}" ] ;
+            fhir:birthDate [ fhir:v "{birthDate|literal}"^^xsd:date ] ;
+            fhir:managingOrganization se:{managingOrganization.reference|ref} ;
             fhir:maritalStatus [
                 fhir:coding [
-                    fhir:system  [ fhir:v "{maritalStatusSystem}"^^xsd:anyURI ] ;
-                    fhir:code    [ fhir:v "{maritalStatusCode}" ] 
+                    fhir:system  [ fhir:v "{maritalStatus.coding.0.system|literal}"^^xsd:anyURI ] ;
+                    fhir:code    [ fhir:v "{maritalStatus.coding.0.code|literal}" ] 
                 ]
             ] .
         
-"""
-        write_to_middle(insert)
-    time_end = time.time()
-    print(f"patient entity creation took {time_end - time_start:.4f} seconds")
-    move_to_final()
-
-def create_encounter_entities():
-    print("creating entcounter entities")  
-    time_start = time.time()
-    def get_identifier_with_reference(identifier):
-        identifierSystem = identifier[0].get('system', "") if identifier else ""
-        identifierValue = identifier[0].get('value', "") if identifier else ""
-        useLine = f";\n\t\t\tfhir:use [ fhir:v \"{identifier[0]['use']}\" ] ;" if identifier[0].get('use') else ""
-        assigner = f";\n\t\t\tfhir:assigner [ fhir:v \"{split_refrence(identifier[0]['assigner']['reference'])}\" ]" if identifier[0].get('assigner') else ""
-        identifier_line = f"""fhir:identifier [
-                fhir:system [ fhir:v "{identifierSystem}"^^xsd:anyURI ] ;
-                fhir:value  [ fhir:v "{identifierValue}" ] {useLine}{assigner}
-            ] ;"""
-        return identifier_line  
-    def get_hospitalization(hospital):
-        if hospital == "":
-            return ""
-        
-        hos = f"""
+""",
+        id=lambda result: str(result.get('id')),
+        gender=lambda result: result.get('gender'),
+        birthDate=lambda result: result.get('birthDate'),
+        extension=extension,
+        communication=communication,
+        identifier=IDENTIFIER,
+        deceasedDateTime=Section("deceasedDateTime", template("""fhir:deceasedDateTime [ fhir:v "{.|literal}"^^xsd:dateTime ] ;""")))
+
+def create_patient_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "patient", PATIENT_PIPELINE, patient_renderer(), query, source)
+
+ENCOUNTER_PIPELINE = [
+    {"$match": {"resourceType": "Encounter"}},
+    {"$project": {"_id": 1, "id": 1, "status": 1, "class": 1, "type": 1, "subject": 1, 
+                 "location": 1, "partOf": 1, "hospitalization": 1, "identifier": 1,
+                 "meta": 1, "priority": 1, "serviceProvider": 1, "serviceType": 1, "period": 1}}
+]
+
+def encounter_renderer(concepts=None):
+    """
+    This fuction builds the template that converts one Encounter document into its knowledge graph entity
+    Args:
+        concepts (ConceptNodes): link the codings to concept nodes, None writes them inline
+    Returns:
+        Template: the entity template
+    """
+    def template(layout, **fields):
+        return Template(layout, fields, FILTERS)
+    identifier = Section("identifier", template("""fhir:identifier [
+                fhir:system [ fhir:v "{system|literal}"^^xsd:anyURI ] ;
+                fhir:value  [ fhir:v "{value|literal}" ] {use}{assigner}
+            ] ;""",
+        system=lambda identifier: identifier[0].get('system', ""),
+        value=lambda identifier: identifier[0].get('value', ""),
+        use=Section("0.use", template(""";\n\t\t\tfhir:use [ fhir:v "{.|literal}" ] ;""")),
+        assigner=Section("0.assigner", template(""";\n\t\t\tfhir:assigner [ fhir:v "{reference|literal}" ]""",
+            reference=lambda assigner: split_refrence(assigner['reference'])))))
+    hospitalization = Section("hospitalization", template("""fhir:hospitalization [
+                {admitSource}{dischargeDisposition}
+        ] ;
+        """,
+        admitSource=Section("admitSource", template("""
             fhir:admitSource [
-                fhir:system  [ fhir:v "{hospital['admitSource']['coding'][0]['system']}"^^xsd:anyURI ] ;
-                fhir:code    [ fhir:v "{hospital['admitSource']['coding'][0]['code']}" ] 
+                fhir:system  [ fhir:v "{coding.0.system|literal}"^^xsd:anyURI ] ;
+                fhir:code    [ fhir:v "{coding.0.code|literal}" ] 
             ] ;
             
-        """ if hospital.get('admitSource') else ""
-        
-        pital = f"""fhir:dischargeDisposition [
-                fhir:system  [ fhir:v "{hospital['dischargeDisposition']['coding'][0]['system']}"^^xsd:anyURI ] ;
-                fhir:code    [ fhir:v "{hospital['dischargeDisposition']['coding'][0]['code']}" ] 
-            ]""" if hospital.get('dischargeDisposition') else ""
-        
-        return f"""fhir:hospitalization [
-                {hos + pital}
-        ] ;
-        """  
-    def get_serviceType(service):
-        if len(service) == 0:
-            return ""
-        
-        service_line = f"""fhir:serviceType [
+        """)),
+        dischargeDisposition=Section("dischargeDisposition", template("""fhir:dischargeDisposition [
+                fhir:system  [ fhir:v "{coding.0.system|literal}"^^xsd:anyURI ] ;
+                fhir:code    [ fhir:v "{coding.0.code|literal}" ] 
+            ]"""))))
+    #the service type and the priority write the system as the value too
+    serviceType = Section("serviceType", template("""fhir:serviceType [
             fhir:coding [
-                fhir:system [ fhir:v "{service['coding'][0]['system']}"^^xsd:anyURI ] ;
-                fhir:value  [ fhir:v "{service['coding'][0]['system']}" ] ;
+                fhir:system [ fhir:v "{coding.0.system|literal}"^^xsd:anyURI ] ;
+                fhir:value  [ fhir:v "{coding.0.system|literal}" ] ;
                 ]
             ]
-            ;"""
-        return service_line  
-    def get_priority(priority):
-        if len(priority) == 0:
-            return ""
-        
-        priority_line = f"""fhir:priority [
+            ;"""))
+    priority = Section("priority", template("""fhir:priority [
             fhir:coding [
-                fhir:system [ fhir:v "{priority['coding'][0]['system']}"^^xsd:anyURI ] ;
-                fhir:value  [ fhir:v "{priority['coding'][0]['system']}" ] ;
+                fhir:system [ fhir:v "{coding.0.system|literal}"^^xsd:anyURI ] ;
+                fhir:value  [ fhir:v "{coding.0.system|literal}" ] ;
                 ]
             ]
-            ;"""
-        return priority_line 
-    def get_period(period):
-        period_line = f"""fhir:period [
-                fhir:start [ fhir:v "{period['start']}"^^xsd:dateTime ] ;
-                fhir:end [ fhir:v "{period['end']}"^^xsd:dateTime ] 
-            ] """
-        return period_line
-    def get_type(typa):
-        codings = ""
-        for x in typa:
-            coding = f"""\t\t\tfhir:type [
-{get_coding(x['coding'])}
-            ] ;"""
-        codings = codings + coding
-        return codings  
-    def get_location(location):
-        locations = ""
-        for x in location:
-            reference = split_refrence(x['location']['reference'])
-            period = get_period(x['period'])
-            location_line = f"""fhir:location [
-                fhir:location se:{reference} ;
+            ;"""))
+    period = Section("period", template("""fhir:period [
+                fhir:start [ fhir:v "{start|literal}"^^xsd:dateTime ] ;
+                fhir:end [ fhir:v "{end|literal}"^^xsd:dateTime ] 
+            ] """))
+    location = Each("location", template("""fhir:location [
+                fhir:location se:{location.reference|ref} ;
                 {period}
             ] ;
-            """
-            locations = locations + location_line
-        return locations
-    pipeline = [
-        {"$match": {"resourceType": "Encounter"}},
-        {"$project": {"_id": 1, "id": 1, "status": 1, "class": 1, "type": 1, "subject": 1, 
-                     "location": 1, "partOf": 1, "hospitalization": 1, "identifier": 1,
-                     "meta": 1, "priority": 1, "serviceProvider": 1, "serviceType": 1, "period": 1}}
-    ]  
-    results = collection.aggregate(pipeline)
-    for result in results:
-        patient = split_refrence(result['subject']['reference'])
-        fhirID = result.get('id')
-        identifier = get_identifier_with_reference(result.get('identifier', []))
-        meta = get_meta(result.get('meta', []))
-        hospitalization = get_hospitalization(result.get('hospitalization', ""))
-        partOf = f"fhir:partOf se:{split_refrence(result['partOf']['reference'])} ;" if result.get("partOf") else ""
-        serviceProvider = f"fhir:serviceProvider se:{split_refrence(result['serviceProvider']['reference'])} ;" if result.get('serviceProvider') else ""
-        serviceType = get_serviceType(result.get('serviceType', []))
-        priority = get_priority(result.get('priority', []))
-        periodLine = get_period(result.get('period'))
-        location = get_location(result.get('location', ''))
-        type_line = get_type(result.get('type', []))   
-        insert = f"""se:{fhirID} a fhir:Encounter ;
-            fhir:id [ fhir:v "{fhirID}" ] ;
+            """,
+        period=period))
+    #only the last type of the encounter is written
+    types = Each(lambda result: result.get('type', [])[-1:], template("""\t\t\tfhir:type [
+{coding}
+            ] ;""",
+        coding=coding_section("coding", concepts)))
+    return template("""se:{id} a fhir:Encounter ;
+            fhir:id [ fhir:v "{id|literal}" ] ;
             fhir:class [
-                fhir:system  [ fhir:v "{result['class']['system']}"^^xsd:anyURI ] ;
-                fhir:code    [ fhir:v "{result['class']['code']}" ] 
+                fhir:system  [ fhir:v "{class.system|literal}"^^xsd:anyURI ] ;
+                fhir:code    [ fhir:v "{class.code|literal}" ] 
             ] ;
-            fhir:status [ fhir:v "{result['status']}" ] ;
-            {periodLine} ;
+            fhir:status [ fhir:v "{status|literal}" ] ;
+            {period} ;
             {partOf}
             {serviceProvider}
-{type_line}
+{type}
 {serviceType}{priority}
             {location}{identifier}
             {hospitalization}
-            fhir:subject se:{patient}  .
-        
-"""
-        write_to_middle(insert)
-    move_to_final()
-    time_end = time.time()
-    print(f"encounter entity creation took {time_end - time_start:.4f} seconds")
-    
-def create_procedure_entities():
-    print("creating procedure entities")
-    time_start = time.time()
-    def get_category(cat):
-        if len(cat) == 0:
-            return ""
+            fhir:subject se:{subject.reference|ref}  .
         
-        catCode = cat['coding'][0]['code']
-        catSystem = cat['coding'][0]['system']
-        return f"""fhir:category [
+""",
+        id=lambda result: str(result.get('id')),
+        period=period,
+        partOf=Section("partOf", template("""fhir:partOf se:{reference|ref} ;""")),
+        serviceProvider=Section("serviceProvider", template("""fhir:serviceProvider se:{reference|ref} ;""")),
+        type=types,
+        serviceType=serviceType,
+        priority=priority,
+        location=location,
+        identifier=identifier,
+        hospitalization=hospitalization)
+
+def create_encounter_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "encounter", ENCOUNTER_PIPELINE, encounter_renderer(writer.concepts), query, source)
+
+PROCEDURE_PIPELINE = [
+    {"$match": {"resourceType": "Procedure"}},
+    {"$project": {"_id": 1, "performedDateTime": 1, "performedPeriod": 1, "id": 1, 
+                 "status": 1, "category": 1, "code": 1, "encounter": 1, "bodySite": 1, 
+                 "subject": 1, "identifier": 1, "meta": 1}}
+]
+
+def procedure_renderer(concepts=None):
+    """
+    This fuction builds the template that converts one Procedure document into its knowledge graph entity
+    Args:
+        concepts (ConceptNodes): link the codings to concept nodes, None writes them inline
+    Returns:
+        Template: the entity template
+    """
+    def template(layout, **fields):
+        return Template(layout, fields, FILTERS)
+    category = Section("category", template("""fhir:category [
                 fhir:coding [
-                    fhir:system  [ fhir:v "{catSystem}"^^xsd:anyURI ] ;
-                    fhir:code    [ fhir:v "{catCode}" ]
+                    fhir:system  [ fhir:v "{coding.0.system|literal}"^^xsd:anyURI ] ;
+                    fhir:code    [ fhir:v "{coding.0.code|literal}" ]
                 ]
             ];
-    """   
-    def get_period(per):
-        if len(per) == 0:
-            return ""
-        
-        start = per['start']
-        end = per['end']
-        return f"""fhir:performedPeriod [
-                fhir:start [ fhir:v "{start}"^^xsd:dateTime ] ;
-                fhir:end [ fhir:v "{end}"^^xsd:dateTime ] 
+    """))
+    performedPeriod = Section("performedPeriod", template("""fhir:performedPeriod [
+                fhir:start [ fhir:v "{start|literal}"^^xsd:dateTime ] ;
+                fhir:end [ fhir:v "{end|literal}"^^xsd:dateTime ] 
                 ];
-    """   
-    def get_body(body):
-        if len(body) == 0:
-            return ""
-        
-        catCode = body[0]['coding'][0]['code']
-        catSystem = body[0]['coding'][0]['system']
-        return f"""fhir:bodySite [
-                fhir:system  [ fhir:v "{catSystem}"^^xsd:anyURI ] ;
-                fhir:code    [ fhir:v "{catCode}" ]
+    """))
+    bodySite = Section("bodySite", template("""fhir:bodySite [
+                fhir:system  [ fhir:v "{0.coding.0.system|literal}"^^xsd:anyURI ] ;
+                fhir:code    [ fhir:v "{0.coding.0.code|literal}" ]
             ];
-    """
-    
-    def get_code_list(code):
-        return get_coding(code['coding'])+";"
-    
-    pipeline = [
-        {"$match": {"resourceType": "Procedure"}},
-        {"$project": {"_id": 1, "performedDateTime": 1, "performedPeriod": 1, "id": 1, 
-                     "status": 1, "category": 1, "code": 1, "encounter": 1, "bodySite": 1, 
-                     "subject": 1, "identifier": 1, "meta": 1}}
-    ]
-    
-    results = collection.aggregate(pipeline)
-    
-    for result in results:
-        fhirID = result['id']
-        status = result['status']
-        patient_reference = split_refrence(result['subject']['reference'])
-        encounter_reference = split_refrence(result['encounter']['reference'])
-        identifier = get_identifier(result.get('identifier', []))
-        coding_list = get_code_list(result['code'])
-        meta = get_meta(result.get('meta', {}))
-        category_list = get_category(result.get('category', []))
-        performedDateTime = f"fhir:performedDateTime [ fhir:v \"{result.get('performedDateTime')}\"^^xsd:dateTime ] ;" if result.get('performedDateTime') else ""
-        performedPeriod = get_period(result.get('performedPeriod', []))
-        bodySite = get_body(result.get('bodySite', []))
-        
-        insert = f"""se:{fhirID} a fhir:Procedure;
-            fhir:id   [ fhir:v "{fhirID}" ] ;
-            fhir:status [ fhir:v "{status}" ] ;
-            fhir:encounter se:{encounter_reference} ;
+    """))
+    return template("""se:{id} a fhir:Procedure;
+            fhir:id   [ fhir:v "{id|literal}" ] ;
+            fhir:status [ fhir:v "{status|literal}" ] ;
+            fhir:encounter se:{encounter.reference|ref} ;
             {identifier}
             fhir:code [
-{coding_list}
+{coding};
             ];
-            {category_list}
+            {category}
             {performedDateTime}
             {performedPeriod}
             {bodySite}
-            fhir:subject se:{patient_reference} .
-
-"""
-        write_to_middle(insert)
-    time_end = time.time()
-    print(f"procedure entity creation took {time_end - time_start:.4f} seconds")
-    move_to_final()
-
-def create_condition_entities():
-    print("creating condition entities")
-    time_start = time.time()
-    pipeline = [
-        {"$match": {"resourceType": "Condition"}},
-        {"$project": {"_id": 1, "id": 1, "identifier": 1, "category": 1, "code": 1, 
-                     "subject": 1, "encounter": 1, "meta": 1}}
-    ]
-    
-    results = collection.aggregate(pipeline)
-    
-    for result in results:
-        fhirID = result.get('id')
-        identifier = get_identifier(result.get('identifier', []))
-        cat = result['category'][0]['coding'][0]
-        catCode = cat['code']
-        catSystem = cat['system']
-        meta = get_meta(result.get('meta', {}))
-        code = get_coding(result['code'].get('coding', []))
-        patient = split_refrence(result['subject']['reference'])
-        encounter = split_refrence(result['encounter']['reference'])
-        
-        insert = f"""se:{fhirID} a fhir:Condition;
-            fhir:id [ fhir:v "{fhirID}" ] ;
+            fhir:subject se:{subject.reference|ref} .
+
+""",
+        identifier=IDENTIFIER,
+        coding=coding_section("code.coding", concepts),
+        category=category,
+        performedDateTime=Section("performedDateTime", template("""fhir:performedDateTime [ fhir:v "{.|literal}"^^xsd:dateTime ] ;""")),
+        performedPeriod=performedPeriod,
+        bodySite=bodySite)
+
+def create_procedure_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "procedure", PROCEDURE_PIPELINE, procedure_renderer(writer.concepts), query, source)
+
+CONDITION_PIPELINE = [
+    {"$match": {"resourceType": "Condition"}},
+    {"$project": {"_id": 1, "id": 1, "identifier": 1, "category": 1, "code": 1, 
+                 "subject": 1, "encounter": 1, "meta": 1}}
+]
+
+def condition_renderer(concepts=None):
+    """
+    This fuction builds the template that converts one Condition document into its knowledge graph entity
+    Args:
+        concepts (ConceptNodes): link the codings to concept nodes, None writes them inline
+    Returns:
+        Template: the entity template
+    """
+    return Template("""se:{id} a fhir:Condition;
+            fhir:id [ fhir:v "{id|literal}" ] ;
             fhir:category [
                 fhir:coding [
-                    fhir:system  [ fhir:v "{catSystem}"^^xsd:anyURI ] ;
-                    fhir:code    [ fhir:v "{catCode}" ] 
+                    fhir:system  [ fhir:v "{category.0.coding.0.system|literal}"^^xsd:anyURI ] ;
+                    fhir:code    [ fhir:v "{category.0.coding.0.code|literal}" ] 
                 ]
             ] ;
             fhir:code [
-{code}
+{coding}
             ] ;
             {identifier}
-            fhir:encounter se:{encounter} ;
-            fhir:subject se:{patient}. 
+            fhir:encounter se:{encounter.reference|ref} ;
+            fhir:subject se:{subject.reference|ref}. 
         
-"""
-        write_to_middle(insert)
-    time_end = time.time()
-    print(f"condition entity creation took {time_end - time_start:.4f} seconds")
-    move_to_final()
-
-def create_medicationDispense_entities():
-    print("creating medication dispense entities")
-    time_start = time.time()
-    def get_dosage(dosage):
-        if len(dosage) == 0:
-            return ""
-        
-        def get_repeat(repeat):
-            if len(repeat) == 0:
-                return ""
-            
-            return f""";\n\t\t\t\t\tfhir:repeat [
-                        fhir:duration [ fhir:v "{repeat['duration']}"^^xsd:decimal ] ; 
-                        fhir:durationUnit [ fhir:v "{repeat['durationUnit']}" ]
+""", {
+        "id": lambda result: str(result.get('id')),
+        "coding": coding_section("code.coding", concepts),
+        "identifier": IDENTIFIER,
+    }, FILTERS)
+
+def create_condition_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "condition", CONDITION_PIPELINE, condition_renderer(writer.concepts), query, source)
+
+MEDICATION_DISPENSE_PIPELINE = [
+    {"$match": {"resourceType": "MedicationDispense"}},
+    {"$project": {"_id": 1, "id": 1, "identifier": 1, "context": 1, "authorizingPrescription": 1, 
+                 "medicationCodeableConcept": 1, "subject": 1, "dosageInstruction": 1, "meta": 1, "status": 1}}
+]
+
+def medicationDispense_renderer(concepts=None):
+    """
+    This fuction builds the template that converts one MedicationDispense document into its knowledge graph entity
+    Args:
+        concepts (ConceptNodes): link the codings to concept nodes, None writes them inline
+    Returns:
+        Template: the entity template
+    """
+    def template(layout, **fields):
+        return Template(layout, fields, FILTERS)
+    repeat = Section("repeat", template(""";\n\t\t\t\t\tfhir:repeat [
+                        fhir:duration [ fhir:v "{duration|literal}"^^xsd:decimal ] ; 
+                        fhir:durationUnit [ fhir:v "{durationUnit|literal}" ]
                     ]
-        """
-        
-        route_coding = get_small_coding(dosage[0]['route']['coding'])
-        route = f"""fhir:route [
-                    {route_coding}
-                ]"""
-        
-        timing = f""";\n\t\t\t\tfhir:timing [
-                       {get_small_coding(dosage[0]['timing']['code']['coding'])}{get_repeat(dosage[0]['timing'].get('repeat', []))}
-               ]""" if len(dosage[0].get('timing', [])) > 0 else ""
-        
-        maxDose = f""";\n\t\t\t\tfhir:maxDosePerPeriod [
+        """))
+    route = template("""fhir:route [
+                    {coding}
+                ]""",
+        coding=coding_section("0.route.coding", concepts, small=True))
+    timing = Section("0.timing", template(""";\n\t\t\t\tfhir:timing [
+                       {coding}{repeat}
+               ]""",
+        coding=coding_section("code.coding", concepts, small=True),
+        repeat=repeat))
+    maxDose = Section("0.maxDosePerPeriod", template(""";\n\t\t\t\tfhir:maxDosePerPeriod [
                     fhir:denominator [
-                        fhir:system [ fhir:v "{dosage[0]['maxDosePerPeriod']['denominator']['system']}"^^xsd:anyURI ] ;
-                        fhir:unit   [ fhir:v "{dosage[0]['maxDosePerPeriod']['denominator']['unit']}" ] ;
-                        fhir:value  [ fhir:v "{dosage[0]['maxDosePerPeriod']['denominator']['value']}"^^xsd:decimal ]
+                        fhir:system [ fhir:v "{denominator.system|literal}"^^xsd:anyURI ] ;
+                        fhir:unit   [ fhir:v "{denominator.unit|literal}" ] ;
+                        fhir:value  [ fhir:v "{denominator.value|literal}"^^xsd:decimal ]
                     ] ;
                     fhir:numerator [
-                        fhir:value [ fhir:v "{dosage[0]['maxDosePerPeriod']['numerator']['value']}"^^xsd:decimal ]
+                        fhir:value [ fhir:v "{numerator.value|literal}"^^xsd:decimal ]
                     ] 
                 ]
-        """ if len(dosage[0].get('maxDosePerPeriod', [])) > 0 else ""
-        
-        return route + timing + maxDose
-    
-    pipeline = [
-        {"$match": {"resourceType": "MedicationDispense"}},
-        {"$project": {"_id": 1, "id": 1, "identifier": 1, "context": 1, "authorizingPrescription": 1, 
-                     "medicationCodeableConcept": 1, "subject": 1, "dosageInstruction": 1, "meta": 1, "status": 1}}
-    ]
-    
-    results = collection.aggregate(pipeline)
-    
-    for result in results:
-        fhirID = result['id']
-        identifier = get_identifier(result.get('identifier'))
-        context = split_refrence(result['context']['reference'])
-        subject = split_refrence(result['subject']['reference'])
-        authorizingPrescription = split_refrence(result['authorizingPrescription'][0]['reference'])
-        meta = get_meta(result.get('meta', {}))
-        mccCoding = get_small_coding(result['medicationCodeableConcept']['coding'])
-        status = result['status']
-        dosage = get_dosage(result.get('dosageInstruction', []))
-        
-        insert = f"""se:{fhirID} a fhir:MedicationDispense;
-            fhir:id [ fhir:v "{fhirID}" ] ;
+        """))
+    return template("""se:{id} a fhir:MedicationDispense;
+            fhir:id [ fhir:v "{id|literal}" ] ;
             {identifier}
-            fhir:context se:{context} ;
-            fhir:subject se:{subject} ;
-            fhir:authorizingPrescription se:MR-{authorizingPrescription} ;
+            fhir:context se:{context.reference|ref} ;
+            fhir:subject se:{subject.reference|ref} ;
+            fhir:authorizingPrescription se:MR-{authorizingPrescription.0.reference|ref} ;
             fhir:medicationCodeableConcept [
-                {mccCoding}
+                {coding}
             ] ;
-            fhir:status [ fhir:v "{status}" ] ;
+            fhir:status [ fhir:v "{status|literal}" ] ;
             fhir:dosageInstruction [
                 {dosage}
             ] .
         
-"""
-        write_to_middle(insert)
-    time_end = time.time()
-    print(f"medication dispense entity creation took {time_end - time_start:.4f} seconds")
-    move_to_final()
-
-def create_medicationRequest_entities():
-    def get_dispense_request(dispense):
-        if len(dispense) == 0:
-            return ""
-        return f"""fhir:dispenseRequest [
+""",
+        identifier=IDENTIFIER,
+        coding=coding_section("medicationCodeableConcept.coding", concepts, small=True),
+        dosage=Section("dosageInstruction", template("""{route}{timing}{maxDose}""", route=route, timing=timing, maxDose=maxDose)))
+
+def create_medicationDispense_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "medication dispense", MEDICATION_DISPENSE_PIPELINE, medicationDispense_renderer(writer.concepts), query, source)
+
+MEDICATION_REQUEST_PIPELINE = [
+    {"$match": {"resourceType": "MedicationRequest"}},
+    {"$project": {"identifier": 1, "authoredOn": 1, "dispenseRequest": 1, "dosageInstruction": 1, "id": 1, "encounter": 1, "intent": 1, "type": 1,
+                 "medicationCodeableConcept": 1, "meta": 1, "status": 1, "subject": 1, "medicationReference": 1}}
+]
+
+def medicationRequest_renderer():
+    """
+    This fuction builds the template that converts one MedicationRequest document into its knowledge graph entity
+    Returns:
+        Template: the entity template
+    """
+    def template(layout, **fields):
+        return Template(layout, fields, FILTERS)
+    dispenseRequest = Section("dispenseRequest", template("""fhir:dispenseRequest [
                 fhir:validityPeriod [
-                    fhir:start [ fhir:v "{dispense['validityPeriod']['start']}"^^xsd:dateTime ] ;
-                    fhir:end [ fhir:v "{dispense['validityPeriod']['end']}"^^xsd:dateTime ]
+                    fhir:start [ fhir:v "{validityPeriod.start|literal}"^^xsd:dateTime ] ;
+                    fhir:end [ fhir:v "{validityPeriod.end|literal}"^^xsd:dateTime ]
                 ]
             ] ;
-"""
-
-    def get_dosage_instruction(dosage):
-        if len(dosage) == 0:
-            return ""
-        
-        def get_repeat(repeat):
-            if len(repeat) == 0:
-                return ""
-            return f""";\n\t\t\t\t\tfhir:repeat [
-                        fhir:duration [ fhir:v "{repeat['duration']}"^^xsd:decimal ] ; 
-                        fhir:durationUnit [ fhir:v "{repeat['durationUnit']}" ]
+"""))
+    repeat = Section("repeat", template(""";\n\t\t\t\t\tfhir:repeat [
+                        fhir:duration [ fhir:v "{duration|literal}"^^xsd:decimal ] ; 
+                        fhir:durationUnit [ fhir:v "{durationUnit|literal}" ]
                     ]
-        """
-        
-        route_coding = get_small_coding(dosage[0]['route']['coding'])
-        text_line = f";\n\t\t\t\tfhir:text [ fhir:v \"{dosage[0]['text']}\"]" if dosage[0].get('text') else ""
-        route = f"""\t\tfhir:route [
+        """))
+    route = template("""\t\tfhir:route [
                     fhir:coding [
-                        fhir:system  [ fhir:v "{dosage[0]['route']['coding'][0]['system']}"^^xsd:anyURI ] ;
-                        fhir:code    [ fhir:v "{dosage[0]['route']['coding'][0]['code']}" ]
+                        fhir:system  [ fhir:v "{0.route.coding.0.system|literal}"^^xsd:anyURI ] ;
+                        fhir:code    [ fhir:v "{0.route.coding.0.code|literal}" ]
                     ]
-                ] {text_line}"""
-        
-        timing = f"""fhir:timing [
+                ] {text}""",
+        text=Section("0.text", template(""";\n\t\t\t\tfhir:text [ fhir:v "{.|literal}"]""")))
+    timing = Section("0.timing", template("""fhir:timing [
                     fhir:coding [
-                        fhir:system  [ fhir:v "{dosage[0]['timing']['code']['coding'][0]['system']}"^^xsd:anyURI ] ;
-                        fhir:code    [ fhir:v "{dosage[0]['timing']['code']['coding'][0]['code']}" ]
-                    ]{get_repeat(dosage[0]['timing'].get('repeat', []))}
+                        fhir:system  [ fhir:v "{code.coding.0.system|literal}"^^xsd:anyURI ] ;
+                        fhir:code    [ fhir:v "{code.coding.0.code|literal}" ]
+                    ]{repeat}
                 ] ;
-""" if len(dosage[0].get('timing', [])) > 0 else ""
-        
-        maxDose = f"""fhir:maxDosePerPeriod [
+""",
+        repeat=repeat))
+    maxDose = Section("0.maxDosePerPeriod", template("""fhir:maxDosePerPeriod [
                     fhir:denominator [
-                        fhir:system [ fhir:v "{dosage[0]['maxDosePerPeriod']['denominator']['system']}"^^xsd:anyURI ] ;
-                        fhir:unit   [ fhir:v "{dosage[0]['maxDosePerPeriod']['denominator']['unit']}" ] ;
-                        fhir:value  [ fhir:v "{dosage[0]['maxDosePerPeriod']['denominator']['value']}"^^xsd:decimal ]
+                        fhir:system [ fhir:v "{denominator.system|literal}"^^xsd:anyURI ] ;
+                        fhir:unit   [ fhir:v "{denominator.unit|literal}" ] ;
+                        fhir:value  [ fhir:v "{denominator.value|literal}"^^xsd:decimal ]
                     ] ;
                     fhir:numerator [
-                        fhir:value [ fhir:v "{dosage[0]['maxDosePerPeriod']['numerator']['value']}"^^xsd:decimal ]
+                        fhir:value [ fhir:v "{numerator.value|literal}"^^xsd:decimal ]
                     ] 
                 ] ;
-""" if len(dosage[0].get('maxDosePerPeriod', [])) > 0 else ""
-        
-        doseAndRate = f"""\t\t\t\tfhir:doseAndRate [
+"""))
+    doseAndRate = Section("0.doseAndRate", template("""\t\t\t\tfhir:doseAndRate [
                     fhir:doseQuantity [
-                        fhir:system [ fhir:v "{dosage[0]['doseAndRate'][0]['doseQuantity']['system']}"^^xsd:anyURI ] ;
-                        fhir:unit   [ fhir:v "{dosage[0]['doseAndRate'][0]['doseQuantity']['unit']}" ] ;
-                        fhir:value  [ fhir:v "{dosage[0]['doseAndRate'][0]['doseQuantity']['value']}"^^xsd:decimal ] ;
-                        fhir:code    [ fhir:v "{dosage[0]['doseAndRate'][0]['doseQuantity']['code']}" ]
+                        fhir:system [ fhir:v "{0.doseQuantity.system|literal}"^^xsd:anyURI ] ;
+                        fhir:unit   [ fhir:v "{0.doseQuantity.unit|literal}" ] ;
+                        fhir:value  [ fhir:v "{0.doseQuantity.value|literal}"^^xsd:decimal ] ;
+                        fhir:code    [ fhir:v "{0.doseQuantity.code|literal}" ]
                     ]
                 ] ; 
-        """ if len(dosage[0].get('doseAndRate', [])) > 0 else ""
-
-        return timing + maxDose + doseAndRate + route
-
-    def get_mr_identifier(identifier):
-        return f"""fhir:identifier [
-                fhir:system [ fhir:v "{identifier[0]['system']}"^^xsd:anyURI ] ;
-                fhir:value  [ fhir:v "{identifier[0]['value']}" ] ;
+        """))
+    identifier = template("""fhir:identifier [
+                fhir:system [ fhir:v "{identifier.0.system|literal}"^^xsd:anyURI ] ;
+                fhir:value  [ fhir:v "{identifier.0.value|literal}" ] ;
                 fhir:type [
                     fhir:coding [
-                        fhir:system  [ fhir:v "{identifier[0]['type']['coding'][0]['system']}"^^xsd:anyURI ] ;
-                        fhir:code    [ fhir:v "{identifier[0]['type']['coding'][0]['code']}" ] ;
-                        fhir:display [ fhir:v "{identifier[0]['type']['coding'][0]['display']}" ]
+                        fhir:system  [ fhir:v "{identifier.0.type.coding.0.system|literal}"^^xsd:anyURI ] ;
+                        fhir:code    [ fhir:v "{identifier.0.type.coding.0.code|literal}" ] ;
+                        fhir:display [ fhir:v "{identifier.0.type.coding.0.display|literal}" ]
                     ]
                 ]
             ] ;
 
-"""
-
-    def get_mcc(mcc):
-        if len(mcc) == 0:
-            return ""
-        return f"""fhir:medicationCodeableConcept [
+""")
+    mcc = Section("medicationCodeableConcept", template("""fhir:medicationCodeableConcept [
             fhir:coding [
-                fhir:system  [ fhir:v "{mcc['coding'][0]['system']}"^^xsd:anyURI ] ;
-                fhir:code    [ fhir:v "{mcc['coding'][0]['code']}" ] 
+                fhir:system  [ fhir:v "{coding.0.system|literal}"^^xsd:anyURI ] ;
+                fhir:code    [ fhir:v "{coding.0.code|literal}" ] 
             ]
         ] ;
-"""
-
-    time_start = time.time()
-    print("creating medication request entities")
-    pipeline = [
-        {"$match": {"resourceType": "MedicationRequest"}},
-        {"$project": {"identifier": 1, "authoredOn": 1, "dispenseRequest": 1, "dosageInstruction": 1, "id": 1, "encounter": 1, "intent": 1, "type": 1,
-                     "medicationCodeableConcept": 1, "meta": 1, "status": 1, "subject": 1, "medicationReference": 1}}
-    ]
-    results = collection.aggregate(pipeline)
-    for result in results:
-        fhirID = result.get('id')
-        meta = get_meta(result.get('meta', {}))
-        authoredOn = result['authoredOn']
-        subject = split_refrence(result['subject']['reference'])
-        encounter = split_refrence(result['encounter']['reference'])
-        dispenseRequest = get_dispense_request(result.get('dispenseRequest', []))
-        dosageInstruction = get_dosage_instruction(result.get('dosageInstruction', []))
-        identifier = get_mr_identifier(result['identifier'])
-        mcc = get_mcc(result.get('medicationCodeableConcept', []))
-        intent = result['intent']
-        status = result['status']
-        medication = f"fhir:medicationReference se:{split_refrence(result['medicationReference']['reference'])} ;" if len(result.get('medicationReference', [])) > 0 else ""
-        insert = f"""se:MR-{fhirID} a fhir:MedicationRequest ;
-            fhir:id [ fhir:v "{fhirID}" ] ;
-            fhir:encounter se:{encounter}  ;
-            fhir:subject se:{subject}  ;
-            fhir:intent [ fhir:v "{intent}" ] ;
-            fhir:status [ fhir:v "{status}"] ;
+"""))
+    return template("""se:MR-{id} a fhir:MedicationRequest ;
+            fhir:id [ fhir:v "{id|literal}" ] ;
+            fhir:encounter se:{encounter.reference|ref}  ;
+            fhir:subject se:{subject.reference|ref}  ;
+            fhir:intent [ fhir:v "{intent|literal}" ] ;
+            fhir:status [ fhir:v "{status|literal}"] ;
             {medication}
             {dispenseRequest}
             fhir:dosageInstruction [
@@ -1025,374 +2349,333 @@ def create_medicationRequest_entities():
             ] ;
             {identifier}
             {mcc}
-            fhir:authoredOn [ fhir:v "{authoredOn}"^^xsd:dateTime ] .
+            fhir:authoredOn [ fhir:v "{authoredOn|literal}"^^xsd:dateTime ] .
         
-"""
-        write_to_middle(insert)
-    time_end = time.time()
-    print(f"medication request entity creation took {time_end - time_start:.4f} seconds")
-    move_to_final()
-
-def create_specimen_entities():
-    def get_specimen_type(typa):
-        display=f";\n\t\t\t\t\tfhir:display [ fhir:v \"{typa['coding'][0]['display']}\" ]" if typa['coding'][0].get('display') else ""
-        return f"""fhir:type [
+""",
+        id=lambda result: str(result.get('id')),
+        medication=Section("medicationReference", template("""fhir:medicationReference se:{reference|ref} ;""")),
+        dispenseRequest=dispenseRequest,
+        dosageInstruction=Section("dosageInstruction", template("""{timing}{maxDose}{doseAndRate}{route}""",
+            timing=timing, maxDose=maxDose, doseAndRate=doseAndRate, route=route)),
+        identifier=identifier,
+        mcc=mcc)
+
+def create_medicationRequest_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "medication request", MEDICATION_REQUEST_PIPELINE, medicationRequest_renderer(), query, source)
+
+SPECIMEN_PIPELINE = [
+    {"$match":{"resourceType":"Specimen"}},
+    {"$project":{"_id":1,"id":1,"identifier":1,"collection":1,"type":1,"subject":1,"meta":1}}
+]
+
+def specimen_renderer(specimens=None):
+    """
+    This fuction builds the template that converts one Specimen document into its knowledge graph entity
+    Args:
+        specimens (SharedNodes): the Specimen ids written so far, a Specimen that is in more than one document is written once
+    Returns:
+        Template: the entity template, empty for a Specimen that was written already
+    """
+    def template(layout, **fields):
+        return Template(layout, fields, FILTERS)
+    if specimens is None:
+        specimens = SharedNodes("specimen-")
+
+    #the writer asks twice for a document it both renders and emits the triples of (integrity=True), it lets it through both times
+    last = None
+
+    def first_seen(result):
+        nonlocal last
+        if result is not last and not specimens.node(result.get('id'))[1]:
+            return None
+        last = result
+        return result
+    specimen_type = Section("type", template("""fhir:type [
                 fhir:coding[
-                    fhir:system  [ fhir:v "{typa['coding'][0]['system']}"^^xsd:anyURI ] ;
-                    fhir:code    [ fhir:v "{typa['coding'][0]['code']}" ] {display}
+                    fhir:system  [ fhir:v "{coding.0.system|literal}"^^xsd:anyURI ] ;
+                    fhir:code    [ fhir:v "{coding.0.code|literal}" ] {display}
                 ]
             ] ;
-            """
-    def get_collection(col):
-        if len(col)==0:
-            return ""
-        return f"""fhir:collection [
-                fhir:collectedDateTime [ fhir:v "{col['collectedDateTime']}"^^xsd:dateTime ] 
-            ] ; 
-            """
-        pass
-    time_start = time.time()
-    print("creating specimen entities")
-    pipeline = [
-        {"$match":{"resourceType":"Specimen"}},
-        {"$project":{"_id":1,"id":1,"identifier":1,"collection":1,"type":1,"subject":1,"meta":1}}
-    ]
-    results = collection.aggregate(pipeline)
-    hashset=set()
-    for result in results:
-        fhirID=result.get('id')
-        if fhirID in hashset:
-            continue
-        hashset.add(fhirID)
-        identifier = get_identifier(result.get('identifier', []))
-        meta = get_meta(result.get('meta', {}))
-        type_list = get_specimen_type(result.get('type', []))
-        subject = split_refrence(result['subject']['reference'])
-        collectedDateTime = f"\t\t\tfhir:collectedDateTime [ fhir:v \"{result['collection']['collectedDateTime']}\"^^xsd:dateTime ] ;" if len(result.get('collection',[]))!=0 else ""
-        insert =f"""se:{fhirID} a fhir:Specimen ;
-            fhir:id [ fhir:v "{fhirID}" ] ;
+            """,
+        display=Section("coding.0.display", template(""";\n\t\t\t\t\tfhir:display [ fhir:v "{.|literal}" ]"""))))
+    specimen = template("""se:{id} a fhir:Specimen ;
+            fhir:id [ fhir:v "{id|literal}" ] ;
             {identifier}
-            {type_list}
+            {type}
 {collectedDateTime}
-            fhir:subject se:{subject} .
+            fhir:subject se:{subject.reference|ref} .
         
-"""
-        write_to_middle(insert)
-    time_end = time.time()
-    print(f"specimen entity creation took {time_end - time_start:.4f} seconds")
-    move_to_final()
-
-def create_medication_entities():
-    def get_medication_identifier(identifier):
-        identifiers=""
-        for x in identifier:
-            identifiers=identifiers+f"""\t\t\tfhir:identifier [
-                fhir:system [ fhir:v "{x['system']}"^^xsd:anyURI ] ;
-                fhir:value  [ fhir:v "{escape_turtle_string(x['value'])}" ]
+""",
+        id=lambda result: str(result.get('id')),
+        identifier=IDENTIFIER,
+        type=specimen_type,
+        collectedDateTime=Section("collection", template("""\t\t\tfhir:collectedDateTime [ fhir:v "{collectedDateTime|literal}"^^xsd:dateTime ] ;""")))
+    return template("""{specimen}""", specimen=Section(first_seen, specimen))
+
+def create_specimen_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "specimen", SPECIMEN_PIPELINE, specimen_renderer(writer.specimens), query, source)
+
+MEDICATION_PIPELINE = [
+    {"$match":{"resourceType":"Medication"}},
+    {"$project":{"_id":1,"id":1,"identifier":1,"ingredient":1,"code":1,"meta":1}}
+]
+
+def medication_renderer():
+    """
+    This fuction builds the template that converts one Medication document into its knowledge graph entity
+    Returns:
+        Template: the entity template
+    """
+    def template(layout, **fields):
+        return Template(layout, fields, FILTERS)
+    identifier = Each("identifier", template("""\t\t\tfhir:identifier [
+                fhir:system [ fhir:v "{system|literal}"^^xsd:anyURI ] ;
+                fhir:value  [ fhir:v "{value|literal}" ]
             ] ;
-"""
-        return identifiers
-    def get_ingredients(ing):
-        if len(ing)==0:
-            return ""
-        ingredients=""
-        for x in ing:
-            ingredients=ingredients + f"\t\t\tfhir:ingredient se:{split_refrence(x['itemReference']['reference'])} ;\n"
-        return ingredients
-    def get_medication_code(coda):
-        if len(coda)==0:
-            return ""
-        return f"""fhir:code [
+"""))
+    code = Section("code", template("""fhir:code [
                 fhir:coding [
-                    fhir:system  [ fhir:v "{coda['coding'][0]['code']}"^^xsd:anyURI ] ;
-                    fhir:code    [ fhir:v "{coda['coding'][0]['code']}" ]
+                    fhir:system  [ fhir:v "{coding.0.code|literal}"^^xsd:anyURI ] ;
+                    fhir:code    [ fhir:v "{coding.0.code|literal}" ]
                 ] 
             ];
-"""
-    time_start = time.time()
-    print("creating Medication entities")
-    pipeline = [
-        {"$match":{"resourceType":"Medication"}},
-        {"$project":{"_id":1,"id":1,"identifier":1,"ingredient":1,"code":1,"meta":1}}
-    ]
-    results = collection.aggregate(pipeline)
-    for result in results:
-        fhirID=result.get('id')
-        identifier=get_medication_identifier(result['identifier'])
-        code=get_medication_code(result.get('code',[]))
-        meta = get_meta(result.get('meta', {}))
-        ingredients=get_ingredients(result.get('ingredient',[]))
-        insert =f"""se:{fhirID} a fhir:Medication ;
+"""))
+    return template("""se:{id} a fhir:Medication ;
 {identifier}
 {ingredients}
             {code}
-            fhir:id [ fhir:v "{fhirID}" ] .
+            fhir:id [ fhir:v "{id|literal}" ] .
 
-"""
-        write_to_middle(insert)
-    time_end = time.time()
-    print(f"medication entity creation took {time_end - time_start:.4f} seconds")
-    move_to_final()
-
-def create_medicationAdministration_entities():
-    def get_category(cat):
-        if len(cat)==0:
-            return ""
-        return f"""\t\t\tfhir:category [
+""",
+        id=lambda result: str(result.get('id')),
+        identifier=identifier,
+        ingredients=Each("ingredient", template("""\t\t\tfhir:ingredient se:{itemReference.reference|ref} ;\n""")),
+        code=code)
+
+def create_medication_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "medication", MEDICATION_PIPELINE, medication_renderer(), query, source)
+
+MEDICATION_ADMINISTRATION_PIPELINE = [
+    {"$match":{"resourceType":"MedicationAdministration"}},
+    {"$project":{"id":1,"meta":1,"category":1,"context":1,"dosage":1,"effectiveDateTime":1,"identifier":1,
+                 "medicationCodeableConcept":1,"request":1,"status":1,"subject":1, "effectivePeriod":1}}
+]
+
+def medicationAdministration_renderer(compact=False, concepts=None):
+    """
+    This fuction builds the template that converts one MedicationAdministration document into its knowledge graph entity
+    Args:
+        compact (bool): leave the cosmetic whitespace out of the entity
+        concepts (ConceptNodes): link the codings to concept nodes, None writes them inline
+    Returns:
+        Template: the entity template
+    """
+    def template(layout, **fields):
+        return Template(layout, fields, FILTERS, compact)
+    category = Section("category", template("""\t\t\tfhir:category [
                 fhir:coding [
-                    fhir:system  [ fhir:v "{cat['coding'][0]['system']}"^^xsd:anyURI ] ;
-                    fhir:code    [ fhir:v "{cat['coding'][0]['code']}" ]
+                    fhir:system  [ fhir:v "{coding.0.system|literal}"^^xsd:anyURI ] ;
+                    fhir:code    [ fhir:v "{coding.0.code|literal}" ]
                 ] 
             ];
-"""
-    def get_dosage(dosage):
-        if len(dosage)==0:
-            return ""
-        text = f"\t\t\t\tfhir:text [ fhir:v \"{dosage['text']}\" ] ;\n" if dosage.get('text',None) else ""
-        rateQuantity = f"""\t\t\t\tfhir:rateQuantity [
-                    fhir:system [ fhir:v "{dosage['rateQuantity']['system']}"^^xsd:anyURI ] ;
-                    fhir:unit   [ fhir:v "{dosage['rateQuantity']['unit']}" ] ;
-                    fhir:value  [ fhir:v "{dosage['rateQuantity']['value']}"^^xsd:decimal ] ;
-                    fhir:code    [ fhir:v "{dosage['rateQuantity']['code']}" ] 
+"""))
+    dose = template("""\t\t\t\tfhir:dose [
+                    fhir:system [ fhir:v "{dose.system|literal}"^^xsd:anyURI ] ;
+                    fhir:value  [ fhir:v "{dose.value|literal}"^^xsd:decimal ]{code}{unit}
+                ]
+""",
+        code=Section("dose.code", template(""" ;\n\t\t\t\t\tfhir:code    [ fhir:v "{.|literal}" ]""")),
+        unit=Section("dose.unit", template(""" ;\n\t\t\t\t\tfhir:unit   [ fhir:v "{.|literal}" ]""")))
+    dosage = Section("dosage", template("""\t\t\tfhir:dosage [
+{rateQuantity}{text}{method}{dose}
+            ] ;
+""",
+        text=Section("text", template("""\t\t\t\tfhir:text [ fhir:v "{.|literal}" ] ;\n""")),
+        rateQuantity=Section("rateQuantity", template("""\t\t\t\tfhir:rateQuantity [
+                    fhir:system [ fhir:v "{system|literal}"^^xsd:anyURI ] ;
+                    fhir:unit   [ fhir:v "{unit|literal}" ] ;
+                    fhir:value  [ fhir:v "{value|literal}"^^xsd:decimal ] ;
+                    fhir:code    [ fhir:v "{code|literal}" ] 
                 ] ;
-""" if dosage.get('rateQuantity',None) else ""
-        method = f"""\t\t\t\tfhir:method [
+""")),
+        method=Section("method", template("""\t\t\t\tfhir:method [
                     fhir:coding [
-                        fhir:system [ fhir:v "{dosage['method']['coding'][0]['system']}"^^xsd:anyURI ] ;
-                        fhir:code    [ fhir:v "{dosage['method']['coding'][0]['code']}" ] 
+                        fhir:system [ fhir:v "{coding.0.system|literal}"^^xsd:anyURI ] ;
+                        fhir:code    [ fhir:v "{coding.0.code|literal}" ] 
                     ]
                 ] ;
-""" if dosage.get('method',None) else ""
-        dose_code=f" ;\n\t\t\t\t\tfhir:code    [ fhir:v \"{escape_turtle_string(dosage['dose']['code'])}\" ]" if dosage['dose'].get('code') else ""
-        dose_unit=f" ;\n\t\t\t\t\tfhir:unit   [ fhir:v \"{escape_turtle_string(dosage['dose']['unit'])}\" ]" if dosage['dose'].get('unit') else ""
-        dose = f"""\t\t\t\tfhir:dose [
-                    fhir:system [ fhir:v "{dosage['dose']['system']}"^^xsd:anyURI ] ;
-                    fhir:value  [ fhir:v "{dosage['dose']['value']}"^^xsd:decimal ]{dose_code}{dose_unit}
-                ]
-"""
-        return f"""\t\t\tfhir:dosage [
-{rateQuantity}{text}{method}{dose}
-            ] ;
-"""
-    def get_period(period):
-        if len(period)==0:
-            return ""
-        period_line = f"""\t\t\tfhir:effectivePeriod [
-                fhir:start [ fhir:v "{period['start']}"^^xsd:dateTime ] ;
-                fhir:end [ fhir:v "{period['end']}"^^xsd:dateTime ] 
+""")),
+        dose=dose))
+    period = Section("effectivePeriod", template("""\t\t\tfhir:effectivePeriod [
+                fhir:start [ fhir:v "{start|literal}"^^xsd:dateTime ] ;
+                fhir:end [ fhir:v "{end|literal}"^^xsd:dateTime ] 
             ] ;
-"""
-        return period_line
-    def get_medication_code(coda):
-        if len(coda)==0:
-            return ""
-        display=f" ;\n\t\t\t\t\tfhir:display [ fhir:v \"{coda['coding'][0]['display']}\" ]" if coda['coding'][0].get('display',None) else ""
-        return f"""\t\t\tfhir:code [
+"""))
+    #the system of the medication code is written from the code
+    medication_code = Section("medicationCodeableConcept", template("""\t\t\tfhir:code [
                 fhir:coding [
-                    fhir:system  [ fhir:v "{coda['coding'][0]['code']}"^^xsd:anyURI ] ;
-                    fhir:code    [ fhir:v "{coda['coding'][0]['code']}" ]{display}
+                    fhir:system  [ fhir:v "{coding.0.code|literal}"^^xsd:anyURI ] ;
+                    fhir:code    [ fhir:v "{coding.0.code|literal}" ]{display}
                 ]
             ] ;
-"""
-    def get_ma_identifier(iden):
-        return f"""\t\t\tfhir:identifier [
-                fhir:system  [ fhir:v "{iden['system']}"^^xsd:anyURI ] ;
-                fhir:value  [ fhir:v "{iden['value']}" ];
+""",
+        display=Section("coding.0.display", template(""" ;\n\t\t\t\t\tfhir:display [ fhir:v "{.|literal}" ]"""))))
+    identifier = template("""\t\t\tfhir:identifier [
+                fhir:system  [ fhir:v "{identifier.0.system|literal}"^^xsd:anyURI ] ;
+                fhir:value  [ fhir:v "{identifier.0.value|literal}" ];
                 fhir:type [
                     fhir:coding [
-                        fhir:system  [ fhir:v "{iden['type']['coding'][0]['system']}"^^xsd:anyURI ] ;
-                        fhir:code    [ fhir:v "{iden['type']['coding'][0]['code']}" ] ;
-                        fhir:display [ fhir:v "{iden['type']['coding'][0]['display']}" ]
+                        fhir:system  [ fhir:v "{identifier.0.type.coding.0.system|literal}"^^xsd:anyURI ] ;
+                        fhir:code    [ fhir:v "{identifier.0.type.coding.0.code|literal}" ] ;
+                        fhir:display [ fhir:v "{identifier.0.type.coding.0.display|literal}" ]
                     ]
                 ]
             ] ;
-"""
-    time_start = time.time()
-    print("creating medication administration entities")
-    pipeline = [
-        {"$match":{"resourceType":"MedicationAdministration"}},
-        {"$project":{"id":1,"meta":1,"category":1,"context":1,"dosage":1,"effectiveDateTime":1,"identifier":1,
-                     "medicationCodeableConcept":1,"request":1,"status":1,"subject":1, "effectivePeriod":1}}
-    ]
-    results = collection.aggregate(pipeline)
-    for result in results:
-        fhirID=result.get('id')
-        effectiveDateTime =f"\t\t\tfhir:effectiveDateTime [ fhir:v \"{result['effectiveDateTime']}\"^^xsd:dateTime ] ;" if len(result.get('effectiveDateTime',[])) else ""
-        request =f"\t\t\tfhir:request se:{split_refrence(result['request']['reference'])} ;" if len(result.get('request',[]))!=0 else ""
-        context =f"\t\t\tfhir:context se:{split_refrence(result['context']['reference'])} ;" if len(result.get('context',[]))!=0 else ""
-        meta = get_meta(result.get('meta', {}))
-        category=get_category(result.get('category',[]))
-        dosage=get_dosage(result.get('dosage',[]))
-        period=get_period(result.get('effectivePeriod',[]))
-        mcc=get_medication_code(result['medicationCodeableConcept'])
-        status=result['status']
-        subject=split_refrence(result['subject']['reference'])
-        identifer=get_ma_identifier(result['identifier'][0])
-        insert =f"""se:{fhirID} a fhir:MedicationAdministration ;
-            fhir:id [ fhir:v "{fhirID}" ] ;
+""")
+    #in concept mode the codeable concepts link to the concept node of their first coding, the medication code keeps its own system
+    if concepts is not None:
+        category = Section("category", template("""\t\t\tfhir:category [ fhir:coding {concept} ] ;\n""", concept=concept_link(concepts, "coding.0")))
+        medication_code = Section("medicationCodeableConcept", template("""\t\t\tfhir:code [ fhir:coding {concept} ] ;\n""", concept=concept_link(concepts, "coding.0")))
+    entity = template("""se:{id} a fhir:MedicationAdministration ;
+            fhir:id [ fhir:v "{id|literal}" ] ;
 {request}
-{mcc}
-{identifer}
+{medication_code}
+{identifier}
 {category}
 {context}
 {period}
 {effectiveDateTime}
 {dosage}
-            fhir:subject se:{subject} ; 
-            fhir:status [ fhir:v "{status}"] .
-
-"""
-        write_to_middle(insert)
-    time_end = time.time()
-    print(f"medication administration entity creation took {time_end - time_start:.4f} seconds")
-    move_to_final()
-
-def create_observation_entities():
-    def get_category(cat):
-        return f"""\t\t\tfhir:category [
+            fhir:subject se:{subject.reference|ref} ; 
+            fhir:status [ fhir:v "{status|literal}"] .
+
+""",
+        id=lambda result: str(result.get('id')),
+        request=Section("request", template("""\t\t\tfhir:request se:{reference|ref} ;""")),
+        context=Section("context", template("""\t\t\tfhir:context se:{reference|ref} ;""")),
+        effectiveDateTime=Section("effectiveDateTime", template("""\t\t\tfhir:effectiveDateTime [ fhir:v "{.|literal}"^^xsd:dateTime ] ;""")),
+        medication_code=medication_code,
+        identifier=identifier,
+        category=category,
+        period=period,
+        dosage=dosage)
+    return entity
+
+def create_medicationAdministration_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "medication administration", MEDICATION_ADMINISTRATION_PIPELINE, medicationAdministration_renderer(writer.compact, writer.concepts), query, source)
+
+OBSERVATION_PIPELINE = [
+    {"$match":{"resourceType":"Observation","dataAbsentRearson":{"$exists": False}}},
+    {"$project":{"id":1,"category":1,"code":1,"derivedFrom":1,"effectiveDateTime":1,"encounter":1,"extension":1,"specimen":1,
+                 "status":1,"subject":1,"identifier":1,"meta":1,"hasMember":1,"interpretation":1,"issued":1,"valueDateTime":1,
+                 "valueString":1,"note":1,"referenceRange":1,"valueCodeableConcept":1,"valueQuantity":1}}
+]
+
+def observation_renderer(compact=False, concepts=None):
+    """
+    This fuction builds the template that converts one Observation document into its knowledge graph entity
+    Args:
+        compact (bool): leave the cosmetic whitespace out of the entity
+        concepts (ConceptNodes): link the codings to concept nodes, None writes them inline
+    Returns:
+        Template: the entity template
+    """
+    def template(layout, **fields):
+        return Template(layout, fields, FILTERS, compact)
+    category = template("""\t\t\tfhir:category [
                 fhir:coding [
-                    fhir:system  [ fhir:v "{cat[0]['coding'][0]['system']}"^^xsd:anyURI ] ;
-                    fhir:code    [ fhir:v "{cat[0]['coding'][0]['code']}" ] 
+                    fhir:system  [ fhir:v "{category.0.coding.0.system|literal}"^^xsd:anyURI ] ;
+                    fhir:code    [ fhir:v "{category.0.coding.0.code|literal}" ] 
                 ]
             ] .
-"""
-    def get_o_code(code):
-        return f"""\t\t\tfhir:code [
+""")
+    #the code of the observation is written from the system
+    code = template("""\t\t\tfhir:code [
                 fhir:coding [
-                    fhir:system  [ fhir:v "{code['coding'][0]['system']}"^^xsd:anyURI ] ;
-                    fhir:code    [ fhir:v "{code['coding'][0]['system']}" ] ;
-                    fhir:display [ fhir:v "{code['coding'][0]['display']}" ]
+                    fhir:system  [ fhir:v "{code.coding.0.system|literal}"^^xsd:anyURI ] ;
+                    fhir:code    [ fhir:v "{code.coding.0.system|literal}" ] ;
+                    fhir:display [ fhir:v "{code.coding.0.display|literal}" ]
                 ]
             ];
-"""
-    def get_extension(ex):
-        if len(ex)==0:
-            return ""
-        comparator=f"\t\t\t\t\tfhir:comparator [ fhir:v \"{ex[0]['valueQuantity']['comparator']}\" ] ;" if len(ex[0].get('valueQuantity',[]))!=0 and len(ex[0]['valueQuantity'].get('comparator',[]))!=0 else ""
-        valueQuantity=f"""\t\t\t\tfhir:valueQuantity [
-{comparator}
-                    fhir:value [ fhir:v "{ex[0]['valueQuantity']['value']}" ] 
-                ] ;
-""" if len(ex[0].get('valueQuantity',[]))!=0 else ""
-        valueString=f"\t\t\t\tfhir:valueString [ fhir:v \"{ex[0]['valueString']}\" ] ;" if len(ex[0].get('valueString',[]))!=0 else ""
-        return f"""\t\t\tfhir:extension [
+""")
+    extension = Section("extension", template("""\t\t\tfhir:extension [
 {valueString}
 {valueQuantity}
-                fhir:url  [ fhir:v "{ex[0]['url']}"^^xsd:anyURI ]
+                fhir:url  [ fhir:v "{0.url|literal}"^^xsd:anyURI ]
             ] ;
-    """
-    def get_members(members):
-        if len(members)==0:
-            return ""
-        references=""
-        for x in members:
-            references=references+f"\t\t\tfhir:hasMember se:{split_refrence(x['reference'])} ;\n"
-        return references
-    def get_interpretation(inter):
-        if len(inter)==0:
-            return ""
-        return f"""fhir:interpretation [
+    """,
+        valueString=Section("0.valueString", template("""\t\t\t\tfhir:valueString [ fhir:v "{.|literal}" ] ;""")),
+        valueQuantity=Section("0.valueQuantity", template("""\t\t\t\tfhir:valueQuantity [
+{comparator}
+                    fhir:value [ fhir:v "{value|literal}" ] 
+                ] ;
+""",
+            comparator=Section("comparator", template("""\t\t\t\t\tfhir:comparator [ fhir:v "{.|literal}" ] ;"""))))))
+    interpretation = Section("interpretation", template("""fhir:interpretation [
                 fhir:coding [
-                    fhir:system  [ fhir:v "{inter[0]['coding'][0]['system']}"^^xsd:anyURI ] ;
-                    fhir:code    [ fhir:v "{inter[0]['coding'][0]['code']}" ] 
+                    fhir:system  [ fhir:v "{0.coding.0.system|literal}"^^xsd:anyURI ] ;
+                    fhir:code    [ fhir:v "{0.coding.0.code|literal}" ] 
                 ]
             ] ;
-"""
-    def get_note(note):
-        if len(note)==0:
-            return ""
-        return f"""\t\t\tfhir:note [
-                fhir:text [ fhir:v "{sanitize_for_kg_literal(note[0]['text'])}" ]
+"""))
+    note = Section("note", template("""\t\t\tfhir:note [
+                fhir:text [ fhir:v "{0.text|literal}" ]
             ] ;
-"""
-    def get_referenceRange(rr):
-        if len(rr)==0:
-            return ""
-        high_unit=f";\n\t\t\t\t\tfhir:unit   [ fhir:v \"{rr[0]['high']['unit']}\" ]" if len(rr[0].get('high',[]))!=0 and rr[0]['high'].get('unit',None) else ""
-        high_value=f";\n\t\t\t\t\tfhir:value   [ fhir:v \"{rr[0]['high']['value']}\" ]" if len(rr[0].get('high',[]))!=0 and rr[0]['high'].get('value',None) else ""
-        high_code=f";\n\t\t\t\t\tfhir:code   [ fhir:v \"{rr[0]['high']['code']}\" ]" if len(rr[0].get('high',[]))!=0 and rr[0]['high'].get('code',None) else ""
-        high=f"""\t\t\t\tfhir:high [
-                    fhir:system [ fhir:v \"{rr[0]['high']['system']}\"^^xsd:anyURI ]{high_unit}{high_value}{high_code}
-                ]""" if len(rr[0].get('high',[]))!=0 else ""
-        
-        low_unit=f";\n\t\t\t\t\tfhir:unit   [ fhir:v \"{rr[0]['low']['unit']}\" ]" if len(rr[0].get('low',[]))!=0 and rr[0]['low'].get('unit',None) else ""
-        low_value=f";\n\t\t\t\t\tfhir:value   [ fhir:v \"{rr[0]['low']['value']}\" ]" if len(rr[0].get('low',[]))!=0 and rr[0]['low'].get('value',None) else ""
-        low_code=f";\n\t\t\t\t\tfhir:code   [ fhir:v \"{rr[0]['low']['code']}\" ]" if len(rr[0].get('low',[]))!=0 and rr[0]['low'].get('code',None) else ""
-        low=f"""\t\t\t\tfhir:low [
-                    fhir:system [ fhir:v \"{rr[0]['low']['system']}\"^^xsd:anyURI ]{low_unit}{low_value}{low_code}
-                ]
-""" if len(rr[0].get('low',[]))!=0 else ""
-        space=""
-        if low!=""and high!="":
-            space=";"
-        return f"""\t\t\tfhir:referenceRange [
+"""))
+
+    #the high and low limits of the range share a layout, the low one ends its line
+    def get_limit(name, end):
+        return Section(f"0.{name}", template(f"""\t\t\t\tfhir:{name} [
+                    fhir:system [ fhir:v "{{system|literal}}"^^xsd:anyURI ]{{unit}}{{value}}{{code}}
+                ]{end}""",
+            unit=Section("unit", template(""";\n\t\t\t\t\tfhir:unit   [ fhir:v "{.|literal}" ]""")),
+            value=Section("value", template(""";\n\t\t\t\t\tfhir:value   [ fhir:v "{.|literal}" ]""")),
+            code=Section("code", template(""";\n\t\t\t\t\tfhir:code   [ fhir:v "{.|literal}" ]"""))))
+    referenceRange = Section("referenceRange", template("""\t\t\tfhir:referenceRange [
 {high}{space}
 {low}
             ] ;
-"""
-    def get_vcc(vcc):
-        if len(vcc)==0:
-            return ""
-        display=f";\n\t\t\t\t\tfhir:display [ fhir:v \"{vcc['coding'][0]['display']}\" ]" if vcc['coding'][0].get('display',None) else ""
-        return f"""\t\t\tfhir:valueCodeableConcept [
+""",
+        high=get_limit("high", ""),
+        low=get_limit("low", "\n"),
+        space=lambda rr: ";" if rr[0].get('low') and rr[0].get('high') else ""))
+    valueCodeableConcept = Section("valueCodeableConcept", template("""\t\t\tfhir:valueCodeableConcept [
                 fhir:coding [
-                    fhir:system  [ fhir:v "{vcc['coding'][0]['system']}"^^xsd:anyURI ] ;
-                    fhir:code    [ fhir:v "{vcc['coding'][0]['code']}" ]
+                    fhir:system  [ fhir:v "{coding.0.system|literal}"^^xsd:anyURI ] ;
+                    fhir:code    [ fhir:v "{coding.0.code|literal}" ]
                 ]
             ] ;
-"""
-    def get_valueQuantity(vq):
-        if len(vq)==0:
-            return ""
-        value =f";\n\t\t\t\tfhir:value [ fhir:v \"{vq['value']}\"^^xsd:decimal ]" if vq.get('value',None) else ""
-        comparator =f";\n\t\t\t\tfhir:comparator [ fhir:v \"{vq['comparator']}\" ]" if vq.get('comparator',None) else ""
-        code = f";\n\t\t\t\tfhir:code [ fhir:v \"{vq['code']}\" ]" if vq.get('code',None) else ""
-        return f"""\t\t\tfhir:valueQuantity [
-                fhir:system [ fhir:v "{vq['system']}"^^xsd:anyURI ]{value}{comparator}{code}
+"""))
+    valueQuantity = Section("valueQuantity", template("""\t\t\tfhir:valueQuantity [
+                fhir:system [ fhir:v "{system|literal}"^^xsd:anyURI ]{value}{comparator}{code}
             ] ;
-"""
-    time_start = time.time()
-    print("creating observation entities")
-    pipeline = [
-        {"$match":{"resourceType":"Observation","dataAbsentRearson":{"$exists": False}}},
-        {"$project":{"id":1,"category":1,"code":1,"derivedFrom":1,"effectiveDateTime":1,"encounter":1,"extension":1,"specimen":1,
-                     "status":1,"subject":1,"identifier":1,"meta":1,"hasMember":1,"interpretation":1,"issued":1,"valueDateTime":1,
-                     "valueString":1,"note":1,"referenceRange":1,"valueCodeableConcept":1,"valueQuantity":1}}
-    ]
-    results = collection.aggregate(pipeline)
-    for result in results:
-        fhirID=result.get('id')
-        category=get_category(result['category'])
-        code=get_o_code(result['code'])
-        derivedFrom =f"\t\t\tfhir:derivedFrom se:{split_refrence(result['derivedFrom'][0]['reference'])} ;" if len(result.get('derivedFrom',[]))!=0 else ""
-        encounter =f"\t\t\tfhir:encounter se:{split_refrence(result['encounter']['reference'])} ;" if len(result.get('encounter',[]))!=0 else ""
-        specimen =f"\t\t\tfhir:specimen se:{split_refrence(result['specimen']['reference'])} ;" if len(result.get('specimen',[]))!=0 else ""
-        status = f"\t\t\tfhir:status [ fhir:v \"{result['status']}\" ] ;"
-        subject = f"\t\t\tfhir:subject se:{split_refrence(result['subject']['reference'])} ;"
-        effectiveDateTime=f"\t\t\tfhir:effectiveDateTime [ fhir:v \"{result['effectiveDateTime']}\"^^xsd:dateTime ] ;" if result.get('effectiveDateTime',None) else ""
-        extension=get_extension(result.get('extension',[]))
-        identifier=get_identifier(result['identifier'])
-        meta = get_meta(result.get('meta', {}))
-        hasMember=get_members(result.get('hasMember',[]))
-        interpretation=get_interpretation(result.get('interpretation',[]))
-        issued=f"\t\t\tfhir:issued [ fhir:v \"{result['issued']}\"^^xsd:dateTime ] ; " if result.get('issued', None) else ""
-        valueDateTime=f"\t\t\tfhir:valueDateTime [ fhir:v \"{result['valueDateTime']}\"^^xsd:dateTime ] ; " if result.get('valueDateTime', None) else ""
-        valueString=f"\t\t\tfhir:valueString [ fhir:v \"{sanatize_quotes(result['valueString'])}\" ] ; " if result.get('valueString', None) else ""
-        note=get_note(result.get('note',[]))
-        referenceRange=get_referenceRange(result.get('referenceRange',[]))
-        vcc=get_vcc(result.get('valueCodeableConcept',[]))
-        valueQuantity=get_valueQuantity(result.get('valueQuantity',[]))
-        insert =f"""se:{fhirID} a fhir:Observation ;
-            fhir:id [ fhir:v "{fhirID}" ] ;
+""",
+        value=Section("value", template(""";\n\t\t\t\tfhir:value [ fhir:v "{.|literal}"^^xsd:decimal ]""")),
+        comparator=Section("comparator", template(""";\n\t\t\t\tfhir:comparator [ fhir:v "{.|literal}" ]""")),
+        code=Section("code", template(""";\n\t\t\t\tfhir:code [ fhir:v "{.|literal}" ]"""))))
+    identifier = Section("identifier", template("""fhir:identifier [
+                fhir:system [ fhir:v "{system|literal}"^^xsd:anyURI ] ;
+                fhir:value  [ fhir:v "{value|literal}" ]
+            ] ;""",
+        system=lambda identifier: str(identifier[0].get('system', "")),
+        value=lambda identifier: identifier[0].get('value', "")))
+    #in concept mode the codeable concepts link to the concept node of their first coding, the code is written from its own code
+    if concepts is not None:
+        category = template("""\t\t\tfhir:category [ fhir:coding {concept} ] .\n""", concept=concept_link(concepts, "category.0.coding.0"))
+        code = template("""\t\t\tfhir:code [ fhir:coding {concept} ] ;\n""", concept=concept_link(concepts, "code.coding.0"))
+        interpretation = Section("interpretation", template("""fhir:interpretation [ fhir:coding {concept} ] ;\n""", concept=concept_link(concepts, "0.coding.0")))
+        valueCodeableConcept = Section("valueCodeableConcept", template("""\t\t\tfhir:valueCodeableConcept [ fhir:coding {concept} ] ;\n""", concept=concept_link(concepts, "coding.0")))
+    entity = template("""se:{id} a fhir:Observation ;
+            fhir:id [ fhir:v "{id|literal}" ] ;
 {specimen}
 {valueString}
 {valueDateTime}
 {issued}
 {valueQuantity}
-{status}
-{subject}
+\t\t\tfhir:status [ fhir:v "{status|literal}" ] ;
+\t\t\tfhir:subject se:{subject.reference|ref} ;
 {note}
-{vcc}
+{valueCodeableConcept}
 {referenceRange}
 {interpretation}
 {code}
@@ -1404,9 +2687,43 @@ def create_observation_entities():
 {effectiveDateTime}
 {category}
         
-"""
-        write_to_middle(insert)
-    time_end = time.time()
-    move_to_final()
-    print(f"observation entity creation took {time_end - time_start:.4f} seconds")
-
+""",
+        id=lambda result: str(result.get('id')),
+        specimen=Section("specimen", template("""\t\t\tfhir:specimen se:{reference|ref} ;""")),
+        valueString=Section("valueString", template("""\t\t\tfhir:valueString [ fhir:v "{.|literal}" ] ; """)),
+        valueDateTime=Section("valueDateTime", template("""\t\t\tfhir:valueDateTime [ fhir:v "{.|literal}"^^xsd:dateTime ] ; """)),
+        issued=Section("issued", template("""\t\t\tfhir:issued [ fhir:v "{.|literal}"^^xsd:dateTime ] ; """)),
+        hasMember=Each("hasMember", template("""\t\t\tfhir:hasMember se:{reference|ref} ;\n""")),
+        derivedFrom=Section("derivedFrom", template("""\t\t\tfhir:derivedFrom se:{0.reference|ref} ;""")),
+        encounter=Section("encounter", template("""\t\t\tfhir:encounter se:{reference|ref} ;""")),
+        effectiveDateTime=Section("effectiveDateTime", template("""\t\t\tfhir:effectiveDateTime [ fhir:v "{.|literal}"^^xsd:dateTime ] ;""")),
+        valueQuantity=valueQuantity,
+        note=note,
+        valueCodeableConcept=valueCodeableConcept,
+        referenceRange=referenceRange,
+        interpretation=interpretation,
+        code=code,
+        identifier=identifier,
+        extension=extension,
+        category=category)
+    return entity
+
+def create_observation_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "observation", OBSERVATION_PIPELINE, observation_renderer(writer.compact, writer.concepts), query, source)
+
+#the entity passes in the order they are written to fhir_final_script.ttl
+#comment out any entity functions you do not want in the final script for test purposes
+ENTITY_PASSES = [
+    create_organization_entities,
+    create_location_entities,
+    create_patient_entities,
+    create_encounter_entities,
+    create_procedure_entities,
+    create_condition_entities,
+    create_medicationDispense_entities,
+    create_medicationRequest_entities,
+    create_specimen_entities,
+    create_medication_entities,
+    create_medicationAdministration_entities,
+    create_observation_entities,
+]
@@ -0,0 +1,414 @@
+#--------------------------------------------------------------
+#
+# This python file finds the fields of a resource type and how many documents have them, the table get_distinct_fields()
+# in fhir_kg_creation.py prints (fields become properties in the knowledge graph)
+#
+#   get_distinct_fields("Observation")                              every Observation, the paths are found by mongoDB
+#   get_distinct_fields("Observation", sample=20000)                a $sample of 20000 documents, with 95% confidence bounds
+#   get_distinct_fields("Observation", sample=0.05)                 a 5% sample
+#   get_distinct_fields("Observation", limit=1000)                  only the first 1000 documents
+#   get_distinct_fields("Observation", source=NdjsonSource(folder), workers=8)
+#
+# In mongoDB the paths are found by an aggregation, it expands the documents one level per stage and only sends back the
+# count of every path, so no document leaves the server. Levels deeper than PROFILE_DEPTH are not expanded, the documents
+# that have deeper fields are counted and reported. The ndjson files are split into byte ranges that worker processes
+# profile on their own, and the counts of the ranges are added up
+#
+#   get_unique_values_by_field("Observation", "valueQuantity.unit")                       a $group in mongoDB
+#   get_unique_values_by_field("Observation", "valueQuantity.value", approximate=True)   fixed memory sketches
+#
+# The unique values of a field are grouped by mongoDB, only one document per value comes back. The approximate mode streams
+# just the field out of mongoDB (or the ndjson files) into a HyperLogLog and a SpaceSaving summary (see kg_sketches.py),
+# which estimate the number of distinct values and keep the most frequent ones in the same memory for any collection size
+#
+#----------------------------------------------------------------
+
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from fhir_kg_creation import PROCESS_START_METHOD, get_mongo_collection
+from kg_sketches import HyperLogLog, SpaceSaving
+from ndjson_source import NdjsonSource, get_path, open_ndjson
+
+
+#levels of nesting the aggregation expands, FHIR resources are rarely deeper than 8
+PROFILE_DEPTH = 12
+
+#bytes of an ndjson file profiled by one task, gzip files can not be split and are a single task
+PROFILE_CHUNK_SIZE = 64 * 1024 * 1024
+
+#z of the confidence bounds printed for a sample, 1.96 for 95% bounds
+CONFIDENCE_Z = 1.96
+
+#precision of the HyperLogLog of the approximate value profile, 2**14 registers give about 0.8% error in 16KB
+VALUE_PRECISION = 14
+
+#counters of the SpaceSaving of the approximate value profile, many more than the values printed so their counts are close
+VALUE_CAPACITY = 1000
+
+#1 for a document that still has nodes deeper than were expanded, summed into the truncated count
+TRUNCATED = {"$cond": [{"$gt": [{"$size": "$frontier"}, 0]}, 1, 0]}
+
+
+def profile_fields(resource_type, sample=None, limit=None, collection=None, depth=PROFILE_DEPTH):
+    """
+    This fuction counts the documents of a resource type that have each field path, inside mongoDB
+    Args:
+        resource_type (string): a value each document has that turns into classes in the knowledge graph
+        sample (int or float): profile a random $sample of this many documents, or of this fraction of them when below 1
+        limit (int): profile only the first documents, up to this many
+        collection (Collection): the mongoDB collection, the one in MONGO_SETTINGS when None
+        depth (int): levels of nesting expanded, deeper fields are left out
+    Returns:
+        dict: the profile, see print_field_table
+    """
+    collection = collection if collection is not None else get_mongo_collection()
+    population = None
+    stages = [{"$match": {"resourceType": resource_type}}]
+    if sample is not None:
+        population = collection.count_documents({"resourceType": resource_type})
+        size = round(sample * population) if sample < 1 else int(sample)
+        stages.append({"$sample": {"size": max(size, 1)}})
+    if limit is not None:
+        stages.append({"$limit": limit})
+    result = next(collection.aggregate(stages + field_path_stages(depth), allowDiskUse=True))
+    total = result["total"][0] if result["total"] else {"documents": 0, "truncated": 0}
+    return {
+        "resource_type": resource_type,
+        "documents": total["documents"],
+        "population": population,
+        "truncated": total["truncated"],
+        "fields": {field["_id"]: field["count"] for field in result["fields"]},
+    }
+
+def field_path_stages(depth=PROFILE_DEPTH):
+    """
+    This fuction builds the aggregation stages that turn every document into the paths it has and count the documents per path
+    Args:
+        depth (int): levels of nesting expanded
+    Returns:
+        list: the stages, they end in one document {total: [{documents, truncated}], fields: [{_id: path, count}]}
+    """
+    return path_expansion_stages(depth) + [{"$facet": {
+        "total": [{"$group": {"_id": None, "documents": {"$sum": 1}, "truncated": {"$sum": TRUNCATED}}}],
+        "fields": [{"$unwind": "$paths"}, {"$group": {"_id": "$paths", "count": {"$sum": 1}}}],
+    }}]
+
+def path_expansion_stages(depth=PROFILE_DEPTH, keep=None):
+    """
+    This fuction builds the aggregation stages that turn every document into the list of paths it has
+    The paths are the ones extract_all_paths found: every key of an object, list indexes only as part of the paths below them
+    Args:
+        depth (int): levels of nesting expanded
+        keep (dict): name -> expression of the document kept next to the paths, like {"type": "$resourceType"}
+    Returns:
+        list: the stages, every document comes out as {paths, frontier (the nodes deeper than depth)} and the kept fields
+    """
+    keep = keep or {}
+    carried = {name: 1 for name in keep}
+    #the frontier holds the nodes of the current level, {p: path, v: value, e: True for an object key that is a field}
+    containers = {"$filter": {"input": "$frontier", "cond": {"$in": [{"$type": "$$this.v"}, ["object", "array"]]}}}
+    fields = {"$map": {"input": {"$filter": {"input": "$frontier", "cond": "$$this.e"}}, "in": "$$this.p"}}
+    children = {"$switch": {
+        "branches": [
+            {"case": {"$eq": [{"$type": "$$this.v"}, "object"]}, "then": {"$map": {
+                "input": {"$objectToArray": "$$this.v"},
+                "as": "field",
+                "in": {"p": {"$concat": ["$$this.p", ".", "$$field.k"]}, "v": "$$field.v", "e": True}}}},
+            {"case": {"$isArray": "$$this.v"}, "then": {"$map": {
+                "input": {"$range": [0, {"$size": "$$this.v"}]},
+                "as": "index",
+                "in": {"p": {"$concat": ["$$this.p", ".", {"$toString": "$$index"}]}, "v": {"$arrayElemAt": ["$$this.v", "$$index"]}, "e": False}}}},
+        ],
+        "default": []}}
+    stages = [
+        {"$project": {"_id": 0, **keep, "paths": {"$literal": []}, "frontier": {"$map": {
+            "input": {"$objectToArray": "$$ROOT"},
+            "in": {"p": "$$this.k", "v": "$$this.v", "e": True}}}}},
+        {"$project": {**carried, "paths": fields, "frontier": containers}},
+    ]
+    for _ in range(depth):
+        stages.append({"$project": {**carried, "paths": 1, "frontier": {"$reduce": {"input": "$frontier", "initialValue": [], "in": {"$concatArrays": ["$$value", children]}}}}})
+        stages.append({"$project": {**carried, "paths": {"$concatArrays": ["$paths", fields]}, "frontier": containers}})
+    return stages
+
+def profile_ndjson_fields(paths, resource_type, sample=None, limit=None, workers=None, seed=0):
+    """
+    This fuction counts the documents of a resource type that have each field path in ndjson files, spread over worker processes
+    Args:
+        paths (string or list): ndjson files, directories that hold them, or an NdjsonSource
+        resource_type (string): a value each document has that turns into classes in the knowledge graph
+        sample (float): profile every document with this chance (a fraction below 1), the lines that are skipped are never parsed
+        limit (int): profile only the first documents, up to this many, read in this process one file after another
+        workers (int): number of worker processes, defaults to the number of cpus
+        seed (int): seed of the sample, the same seed picks the same documents
+    Returns:
+        dict: the profile, see print_field_table
+    """
+    if sample is not None and sample >= 1:
+        raise ValueError("the ndjson files are sampled by rate, give sample as a fraction below 1")
+    source = paths if isinstance(paths, NdjsonSource) else NdjsonSource(paths)
+    chunks = []
+    for path in source.files:
+        if path.endswith(".gz"):
+            chunks.append((path, 0, None))
+            continue
+        for start in range(0, max(os.path.getsize(path), 1), PROFILE_CHUNK_SIZE):
+            chunks.append((path, start, start + PROFILE_CHUNK_SIZE))
+    totals = {"documents": 0, "lines": 0, "fields": {}}
+
+    def add(counts):
+        totals["documents"] += counts["documents"]
+        totals["lines"] += counts["lines"]
+        for path, count in counts["fields"].items():
+            totals["fields"][path] = totals["fields"].get(path, 0) + count
+
+    if limit is not None:
+        for path, start, end in chunks:
+            if totals["documents"] >= limit:
+                break
+            add(profile_ndjson_chunk(path, start, end, resource_type, sample, limit - totals["documents"], seed))
+    else:
+        context = multiprocessing.get_context(PROCESS_START_METHOD)
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=context) as pool:
+            futures = [pool.submit(profile_ndjson_chunk, path, start, end, resource_type, sample, None, seed) for path, start, end in chunks]
+            for future in futures:
+                add(future.result())
+    return {
+        "resource_type": resource_type,
+        "documents": totals["documents"],
+        #every document of the type was seen, so the sample knows its population
+        "population": totals["lines"] if sample is not None else None,
+        "truncated": 0,
+        "fields": totals["fields"],
+    }
+
+def profile_ndjson_chunk(path, start, end, resource_type, sample=None, limit=None, seed=0):
+    """
+    This fuction counts the field paths of the documents whose lines start in a byte range of an ndjson file, it runs in a worker
+    Args:
+        path (string): the ndjson file
+        start (int): first byte of the range
+        end (int): the byte after the range, a line that starts before it is read to its end, None reads to the end of the file
+        resource_type (string): only documents of this resource type are counted
+        sample (float): count every document with this chance
+        limit (int): stop after this many documents
+        seed (int): seed of the sample
+    Returns:
+        dict: documents counted, lines that declare the resource type and the count of every path
+    """
+    needle = f'"{resource_type}"'.encode("utf-8")
+    #the resource type as the value of a resourceType key, the name alone is also in the references to the type
+    declared = re.compile(rb'"resourceType"\s*:\s*' + re.escape(needle))
+    chance = random.Random(f"{seed}:{path}:{start}").random
+    fields = {}
+    documents = 0
+    lines = 0
+    with open_ndjson(path) as file:
+        position = start
+        if start > 0:
+            #the line that runs over the start belongs to the range before
+            file.seek(start - 1)
+            position += len(file.readline()) - 1
+        for line in file:
+            if (end is not None and position >= end) or (limit is not None and documents >= limit):
+                break
+            position += len(line)
+            if needle not in line or not declared.search(line):
+                continue
+            lines += 1
+            if sample is not None and chance() >= sample:
+                continue
+            doc = json.loads(line)
+            #a resource of the type contained in another one
+            if doc.get("resourceType") != resource_type:
+                lines -= 1
+                continue
+            documents += 1
+            for field_path in document_paths(doc):
+                fields[field_path] = fields.get(field_path, 0) + 1
+    return {"documents": documents, "lines": lines, "fields": fields}
+
+def document_paths(document):
+    """
+    This fuction lists the field paths of a document, every key of an object and list indexes only as part of the paths below them
+    Args:
+        document (dict): a fhir document
+    Returns:
+        list: the paths, each path once
+    """
+    paths = []
+    stack = [("", document)]
+    while stack:
+        prefix, value = stack.pop()
+        if isinstance(value, dict):
+            for key, item in value.items():
+                path = f"{prefix}.{key}" if prefix else key
+                paths.append(path)
+                if isinstance(item, (dict, list)):
+                    stack.append((path, item))
+        else:
+            for index, item in enumerate(value):
+                if isinstance(item, (dict, list)):
+                    stack.append((f"{prefix}.{index}" if prefix else str(index), item))
+    return paths
+
+def confidence_bounds(count, documents, z=CONFIDENCE_Z):
+    """
+    This fuction gives the Wilson score interval of the share of documents that have a field, from a sample
+    Args:
+        count (int): sampled documents with the field
+        documents (int): sampled documents
+        z (float): z of the interval, 1.96 for 95%
+    Returns:
+        tuple: the low and high bound in percent
+    """
+    if documents == 0:
+        return 0.0, 100.0
+    share = count / documents
+    denominator = 1 + z * z / documents
+    center = (share + z * z / (2 * documents)) / denominator
+    margin = z * math.sqrt(share * (1 - share) / documents + z * z / (4 * documents * documents)) / denominator
+    return max(center - margin, 0.0) * 100, min(center + margin, 1.0) * 100
+
+def print_field_table(profile):
+    """
+    This fuction prints the count and percentage of every field path, with the confidence bounds when the documents were sampled
+    Args:
+        profile (dict): resource_type, documents (the documents profiled), population (the documents of the type when they
+            were sampled, None otherwise), truncated (documents with fields deeper than were expanded) and fields (path -> count)
+    """
+    total_docs = profile["documents"]
+    sampled = profile["population"] is not None
+    print(f"Field analysis for resourceType: {profile['resource_type']}")
+    print(f"Total documents analyzed: {total_docs}")
+    if sampled:
+        print(f"Sampled from {profile['population']} documents, the confidence bounds of the percentages are in brackets")
+    if profile["truncated"]:
+        print(f"{profile['truncated']} documents are nested deeper than were expanded, the fields below that depth are missing")
+    print("-" * 60)
+
+    for field_path in sorted(profile["fields"].keys()):
+        count = profile["fields"][field_path]
+        percentage = (count / total_docs * 100) if total_docs > 0 else 0
+        line = f"{field_path:<40} | Count: {count:>4} | {percentage:>5.1f}%"
+        if sampled:
+            low, high = confidence_bounds(count, total_docs)
+            line += f" [{low:5.1f}, {high:5.1f}]"
+        print(line)
+
+def profile_values(resource_type, field_path, collection=None, approximate=False, top=10):
+    """
+    This fuction counts the values of a field in the documents of a resource type, exactly or in fixed memory
+    Args:
+        resource_type (string): a value each document has that turns into classes in the knowledge graph
+        field_path (string): dotted path of the field, numbers index into lists (code.coding.0.code)
+        collection (object): the mongoDB collection, the one in MONGO_SETTINGS when None, or an NdjsonSource which is read in this process
+        approximate (bool): estimate the number of distinct values and keep the most frequent ones in fixed memory
+        top (int): most frequent values kept in the profile
+    Returns:
+        dict: the profile, see print_value_table
+    """
+    collection = collection if collection is not None else get_mongo_collection()
+    counts = {}
+    documents = 0
+    if approximate or isinstance(collection, NdjsonSource):
+        distinct = HyperLogLog(VALUE_PRECISION) if approximate else None
+        frequent = SpaceSaving(max(VALUE_CAPACITY, top)) if approximate else None
+        for value in stream_values(resource_type, field_path, collection):
+            documents += 1
+            if value is None:
+                continue
+            if approximate:
+                distinct.add(value)
+                frequent.add(value)
+            else:
+                counts[value] = counts.get(value, 0) + 1
+        if approximate:
+            return {
+                "field_path": field_path,
+                "documents": documents,
+                "distinct": distinct.count(),
+                "error": distinct.error(),
+                "top": frequent.top(top),
+            }
+    else:
+        #a document without the field lands in the null group, so the groups add up to every document
+        pipeline = [{"$match": {"resourceType": resource_type}}, {"$group": {"_id": value_expression(field_path), "count": {"$sum": 1}}}]
+        for group in collection.aggregate(pipeline, allowDiskUse=True):
+            documents += group["count"]
+            if group["_id"] is not None:
+                counts[group["_id"]] = group["count"]
+    return {
+        "field_path": field_path,
+        "documents": documents,
+        "distinct": len(counts),
+        "error": 0.0,
+        "top": [(value, count, 0) for value, count in sorted(counts.items(), key=lambda item: item[1], reverse=True)[:top]],
+        "values": counts,
+    }
+
+def stream_values(resource_type, field_path, collection):
+    """
+    This fuction streams the value of a field of every document of a resource type, only the field leaves mongoDB
+    Args:
+        resource_type (string): a value each document has that turns into classes in the knowledge graph
+        field_path (string): dotted path of the field
+        collection (object): the mongoDB collection or an NdjsonSource
+    Returns:
+        iterator: the value of every document, None when it does not have the field
+    """
+    if isinstance(collection, NdjsonSource):
+        for doc in collection.find({"resourceType": resource_type}):
+            yield get_path(doc, field_path)[1]
+        return
+    pipeline = [{"$match": {"resourceType": resource_type}}, {"$project": {"_id": 0, "value": value_expression(field_path)}}]
+    for doc in collection.aggregate(pipeline):
+        yield doc.get("value")
+
+def value_expression(field_path):
+    """
+    This fuction builds the aggregation expression of the value at a dotted path, walked like get_unique_values_by_field always did
+    A number indexes into a list and is a key of an object, a key on anything but an object gives null
+    Args:
+        field_path (string): dotted path of the field
+    Returns:
+        object: the expression
+    """
+    steps = field_path.split(".")
+    expression = "$$ROOT"
+    for step in steps:
+        if step.isdigit():
+            branches = [
+                {"case": {"$isArray": "$$value"}, "then": {"$arrayElemAt": ["$$value", int(step)]}},
+                {"case": {"$eq": [{"$type": "$$value"}, "object"]}, "then": f"$$value.{step}"},
+            ]
+            walk = {"$switch": {"branches": branches, "default": None}}
+        else:
+            #a dotted path would reach into every item of a list, the loop over documents returned nothing there
+            walk = {"$cond": [{"$eq": [{"$type": "$$value"}, "object"]}, f"$$value.{step}", None]}
+        expression = {"$let": {"vars": {"value": expression}, "in": walk}}
+    return expression
+
+def print_value_table(profile):
+    """
+    This fuction prints the values of a field, every unique value for an exact profile and the estimate and most frequent
+    values for an approximate one
+    Args:
+        profile (dict): field_path, documents (the documents looked at), distinct (the number of values), error (the relative
+            error of distinct), top ((value, count, error) of the most frequent values) and values (value -> count, exact only)
+    """
+    if "values" in profile:
+        print(f"\nUnique values for '{profile['field_path']}' (found in {profile['documents']} documents):")
+        for v in profile["values"]:
+            print(f"  - {v}")
+        return
+    print(f"\nDistinct values for '{profile['field_path']}' (found in {profile['documents']} documents): about {profile['distinct']} (standard error {profile['error']:.1%})")
+    print("Most frequent values:")
+    for value, count, error in profile["top"]:
+        print(f"  - {value}: {count}" + (f" (at most {error} too high)" if error else ""))
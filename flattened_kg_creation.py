@@ -8,58 +8,99 @@
 #
 # I query a local mongoDB database with the MIMIC IV FHIR Demo on it, to use my code you will need to upload a combined ndjson file into your local database 
 #
+# Or skip mongoDB and read the ndjson files directly with create_ttl_script(source=NdjsonSource(*folder of ndjson files*)) (see ndjson_source.py)
+#
+# To create this script and the fhir script in one read of the data use create_both_ttl_scripts() in dual_kg_creation.py
+#
 #----------------------------------------------------------------
 
-from pymongo import MongoClient
+import hashlib
 import json 
 import time
 import uuid
-from fhir_kg_creation import get_distinct_fields, get_fields_in_all_documents, get_resource_type_list, get_sample_from_resource_type, get_unique_values_by_field
+from functools import lru_cache
+from kg_compression import COMPRESSION_EXTENSIONS
+from kg_templates import Each, Section, Template
+from kg_triples import OUTPUT_FORMATS, TripleConverter, escape_string, read_prefixes
+from fhir_kg_creation import get_distinct_fields, get_fields_in_all_documents, get_resource_type_list, get_schema_census, get_sample_from_resource_type, get_unique_values_by_field
+from fhir_kg_creation import RunMetrics, RunOptions, WRITE_BUFFER_SIZE, get_cohort, get_mongo_collection, run_entity_pass, run_entity_passes, run_entity_passes_in_parallel
+from fhir_kg_creation import ConceptNodes, DefinedNodes, SharedNodes, concept_link
 
-# Connect to MongoDB
-client = MongoClient("mongodb://localhost:27017/")
 
-# Access a database
-db = client["mimic"]
-collection = db["fhir"]
+#the namespace of the uuid5 ids of the generated nodes
+ID_NAMESPACE = uuid.UUID('ee172322-118b-5716-abbc-18e4c5437e15')
+ID_NAMESPACE_BYTES = ID_NAMESPACE.bytes
+#the schemes generate_id can make ids with, uuid5 gives the ids of earlier graphs
+ID_SCHEMES = ("uuid5", "blake2b")
+#ids kept for strings that come back, the LocationEncounter strings repeat for every encounter
+ID_CACHE_SIZE = 1 << 16
 
 
-#comment out any entity functions you do not want in the final script for test purposes
 #it takes roughly a minute to create the full script
-def create_ttl_script():
+def create_ttl_script(buffer_size=WRITE_BUFFER_SIZE, workers=1, partitions=None, source=None, checkpoint=False, resume=False, incremental=False, report=None, callback=None, compact=False, output_format="ttl", graph="resource_type", compression=None, concepts=False, shared_dosages=False, id_scheme="uuid5", cohort=None, patient_index=False, integrity=False):
     """
     This calls all needed functions to create the full knowledge graph and output it to final_script.ttl
+    Args:
+        buffer_size (int): size in bytes of the write buffer in front of flattened_final_script.ttl
+        workers (int): number of processes the entity passes are spread over, 1 runs them one after another
+        partitions (int): number of _id ranges the Observation and MedicationAdministration passes are split into in parallel mode, defaults to workers
+        source (object): where the fhir documents are read from, the mongoDB collection when None or an NdjsonSource to convert the ndjson files directly
+        checkpoint (bool): record progress in flattened_final_script.ttl.checkpoint.json so a failed run can be resumed (workers must be 1)
+        resume (bool): continue a failed run from its last checkpoint instead of starting over, starts over when there is no checkpoint
+        incremental (bool): only convert the documents whose WATERMARK_FIELD is newer than in the last incremental run and write them
+            to a flattened_final_script_delta_*time*.ttl file, the first incremental run writes the full flattened_final_script.ttl (workers must be 1)
+        report (string): a .json or .csv file the RunMetrics of the run are written to
+        callback (function): called with the metrics of every entity pass as soon as the pass is done
+        compact (bool): leave the indentation and blank lines out of the entities that are rendered from templates (Observation and MedicationAdministration)
+        output_format (string): "ttl" for turtle, "nt" for N-Triples or "nq" for N-Quads, the line based formats go to flattened_final_script.nt or .nq,
+            skolemize the blank nodes and can be split at any newline
+        graph (string): the named graphs of "nq", "resource_type" for one per resource type or "patient" for one per patient
+        compression (string): "gzip" or "zstd" to compress the output while it is written, to flattened_final_script.ttl.gz or .zst
+            (zstd needs the zstandard package), checkpoint and resume need an uncompressed output
+        concepts (bool): write every coding system and code once as a se:concept_*hash* node and link the entities to it with
+            fhir:*name*Coding instead of the *name*CodingSystem and *name*CodingCode properties (see ConceptNodes in fhir_kg_creation.py)
+        shared_dosages (bool): give dosage instructions with the same contents one se:dosage-*hash* node, written once, instead of a
+            DosageInstruction node for every MedicationDispense and MedicationRequest
+        id_scheme (string): how the ids of the LocationEncounter and DosageInstruction nodes are made, "uuid5" gives the ids of
+            earlier graphs so they stay joinable, "blake2b" is faster but gives different ids (see generate_id)
+        cohort (object): only convert these Patient ids, or the Patients matching this mongoDB filter, and the documents they
+            reach through their references (see kg_cohort.py)
+        patient_index (bool): write the byte ranges of the entities of every patient to flattened_final_script.ttl.patients so
+            extract_patient() can cut the graph of one patient out of the output (see kg_patient_index.py)
+        integrity (bool): check that every se: node the entities link to is defined in the output and report the dangling
+            links per predicate to flattened_final_script.ttl.integrity.json (see kg_integrity.py, workers must be 1)
+    Returns:
+        RunMetrics: documents, entities, bytes and timings of every entity pass and of the whole run
     """
     time_start = time.time()
-    with open("flattened_final_script.ttl", "w") as f:
-        f.write("")
     print("writing to file")
     with open('flattened_kg_script.ttl', 'r', encoding='utf-8') as file:
         ttl_string = file.read()
-    with open("flattened_final_script.ttl", "w") as f:
-        f.write(ttl_string)
-    create_organization_entities()
-    create_location_entities()
-    create_patient_entities()
-    create_encounter_entities()
-    create_procedure_entities()
-    create_condition_entities()
-    create_medicationDispense_entities()
-    create_medicationRequest_entities()
-    create_specimen_entities()
-    create_medication_entities()
-    create_medicationAdministration_entities()
-    create_observation_entities()
-    char_count = 0
-    line_count = 0
-    with open("flattened_final_script.ttl", "r", encoding="utf-8") as f:
-        for line in f:
-            line_count += 1
-            char_count += len(line)
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"unknown output format {output_format}, use one of {', '.join(OUTPUT_FORMATS)}")
+    converter = None
+    if output_format != "ttl":
+        converter = TripleConverter(output_format, graph, read_prefixes(ttl_string))
+    if id_scheme not in ID_SCHEMES:
+        raise ValueError(f"unknown id scheme {id_scheme}, use one of {', '.join(ID_SCHEMES)}")
+    options = RunOptions(buffer_size=buffer_size, workers=workers, partitions=partitions, source=source, checkpoint=checkpoint, resume=resume,
+                         incremental=incremental, compression=compression, compact=compact, converter=converter, concepts=ConceptNodes(CONCEPT_DEFINITION) if concepts else None,
+                         dosages=DefinedNodes("dosage-", DOSAGE_INSTRUCTION) if shared_dosages else None, id_scheme=id_scheme, patient_index=patient_index, integrity=integrity)
+    options.check()
+    options.cohort = get_cohort(cohort, source)
+    metrics = RunMetrics(f"flattened_final_script{OUTPUT_FORMATS[output_format]}{COMPRESSION_EXTENSIONS.get(compression, '')}", callback)
+    if workers > 1:
+        run_entity_passes_in_parallel(ENTITY_PASSES, metrics.output_path, ttl_string, options, metrics)
+    else:
+        metrics.output_path = run_entity_passes(ENTITY_PASSES, metrics.output_path, ttl_string, options, metrics)
     time_end = time.time()
+    metrics.finish(time_end - time_start)
     print(f"Script completed in {time_end - time_start:.4f} seconds")   
-    print(f"Character count: {char_count}")
-    print(f"Line count: {line_count}")
+    print(f"Character count: {metrics.characters}")
+    print(f"Line count: {metrics.line_count()}")
+    if report:
+        metrics.write_report(report)
+    return metrics
 
 
 #database specific functions
@@ -69,52 +110,67 @@ def collect_one_pipeline():
     """
     This fuction prints a document from a collect one pipeline. Use this to define specific fields you want to exist and see the json output.
     """
-    result = collection.find_one({"resourceType":"Encounter","serviceType":{"$exists":True}})
+    result = get_mongo_collection().find_one({"resourceType":"Encounter","serviceType":{"$exists":True}})
 
     print(json.dumps(result, indent=2, default=str))
 
 
 #file writing and sanatization functions
 
-def generate_id(unique_string):
+@lru_cache(maxsize=ID_CACHE_SIZE)
+def generate_id(unique_string, scheme="uuid5"):
     """
     This fuction creates a id in the structure of the mimic fhir id given a string
-    (Note that the same unique_string will output the same id)
+    (Note that the same unique_string will output the same id, the ids of repeated strings are kept in a bounded cache)
     Args:
         unique_string (string): a unique string that is converted to an ID
+        scheme (string): "uuid5" for the uuid5 of the string in ID_NAMESPACE, the ids of earlier graphs, or "blake2b" for a
+            faster hash of the string written as a version 8 uuid, the ids differ from the uuid5 ones
     Returns:
         str: random id
     """
-    namespace = uuid.UUID('ee172322-118b-5716-abbc-18e4c5437e15')
-    return uuid.uuid5(namespace, unique_string)
+    if scheme == "uuid5":
+        #the steps of uuid.uuid5 without building UUID objects, the digest is the same so the ids are the same
+        digest = bytearray(hashlib.sha1(ID_NAMESPACE_BYTES + unique_string.encode("utf-8")).digest()[:16])
+        version = 5
+    elif scheme == "blake2b":
+        digest = bytearray(hashlib.blake2b(unique_string.encode("utf-8"), digest_size=16).digest())
+        version = 8
+    else:
+        raise ValueError(f"unknown id scheme {scheme}, use one of {', '.join(ID_SCHEMES)}")
+    #the version in the high nibble of byte 6 and the RFC 4122 variant in the high bits of byte 8
+    digest[6] = (digest[6] & 0x0f) | (version << 4)
+    digest[8] = (digest[8] & 0x3f) | 0x80
+    text = digest.hex()
+    return f"{text[:8]}-{text[8:12]}-{text[12:16]}-{text[16:20]}-{text[20:]}"
 
-def write_to_middle(insertion):
+def escape_turtle_string(s):
     """
-    appends string to middle_man.txt
-    Args:
-        insertion (string): a string of text
+    This fuction sanatizes text with slashes so that it compiles under python and rdf rules, kept for callers of the old name
+    Returns:
+        str: sanatized text
     """
-    with open("middle_man.txt", "a") as f:
-            f.write(insertion)
+    return escape_string(s)
 
-def clear_middle():
+def sanatize_quotes(s):
     """
-    This fuction empties the text file middle_man.txt
+    This fuction sanatizes quotes in a string for python and rdf compliance, kept for callers of the old name
+    Args:
+        s (string): a string of text
+    Returns:
+        str: sanatized string
     """
-    with open("middle_man.txt", "w") as f:
-            f.write("")
+    return escape_string(s)
 
-def move_to_final():
+def sanitize_for_kg_literal(text):
     """
-    This function appends middle_man.txt to final_script.ttl then clears middle_man.txt
+    This fuction sanatizes text for both slashes and quotes, kept for callers of the old name
+    Args:
+        text (string): a string of text
+    Returns:
+        str: the sanatized text 
     """
-    with open("middle_man.txt", "r", encoding="utf-8") as txt_file:
-        content = txt_file.read()
-
-    with open("flattened_final_script.ttl", "a", encoding="utf-8") as ttl_file:
-        ttl_file.write("\n")
-        ttl_file.write(content)
-    clear_middle()
+    return escape_string(text)
 
 def split_refrence(refrence):
     """
@@ -126,966 +182,741 @@ def split_refrence(refrence):
     """
     return refrence.split("/")[-1]
 
-def escape_turtle_string(s):
+def define_concept(node, system, code, display=None):
     """
-    This fuction sanatizes text with slashes so that it compiles under python and rdf rules
+    This fuction writes the concept node of a coding, the entities that use the coding link to it with fhir:*name*Coding
+    Args:
+        node (string): the node of the concept
+        system (string): the code system
+        code (string): the code
+        display (string): the display of the first coding seen with the code
     Returns:
-        str: sanatized text
+        str: the statement of the concept node
     """
-    return s.replace('\\', '\\\\').replace('"', '\\"')
-
-def sanatize_quotes(s):
+    return CONCEPT_DEFINITION.render({"node": node.partition(":")[2], "system": system, "code": code, "display": display})
+
+#the filters the entity templates can apply to a value, {path|filter} (see kg_templates.py)
+FILTERS = {
+    "ref": split_refrence,
+    "literal": escape_string,
+}
+
+#the statement of a concept node, the writer renders it on the documents ConceptNodes collects, the entities link to it with fhir:*name*Coding
+CONCEPT_DEFINITION = Template("""se:{node} a fhir:Coding ;
+\t\t\tfhir:codingSystem "{system|literal}" ;
+\t\t\tfhir:codingCode "{code|literal}"{display} .
+
+""", {
+    "display": Section("display", Template(' ;\n\t\t\tfhir:codingDisplay "{.|literal}"', filters=FILTERS)),
+}, FILTERS)
+
+#the blocks the renderers share
+IDENTIFIER = Section("identifier", Template("""\t\t\tfhir:identifierSystem "{system|literal}" ;
+            fhir:identifierValue "{value|literal}" ;""", {
+    "system": lambda identifier: identifier[0].get('system', ""),
+    "value": lambda identifier: identifier[0].get('value', ""),
+}, FILTERS))
+
+def coding_section(name, path, concepts=None):
     """
-    This fuction sanatizes quotes in a string for python and rdf compliance
+    This fuction builds the block of the first coding of the coding list at a path of the document, its *name*CodingSystem,
+    *name*CodingCode and *name*CodingDisplay properties or the fhir:*name*Coding link to its concept node
     Args:
-        s (string): a string of text
+        name (string): the field of the coding, like type or code
+        path (string): dotted path of the coding list, the block is empty when it is missing or empty
+        concepts (ConceptNodes): the concept nodes of the run, None writes the coding out
     Returns:
-        str: sanatized string
+        Section: the block
     """
-    return s.replace('"', '\\"')
-    
-def sanitize_for_kg_literal(text):
+    if concepts is not None:
+        return Section(path, Template(f"\t\t\tfhir:{name}Coding {{concept}} ;", {"concept": concept_link(concepts, "0")}, FILTERS))
+    return Section(path, Template(f"""\t\t\tfhir:{name}CodingSystem  "{{system|literal}}" ;
+            fhir:{name}CodingCode "{{code|literal}}" ;
+            fhir:{name}CodingDisplay "{{display|literal}}" ;""", {
+        "system": lambda coding: coding[0].get('system', ''),
+        "code": lambda coding: coding[0].get('code', ''),
+        "display": lambda coding: coding[0].get('display', ''),
+    }, FILTERS))
+
+def mcc_section(path, concepts=None):
     """
-    This fuction sanatizes text for both slashes and quotes
+    This fuction builds the block of the first medication coding of the coding list at a path of the document, without display
     Args:
-        text (string): a string of text
+        path (string): dotted path of the coding list, the block is empty when it is missing or empty
+        concepts (ConceptNodes): the concept nodes of the run, None writes the coding out
     Returns:
-        str: the sanatized text 
+        Section: the block
     """
-    if not isinstance(text, str):
-        text = str(text)
-
-    # Escape backslashes first
-    text = text.replace('\\', '\\\\')
-    # Escape double quotes
-    text = text.replace('"', '\\"')
-    # Escape newlines and carriage returns
-    text = text.replace('\n', '\\n').replace('\r', '\\r')
-
-    return text
+    if concepts is not None:
+        return Section(path, Template("\t\t\tfhir:mccCoding {concept} ;\n", {"concept": concept_link(concepts, "0")}, FILTERS))
+    return Section(path, Template("""\t\t\tfhir:mccCodingCode "{code|literal}" ;
+            fhir:mccCodingSystem "{system|literal}" ; 
+""", {
+        "system": lambda coding: coding[0].get('system', ''),
+        "code": lambda coding: coding[0].get('code', ''),
+    }, FILTERS))
+
+#the properties of a DosageInstruction entity, the text is the normalized contents SharedNodes gives a node to
+DOSAGE_PROPERTIES = Template("""fhir:routeCodingCode "{route.coding.0.code|literal}" ;{doseAndRate}{maxDosePerPeriod}{timing}
+            fhir:routeCodingSystem "{route.coding.0.system|literal}" .""", {
+    "doseAndRate": Section("doseAndRate", Template("""
+\t\t\tfhir:doseQuantityCode "{0.doseQuantity.code|literal}" ;
+\t\t\tfhir:doseQuantitySystem "{0.doseQuantity.system|literal}" ;
+\t\t\tfhir:doseQuantityUnit "{0.doseQuantity.unit|literal}" ;
+\t\t\tfhir:doseQuantityValue "{0.doseQuantity.value|literal}" ;""", filters=FILTERS)),
+    "maxDosePerPeriod": Section("maxDosePerPeriod", Template("""
+\t\t\tfhir:maxDosePerPeriodDenominatorSystem "{denominator.system|literal}" ;
+\t\t\tfhir:maxDosePerPeriodDenominatorUnit "{denominator.unit|literal}" ;
+\t\t\tfhir:maxDosePerPeriodDenominatorValue "{denominator.value|literal}" ;
+\t\t\tfhir:maxDosePerPeriodNumeratorValue "{numerator.value|literal}" ;""", filters=FILTERS)),
+    "timing": Section("timing", Template("""
+\t\t\tfhir:timingCodeCodingCode "{code.coding.0.code|literal}" ;
+\t\t\tfhir:timingCodeCodingSystem "{code.coding.0.system|literal}" ;{repeat}""", {
+        "repeat": Section("repeat", Template("""
+\t\t\tfhir:timingRepeatDuration "{duration|literal}" ;
+\t\t\tfhir:timingRepeatDurationUnit "{durationUnit|literal}" ;""", filters=FILTERS)),
+    }, FILTERS)),
+}, FILTERS)
+
+#the DosageInstruction entity, rendered on the dosage instruction with its node (see get_dosageInstruction_entities), the writer
+#renders it for the shared nodes
+DOSAGE_INSTRUCTION = Template("""se:{node} a fhir:DosageInstruction ;
+            {properties}
+
+""", {"properties": DOSAGE_PROPERTIES}, FILTERS)
 
 #these functions create the entities, note this is the general structure below
-# create_*resource_type*_entities():
-#     
-#     collection of functions to convert specific nested fields
+# *RESOURCE_TYPE*_PIPELINE = mongoDB pipeline to query the database
 #
-#     mongoDB pipeline to query the database
-#
-#     for result in results:
-#         iterates through each document
-#
-#         creates a string of a single entity in the knowledge graph
+# *resource_type*_renderer():
+#     
+#     builds the kg_templates.Template of a single entity in the knowledge graph, optional blocks are Sections and repeated
+#     blocks are Each, the blocks shared between renderers are kept above
 #
-#         appends this single entity to middle_man.txt
+# create_*resource_type*_entities(writer):
+#     runs the pipeline and writes every entity to flattened_final_script.ttl through the TtlWriter, which renders the template as turtle or
+#     emits its triples for the N-Triples and N-Quads outputs
 #
-#     appends middle_man.txt to final_script.ttl then clears middle_man.txt
-
-
-
-def create_organization_entities():
-    def get_identifier(identifier):
-        """
-        This fuction converts identifier information into knowledge graph format
-        Args:
-            identifier (dict): a dictionary holding coding information
-        Returns:
-            str: the converted identifier property 
-        """
-        if len(identifier)==0:
-            return ""
-        identifierSystem=identifier[0].get('system',"")  if identifier else ""
-        identifierValue=identifier[0].get('value',"")  if identifier else ""
-        identifier_line=f"""\t\t\tfhir:identifierSystem "{identifierSystem}" ;
-            fhir:identifierValue "{sanatize_quotes(identifierValue)}" ;"""
-        return identifier_line
-    def get_coding(coding):
-        """
-        This fuction converts coding information into knowledge graph format
-        Args:
-            coding (dict): a dictionary holding coding information
-        Returns:
-            str: the converted coding property 
-        """
-        if len(coding)==0:
-            return ""
-        typeCodingSystem = coding[0].get('system', '')
-        typeCodingCode = coding[0].get('code', '')
-        typeCodingDisplay = coding[0].get('display', '')
-        coding_line =f"""\t\t\tfhir:typeCodingSystem  "{typeCodingSystem}" ;
-            fhir:typeCodingCode "{typeCodingCode}" ;
-            fhir:typeCodingDisplay "{typeCodingDisplay}" ;"""
-        return coding_line
-    time_start = time.time()
-    print("creating organization entities")
-    pipeline = [
-        {"$match":{"resourceType":"Organization"}},
-        {"$project":{"_id":1,"id":1,"identifier":1,"active":1,"type":1,"name":1,"meta":1}}
-    ]
-    results = collection.aggregate(pipeline)
-    for result in results:
-        fhirID=result.get('id')
-        identifier = get_identifier(result.get('identifier', []))
-        name=result.get('name')
-        active=result.get('active')
-        type_list = result.get('type', [])
-        coding_list=get_coding(type_list[0].get('coding', [])) if type_list else []
-        insert =f"""se:{fhirID} a fhir:Organization ;
-            fhir:id "{fhirID}" ;
-{identifier}
-            fhir:active "{str(active).lower()}" ;
-{coding_list}
-            fhir:name "{name}" .
+# the Observation and MedicationAdministration templates take the compact argument too, it leaves out the cosmetic whitespace
 
-"""
-        write_to_middle(insert)
-    time_end = time.time()
-    move_to_final()
-    print(f"organization entity creation took {time_end - time_start:.4f} seconds")
-
-def create_location_entities():
-    def get_coding(coding):
-        """
-        This fuction converts coding information into knowledge graph format
-        Args:
-            coding (dict): a dictionary holding coding information
-        Returns:
-            str: the converted coding property 
-        """
-        if len(coding)==0:
-            return ""
-        typeCodingSystem = coding[0].get('system', '')
-        typeCodingCode = coding[0].get('code', '')
-        typeCodingDisplay = coding[0].get('display', '')
-        coding_line =f"""\t\t\tfhir:typeCodingSystem  "{typeCodingSystem}" ;
-            fhir:typeCodingCode "{typeCodingCode}" ;
-            fhir:typeCodingDisplay "{typeCodingDisplay}" ;"""
-        return coding_line
-    print("creating location entities")
-    time_start = time.time()
-    pipeline = [
-        {"$match":{"resourceType":"Location"}},
-        {"$project":{"_id":1,"id":1,"status":1,"name":1,"physicalType":1,"managingOrganization":1,"meta":1}}
-    ]
-    results = collection.aggregate(pipeline)
-    for result in results:
-        fhirID=result.get('id')
-        status=result.get('status')
-        name=result.get('name')
-        type_list = result.get('physicalType', [])
-        coding_list=get_coding(type_list.get('coding', [])) if type_list else []
-        managingOrganization=split_refrence(result['managingOrganization']['reference'])
-        insert =f"""se:{fhirID} a fhir:Location ;
-            fhir:id "{fhirID}" ;
-            fhir:status "{status}" ;
-            fhir:name "{name}" ;
-{coding_list}
-            fhir:managingOrganizationReference se:{managingOrganization} .
-
-"""
-        write_to_middle(insert)
-    time_end = time.time()
-    move_to_final()
-    print(f"location entity creation took {time_end - time_start:.4f} seconds")
 
-def create_patient_entities():
-    print("creating patient entities")
-    time_start = time.time()
 
-    def get_identifier(identifier):
-        """
-        This fuction converts identifier information into knowledge graph format
-        Args:
-            identifier (dict): a dictionary holding coding information
-        Returns:
-            str: the converted identifier property 
-        """
-        if len(identifier)==0:
-            return ""
-        identifierSystem=identifier[0].get('system',"")  if identifier else ""
-        identifierValue=identifier[0].get('value',"")  if identifier else ""
-        identifier_line=f"""\t\t\tfhir:identifierSystem "{identifierSystem}" ;
-            fhir:identifierValue "{sanatize_quotes(identifierValue)}" ;"""
-        return identifier_line
-
-    def get_communication(communication):
-        if len(communication) == 0:
-            return ""
-        code = communication[0]['language']['coding'][0]['code']
-        system = communication[0]['language']['coding'][0]['system']
-        com_line = f"""\t\t\tfhir:communicationLangaugeCodingCode "{code}" ;
-            fhir:communicationLangaugeCodingSystem "{system}" ;"""
-        return com_line
-    
-    def get_extension(extension):
-        ethinicity= f"\n\t\t\tfhir:ethnicity \"{extension[1]['extension'][0]['valueCoding']['display']}\" ;" if extension and 'extension' in extension[1] else ""
-        extensionZero = f"""\t\t\tfhir:race "{extension[0]['extension'][0]['valueCoding']['display']}" ;{ethinicity}"""
-        return extensionZero
-
-    pipeline = [
-        {"$match": {"resourceType": "Patient"}},
-        {"$project": {"_id": 1, "id": 1, "birthDate": 1, "deceasedDateTime": 1, "extension": 1, 
-                     "identifier": 1, "gender": 1, "maritalStatus": 1, "communication": 1, 
-                     "managingOrganization": 1, "meta": 1}}
-    ]
-    
-    results = collection.aggregate(pipeline)
-    
-    for result in results:
-        fhirID = result.get('id')
-        identifier = get_identifier(result.get('identifier', []))
-        maritalStatusCode = result['maritalStatus']['coding'][0]['code']
-        maritalStatusSystem = result['maritalStatus']['coding'][0]['system']
-        managingOrganization = split_refrence(result['managingOrganization']['reference'])
-        communication = get_communication(result.get('communication', []))
-        gender = result.get('gender')
-        birthDate = result.get('birthDate')
-        deceased = result.get('deceasedDateTime')
-        deceasedDateTime = f"\n\t\t\tfhir:deceasedDateTime \"{deceased}\" ;" if deceased else ""
-        extension = get_extension(result.get('extension', []))
-        
-        insert = f"""se:{fhirID} a fhir:Patient ;
-            fhir:id "{fhirID}" ;
+ORGANIZATION_PIPELINE = [
+    {"$match":{"resourceType":"Organization"}},
+    {"$project":{"_id":1,"id":1,"identifier":1,"active":1,"type":1,"name":1,"meta":1}}
+]
+
+def organization_renderer(concepts=None):
+    """
+    This fuction builds the template that converts one Organization document into its knowledge graph entity
+    Args:
+        concepts (ConceptNodes): link the codings to concept nodes, None writes them inline
+    Returns:
+        Template: the entity template
+    """
+    return Template("""se:{id} a fhir:Organization ;
+            fhir:id "{id|literal}" ;
+{identifier}
+            fhir:active "{active|literal}" ;
+{coding}
+            fhir:name "{name|literal}" .
+
+""", {
+        "id": lambda result: str(result.get('id')),
+        "active": lambda result: str(result.get('active')).lower(),
+        "name": lambda result: result.get('name'),
+        "identifier": IDENTIFIER,
+        "coding": coding_section("type", "type.0.coding", concepts),
+    }, FILTERS)
+
+def create_organization_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "organization", ORGANIZATION_PIPELINE, organization_renderer(writer.concepts), query, source)
+
+LOCATION_PIPELINE = [
+    {"$match":{"resourceType":"Location"}},
+    {"$project":{"_id":1,"id":1,"status":1,"name":1,"physicalType":1,"managingOrganization":1,"meta":1}}
+]
+
+def location_renderer(concepts=None):
+    """
+    This fuction builds the template that converts one Location document into its knowledge graph entity
+    Args:
+        concepts (ConceptNodes): link the codings to concept nodes, None writes them inline
+    Returns:
+        Template: the entity template
+    """
+    return Template("""se:{id} a fhir:Location ;
+            fhir:id "{id|literal}" ;
+            fhir:status "{status|literal}" ;
+            fhir:name "{name|literal}" ;
+{coding}
+            fhir:managingOrganizationReference se:{managingOrganization.reference|ref} .
+
+""", {
+        "id": lambda result: str(result.get('id')),
+        "status": lambda result: result.get('status'),
+        "name": lambda result: result.get('name'),
+        "coding": coding_section("type", "physicalType.coding", concepts),
+    }, FILTERS)
+
+def create_location_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "location", LOCATION_PIPELINE, location_renderer(writer.concepts), query, source)
+
+PATIENT_PIPELINE = [
+    {"$match": {"resourceType": "Patient"}},
+    {"$project": {"_id": 1, "id": 1, "birthDate": 1, "deceasedDateTime": 1, "extension": 1, 
+                 "identifier": 1, "gender": 1, "maritalStatus": 1, "communication": 1, 
+                 "managingOrganization": 1, "meta": 1}}
+]
+
+def patient_renderer():
+    """
+    This fuction builds the template that converts one Patient document into its knowledge graph entity
+    Returns:
+        Template: the entity template
+    """
+    def template(layout, **fields):
+        return Template(layout, fields, FILTERS)
+    communication = Section("communication", template("""\t\t\tfhir:communicationLangaugeCodingCode "{0.language.coding.0.code|literal}" ;
+            fhir:communicationLangaugeCodingSystem "{0.language.coding.0.system|literal}" ;"""))
+    extension = Section("extension", template("""\t\t\tfhir:race "{0.extension.0.valueCoding.display|literal}" ;{ethnicity}""",
+        ethnicity=Section(lambda extension: extension[1] if 'extension' in extension[1] else None,
+            template("""\n\t\t\tfhir:ethnicity "{extension.0.valueCoding.display|literal}" ;"""))))
+    return template("""se:{id} a fhir:Patient ;
+            fhir:id "{id|literal}" ;
 {extension}
 {communication}
 {identifier}{deceasedDateTime}
-            fhir:gender "{gender}" ;
-            fhir:birthDate "{birthDate}" ;
-            fhir:managingOrganizationReference se:{managingOrganization} ;
-            fhir:system "{maritalStatusSystem}" ;
-            fhir:code "{maritalStatusCode}" .
-        
-"""
-        write_to_middle(insert)
-    time_end = time.time()
-    print(f"patient entity creation took {time_end - time_start:.4f} seconds")
-    move_to_final()
-
-def create_encounter_entities():
-    print("creating entcounter entities")  
-    time_start = time.time()
-    def get_coding(codinga):
-        """
-        This fuction converts coding information into knowledge graph format
-        Args:
-            coding (dict): a dictionary holding coding information
-        Returns:
-            str: the converted coding property 
-        """
-        if len(codinga)==0:
-            return ""
-        coding=codinga[0]['coding']
-        typeCodingSystem = coding[0].get('system', '')
-        typeCodingCode = coding[0].get('code', '')
-        typeCodingDisplay = coding[0].get('display', '')
-        coding_line =f"""\t\t\tfhir:typeCodingSystem  "{typeCodingSystem}" ;
-            fhir:typeCodingCode "{typeCodingCode}" ;
-            fhir:typeCodingDisplay "{typeCodingDisplay}" ;"""
-        return coding_line
-
-    def get_identifier_with_reference(identifier):
-        identifierSystem = identifier[0].get('system', "") if identifier else ""
-        identifierValue = identifier[0].get('value', "") if identifier else ""
-        useLine = f"\n\t\t\tfhir:identifierUse \"{identifier[0]['use']}\" ;" if identifier[0].get('use') else ""
-        assigner = f"\n\t\t\tfhir:assignerReference se:{split_refrence(identifier[0]['assigner']['reference'])} ;" if identifier[0].get('assigner') else ""
-        identifier_line = f"""\t\t\tfhir:identifierSystem "{identifierSystem}" ;
-            fhir:identifierValue "{identifierValue}";{useLine}{assigner}"""
-        return identifier_line  
-
-    def get_hospitalization(hospital):
-        if hospital == "":
-            return ""
-        hos = f"""\t\t\tfhir:admitSourceSystem "{hospital['admitSource']['coding'][0]['system']}"; 
-            fhir:admitSourceCode "{hospital['admitSource']['coding'][0]['code']}" ;""" if hospital.get('admitSource') else ""
+            fhir:gender "{gender|literal}" ;
+            fhir:birthDate "{birthDate|literal}" ;
+            fhir:managingOrganizationReference se:{managingOrganization.reference|ref} ;
+            fhir:system "{maritalStatus.coding.0.system|literal}" ;
+            fhir:code "{maritalStatus.coding.0.code|literal}" .
         
-        pital = f"""\n\t\t\tfhir:dischargeSourceSystem "{hospital['dischargeDisposition']['coding'][0]['system']}"; 
-            fhir:dischargeSourceCode "{hospital['dischargeDisposition']['coding'][0]['code']}" ;""" if hospital.get('dischargeDisposition') else ""
-        
-        return hos + pital
-    def get_serviceType(service):
-        if len(service) == 0:
-            return ""
-        
-        service_line = f"""\t\t\tfhir:serviceTypeCodingSystem "{service['coding'][0]['system']}" ;
-            fhir:serviceTypeCodingCode "{service['coding'][0]['code']}" ;"""
-        return service_line  
-    def get_priority(priority):
-        if len(priority) == 0:
-            return ""
-        
-        priority_line = f"""\t\t\tfhir:priorityCodingSystem "{priority['coding'][0]['system']}";
-            fhir:priorityCodingValue "{priority['coding'][0]['system']}";"""
-        return priority_line 
-    def get_period(period):
-        period_line = f"""\t\t\tfhir:periodStart "{period['start']}" ; 
-            fhir:periodEnd "{period['end']}" """
-        return period_line
-    def get_location(location):
-        locations = ""
-        a=0
-        location_list=""
-        location_line=""
-        for x in location:
-            id=generate_id("locationEncounter"+str(a))
-            reference = split_refrence(x['location']['reference'])
-            period = get_period(x['period'])
-            location_list=location_list+f"\t\t\tfhir:LocationEncounterReference se:{id} ;\n"
-            location_line = location_line+f"""\nse:{id} a fhir:LocationEncounter ;
-            fhir:locationReference se:{reference} ;
-{period} .
-
-"""
-            a+=1
-        return location_list,location_line
-    pipeline = [
-        {"$match": {"resourceType": "Encounter"}},
-        {"$project": {"_id": 1, "id": 1, "status": 1, "class": 1, "type": 1, "subject": 1, 
-                     "location": 1, "partOf": 1, "hospitalization": 1, "identifier": 1,
-                     "meta": 1, "priority": 1, "serviceProvider": 1, "serviceType": 1, "period": 1}}
-    ]  
-    results = collection.aggregate(pipeline)
-    for result in results:
-        patient = split_refrence(result['subject']['reference'])
-        fhirID = result.get('id')
-        identifier = get_identifier_with_reference(result.get('identifier', []))
-        hospitalization = get_hospitalization(result.get('hospitalization', ""))
-        partOf = f"fhir:partOfReference se:{split_refrence(result['partOf']['reference'])} ;" if result.get("partOf") else ""
-        serviceProvider = f"fhir:serviceProviderReference se:{split_refrence(result['serviceProvider']['reference'])} ;" if result.get('serviceProvider') else ""
-        serviceType = get_serviceType(result.get('serviceType', []))
-        priority = get_priority(result.get('priority', []))
-        periodLine = get_period(result.get('period'))
-        location_list,location_line = get_location(result.get('location', ''))
-        type_line = get_coding(result.get('type', []))   
-        insert = f"""se:{fhirID} a fhir:Encounter ;
-            fhir:id "{fhirID}" ;
-            fhir:classSystem "{result['class']['system']}";
-            fhir:classCode "{result['class']['code']}";
-            fhir:status "{result['status']}" ;
-{periodLine} ;
+""",
+        id=lambda result: str(result.get('id')),
+        gender=lambda result: result.get('gender'),
+        birthDate=lambda result: result.get('birthDate'),
+        extension=extension,
+        communication=communication,
+        identifier=IDENTIFIER,
+        deceasedDateTime=Section("deceasedDateTime", template("""\n\t\t\tfhir:deceasedDateTime "{.|literal}" ;""")))
+
+def create_patient_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "patient", PATIENT_PIPELINE, patient_renderer(), query, source)
+
+ENCOUNTER_PIPELINE = [
+    {"$match": {"resourceType": "Encounter"}},
+    {"$project": {"_id": 1, "id": 1, "status": 1, "class": 1, "type": 1, "subject": 1, 
+                 "location": 1, "partOf": 1, "hospitalization": 1, "identifier": 1,
+                 "meta": 1, "priority": 1, "serviceProvider": 1, "serviceType": 1, "period": 1}}
+]
+
+def encounter_renderer(concepts=None, id_scheme="uuid5"):
+    """
+    This fuction builds the template that converts one Encounter document into its knowledge graph entity, the LocationEncounter
+    entities of its locations are written behind it
+    Args:
+        concepts (ConceptNodes): link the codings to concept nodes, None writes them inline
+        id_scheme (string): the generate_id scheme of the LocationEncounter nodes
+    Returns:
+        Template: the entity template
+    """
+    def template(layout, **fields):
+        return Template(layout, fields, FILTERS)
+    identifier = Section("identifier", template("""\t\t\tfhir:identifierSystem "{system|literal}" ;
+            fhir:identifierValue "{value|literal}";{use}{assigner}""",
+        system=lambda identifier: identifier[0].get('system', ""),
+        value=lambda identifier: identifier[0].get('value', ""),
+        use=Section("0.use", template("""\n\t\t\tfhir:identifierUse "{.|literal}" ;""")),
+        assigner=Section("0.assigner", template("""\n\t\t\tfhir:assignerReference se:{reference|ref} ;"""))))
+    hospitalization = Section("hospitalization", template("""{admitSource}{dischargeDisposition}""",
+        admitSource=Section("admitSource", template("""\t\t\tfhir:admitSourceSystem "{coding.0.system|literal}"; 
+            fhir:admitSourceCode "{coding.0.code|literal}" ;""")),
+        dischargeDisposition=Section("dischargeDisposition", template("""\n\t\t\tfhir:dischargeSourceSystem "{coding.0.system|literal}"; 
+            fhir:dischargeSourceCode "{coding.0.code|literal}" ;"""))))
+    period = template("""\t\t\tfhir:periodStart "{start|literal}" ; 
+            fhir:periodEnd "{end|literal}" """)
+
+    #the LocationEncounter nodes are numbered in the order of the locations of the encounter, so encounters share them
+    def get_locations(result):
+        return [{"node": generate_id("locationEncounter" + str(number), id_scheme), "location": location}
+                for number, location in enumerate(result.get('location', ''))]
+    return template("""se:{id} a fhir:Encounter ;
+            fhir:id "{id|literal}" ;
+            fhir:classSystem "{class.system|literal}";
+            fhir:classCode "{class.code|literal}";
+            fhir:status "{status|literal}" ;
+{period} ;
             {partOf}
             {serviceProvider}
-{type_line}
+{type}
 {serviceType}
 {priority}
 {location_list}
 {identifier}
 {hospitalization}
-            fhir:subjectReference se:{patient}  .
-        
-"""
-        write_to_middle(insert+location_line)
-    move_to_final()
-    time_end = time.time()
-    print(f"encounter entity creation took {time_end - time_start:.4f} seconds")
-    
-def create_procedure_entities():
-    print("creating procedure entities")
-    time_start = time.time()
-    def get_identifier(identifier):
-        """
-        This fuction converts identifier information into knowledge graph format
-        Args:
-            identifier (dict): a dictionary holding coding information
-        Returns:
-            str: the converted identifier property 
-        """
-        if len(identifier)==0:
-            return ""
-        identifierSystem=identifier[0].get('system',"")  if identifier else ""
-        identifierValue=identifier[0].get('value',"")  if identifier else ""
-        identifier_line=f"""\t\t\tfhir:identifierSystem "{identifierSystem}" ;
-            fhir:identifierValue "{sanatize_quotes(identifierValue)}" ;"""
-        return identifier_line
-    def get_category(cat):
-        if len(cat) == 0:
-            return ""
-        
-        catCode = cat['coding'][0]['code']
-        catSystem = cat['coding'][0]['system']
-        return f"""\t\t\tfhir:categoryCodingCode "{catCode}" ;
-            fhir:categoryCodingSystem "{catSystem}" ; 
-"""   
-    def get_period(per):
-        if len(per) == 0:
-            return ""
+            fhir:subjectReference se:{subject.reference|ref}  .
         
-        start = per['start']
-        end = per['end']
-        return f"""\t\t\tfhir:performedPeriodStart "{start}" ;
-            fhir:performedPeriodEnd "{end}" ; 
-"""   
-    def get_body(body):
-        if len(body) == 0:
-            return ""
-        
-        catCode = body[0]['coding'][0]['code']
-        catSystem = body[0]['coding'][0]['system']
-        return f"""fhir:bodySiteSystem "{catSystem}" ;
-            fhir:bodySiteCode "{catCode}" ; 
-"""
-    
-    def get_coding(codinga):
-        """
-        This fuction converts coding information into knowledge graph format
-        Args:
-            coding (dict): a dictionary holding coding information
-        Returns:
-            str: the converted coding property 
-        """
-        coding=codinga['coding']
-        if len(coding)==0:
-            return ""
-        codeCodingSystem = coding[0].get('system', '')
-        codeCodingCode = coding[0].get('code', '')
-        codeCodingDisplay = coding[0].get('display', '')
-        coding_line =f"""\t\t\tfhir:codeCodingSystem  "{codeCodingSystem}" ;
-            fhir:codeCodingCode "{codeCodingCode}" ;
-            fhir:codeCodingDisplay "{codeCodingDisplay}" ;"""
-        return coding_line
-
-    
-    pipeline = [
-        {"$match": {"resourceType": "Procedure"}},
-        {"$project": {"_id": 1, "performedDateTime": 1, "performedPeriod": 1, "id": 1, 
-                     "status": 1, "category": 1, "code": 1, "encounter": 1, "bodySite": 1, 
-                     "subject": 1, "identifier": 1, "meta": 1}}
-    ]
-    
-    results = collection.aggregate(pipeline)
-    
-    for result in results:
-        fhirID = result['id']
-        status = result['status']
-        patient_reference = split_refrence(result['subject']['reference'])
-        encounter_reference = split_refrence(result['encounter']['reference'])
-        identifier = get_identifier(result.get('identifier', []))
-        coding_list = get_coding(result['code'])
-        category_list = get_category(result.get('category', []))
-        performedDateTime = f"\t\t\tfhir:performedDateTime \"{result.get('performedDateTime')}\" ;" if result.get('performedDateTime') else ""
-        performedPeriod = get_period(result.get('performedPeriod', []))
-        bodySite = get_body(result.get('bodySite', []))
-        
-        insert = f"""se:{fhirID} a fhir:Procedure;
-            fhir:id "{fhirID}" ;
-            fhir:status "{status}" ;
-            fhir:encounterReference se:{encounter_reference} ;
+{location_entities}""",
+        id=lambda result: str(result.get('id')),
+        period=Section("period", period),
+        partOf=Section("partOf", template("""fhir:partOfReference se:{reference|ref} ;""")),
+        serviceProvider=Section("serviceProvider", template("""fhir:serviceProviderReference se:{reference|ref} ;""")),
+        type=coding_section("type", "type.0.coding", concepts),
+        serviceType=Section("serviceType", template("""\t\t\tfhir:serviceTypeCodingSystem "{coding.0.system|literal}" ;
+            fhir:serviceTypeCodingCode "{coding.0.code|literal}" ;""")),
+        #the priority writes the system as the value too
+        priority=Section("priority", template("""\t\t\tfhir:priorityCodingSystem "{coding.0.system|literal}";
+            fhir:priorityCodingValue "{coding.0.system|literal}";""")),
+        location_list=Each(get_locations, template("""\t\t\tfhir:LocationEncounterReference se:{node} ;\n""")),
+        identifier=identifier,
+        hospitalization=hospitalization,
+        location_entities=Each(get_locations, template("""\nse:{node} a fhir:LocationEncounter ;
+            fhir:locationReference se:{location.location.reference|ref} ;
+{period} .
+
+""",
+            period=Section("location.period", period))))
+
+def create_encounter_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "encounter", ENCOUNTER_PIPELINE, encounter_renderer(writer.concepts, writer.id_scheme), query, source)
+
+PROCEDURE_PIPELINE = [
+    {"$match": {"resourceType": "Procedure"}},
+    {"$project": {"_id": 1, "performedDateTime": 1, "performedPeriod": 1, "id": 1, 
+                 "status": 1, "category": 1, "code": 1, "encounter": 1, "bodySite": 1, 
+                 "subject": 1, "identifier": 1, "meta": 1}}
+]
+
+def procedure_renderer(concepts=None):
+    """
+    This fuction builds the template that converts one Procedure document into its knowledge graph entity
+    Args:
+        concepts (ConceptNodes): link the codings to concept nodes, None writes them inline
+    Returns:
+        Template: the entity template
+    """
+    def template(layout, **fields):
+        return Template(layout, fields, FILTERS)
+    return template("""se:{id} a fhir:Procedure;
+            fhir:id "{id|literal}" ;
+            fhir:status "{status|literal}" ;
+            fhir:encounterReference se:{encounter.reference|ref} ;
 {identifier}
-{coding_list}
-{category_list}
+{coding}
+{category}
 {performedDateTime}
 {performedPeriod}
             {bodySite}
-            fhir:subject se:{patient_reference} .
-
-"""
-        write_to_middle(insert)
-    time_end = time.time()
-    print(f"procedure entity creation took {time_end - time_start:.4f} seconds")
-    move_to_final()
-
-def create_condition_entities():
-    print("creating condition entities")
-    time_start = time.time()
-    pipeline = [
-        {"$match": {"resourceType": "Condition"}},
-        {"$project": {"_id": 1, "id": 1, "identifier": 1, "category": 1, "code": 1, 
-                     "subject": 1, "encounter": 1, "meta": 1}}
-    ]
-    
-    results = collection.aggregate(pipeline)
-    
-    for result in results:
-        fhirID = result.get('id')
-        identifierSystem = result['identifier'][0]['system']
-        identifierValue = result['identifier'][0]['value']
-        cat = result['category'][0]['coding'][0]
-        catCode = cat['code']
-        catSystem = cat['system']
-        codeCodingCode = result['code']['coding'][0]['code']
-        codeCodingDisplay = result['code']['coding'][0]['display']
-        codeCodingSystem = result['code']['coding'][0]['system']
-        patient = split_refrence(result['subject']['reference'])
-        encounter = split_refrence(result['encounter']['reference'])
-        
-        insert = f"""se:{fhirID} a fhir:Condition;
-            fhir:id "{fhirID}" ;
-            fhir:identifierSystem "{identifierSystem}" ;
-            fhir:identifierValue "{identifierValue}" ;
-            fhir:categoryCodingCode "{catCode}" ;
-            fhir:categoryCodingSystem "{catSystem}" ;
-            fhir:codeCodingCode "{codeCodingCode}" ;
-            fhir:codeCodingDisplay "{codeCodingDisplay}" ;
-            fhir:codeCodingSystem "{codeCodingSystem}" ;
-            fhir:encounterReference se:{encounter} ;
-            fhir:subjectReference se:{patient} . 
+            fhir:subject se:{subject.reference|ref} .
+
+""",
+        identifier=IDENTIFIER,
+        coding=coding_section("code", "code.coding", concepts),
+        category=Section("category", template("""\t\t\tfhir:categoryCodingCode "{coding.0.code|literal}" ;
+            fhir:categoryCodingSystem "{coding.0.system|literal}" ; 
+""")),
+        performedDateTime=Section("performedDateTime", template("""\t\t\tfhir:performedDateTime "{.|literal}" ;""")),
+        performedPeriod=Section("performedPeriod", template("""\t\t\tfhir:performedPeriodStart "{start|literal}" ;
+            fhir:performedPeriodEnd "{end|literal}" ; 
+""")),
+        bodySite=Section("bodySite", template("""fhir:bodySiteSystem "{0.coding.0.system|literal}" ;
+            fhir:bodySiteCode "{0.coding.0.code|literal}" ; 
+""")))
+
+def create_procedure_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "procedure", PROCEDURE_PIPELINE, procedure_renderer(writer.concepts), query, source)
+
+CONDITION_PIPELINE = [
+    {"$match": {"resourceType": "Condition"}},
+    {"$project": {"_id": 1, "id": 1, "identifier": 1, "category": 1, "code": 1, 
+                 "subject": 1, "encounter": 1, "meta": 1}}
+]
+
+def condition_renderer(concepts=None):
+    """
+    This fuction builds the template that converts one Condition document into its knowledge graph entity
+    Args:
+        concepts (ConceptNodes): link the codings to concept nodes, None writes them inline
+    Returns:
+        Template: the entity template
+    """
+    def template(layout, **fields):
+        return Template(layout, fields, FILTERS)
+    code = template("""fhir:codeCodingCode "{code.coding.0.code|literal}" ;
+            fhir:codeCodingDisplay "{code.coding.0.display|literal}" ;
+            fhir:codeCodingSystem "{code.coding.0.system|literal}" ;""")
+    if concepts is not None:
+        code = template("""fhir:codeCoding {concept} ;""", concept=concept_link(concepts, "code.coding.0"))
+    return template("""se:{id} a fhir:Condition;
+            fhir:id "{id|literal}" ;
+            fhir:identifierSystem "{identifier.0.system|literal}" ;
+            fhir:identifierValue "{identifier.0.value|literal}" ;
+            fhir:categoryCodingCode "{category.0.coding.0.code|literal}" ;
+            fhir:categoryCodingSystem "{category.0.coding.0.system|literal}" ;
+            {code}
+            fhir:encounterReference se:{encounter.reference|ref} ;
+            fhir:subjectReference se:{subject.reference|ref} . 
         
-"""
-        write_to_middle(insert)
-    time_end = time.time()
-    print(f"condition entity creation took {time_end - time_start:.4f} seconds")
-    move_to_final()
+""",
+        id=lambda result: str(result.get('id')),
+        code=code)
+
+def create_condition_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "condition", CONDITION_PIPELINE, condition_renderer(writer.concepts), query, source)
 
-def get_dosageInstruction_entities(dosaga,id):
+def get_dosageInstruction_entities(dosaga,id,dosages=None):
+    """
+    This fuction finds the DosageInstruction entity of the first dosage instruction of a MedicationDispense or MedicationRequest
+    Args:
+        dosaga (list): the dosageInstruction field
+        id (string): the id of the entity
+        dosages (DefinedNodes): give dosage instructions with the same properties one node instead of using id, the writer writes
+            the entity of a new node on its own
+    Returns:
+        tuple: the id of the entity, None when there is no dosage instruction, and the document DOSAGE_INSTRUCTION is rendered on,
+            the dosage instruction with its node, None when the node is shared
+    """
     if len(dosaga)==0:
-        return ""
+        return None, None
     dosage=dosaga[0]
-    dar=dosage['doseAndRate'] if dosage.get('doseAndRate',None) else None
-    doseQuantityCode=f"\n\t\t\tfhir:doseQuantityCode \"{dosage['doseAndRate'][0]['doseQuantity']['code']}\" ;" if dar else ""
-    doseQuantitySystem=f"\n\t\t\tfhir:doseQuantitySystem \"{dosage['doseAndRate'][0]['doseQuantity']['system']}\" ;" if dar else ""
-    doseQuantityUnit=f"\n\t\t\tfhir:doseQuantityUnit \"{dosage['doseAndRate'][0]['doseQuantity']['unit']}\" ;" if dar else ""
-    doseQuantityValue=f"\n\t\t\tfhir:doseQuantityValue \"{dosage['doseAndRate'][0]['doseQuantity']['value']}\" ;" if dar else ""
-    mdpp=dosage['maxDosePerPeriod'] if dosage.get('maxDosePerPeriod',None) else None
-    maxDosePerPeriodDenominatorSystem=f"\n\t\t\tfhir:maxDosePerPeriodDenominatorSystem \"{mdpp['denominator']['system']}\" ;" if mdpp else ""
-    maxDosePerPeriodDenominatorUnit=f"\n\t\t\tfhir:maxDosePerPeriodDenominatorUnit \"{mdpp['denominator']['unit']}\" ;" if mdpp else ""
-    maxDosePerPeriodDenominatorValue=f"\n\t\t\tfhir:maxDosePerPeriodDenominatorValue \"{mdpp['denominator']['value']}\" ;" if mdpp else ""
-    maxDosePerPeriodNumeratorValue=f"\n\t\t\tfhir:maxDosePerPeriodNumeratorValue \"{mdpp['numerator']['value']}\" ;" if mdpp else ""
-    timing=dosage['timing'] if dosage.get('timing',None) else None
-    timingCodeCodingCode=f"\n\t\t\tfhir:timingCodeCodingCode \"{timing['code']['coding'][0]['code']}\" ;" if timing else ""
-    timingCodeCodingSystem=f"\n\t\t\tfhir:timingCodeCodingSystem \"{timing['code']['coding'][0]['system']}\" ;" if timing else ""
-    repeat=timing['repeat'] if timing and timing.get('repeat',None) else None
-    timingRepeatDuration = f"\n\t\t\tfhir:timingRepeatDuration \"{repeat['duration']}\" ;" if repeat else ""
-    timingRepeatDurationUnit = f"\n\t\t\tfhir:timingRepeatDurationUnit \"{repeat['durationUnit']}\" ;" if repeat else ""
-    optional=f"{doseQuantityCode}{doseQuantitySystem}{doseQuantityUnit}{doseQuantityValue}{maxDosePerPeriodDenominatorSystem}"
-    optional=f"{optional}{maxDosePerPeriodDenominatorUnit}{maxDosePerPeriodDenominatorValue}{maxDosePerPeriodNumeratorValue}"
-    optional=f"{optional}{timingCodeCodingCode}{timingCodeCodingSystem}{timingRepeatDuration}{timingRepeatDurationUnit}"
-    return f"""se:{id} a fhir:DosageInstruction ;
-            fhir:routeCodingCode "{dosage['route']['coding'][0]['code']}" ;{optional}
-            fhir:routeCodingSystem "{dosage['route']['coding'][0]['system']}" .
-
-"""
-
-def create_medicationDispense_entities():
-    print("creating medication dispense entities")
-    time_start = time.time()
-    
-    def get_identifier(identifier):
-        """
-        This fuction converts identifier information into knowledge graph format
-        Args:
-            identifier (dict): a dictionary holding coding information
-        Returns:
-            str: the converted identifier property 
-        """
-        if len(identifier)==0:
-            return ""
-        identifierSystem=identifier[0].get('system',"")  if identifier else ""
-        identifierValue=identifier[0].get('value',"")  if identifier else ""
-        identifier_line=f"""\t\t\tfhir:identifierSystem "{identifierSystem}" ;
-            fhir:identifierValue "{sanatize_quotes(identifierValue)}" ;"""
-        return identifier_line
-
-    def get_small_coding(coding):
-        """
-        This fuction converts coding information into knowledge graph format without display
-        Args:
-            coding (dict): a dictionary holding coding information
-        Returns:
-            str: the converted coding property 
-        """
-        if len(coding)==0:
-            return ""
-        typeCodingSystem = coding[0].get('system', '')
-        typeCodingCode = coding[0].get('code', '')
-        coding_line =f"""\t\t\tfhir:mccCodingCode "{typeCodingCode}" ;
-            fhir:mccCodingSystem "{typeCodingSystem}" ; 
-"""
-        return coding_line
-
-    pipeline = [
-        {"$match": {"resourceType": "MedicationDispense"}},
-        {"$project": {"_id": 1, "id": 1, "identifier": 1, "context": 1, "authorizingPrescription": 1, 
-                     "medicationCodeableConcept": 1, "subject": 1, "dosageInstruction": 1, "meta": 1, "status": 1}}
-    ]
-    
-    results = collection.aggregate(pipeline)
-    
-    for result in results:
-        fhirID = result['id']
-        identifier = get_identifier(result.get('identifier'))
-        context = split_refrence(result['context']['reference'])
-        subject = split_refrence(result['subject']['reference'])
-        authorizingPrescription = split_refrence(result['authorizingPrescription'][0]['reference'])
-        mccCoding = get_small_coding(result['medicationCodeableConcept']['coding'])
-        status = result['status']
-        dosageID=generate_id("md dosage"+fhirID)
-        dosage = get_dosageInstruction_entities(result.get('dosageInstruction',[]),dosageID)
-        dosageLine=f"\n\t\t\tfhir:dosageInstructionReference se:{dosageID} ;" if len(dosage)!=0 else ""
-        insert = f"""se:{fhirID} a fhir:MedicationDispense;
-            fhir:id "{fhirID}" ;
+    #the written properties are the normalized contents, instructions that write the same properties share a node
+    if dosages is not None:
+        return dosages.define(DOSAGE_PROPERTIES.render(dosage), dosage), None
+    return id, dict(dosage, node=id)
+
+MEDICATION_DISPENSE_PIPELINE = [
+    {"$match": {"resourceType": "MedicationDispense"}},
+    {"$project": {"_id": 1, "id": 1, "identifier": 1, "context": 1, "authorizingPrescription": 1, 
+                 "medicationCodeableConcept": 1, "subject": 1, "dosageInstruction": 1, "meta": 1, "status": 1}}
+]
+
+def medicationDispense_renderer(concepts=None, dosages=None, id_scheme="uuid5"):
+    """
+    This fuction builds the template that converts one MedicationDispense document into its knowledge graph entity, the
+    DosageInstruction entity of its dosage instruction is written behind it
+    Args:
+        concepts (ConceptNodes): link the codings to concept nodes, None writes them inline
+        dosages (DefinedNodes): share one node between dosage instructions with the same contents, None writes one per resource
+        id_scheme (string): the generate_id scheme of the DosageInstruction nodes
+    Returns:
+        Template: the entity template
+    """
+    def template(layout, **fields):
+        return Template(layout, fields, FILTERS)
+
+    #the node of the dosage instruction is found once per document, it is numbered or shared before anything is written
+    def get_dosage(result):
+        dosageID, dosage = get_dosageInstruction_entities(result.get('dosageInstruction',[]),generate_id("md dosage"+result['id'], id_scheme),dosages)
+        return dict(result, dosageID=dosageID, dosage=dosage)
+    entity = template("""se:{id} a fhir:MedicationDispense;
+            fhir:id "{id|literal}" ;
 {identifier}
-            fhir:contextReference se:{context} ;
-            fhir:authorizingPrescriptionReference se:MR-{authorizingPrescription} ;
-{mccCoding}
-            fhir:status "{status}" ;{dosageLine} 
-            fhir:subjectReference se:{subject} .
+            fhir:contextReference se:{context.reference|ref} ;
+            fhir:authorizingPrescriptionReference se:MR-{authorizingPrescription.0.reference|ref} ;
+{mcc}
+            fhir:status "{status|literal}" ;{dosageLine} 
+            fhir:subjectReference se:{subject.reference|ref} .
         
-"""
-        write_to_middle(insert+dosage)
-    time_end = time.time()
-    print(f"medication dispense entity creation took {time_end - time_start:.4f} seconds")
-    move_to_final()
-
-def create_medicationRequest_entities():
-    def get_dispense_request(dispense):
-        if len(dispense) == 0:
-            return ""
-        return f"""fhir:dispenseRequestValidityPeriodStart "{dispense['validityPeriod']['start']}" ;
-            fhir:dispenseRequestValidityPeriodEnd "{dispense['validityPeriod']['end']}" ;
-"""
-
-
-    def get_mr_identifier(identifier):
-        return f"""fhir:identifierSystem "{identifier[0]['system']}" ;
-            fhir:identifierValue "{identifier[0]['value']}" ;
-            fhir:identifierTypeCodingSystem "{identifier[0]['type']['coding'][0]['system']}" ;
-            fhir:identifierTypeCodingCode "{identifier[0]['type']['coding'][0]['code']}" ;
-            fhir:identifierTypeCodingDisplay "{identifier[0]['type']['coding'][0]['display']}" ;
-"""
-
-    def get_mcc(codinga):
-        if len(codinga)==0:
-            return ""
-        coding=codinga['coding']
-        typeCodingSystem = coding[0].get('system', '')
-        typeCodingCode = coding[0].get('code', '')
-        coding_line =f"""\t\t\tfhir:mccCodingCode "{typeCodingCode}" ;
-            fhir:mccCodingSystem "{typeCodingSystem}" ; 
-"""
-        return coding_line
-
-    time_start = time.time()
-    print("creating medication request entities")
-    pipeline = [
-        {"$match": {"resourceType": "MedicationRequest"}},
-        {"$project": {"identifier": 1, "authoredOn": 1, "dispenseRequest": 1, "dosageInstruction": 1, "id": 1, "encounter": 1, "intent": 1, "type": 1,
-                     "medicationCodeableConcept": 1, "meta": 1, "status": 1, "subject": 1, "medicationReference": 1}}
-    ]
-    results = collection.aggregate(pipeline)
-    for result in results:
-        fhirID = result.get('id')
-        authoredOn = result['authoredOn']
-        subject = split_refrence(result['subject']['reference'])
-        encounter = split_refrence(result['encounter']['reference'])
-        dispenseRequest = get_dispense_request(result.get('dispenseRequest', []))
-        dosageID=generate_id("mr dosage"+fhirID)
-        dosage = get_dosageInstruction_entities(result.get('dosageInstruction',[]),dosageID)
-        dosageLine=f"\n\t\t\tfhir:dosageInstructionReference se:{dosageID} ;" if len(dosage)!=0 else ""
-        identifier = get_mr_identifier(result['identifier'])
-        mcc = get_mcc(result.get('medicationCodeableConcept', []))
-        intent = result['intent']
-        status = result['status']
-        medication = f"fhir:medicationReference se:{split_refrence(result['medicationReference']['reference'])} ;" if len(result.get('medicationReference', [])) > 0 else ""
-        insert = f"""se:MR-{fhirID} a fhir:MedicationRequest ;
-            fhir:id "{fhirID}" ;
-            fhir:encounterReference se:{encounter}  ;
-            fhir:subjectReference se:{subject}  ;
-            fhir:intent "{intent}" ;
-            fhir:status "{status}" ;
+{dosage}""",
+        identifier=IDENTIFIER,
+        mcc=mcc_section("medicationCodeableConcept.coding", concepts),
+        dosageLine=Section("dosageID", template("""\n\t\t\tfhir:dosageInstructionReference se:{.} ;""")),
+        dosage=Section("dosage", DOSAGE_INSTRUCTION))
+    return template("""{entity}""", entity=Section(get_dosage, entity))
+
+def create_medicationDispense_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "medication dispense", MEDICATION_DISPENSE_PIPELINE, medicationDispense_renderer(writer.concepts, writer.dosages, writer.id_scheme), query, source)
+
+MEDICATION_REQUEST_PIPELINE = [
+    {"$match": {"resourceType": "MedicationRequest"}},
+    {"$project": {"identifier": 1, "authoredOn": 1, "dispenseRequest": 1, "dosageInstruction": 1, "id": 1, "encounter": 1, "intent": 1, "type": 1,
+                 "medicationCodeableConcept": 1, "meta": 1, "status": 1, "subject": 1, "medicationReference": 1}}
+]
+
+def medicationRequest_renderer(concepts=None, dosages=None, id_scheme="uuid5"):
+    """
+    This fuction builds the template that converts one MedicationRequest document into its knowledge graph entity, the
+    DosageInstruction entity of its dosage instruction is written behind it
+    Args:
+        concepts (ConceptNodes): link the codings to concept nodes, None writes them inline
+        dosages (DefinedNodes): share one node between dosage instructions with the same contents, None writes one per resource
+        id_scheme (string): the generate_id scheme of the DosageInstruction nodes
+    Returns:
+        Template: the entity template
+    """
+    def template(layout, **fields):
+        return Template(layout, fields, FILTERS)
+
+    #the node of the dosage instruction is found once per document, it is numbered or shared before anything is written
+    def get_dosage(result):
+        dosageID, dosage = get_dosageInstruction_entities(result.get('dosageInstruction',[]),generate_id("mr dosage"+str(result.get('id')), id_scheme),dosages)
+        return dict(result, dosageID=dosageID, dosage=dosage)
+    entity = template("""se:MR-{id} a fhir:MedicationRequest ;
+            fhir:id "{id|literal}" ;
+            fhir:encounterReference se:{encounter.reference|ref}  ;
+            fhir:subjectReference se:{subject.reference|ref}  ;
+            fhir:intent "{intent|literal}" ;
+            fhir:status "{status|literal}" ;
             {medication}
             {dispenseRequest}{dosageLine}
             {identifier}
 {mcc}
-            fhir:authoredOn "{authoredOn}" .
+            fhir:authoredOn "{authoredOn|literal}" .
         
-"""
-        write_to_middle(insert+dosage)
-    time_end = time.time()
-    print(f"medication request entity creation took {time_end - time_start:.4f} seconds")
-    move_to_final()
-
-def create_specimen_entities():
-    def get_specimen_type(typa):
-        display=f"\n\t\t\tfhir:typeCodingDisplay  \"{typa['coding'][0]['display']}\" ;" if typa['coding'][0].get('display') else ""
-        return f"""\t\t\tfhir:typeCodingSystem "{typa['coding'][0]['system']}" ;
-            fhir:typeCodingCode "{typa['coding'][0]['code']}" ;{display}"""
-    def get_identifier(identifier):
-        """
-        This fuction converts identifier information into knowledge graph format
-        Args:
-            identifier (dict): a dictionary holding coding information
-        Returns:
-            str: the converted identifier property 
-        """
-        if len(identifier)==0:
-            return ""
-        identifierSystem=identifier[0].get('system',"")  if identifier else ""
-        identifierValue=identifier[0].get('value',"")  if identifier else ""
-        identifier_line=f"""\t\t\tfhir:identifierSystem "{identifierSystem}" ;
-            fhir:identifierValue "{sanatize_quotes(identifierValue)}" ;"""
-        return identifier_line
-    time_start = time.time()
-    print("creating specimen entities")
-    pipeline = [
-        {"$match":{"resourceType":"Specimen"}},
-        {"$project":{"_id":1,"id":1,"identifier":1,"collection":1,"type":1,"subject":1,"meta":1}}
-    ]
-    results = collection.aggregate(pipeline)
-    hashset=set()
-    for result in results:
-        fhirID=result.get('id')
-        if fhirID in hashset:
-            continue
-        hashset.add(fhirID)
-        identifier = get_identifier(result.get('identifier', []))
-        type_list = get_specimen_type(result.get('type', []))
-        subject = split_refrence(result['subject']['reference'])
-        collectedDateTime = f"\t\t\tfhir:collectedDateTime \"{result['collection']['collectedDateTime']}\" ;" if len(result.get('collection',[]))!=0 else ""
-        insert =f"""se:{fhirID} a fhir:Specimen ;
-            fhir:id "{fhirID}" ;
+{dosage}""",
+        id=lambda result: str(result.get('id')),
+        medication=Section("medicationReference", template("""fhir:medicationReference se:{reference|ref} ;""")),
+        dispenseRequest=Section("dispenseRequest", template("""fhir:dispenseRequestValidityPeriodStart "{validityPeriod.start|literal}" ;
+            fhir:dispenseRequestValidityPeriodEnd "{validityPeriod.end|literal}" ;
+""")),
+        dosageLine=Section("dosageID", template("""\n\t\t\tfhir:dosageInstructionReference se:{.} ;""")),
+        identifier=template("""fhir:identifierSystem "{identifier.0.system|literal}" ;
+            fhir:identifierValue "{identifier.0.value|literal}" ;
+            fhir:identifierTypeCodingSystem "{identifier.0.type.coding.0.system|literal}" ;
+            fhir:identifierTypeCodingCode "{identifier.0.type.coding.0.code|literal}" ;
+            fhir:identifierTypeCodingDisplay "{identifier.0.type.coding.0.display|literal}" ;
+"""),
+        mcc=mcc_section("medicationCodeableConcept.coding", concepts),
+        dosage=Section("dosage", DOSAGE_INSTRUCTION))
+    return template("""{entity}""", entity=Section(get_dosage, entity))
+
+def create_medicationRequest_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "medication request", MEDICATION_REQUEST_PIPELINE, medicationRequest_renderer(writer.concepts, writer.dosages, writer.id_scheme), query, source)
+
+SPECIMEN_PIPELINE = [
+    {"$match":{"resourceType":"Specimen"}},
+    {"$project":{"_id":1,"id":1,"identifier":1,"collection":1,"type":1,"subject":1,"meta":1}}
+]
+
+def specimen_renderer(specimens=None):
+    """
+    This fuction builds the template that converts one Specimen document into its knowledge graph entity
+    Args:
+        specimens (SharedNodes): the Specimen ids written so far, a Specimen that is in more than one document is written once
+    Returns:
+        Template: the entity template, empty for a Specimen that was written already
+    """
+    def template(layout, **fields):
+        return Template(layout, fields, FILTERS)
+    if specimens is None:
+        specimens = SharedNodes("specimen-")
+
+    #with integrity=True the writer renders a document and emits its triples, the same document passes the second time too
+    last = None
+
+    def first_seen(result):
+        nonlocal last
+        if result is not last and not specimens.node(result.get('id'))[1]:
+            return None
+        last = result
+        return result
+    specimen_type = Section("type", template("""\t\t\tfhir:typeCodingSystem "{coding.0.system|literal}" ;
+            fhir:typeCodingCode "{coding.0.code|literal}" ;{display}""",
+        display=Section("coding.0.display", template("""\n\t\t\tfhir:typeCodingDisplay  "{.|literal}" ;"""))))
+    specimen = template("""se:{id} a fhir:Specimen ;
+            fhir:id "{id|literal}" ;
 {identifier}
-{type_list}
+{type}
 {collectedDateTime}
-            fhir:subjectReference se:{subject} .
+            fhir:subjectReference se:{subject.reference|ref} .
         
-"""
-        write_to_middle(insert)
-    time_end = time.time()
-    print(f"specimen entity creation took {time_end - time_start:.4f} seconds")
-    move_to_final()
-
-def create_medication_entities():
-    def get_medication_identifier(identifier):
-        identifiers=""
-        for x in identifier:
-            identifiers=identifiers+f"""\t\t\tfhir:identifierSystem "{x['system']}" ;
-            fhir:identifierValue "{escape_turtle_string(x['value'])}" ;
-"""
-        return identifiers
-    def get_ingredients(ing):
-        if len(ing)==0:
-            return ""
-        ingredients=""
-        for x in ing:
-            ingredients=ingredients + f"\t\t\tfhir:ingredientReference se:{split_refrence(x['itemReference']['reference'])} ;\n"
-        return ingredients
-    def get_medication_code(coda):
-        if len(coda)==0:
-            return ""
-        return f"""\t\t\tfhir:codeCodingSystem "{coda['coding'][0]['code']}";
-            fhir:codeCodingCode "{coda['coding'][0]['code']}" ;"""
-    time_start = time.time()
-    print("creating Medication entities")
-    pipeline = [
-        {"$match":{"resourceType":"Medication"}},
-        {"$project":{"_id":1,"id":1,"identifier":1,"ingredient":1,"code":1,"meta":1}}
-    ]
-    results = collection.aggregate(pipeline)
-    for result in results:
-        fhirID=result.get('id')
-        identifier=get_medication_identifier(result['identifier'])
-        code=get_medication_code(result.get('code',[]))
-        ingredients=get_ingredients(result.get('ingredient',[]))
-        insert =f"""se:{fhirID} a fhir:Medication ;
+""",
+        id=lambda result: str(result.get('id')),
+        identifier=IDENTIFIER,
+        type=specimen_type,
+        collectedDateTime=Section("collection", template("""\t\t\tfhir:collectedDateTime "{collectedDateTime|literal}" ;""")))
+    return template("""{specimen}""", specimen=Section(first_seen, specimen))
+
+def create_specimen_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "specimen", SPECIMEN_PIPELINE, specimen_renderer(writer.specimens), query, source)
+
+MEDICATION_PIPELINE = [
+    {"$match":{"resourceType":"Medication"}},
+    {"$project":{"_id":1,"id":1,"identifier":1,"ingredient":1,"code":1,"meta":1}}
+]
+
+def medication_renderer(concepts=None):
+    """
+    This fuction builds the template that converts one Medication document into its knowledge graph entity
+    Args:
+        concepts (ConceptNodes): link the codings to concept nodes, None writes them inline
+    Returns:
+        Template: the entity template
+    """
+    def template(layout, **fields):
+        return Template(layout, fields, FILTERS)
+    #the system of the medication code is written from the code, a concept node keeps its own system
+    code = Section("code", template("""\t\t\tfhir:codeCodingSystem "{coding.0.code|literal}";
+            fhir:codeCodingCode "{coding.0.code|literal}" ;"""))
+    if concepts is not None:
+        code = Section("code", template("""\t\t\tfhir:codeCoding {concept} ;""", concept=concept_link(concepts, "coding.0")))
+    return template("""se:{id} a fhir:Medication ;
 {identifier}
 {ingredients}
 {code}
-            fhir:id "{fhirID}" .
-
-"""
-        write_to_middle(insert)
-    time_end = time.time()
-    print(f"medication entity creation took {time_end - time_start:.4f} seconds")
-    move_to_final()
-
-def create_medicationAdministration_entities():
-    def get_category(cat):
-        if len(cat)==0:
-            return ""
-        return f"""\t\t\tfhir:categoryCodingSystem "{cat['coding'][0]['system']}" ;
-            fhir:categoryCodingCode "{cat['coding'][0]['code']}"; """
-    def get_dosage(dosage):
-        if len(dosage)==0:
-            return ""
-        text = f"\t\t\tfhir:doseText \"{dosage['text']}\" ;\n" if dosage.get('text',None) else ""
-        rateQuantity = f"""\t\t\tfhir:dosageRateQuantitySystem "{dosage['rateQuantity']['system']}" ;
-            fhir:dosageRateQuantityUnit "{dosage['rateQuantity']['unit']}" ;
-            fhir:dosageRateQuantityValue "{dosage['rateQuantity']['value']}" ;
-            fhir:dosageRateCode "{dosage['rateQuantity']['code']}" ;
-""" if dosage.get('rateQuantity',None) else ""
-        method = f"""\t\t\tfhir:methodCodingsystem "{dosage['method']['coding'][0]['system']}" ;
-            fhir:methodCodingcode "{dosage['method']['coding'][0]['code']}" ;
-""" if dosage.get('method',None) else ""
-        dose_code=f"\n\t\t\tfhir:doseCode \"{escape_turtle_string(dosage['dose']['code'])}\" ;" if dosage['dose'].get('code') else ""
-        dose_unit=f"\n\t\t\tfhir:doseUnit \"{escape_turtle_string(dosage['dose']['unit'])}\" ;" if dosage['dose'].get('unit') else ""
-        dose = f"""\t\t\tfhir:doseSystem "{dosage['dose']['system']}" ;
-            fhir:doseValue "{dosage['dose']['value']}" ;{dose_code}{dose_unit}
-"""
-        return f"""{rateQuantity}{text}{method}{dose}
-"""
-    def get_period(period):
-        if len(period)==0:
-            return ""
-        period_line = f"""\t\t\tfhir:effectivePeriodStart "{period['start']}" ;
-            fhir:effectivePeriodEnd "{period['end']}" ;"""
-        return period_line
-    def get_medication_code(coda):
-        if len(coda)==0:
-            return ""
-        display=f" ;\n\t\t\tfhir:codeCodingDisplay \"{coda['coding'][0]['display']}\" ;" if coda['coding'][0].get('display',None) else ""
-        return f"""\t\t\tfhir:codeCodingSystem "{coda['coding'][0]['code']}" ;
-                    fhir:codeCodingCode "{coda['coding'][0]['code']}" ; {display}
-"""
-    def get_mr_identifier(identifier):
-        return f"""fhir:identifierSystem "{identifier[0]['system']}" ;
-            fhir:identifierValue "{identifier[0]['value']}" ;
-            fhir:identifierTypeCodingSystem "{identifier[0]['type']['coding'][0]['system']}" ;
-            fhir:identifierTypeCodingCode "{identifier[0]['type']['coding'][0]['code']}" ;
-            fhir:identifierTypeCodingDisplay "{identifier[0]['type']['coding'][0]['display']}" ;
-"""
-
-    time_start = time.time()
-    print("creating medication administration entities")
-    pipeline = [
-        {"$match":{"resourceType":"MedicationAdministration"}},
-        {"$project":{"id":1,"meta":1,"category":1,"context":1,"dosage":1,"effectiveDateTime":1,"identifier":1,
-                     "medicationCodeableConcept":1,"request":1,"status":1,"subject":1, "effectivePeriod":1}}
-    ]
-    results = collection.aggregate(pipeline)
-    for result in results:
-        fhirID=result.get('id')
-        effectiveDateTime =f"\t\t\tfhir:effectiveDateTime \"{result['effectiveDateTime']}\" ;" if len(result.get('effectiveDateTime',[])) else ""
-        request =f"\t\t\tfhir:requestReference se:{split_refrence(result['request']['reference'])} ;" if len(result.get('request',[]))!=0 else ""
-        context =f"\t\t\tfhir:contextReference se:{split_refrence(result['context']['reference'])} ;" if len(result.get('context',[]))!=0 else ""
-        category=get_category(result.get('category',[]))
-        dosage=get_dosage(result.get('dosage',[]))
-        period=get_period(result.get('effectivePeriod',[]))
-        mcc=get_medication_code(result['medicationCodeableConcept'])
-        status=result['status']
-        subject=split_refrence(result['subject']['reference'])
-        identifer=get_mr_identifier(result['identifier'])
-        insert =f"""se:{fhirID} a fhir:MedicationAdministration ;
-            fhir:id "{fhirID}" ;
+            fhir:id "{id|literal}" .
+
+""",
+        id=lambda result: str(result.get('id')),
+        identifier=Each("identifier", template("""\t\t\tfhir:identifierSystem "{system|literal}" ;
+            fhir:identifierValue "{value|literal}" ;
+""")),
+        ingredients=Each("ingredient", template("""\t\t\tfhir:ingredientReference se:{itemReference.reference|ref} ;\n""")),
+        code=code)
+
+def create_medication_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "medication", MEDICATION_PIPELINE, medication_renderer(writer.concepts), query, source)
+
+MEDICATION_ADMINISTRATION_PIPELINE = [
+    {"$match":{"resourceType":"MedicationAdministration"}},
+    {"$project":{"id":1,"meta":1,"category":1,"context":1,"dosage":1,"effectiveDateTime":1,"identifier":1,
+                 "medicationCodeableConcept":1,"request":1,"status":1,"subject":1, "effectivePeriod":1}}
+]
+
+def medicationAdministration_renderer(compact=False, concepts=None):
+    """
+    This fuction builds the template that converts one MedicationAdministration document into its knowledge graph entity
+    Args:
+        compact (bool): leave the cosmetic whitespace out of the entity
+        concepts (ConceptNodes): link the codings to concept nodes, None writes them inline
+    Returns:
+        Template: the entity template
+    """
+    def template(layout, **fields):
+        return Template(layout, fields, FILTERS, compact)
+    category = Section("category", template("""\t\t\tfhir:categoryCodingSystem "{coding.0.system|literal}" ;
+            fhir:categoryCodingCode "{coding.0.code|literal}"; """))
+    dose = template("""\t\t\tfhir:doseSystem "{dose.system|literal}" ;
+            fhir:doseValue "{dose.value|literal}" ;{code}{unit}
+""",
+        code=Section("dose.code", template("""\n\t\t\tfhir:doseCode "{.|literal}" ;""")),
+        unit=Section("dose.unit", template("""\n\t\t\tfhir:doseUnit "{.|literal}" ;""")))
+    dosage = Section("dosage", template("""{rateQuantity}{text}{method}{dose}
+""",
+        text=Section("text", template("""\t\t\tfhir:doseText "{.|literal}" ;\n""")),
+        rateQuantity=Section("rateQuantity", template("""\t\t\tfhir:dosageRateQuantitySystem "{system|literal}" ;
+            fhir:dosageRateQuantityUnit "{unit|literal}" ;
+            fhir:dosageRateQuantityValue "{value|literal}" ;
+            fhir:dosageRateCode "{code|literal}" ;
+""")),
+        method=Section("method", template("""\t\t\tfhir:methodCodingsystem "{coding.0.system|literal}" ;
+            fhir:methodCodingcode "{coding.0.code|literal}" ;
+""")),
+        dose=dose))
+    period = Section("effectivePeriod", template("""\t\t\tfhir:effectivePeriodStart "{start|literal}" ;
+            fhir:effectivePeriodEnd "{end|literal}" ;"""))
+    #the system of the medication code is written from the code
+    medication_code = Section("medicationCodeableConcept", template("""\t\t\tfhir:codeCodingSystem "{coding.0.code|literal}" ;
+                    fhir:codeCodingCode "{coding.0.code|literal}" ; {display}
+""",
+        display=Section("coding.0.display", template(""" ;\n\t\t\tfhir:codeCodingDisplay "{.|literal}" ;"""))))
+    identifier = template("""fhir:identifierSystem "{identifier.0.system|literal}" ;
+            fhir:identifierValue "{identifier.0.value|literal}" ;
+            fhir:identifierTypeCodingSystem "{identifier.0.type.coding.0.system|literal}" ;
+            fhir:identifierTypeCodingCode "{identifier.0.type.coding.0.code|literal}" ;
+            fhir:identifierTypeCodingDisplay "{identifier.0.type.coding.0.display|literal}" ;
+""")
+    #in concept mode the codings link to their concept node, the medication code keeps its own system
+    if concepts is not None:
+        category = Section("category", template("""\t\t\tfhir:categoryCoding {concept} ; """, concept=concept_link(concepts, "coding.0")))
+        medication_code = Section("medicationCodeableConcept", template("""\t\t\tfhir:codeCoding {concept} ;\n""", concept=concept_link(concepts, "coding.0")))
+    entity = template("""se:{id} a fhir:MedicationAdministration ;
+            fhir:id "{id|literal}" ;
 {request}
-{mcc}
-    {identifer}
+{medication_code}
+    {identifier}
 {category}
 {context}
 {period}
 {effectiveDateTime}
 {dosage}
-            fhir:subjectReference se:{subject} ; 
-            fhir:status "{status}" .
-
-"""
-        write_to_middle(insert)
-    time_end = time.time()
-    print(f"medication administration entity creation took {time_end - time_start:.4f} seconds")
-    move_to_final()
-
-def create_observation_entities():
-    def get_category(cat):
-        return f"""\t\t\tfhir:categoryCodingSystem "{cat[0]['coding'][0]['system']}" ;
-            fhir:categoryCodingCode "{cat[0]['coding'][0]['code']}" . """
-    def get_o_code(code):
-        return f"""\t\t\tfhir:codeCodingSystem "{code['coding'][0]['system']}";
-            fhir:codeCodingCode "{code['coding'][0]['system']}" ;
-            fhir:codeCodingDisplay "{code['coding'][0]['display']}" ;"""
-    def get_extension(ex):
-        if len(ex)==0:
-            return ""
-        comparator=f"\n\t\t\tfhir:extensionValueQuantityComparator \"{ex[0]['valueQuantity']['comparator']}\" ;" if len(ex[0].get('valueQuantity',[]))!=0 and len(ex[0]['valueQuantity'].get('comparator',[]))!=0 else ""
-        valueQuantity=f"""\n\t\t\tfhir:extensionValueQuantityValue "{ex[0]['valueQuantity']['value']}" ;{comparator}
-""" if len(ex[0].get('valueQuantity',[]))!=0 else ""
-        valueString=f"\n\t\t\tfhir:extensionValueString \"{ex[0]['valueString']}\" ;" if len(ex[0].get('valueString',[]))!=0 else ""
-        return f"""fhir:extensionUrl "{ex[0]['url']}" ;{valueString}{valueQuantity}"""
-    def get_members(members):
-        if len(members)==0:
-            return ""
-        references=""
-        for x in members:
-            references=references+f"\t\t\tfhir:hasMemberReference se:{split_refrence(x['reference'])} ;\n"
-        return references
-    def get_interpretation(inter):
-        if len(inter)==0:
-            return ""
-        return f"""\t\t\tfhir:interpretationCodingSystem "{inter[0]['coding'][0]['system']}" ;
-            fhir:interpretationCodingCode "{inter[0]['coding'][0]['code']}" ; """
-    def get_note(note):
-        if len(note)==0:
-            return ""
-        return f"""\t\t\tfhir:noteText "{sanitize_for_kg_literal(note[0]['text'])}" ;"""
-    def get_referenceRange(rr):
-        if len(rr)==0:
-            return ""
-        high_unit=f"\n\t\t\tfhir:rrHighUnit \"{rr[0]['high']['unit']}\" ;" if len(rr[0].get('high',[]))!=0 and rr[0]['high'].get('unit',None) else ""
-        high_value=f"\n\t\t\tfhir:rrHighValue \"{rr[0]['high']['value']}\" ;" if len(rr[0].get('high',[]))!=0 and rr[0]['high'].get('value',None) else ""
-        high_code=f"\n\t\t\tfhir:rrHighCode \"{rr[0]['high']['code']}\" ;" if len(rr[0].get('high',[]))!=0 and rr[0]['high'].get('code',None) else ""
-        high=f"""\t\t\tfhir:rrHighSystem \"{rr[0]['high']['system']}\" ;{high_unit}{high_value}{high_code}
-""" if len(rr[0].get('high',[]))!=0 else ""
-        
-        low_unit=f";\n\t\t\tfhir:rrLowUnit \"{rr[0]['low']['unit']}\" ;" if len(rr[0].get('low',[]))!=0 and rr[0]['low'].get('unit',None) else ""
-        low_value=f";\n\t\t\tfhir:rrLowValue \"{rr[0]['low']['value']}\" ;" if len(rr[0].get('low',[]))!=0 and rr[0]['low'].get('value',None) else ""
-        low_code=f";\n\t\t\tfhir:rrLowCode \"{rr[0]['low']['code']}\" ;" if len(rr[0].get('low',[]))!=0 and rr[0]['low'].get('code',None) else ""
-        low=f"""\t\t\tfhir:rrLowSystem \"{rr[0]['low']['system']}\" ;{low_unit}{low_value}{low_code}""" if len(rr[0].get('low',[]))!=0 else ""
-        return high+low
-    def get_vcc(vcc):
-        if len(vcc)==0:
-            return ""
-        display=f";\n\t\t\tfhir:vccCodingDisplay \"{vcc['coding'][0]['display']}\" ;" if vcc['coding'][0].get('display',None) else ""
-        return f"""\t\t\tfhir:vccCodingSystem"{vcc['coding'][0]['system']}" ;
-                    fhir:vccCodingCode "{vcc['coding'][0]['code']}" ;"""
-    def get_valueQuantity(vq):
-        if len(vq)==0:
-            return ""
-        value =f"\n\t\t\tfhir:valueQuantityValue \"{vq['value']}\" ;" if vq.get('value',None) else ""
-        comparator =f"\n\t\t\tfhir:valueQuantityComparator \"{vq['comparator']}\" ;" if vq.get('comparator',None) else ""
-        code = f";\n\t\t\tfhir:valueQuantityCode \"{vq['code']}\" ;" if vq.get('code',None) else ""
-        return f"""\t\t\tfhir:valueQuantitySystem "{vq['system']}" ;{value}{comparator}{code}"""
-    def get_identifier(identifier):
-        """
-        This fuction converts identifier information into knowledge graph format
-        Args:
-            identifier (dict): a dictionary holding coding information
-        Returns:
-            str: the converted identifier property 
-        """
-        if len(identifier)==0:
-            return ""
-        identifierSystem=identifier[0].get('system',"")  if identifier else ""
-        identifierValue=identifier[0].get('value',"")  if identifier else ""
-        identifier_line=f"""\t\t\tfhir:identifierSystem "{identifierSystem}" ;
-            fhir:identifierValue "{sanatize_quotes(identifierValue)}" ;"""
-        return identifier_line
-    time_start = time.time()
-    print("creating observation entities")
-    pipeline = [
-        {"$match":{"resourceType":"Observation","dataAbsentRearson":{"$exists": False}}},
-        {"$project":{"id":1,"category":1,"code":1,"derivedFrom":1,"effectiveDateTime":1,"encounter":1,"extension":1,"specimen":1,
-                     "status":1,"subject":1,"identifier":1,"meta":1,"hasMember":1,"interpretation":1,"issued":1,"valueDateTime":1,
-                     "valueString":1,"note":1,"referenceRange":1,"valueCodeableConcept":1,"valueQuantity":1}}
-    ]
-    results = collection.aggregate(pipeline)
-    for result in results:
-        fhirID=result.get('id')
-        category=get_category(result['category'])
-        code=get_o_code(result['code'])
-        derivedFrom =f"\t\t\tfhir:derivedFromReference se:{split_refrence(result['derivedFrom'][0]['reference'])} ;" if len(result.get('derivedFrom',[]))!=0 else ""
-        encounter =f"\t\t\tfhir:encounterReference se:{split_refrence(result['encounter']['reference'])} ;" if len(result.get('encounter',[]))!=0 else ""
-        specimen =f"\t\t\tfhir:specimenReference se:{split_refrence(result['specimen']['reference'])} ;" if len(result.get('specimen',[]))!=0 else ""
-        status = f"\t\t\tfhir:status \"{result['status']}\" ;"
-        subject = f"\t\t\tfhir:subjectReference se:{split_refrence(result['subject']['reference'])} ;"
-        effectiveDateTime=f"\t\t\tfhir:effectiveDateTime \"{result['effectiveDateTime']}\" ;" if result.get('effectiveDateTime',None) else ""
-        extension=get_extension(result.get('extension',[]))
-        identifier=get_identifier(result['identifier'])
-        hasMember=get_members(result.get('hasMember',[]))
-        interpretation=get_interpretation(result.get('interpretation',[]))
-        issued=f"\t\t\tfhir:issued \"{result['issued']}\" ; " if result.get('issued', None) else ""
-        valueDateTime=f"\t\t\tfhir:valueDateTime \"{result['valueDateTime']}\" ; " if result.get('valueDateTime', None) else ""
-        valueString=f"\t\t\tfhir:valueString \"{sanatize_quotes(result['valueString'])}\" ; " if result.get('valueString', None) else ""
-        note=get_note(result.get('note',[]))
-        referenceRange=get_referenceRange(result.get('referenceRange',[]))
-        vcc=get_vcc(result.get('valueCodeableConcept',[]))
-        valueQuantity=get_valueQuantity(result.get('valueQuantity',[]))
-        insert =f"""se:{fhirID} a fhir:Observation ;
-            fhir:id "{fhirID}" ;
+            fhir:subjectReference se:{subject.reference|ref} ; 
+            fhir:status "{status|literal}" .
+
+""",
+        id=lambda result: str(result.get('id')),
+        request=Section("request", template("""\t\t\tfhir:requestReference se:{reference|ref} ;""")),
+        context=Section("context", template("""\t\t\tfhir:contextReference se:{reference|ref} ;""")),
+        effectiveDateTime=Section("effectiveDateTime", template("""\t\t\tfhir:effectiveDateTime "{.|literal}" ;""")),
+        medication_code=medication_code,
+        identifier=identifier,
+        category=category,
+        period=period,
+        dosage=dosage)
+    return entity
+
+def create_medicationAdministration_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "medication administration", MEDICATION_ADMINISTRATION_PIPELINE, medicationAdministration_renderer(writer.compact, writer.concepts), query, source)
+
+OBSERVATION_PIPELINE = [
+    {"$match":{"resourceType":"Observation","dataAbsentRearson":{"$exists": False}}},
+    {"$project":{"id":1,"category":1,"code":1,"derivedFrom":1,"effectiveDateTime":1,"encounter":1,"extension":1,"specimen":1,
+                 "status":1,"subject":1,"identifier":1,"meta":1,"hasMember":1,"interpretation":1,"issued":1,"valueDateTime":1,
+                 "valueString":1,"note":1,"referenceRange":1,"valueCodeableConcept":1,"valueQuantity":1}}
+]
+
+def observation_renderer(compact=False, concepts=None):
+    """
+    This fuction builds the template that converts one Observation document into its knowledge graph entity
+    Args:
+        compact (bool): leave the cosmetic whitespace out of the entity
+        concepts (ConceptNodes): link the codings to concept nodes, None writes them inline
+    Returns:
+        Template: the entity template
+    """
+    def template(layout, **fields):
+        return Template(layout, fields, FILTERS, compact)
+    category = template("""\t\t\tfhir:categoryCodingSystem "{category.0.coding.0.system|literal}" ;
+            fhir:categoryCodingCode "{category.0.coding.0.code|literal}" . """)
+    #the code of the observation is written from the system
+    code = template("""\t\t\tfhir:codeCodingSystem "{code.coding.0.system|literal}";
+            fhir:codeCodingCode "{code.coding.0.system|literal}" ;
+            fhir:codeCodingDisplay "{code.coding.0.display|literal}" ;""")
+    extension = Section("extension", template("""fhir:extensionUrl "{0.url|literal}" ;{valueString}{valueQuantity}""",
+        valueString=Section("0.valueString", template("""\n\t\t\tfhir:extensionValueString "{.|literal}" ;""")),
+        valueQuantity=Section("0.valueQuantity", template("""\n\t\t\tfhir:extensionValueQuantityValue "{value|literal}" ;{comparator}\n""",
+            comparator=Section("comparator", template("""\n\t\t\tfhir:extensionValueQuantityComparator "{.|literal}" ;"""))))))
+    interpretation = Section("interpretation", template("""\t\t\tfhir:interpretationCodingSystem "{0.coding.0.system|literal}" ;
+            fhir:interpretationCodingCode "{0.coding.0.code|literal}" ; """))
+    note = Section("note", template("""\t\t\tfhir:noteText "{0.text|literal}" ;"""))
+    referenceRange = Section("referenceRange", template("""{high}{low}""",
+        high=Section("0.high", template("""\t\t\tfhir:rrHighSystem "{system|literal}" ;{unit}{value}{code}\n""",
+            unit=Section("unit", template("""\n\t\t\tfhir:rrHighUnit "{.|literal}" ;""")),
+            value=Section("value", template("""\n\t\t\tfhir:rrHighValue "{.|literal}" ;""")),
+            code=Section("code", template("""\n\t\t\tfhir:rrHighCode "{.|literal}" ;""")))),
+        low=Section("0.low", template("""\t\t\tfhir:rrLowSystem "{system|literal}" ;{unit}{value}{code}""",
+            unit=Section("unit", template(""";\n\t\t\tfhir:rrLowUnit "{.|literal}" ;""")),
+            value=Section("value", template(""";\n\t\t\tfhir:rrLowValue "{.|literal}" ;""")),
+            code=Section("code", template(""";\n\t\t\tfhir:rrLowCode "{.|literal}" ;"""))))))
+    valueCodeableConcept = Section("valueCodeableConcept", template("""\t\t\tfhir:vccCodingSystem"{coding.0.system|literal}" ;
+                    fhir:vccCodingCode "{coding.0.code|literal}" ;"""))
+    valueQuantity = Section("valueQuantity", template("""\t\t\tfhir:valueQuantitySystem "{system|literal}" ;{value}{comparator}{code}""",
+        value=Section("value", template("""\n\t\t\tfhir:valueQuantityValue "{.|literal}" ;""")),
+        comparator=Section("comparator", template("""\n\t\t\tfhir:valueQuantityComparator "{.|literal}" ;""")),
+        code=Section("code", template(""";\n\t\t\tfhir:valueQuantityCode "{.|literal}" ;"""))))
+    identifier = Section("identifier", template("""\t\t\tfhir:identifierSystem "{system|literal}" ;
+            fhir:identifierValue "{value|literal}" ;""",
+        system=lambda identifier: str(identifier[0].get('system', "")),
+        value=lambda identifier: identifier[0].get('value', "")))
+    #in concept mode the codings link to their concept node, the code is written from its own code
+    if concepts is not None:
+        category = template("""\t\t\tfhir:categoryCoding {concept} . """, concept=concept_link(concepts, "category.0.coding.0"))
+        code = template("""\t\t\tfhir:codeCoding {concept} ;""", concept=concept_link(concepts, "code.coding.0"))
+        interpretation = Section("interpretation", template("""\t\t\tfhir:interpretationCoding {concept} ; """, concept=concept_link(concepts, "0.coding.0")))
+        valueCodeableConcept = Section("valueCodeableConcept", template("""\t\t\tfhir:vccCoding {concept} ;""", concept=concept_link(concepts, "coding.0")))
+    entity = template("""se:{id} a fhir:Observation ;
+            fhir:id "{id|literal}" ;
 {specimen}
 {valueString}
 {valueDateTime}
 {issued}
 {valueQuantity}
-{status}
-{subject}
+\t\t\tfhir:status "{status|literal}" ;
+\t\t\tfhir:subjectReference se:{subject.reference|ref} ;
 {note}
-{vcc}
+{valueCodeableConcept}
 {referenceRange}
 {interpretation}
 {code}
@@ -1097,9 +928,43 @@ def create_observation_entities():
 {effectiveDateTime}
 {category}
         
-"""
-        write_to_middle(insert)
-    time_end = time.time()
-    move_to_final()
-    print(f"observation entity creation took {time_end - time_start:.4f} seconds")
-
+""",
+        id=lambda result: str(result.get('id')),
+        specimen=Section("specimen", template("""\t\t\tfhir:specimenReference se:{reference|ref} ;""")),
+        valueString=Section("valueString", template("""\t\t\tfhir:valueString "{.|literal}" ; """)),
+        valueDateTime=Section("valueDateTime", template("""\t\t\tfhir:valueDateTime "{.|literal}" ; """)),
+        issued=Section("issued", template("""\t\t\tfhir:issued "{.|literal}" ; """)),
+        hasMember=Each("hasMember", template("""\t\t\tfhir:hasMemberReference se:{reference|ref} ;\n""")),
+        derivedFrom=Section("derivedFrom", template("""\t\t\tfhir:derivedFromReference se:{0.reference|ref} ;""")),
+        encounter=Section("encounter", template("""\t\t\tfhir:encounterReference se:{reference|ref} ;""")),
+        effectiveDateTime=Section("effectiveDateTime", template("""\t\t\tfhir:effectiveDateTime "{.|literal}" ;""")),
+        valueQuantity=valueQuantity,
+        note=note,
+        valueCodeableConcept=valueCodeableConcept,
+        referenceRange=referenceRange,
+        interpretation=interpretation,
+        code=code,
+        identifier=identifier,
+        extension=extension,
+        category=category)
+    return entity
+
+def create_observation_entities(writer, query=None, source=None):
+    run_entity_pass(writer, "observation", OBSERVATION_PIPELINE, observation_renderer(writer.compact, writer.concepts), query, source)
+
+#the entity passes in the order they are written to flattened_final_script.ttl
+#comment out any entity functions you do not want in the final script for test purposes
+ENTITY_PASSES = [
+    create_organization_entities,
+    create_location_entities,
+    create_patient_entities,
+    create_encounter_entities,
+    create_procedure_entities,
+    create_condition_entities,
+    create_medicationDispense_entities,
+    create_medicationRequest_entities,
+    create_specimen_entities,
+    create_medication_entities,
+    create_medicationAdministration_entities,
+    create_observation_entities,
+]
@@ -0,0 +1,169 @@
+#--------------------------------------------------------------
+#
+# This python file picks the documents of a cohort of patients so a test graph can be converted without converting everything
+#
+#   create_ttl_script(cohort=["patient id", ...])                        these patients and everything they reach
+#   create_ttl_script(cohort={"gender": "female"}, source=source)        the patients matching a mongoDB filter
+#   create_both_ttl_scripts(cohort=[...]) in dual_kg_creation.py
+#
+# The cohort is closed over the references: the Encounters of the patients, their Observations, Procedures, Conditions and
+# MedicationRequests (by subject or encounter), the MedicationDispenses and MedicationAdministrations that point to those
+# requests, and the Specimens, Medications, Locations and Organizations any of them refer to. Every step is one $in query
+# on a reference field, create_cohort_indexes() adds the indexes that answer them without a collection scan
+#
+# The entity passes then read only the _ids of the closure, so the graph holds no reference that points outside of it
+#
+#----------------------------------------------------------------
+
+from fhir_kg_creation import get_mongo_collection
+from ndjson_source import NdjsonSource
+
+
+#resource type -> (reference field, resource type it points to), a document joins the cohort when one of its fields points to
+#a member, in the order they are resolved so every resource type only points to the ones before it
+COHORT_LINKS = {
+    "Encounter": [("subject.reference", "Patient")],
+    "Condition": [("subject.reference", "Patient"), ("encounter.reference", "Encounter")],
+    "Procedure": [("subject.reference", "Patient"), ("encounter.reference", "Encounter")],
+    "Observation": [("subject.reference", "Patient"), ("encounter.reference", "Encounter")],
+    "MedicationRequest": [("subject.reference", "Patient"), ("encounter.reference", "Encounter")],
+    "MedicationDispense": [("subject.reference", "Patient"), ("context.reference", "Encounter"), ("authorizingPrescription.reference", "MedicationRequest")],
+    "MedicationAdministration": [("subject.reference", "Patient"), ("context.reference", "Encounter"), ("request.reference", "MedicationRequest")],
+    "Specimen": [("subject.reference", "Patient")],
+}
+
+#resource type -> top level fields whose references pull the resources they point to into the cohort
+COHORT_REFERENCES = {
+    "Patient": ["managingOrganization"],
+    "Encounter": ["serviceProvider", "location", "identifier"],
+    "Observation": ["specimen"],
+    "MedicationRequest": ["medicationReference"],
+    "MedicationDispense": ["medicationReference"],
+    "MedicationAdministration": ["medicationReference"],
+    "Location": ["managingOrganization"],
+    "Medication": ["ingredient"],
+}
+
+#the resource types a member refers to by id, Locations point to Organizations and Medications to their ingredients
+REFERENCED_TYPES = ["Specimen", "Medication", "Location", "Organization"]
+
+
+class Cohort:
+    """
+    This class holds the _ids of every document in the closure of a cohort, the entity passes only convert these
+    Args:
+        members (dict): resource type -> list of _ids
+    """
+    def __init__(self, members):
+        self.members = members
+
+    def query(self, pipeline):
+        """
+        This fuction returns the condition that keeps an entity pass to the cohort, by the resource type its pipeline matches
+        Args:
+            pipeline (list): an entity pipeline that starts with a $match on resourceType
+        Returns:
+            dict: {"_id": {"$in": _ids}}, an empty list when no document of the resource type is in the cohort
+        """
+        resource_type = pipeline[0]["$match"].get("resourceType")
+        return {"_id": {"$in": self.members.get(resource_type, [])}}
+
+    def counts(self):
+        """
+        This fuction counts the documents of every resource type in the cohort
+        Returns:
+            dict: resource type -> number of documents
+        """
+        return {resource_type: len(ids) for resource_type, ids in self.members.items()}
+
+def resolve_cohort(patients, source=None):
+    """
+    This fuction finds the closure of a cohort of patients, the documents that belong to them or that they refer to
+    Args:
+        patients (object): a list of Patient ids, or a mongoDB filter the Patients of the cohort match
+        source (object): the document source, the mongoDB collection when None or an NdjsonSource
+    Returns:
+        Cohort: the _ids of every document in the closure
+    """
+    collection = source if source is not None else get_mongo_collection()
+    #resource type -> {_id: fhir id} of the members found so far
+    members = {}
+    #resource type -> fhir ids the members refer to
+    referenced = {resource_type: set() for resource_type in REFERENCED_TYPES}
+
+    def add_members(resource_type, query):
+        fields = COHORT_REFERENCES.get(resource_type, [])
+        projection = {"_id": 1, "id": 1, **{field: 1 for field in fields}}
+        found = members.setdefault(resource_type, {})
+        for doc in collection.find({"resourceType": resource_type, **query}, projection):
+            if doc["_id"] in found:
+                continue
+            found[doc["_id"]] = doc.get("id")
+            for field in fields:
+                for reference in find_references(doc.get(field)):
+                    #*resource_type*/*id*, absolute references have the server in front of it
+                    parts = reference.split("/")
+                    if len(parts) > 1 and parts[-2] in referenced:
+                        referenced[parts[-2]].add(parts[-1])
+
+    if isinstance(patients, dict):
+        add_members("Patient", patients)
+    else:
+        add_members("Patient", {"id": {"$in": list(patients)}})
+    for resource_type, links in COHORT_LINKS.items():
+        branches = []
+        for field, target_type in links:
+            references = [f"{target_type}/{target_id}" for target_id in members.get(target_type, {}).values()]
+            if references:
+                branches.append({field: {"$in": references}})
+        if branches:
+            add_members(resource_type, {"$or": branches} if len(branches) > 1 else branches[0])
+    #the referenced resources can refer to more of them, so the lookups repeat until nothing new turns up
+    looked_up = {resource_type: set() for resource_type in REFERENCED_TYPES}
+    while True:
+        lookups = {}
+        for resource_type in REFERENCED_TYPES:
+            missing = referenced[resource_type] - looked_up[resource_type] - set(members.get(resource_type, {}).values())
+            if missing:
+                lookups[resource_type] = sorted(missing)
+        if not lookups:
+            break
+        for resource_type, ids in lookups.items():
+            looked_up[resource_type].update(ids)
+            add_members(resource_type, {"id": {"$in": ids}})
+    return Cohort({resource_type: list(found) for resource_type, found in members.items()})
+
+def find_references(value):
+    """
+    This fuction finds every reference string in a field, however deep it is nested
+    Args:
+        value (object): the field, a dict, a list of them or None
+    Returns:
+        list: the references, like "Organization/*id*"
+    """
+    references = []
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            reference = value.get("reference")
+            if isinstance(reference, str):
+                references.append(reference)
+            stack.extend(item for item in value.values() if isinstance(item, (dict, list)))
+        elif isinstance(value, list):
+            stack.extend(value)
+    return references
+
+def create_cohort_indexes(collection=None):
+    """
+    This fuction creates the indexes the $in queries of resolve_cohort run on, every reference field of COHORT_LINKS and the id
+    Args:
+        collection (Collection): the mongoDB collection, the one in MONGO_SETTINGS when None
+    Returns:
+        list: the names of the indexes
+    """
+    collection = collection if collection is not None else get_mongo_collection()
+    if isinstance(collection, NdjsonSource):
+        raise ValueError("ndjson files have no indexes, a cohort of them is resolved by reading the files")
+    fields = ["id"] + sorted({field for links in COHORT_LINKS.values() for field, _ in links})
+    return [collection.create_index([("resourceType", 1), (field, 1)]) for field in fields]
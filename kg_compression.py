@@ -0,0 +1,184 @@
+#--------------------------------------------------------------
+#
+# This python file holds the compressed output files the knowledge graphs can be written to
+#
+# open_output() picks the compression from the file extension, .gz for gzip and .zst for zstandard, any other extension
+# is an ordinary text file
+#
+#   create_ttl_script(compression="gzip")   writes fhir_final_script.ttl.gz
+#   create_ttl_script(compression="zstd")   writes fhir_final_script.ttl.zst
+#
+# The text is cut into blocks of BLOCK_SIZE bytes that are compressed on a thread pool (zlib and zstandard release the GIL)
+# while the next block is filled, and written in order. Every block is a complete gzip member or zstd frame, and a file of
+# members or frames one after another is a single valid stream for gzip -d, zstd -d, zcat and python, so shards and
+# headers compressed on their own can be joined by copying their bytes
+#
+# zstd needs the zstandard package (pip install zstandard), gzip only needs the standard library
+#
+#----------------------------------------------------------------
+
+import os
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+#file extension -> compression
+COMPRESSED_EXTENSIONS = {".gz": "gzip", ".zst": "zstd"}
+#compression -> file extension
+COMPRESSION_EXTENSIONS = {compression: extension for extension, compression in COMPRESSED_EXTENSIONS.items()}
+
+#uncompressed bytes per block, bigger blocks compress a little better, smaller ones spread over the threads sooner
+BLOCK_SIZE = 1 << 20
+
+#threads compressing the blocks of one file, parallel runs have one pool per shard
+COMPRESSION_THREADS = min(4, os.cpu_count() or 1)
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+class CompressedOutput:
+    """
+    This class is a text file that compresses what is written to it block by block on a thread pool
+    Args:
+        path (string): the compressed file
+        mode (string): "w" to start a new file or "a" to add blocks behind the ones already in it
+        buffer_size (int): size in bytes of the write buffer in front of the file
+        compression (string): "gzip" or "zstd"
+        threads (int): number of threads compressing blocks
+    """
+    def __init__(self, path, mode="w", buffer_size=-1, compression="gzip", threads=COMPRESSION_THREADS):
+        self.compress = get_compressor(compression)
+        self.file = open(path, mode + "b", buffering=buffer_size)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        #compressions in flight, oldest first, at most two per thread so memory stays at a few blocks
+        self.pending = deque()
+        self.limit = 2 * threads
+        self.block = bytearray()
+        #uncompressed bytes written through this file
+        self.position = 0
+
+    def write(self, text):
+        """
+        This fuction adds text to the current block and hands the block to the pool once it is full
+        Args:
+            text (string): a string of text
+        """
+        data = text.encode("utf-8")
+        self.block += data
+        self.position += len(data)
+        if len(self.block) >= BLOCK_SIZE:
+            self.submit_block()
+
+    def submit_block(self):
+        """
+        This fuction starts compressing the current block, writing the oldest finished blocks when too many are in flight
+        """
+        if self.block:
+            self.pending.append(self.pool.submit(self.compress, bytes(self.block)))
+            self.block = bytearray()
+        while len(self.pending) > self.limit:
+            self.file.write(self.pending.popleft().result())
+
+    def tell(self):
+        """
+        This fuction returns the number of uncompressed bytes written so far
+        Returns:
+            int: the size in bytes of the text
+        """
+        return self.position
+
+    def fileno(self):
+        """
+        This fuction returns the file descriptor of the compressed file
+        Returns:
+            int: the file descriptor
+        """
+        return self.file.fileno()
+
+    def flush(self):
+        """
+        This fuction compresses the current block and writes every block, the file then ends after a complete member or frame
+        """
+        self.submit_block()
+        while self.pending:
+            self.file.write(self.pending.popleft().result())
+        self.file.flush()
+
+    def close(self):
+        """
+        This fuction writes the last blocks and closes the file
+        """
+        if self.file.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self.pool.shutdown()
+            self.file.close()
+
+
+def get_compression(path):
+    """
+    This fuction finds the compression of a file from its extension
+    Args:
+        path (string): the file
+    Returns:
+        string: "gzip", "zstd" or None for an uncompressed file
+    """
+    return COMPRESSED_EXTENSIONS.get(os.path.splitext(path)[1])
+
+def open_output(path, mode="w", buffer_size=-1):
+    """
+    This fuction opens an output file for writing text, compressed when its extension asks for it
+    Args:
+        path (string): the file, ending in .gz or .zst for a compressed file
+        mode (string): "w" to start a new file or "a" to append to an existing one
+        buffer_size (int): size in bytes of the write buffer in front of the file
+    Returns:
+        object: a file with write, tell, flush, fileno and close, tell counts the uncompressed bytes
+    """
+    compression = get_compression(path)
+    if compression is None:
+        return open(path, mode, encoding="utf-8", buffering=buffer_size)
+    return CompressedOutput(path, mode, buffer_size, compression)
+
+def compress_text(text, compression):
+    """
+    This fuction compresses a piece of text on its own, so it can be joined with the blocks of a compressed file
+    Args:
+        text (string): the text
+        compression (string): "gzip", "zstd" or None to only encode it
+    Returns:
+        bytes: the text as one gzip member or zstd frame
+    """
+    if compression is None:
+        return text.encode("utf-8")
+    return get_compressor(compression)(text.encode("utf-8"))
+
+def get_compressor(compression):
+    """
+    This fuction returns the function that turns a block into a gzip member or zstd frame
+    Args:
+        compression (string): "gzip" or "zstd"
+    Returns:
+        function: compress(bytes) -> bytes, safe to call from several threads at once
+    """
+    if compression == "gzip":
+        def compress(block):
+            #wbits 31 writes the gzip header and trailer around the deflate stream
+            compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+            return compressor.compress(block) + compressor.flush()
+        return compress
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("zstd output needs the zstandard package, pip install zstandard or write .gz") from None
+
+        def compress(block):
+            #a compressor can not be shared between threads, making one is cheap next to a block
+            return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(block)
+        return compress
+    raise ValueError(f"unknown compression {compression}, use gzip or zstd")
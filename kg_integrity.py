@@ -0,0 +1,326 @@
+#--------------------------------------------------------------
+#
+# This python file checks that the se: nodes the entities link to are defined somewhere in the output
+#
+#   create_ttl_script(integrity=True)                       checks while the output is written, the report goes to
+#                                                           fhir_final_script.ttl.integrity.json and is printed
+#   check_integrity("fhir_final_script.ttl")                checks a turtle file that is already written, for example the
+#                                                           output of a parallel run
+#
+# The renderers link entities with statements like fhir:encounter se:*id* or fhir:authorizingPrescription se:MR-*id*, built
+# from split_refrence() without looking at whether the target was converted. The check takes the triples the entity
+# templates emit (see kg_triples.py), the same ones the nt/nq output is written from: a se: node that is the subject of a
+# triple is defined, a se: node that is the object of one is linked to, however deep in blank nodes or lists it is.
+# check_integrity reads the triples back from the file, turtle with the strict TurtleParser and N-Triples or N-Quads line
+# by line
+#
+# Only 8 byte hashes of the nodes are kept. The defined subjects go into a BloomFilter (see kg_sketches.py) that takes three
+# quarters of the memory budget, a link whose target is in it already is resolved on the spot. The other links point
+# forward (a MedicationDispense is written before the MedicationRequest it points to) or dangle, they wait in a buffer of
+# hashes that holds the last quarter. A full buffer drops the links that were resolved since and goes to a temporary file
+# when it is still half full. The file is capped at the spill budget, the links that wait after that are only counted per
+# predicate and a fixed sample of them is kept, the dangling links among them are estimated from the sample and the report
+# says so. The memory and the disk stay the same however big the output is. At the end every waiting link is looked up once
+# more, the ones still missing are dangling
+#
+# The filter can hold a hash it was never given, so a dangling link is missed with the false positive rate in the report,
+# a larger memory budget lowers it. A subject that is defined twice is counted under redefined, with the same caveat
+#
+#----------------------------------------------------------------
+
+from array import array
+import hashlib
+import json
+import os
+import random
+import re
+import tempfile
+
+from kg_sketches import BloomFilter
+from kg_triples import FHIR, NODE, TurtleParser, read_nquads
+
+
+#the memory in bytes the hashes of one check are kept in
+INTEGRITY_MEMORY = 64 * 1024 * 1024
+
+#the bytes of waiting links the temporary file takes at most
+INTEGRITY_SPILL = 4 * INTEGRITY_MEMORY
+
+#the waiting links kept per predicate once the temporary file is full, the dangling ones among the rest are estimated from them
+INTEGRITY_OVERFLOW_SAMPLES = 4096
+
+#the dangling nodes reported per predicate
+INTEGRITY_SAMPLES = 5
+
+#the extension of the report file, added to the name of the output file
+INTEGRITY_EXTENSION = ".integrity.json"
+
+#the namespace of the se: nodes in the ontology headers, a header or turtle file that declares se: sets it
+SE_NAMESPACE = "http://example.org/myontology#"
+
+#the converters write no line breaks in literals, so a line that ends with a dot ends a statement
+STATEMENT_END = re.compile(r"^[^#\n][^\n]*\.[ \t]*$", re.MULTILINE)
+
+
+class IntegrityCheck:
+    """
+    This class collects the defined subjects and the links to se: nodes of the triples of the entities a TtlWriter writes
+    Args:
+        path (string): the report file, None only returns the report
+        memory (int): the bytes the hashes are kept in
+        samples (int): the dangling nodes reported per predicate
+        spill (int): the bytes of waiting links the temporary file takes at most
+        namespace (string): IRI of the se: nodes
+    """
+    def __init__(self, path=None, memory=INTEGRITY_MEMORY, samples=INTEGRITY_SAMPLES, spill=INTEGRITY_SPILL, namespace=SE_NAMESPACE):
+        self.path = path
+        self.samples = samples
+        self.namespace = namespace
+        self.defined = BloomFilter(memory * 3 // 4 * 8)
+        #a waiting link takes 8 bytes of hash and 2 of predicate
+        self.capacity = max(memory // 4 // 10, 1)
+        self.waiting_hashes = array("Q")
+        self.waiting_predicates = array("H")
+        #the temporary file the waiting links go to when the buffer stays full, None until it does
+        self.spill = None
+        self.spill_limit = spill
+        self.spilled = 0
+        self.subjects = 0
+        self.redefined = 0
+        #the se: subject of the last triple scanned, a statement split over two scans is counted once
+        self.last_subject = None
+        #predicate -> its index in the lists below
+        self.predicates = {}
+        self.links = []
+        #hash -> node of the first waiting links of every predicate, the samples are taken from the ones that stay missing
+        self.candidates = []
+        #the waiting links that found the temporary file full, counted per predicate, and a fixed size sample of their hashes
+        self.overflow = []
+        self.overflow_samples = []
+        self.random = random.Random(0)
+
+    def header(self, text):
+        """
+        This fuction reads the ontology header, the se: prefix it declares is the namespace of the nodes
+        Args:
+            text (string): the turtle header
+        """
+        parser = TurtleParser()
+        triples = parser.parse(text)
+        self.namespace = parser.prefixes.get("se", self.namespace)
+        self.scan(triples)
+
+    def scan(self, triples):
+        """
+        This fuction records the subjects and links of triples that are written to the output
+        Args:
+            triples (list): the Triples of whole statements
+        """
+        namespace = self.namespace
+        start = len(namespace)
+        #a se: subject is counted once per statement, the triples of the blank nodes inside it do not end it
+        last = self.last_subject
+        for triple in triples:
+            subject = triple.subject
+            if subject != last and subject.startswith(namespace):
+                last = subject
+                self.subjects += 1
+                if self.defined.add(node_hash(subject[start:])):
+                    self.redefined += 1
+        self.last_subject = last
+        for triple in triples:
+            if triple.datatype is NODE and triple.object.startswith(namespace):
+                predicate = triple.predicate
+                self.link("fhir:" + predicate[len(FHIR):] if predicate.startswith(FHIR) else f"<{predicate}>", triple.object[start:])
+
+    def link(self, predicate, node):
+        """
+        This fuction records one link, it waits for the end of the output when its target is not defined yet
+        Args:
+            predicate (string): the predicate, like fhir:encounter
+            node (string): the local name of the target
+        """
+        index = self.predicates.get(predicate)
+        if index is None:
+            index = self.predicates[predicate] = len(self.links)
+            self.links.append(0)
+            self.candidates.append({})
+            self.overflow.append(0)
+            self.overflow_samples.append(array("Q"))
+        self.links[index] += 1
+        hashed = node_hash(node)
+        if self.defined.contains(hashed):
+            return
+        self.waiting_hashes.append(hashed)
+        self.waiting_predicates.append(index)
+        candidates = self.candidates[index]
+        if len(candidates) < self.samples * 20:
+            candidates[hashed] = node
+        if len(self.waiting_hashes) >= self.capacity:
+            self.drop_resolved()
+
+    def drop_resolved(self):
+        """
+        This fuction drops the waiting links whose target was defined since, the rest goes to the temporary file when the
+        buffer is still half full, or into the overflow counts and samples when the file is full
+        """
+        defined = self.defined
+        hashes, predicates = array("Q"), array("H")
+        for hashed, index in zip(self.waiting_hashes, self.waiting_predicates):
+            if not defined.contains(hashed):
+                hashes.append(hashed)
+                predicates.append(index)
+        for candidates in self.candidates:
+            for hashed in [hashed for hashed in candidates if defined.contains(hashed)]:
+                del candidates[hashed]
+        if len(hashes) * 2 >= self.capacity:
+            size = 8 + len(hashes) * 10
+            if self.spilled + size <= self.spill_limit:
+                if self.spill is None:
+                    self.spill = tempfile.TemporaryFile()
+                self.spill.write(len(hashes).to_bytes(8, "big"))
+                hashes.tofile(self.spill)
+                predicates.tofile(self.spill)
+                self.spilled += size
+            else:
+                self.sample_overflow(hashes, predicates)
+            hashes, predicates = array("Q"), array("H")
+        self.waiting_hashes, self.waiting_predicates = hashes, predicates
+
+    def sample_overflow(self, hashes, predicates):
+        """
+        This fuction counts waiting links that do not fit the temporary file, a reservoir sample of every predicate is kept
+        Args:
+            hashes (array): the hashes of the targets
+            predicates (array): the predicate indexes of the links
+        """
+        for hashed, index in zip(hashes, predicates):
+            self.overflow[index] += 1
+            sample = self.overflow_samples[index]
+            if len(sample) < INTEGRITY_OVERFLOW_SAMPLES:
+                sample.append(hashed)
+            else:
+                slot = self.random.randrange(self.overflow[index])
+                if slot < INTEGRITY_OVERFLOW_SAMPLES:
+                    sample[slot] = hashed
+
+    def waiting(self):
+        """
+        This fuction reads back the waiting links, the ones in the temporary file first
+        Returns:
+            iterator: (hashes, predicates) arrays
+        """
+        if self.spill is not None:
+            self.spill.seek(0)
+            while True:
+                count = self.spill.read(8)
+                if not count:
+                    break
+                hashes, predicates = array("Q"), array("H")
+                hashes.fromfile(self.spill, int.from_bytes(count, "big"))
+                predicates.fromfile(self.spill, len(hashes))
+                yield hashes, predicates
+        yield self.waiting_hashes, self.waiting_predicates
+
+    def finish(self):
+        """
+        This fuction looks up every waiting link once the whole output is written and saves the report
+        Returns:
+            dict: subjects, redefined, links, dangling, estimated, false_positive_rate and per predicate its links, dangling
+                links and samples, the predicates with the most dangling links first, dangling counts part of which come from
+                the overflow sample are rounded estimates and marked estimated
+        """
+        defined = self.defined
+        dangling = [0] * len(self.links)
+        for hashes, predicates in self.waiting():
+            for hashed, index in zip(hashes, predicates):
+                if not defined.contains(hashed):
+                    dangling[index] += 1
+        for index, sample in enumerate(self.overflow_samples):
+            if sample:
+                missing = sum(1 for hashed in sample if not defined.contains(hashed))
+                dangling[index] += round(self.overflow[index] * missing / len(sample))
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+        predicates = {}
+        for predicate, index in sorted(self.predicates.items(), key=lambda item: (-dangling[item[1]], item[0])):
+            samples = [f"se:{node}" for hashed, node in self.candidates[index].items() if not defined.contains(hashed)]
+            predicates[predicate] = {"links": self.links[index], "dangling": dangling[index], "samples": samples[:self.samples]}
+            if self.overflow[index]:
+                predicates[predicate]["estimated"] = True
+        report = {
+            "subjects": self.subjects,
+            "redefined": self.redefined,
+            "links": sum(self.links),
+            "dangling": sum(dangling),
+            "estimated": any(self.overflow),
+            "false_positive_rate": defined.false_positive_rate(),
+            "predicates": predicates,
+        }
+        if self.path is not None:
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as file:
+                json.dump(report, file, indent=1)
+            os.replace(temp_path, self.path)
+        return report
+
+def node_hash(node):
+    """
+    This fuction hashes the local name of a se: node
+    Args:
+        node (string): the local name
+    Returns:
+        int: the 8 byte hash
+    """
+    return int.from_bytes(hashlib.blake2b(node.encode("utf-8"), digest_size=8).digest(), "big")
+
+def print_integrity_report(report):
+    """
+    This fuction prints the report of an IntegrityCheck
+    Args:
+        report (dict): the report finish() returned
+    """
+    estimated = ", estimated from a sample of the links that waited longest" if report.get("estimated") else ""
+    print(f"Integrity: {report['dangling']} of {report['links']} links to se: nodes dangle{estimated}, {report['subjects']} subjects, {report['redefined']} defined more than once")
+    for predicate, entry in report["predicates"].items():
+        samples = f", Samples: {' '.join(entry['samples'])}" if entry["samples"] else ""
+        print(f"{predicate}, Links: {entry['links']}, Dangling: {entry['dangling']}{' (estimated)' if entry.get('estimated') else ''}{samples}")
+    print(f"a dangling link is missed with a chance of {report['false_positive_rate']:.2e}")
+
+def check_integrity(path="fhir_final_script.ttl", memory=INTEGRITY_MEMORY, samples=INTEGRITY_SAMPLES, spill=INTEGRITY_SPILL):
+    """
+    This fuction checks the links of an output file that is already written, reading it once in blocks of whole statements
+    Args:
+        path (string): the turtle, N-Triples (.nt) or N-Quads (.nq) file, the report is written next to it with INTEGRITY_EXTENSION added
+        memory (int): the bytes the hashes are kept in
+        samples (int): the dangling nodes reported per predicate
+        spill (int): the bytes of waiting links the temporary file takes at most
+    Returns:
+        dict: the report (see IntegrityCheck.finish)
+    """
+    check = IntegrityCheck(path + INTEGRITY_EXTENSION, memory, samples, spill)
+    lines_format = os.path.splitext(path)[1] in (".nt", ".nq")
+    parser = TurtleParser()
+    pending = ""
+    with open(path, "r", encoding="utf-8") as file:
+        while True:
+            lines = file.readlines(1024 * 1024)
+            if not lines:
+                break
+            if lines_format:
+                check.scan(read_nquads("".join(lines)))
+                continue
+            #a block is parsed up to its last statement, the rest is put in front of the next block
+            text = pending + "".join(lines)
+            end = 0
+            for match in STATEMENT_END.finditer(text):
+                end = match.end()
+            pending = text[end:]
+            triples = parser.parse(text[:end])
+            check.namespace = parser.prefixes.get("se", check.namespace)
+            check.scan(triples)
+    check.scan(parser.parse(pending))
+    report = check.finish()
+    print_integrity_report(report)
+    return report
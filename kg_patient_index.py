@@ -0,0 +1,236 @@
+#--------------------------------------------------------------
+#
+# This python file indexes the entities of every patient in an output file so the graph of one patient can be cut out of it
+#
+#   create_ttl_script(patient_index=True)                   writes fhir_final_script.ttl.patients next to the output
+#   extract_patient("patient id")                           the turtle of the patient, the prefixes first
+#   extract_patient("patient id", "flattened_final_script.ttl")
+#
+# While the output is written the writer records the byte range of every entity whose subject is a patient (and of the
+# Patient entity itself), ranges that follow each other are joined. The index file holds one line per patient, sorted by
+# id, so a lookup is a binary search in the mmapped index followed by slices of the mmapped output, nothing is parsed
+#
+# The shared nodes (concepts and shared dosage instructions, see DefinedNodes in fhir_kg_creation.py) are written once,
+# behind the entity that linked to them first, but they are no part of its patient. Their statements are written on their
+# own and the index holds a line se:*node* with the range of every shared node, and behind the ranges of a patient the
+# shared nodes its entities link to. extract_patient appends the statements of those nodes to the fragment, so every
+# fragment defines the nodes it links to:
+#
+#   *patient id*<tab>*start*:*end* *start*:*end*<tab>*node* *node*
+#   se:*node*<tab>*start*:*end*
+#
+# Patient ids are fhir ids, which have no ":", so the two kinds of lines never mix up
+#
+#----------------------------------------------------------------
+
+import mmap
+import os
+from bisect import bisect_left, bisect_right
+
+from kg_triples import PREFIX_LINE
+
+
+#the extension of the index file, added to the name of the output file
+PATIENT_INDEX_EXTENSION = ".patients"
+
+
+class PatientIndex:
+    """
+    This class collects the byte ranges of the entities of every patient as a TtlWriter writes them
+    Args:
+        path (string): the index file, None for the shard of a parallel run whose ranges are merged into the index of the output
+    """
+    def __init__(self, path=None):
+        self.path = path
+        #the bytes written so far, counted here because tell() on the text output is slow enough to show on every entity
+        self.position = 0
+        #the bytes at the start of the output that hold the prefixes, set by header()
+        self.header_size = 0
+        #patient id -> flat list of start, end, start, end ...
+        self.ranges = {}
+        #shared node -> start, end of its statement
+        self.definitions = {}
+        #patient id -> the shared nodes its entities link to
+        self.links = {}
+
+    def header(self, text):
+        """
+        This fuction records the header at the start of the output, its prefixes are put in front of every fragment
+        Args:
+            text (string): the header as it is written, turtle or N-Triples
+        """
+        self.header_size = len(text.encode("utf-8")) if PREFIX_LINE.search(text) else 0
+
+    def advance(self, text, patient=None, node=None):
+        """
+        This fuction moves past text written to the output, the range of the text is added to a patient when one is given
+        Args:
+            text (string): the text written
+            patient (string): the patient id the text belongs to, None for text of no patient
+            node (string): the shared node the text is the statement of
+        """
+        size = len(text) if text.isascii() else len(text.encode("utf-8"))
+        start = self.position
+        self.position += size
+        if node is not None:
+            self.definitions.setdefault(node, (start, self.position))
+        elif patient is not None:
+            ranges = self.ranges.get(patient)
+            if ranges is None:
+                self.ranges[patient] = [start, self.position]
+            elif ranges[-1] == start:
+                ranges[-1] = self.position
+            else:
+                ranges.extend((start, self.position))
+
+    def link(self, patient, nodes):
+        """
+        This fuction records the shared nodes an entity of a patient links to
+        Args:
+            patient (string): the patient id, None for an entity of no patient
+            nodes (list): the shared nodes
+        """
+        if patient is not None and nodes:
+            linked = self.links.get(patient)
+            if linked is None:
+                self.links[patient] = set(nodes)
+            else:
+                linked.update(nodes)
+
+    def merge(self, shard, offset, insertions=()):
+        """
+        This fuction adds the index of a shard that was written on its own
+        Args:
+            shard (PatientIndex): the index of the shard
+            offset (int): where the shard starts in the output
+            insertions (list): (position, size) of the text put into the shard when it is joined, by position, what is
+                behind a position moves by the size and a range across it is cut in two
+        """
+        positions = [position for position, _ in insertions]
+        #shifts[n] is the size of the first n insertions
+        shifts = [0]
+        for _, size in insertions:
+            shifts.append(shifts[-1] + size)
+
+        def move(position, end=False):
+            #an end stays in front of the text inserted at it, a start goes behind it
+            moved = bisect_left(positions, position) if end else bisect_right(positions, position)
+            return position + offset + shifts[moved]
+
+        for node, (start, end) in shard.definitions.items():
+            self.definitions.setdefault(node, (move(start), move(end, True)))
+        for patient, nodes in shard.links.items():
+            self.link(patient, nodes)
+        for patient, shard_ranges in shard.ranges.items():
+            moved = []
+            for index in range(0, len(shard_ranges), 2):
+                start, end = shard_ranges[index], shard_ranges[index + 1]
+                cuts = positions[bisect_right(positions, start):bisect_left(positions, end)]
+                for cut in cuts:
+                    moved.extend((move(start), move(cut, True)))
+                    start = cut
+                moved.extend((move(start), move(end, True)))
+            known = self.ranges.get(patient)
+            if known is None:
+                self.ranges[patient] = moved
+            elif known[-1] == moved[0]:
+                known[-1] = moved[1]
+                known.extend(moved[2:])
+            else:
+                known.extend(moved)
+
+    def save(self):
+        """
+        This fuction writes the index file, one line per patient and per shared node sorted by key
+        """
+        lines = []
+        for patient in self.ranges.keys() | self.links.keys():
+            ranges = self.ranges.get(patient, [])
+            pairs = " ".join(f"{ranges[index]}:{ranges[index + 1]}" for index in range(0, len(ranges), 2))
+            nodes = self.links.get(patient)
+            lines.append(f"{patient}\t{pairs}\t{' '.join(sorted(nodes))}\n" if nodes else f"{patient}\t{pairs}\n")
+        for node, (start, end) in self.definitions.items():
+            lines.append(f"se:{node}\t{start}:{end}\n")
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as file:
+            #the first line sorts before any id, it is skipped by the search
+            file.write(f"\t{self.header_size}\n".encode("utf-8"))
+            for line in sorted(line.encode("utf-8") for line in lines):
+                file.write(line)
+        os.replace(temp_path, self.path)
+
+def subject_patient(document):
+    """
+    This fuction finds the patient a document belongs to through its subject
+    Args:
+        document (dict): a fhir document
+    Returns:
+        str: the patient id, None when the subject is not a patient
+    """
+    subject = document.get("subject")
+    reference = subject.get("reference") if subject else None
+    if not reference:
+        return None
+    resource_type, _, patient = reference.rpartition("/")
+    return patient if resource_type.endswith("Patient") else None
+
+def find_entry(index, key):
+    """
+    This fuction looks up a line of the index with a binary search over its lines
+    Args:
+        index (mmap): the mmapped index file
+        key (string): a patient id, or se:*node* for a shared node
+    Returns:
+        tuple: the (start, end) byte ranges in the output and the shared nodes the entities link to, both empty when the key
+            is not in the index
+    """
+    key = key.encode("utf-8")
+    low = index.find(b"\n") + 1
+    high = len(index)
+    while low < high:
+        middle = (low + high) // 2
+        line_start = index.rfind(b"\n", low, middle) + 1 or low
+        line_end = index.find(b"\n", line_start)
+        tab = index.find(b"\t", line_start, line_end)
+        line_key = index[line_start:tab]
+        if line_key == key:
+            pairs, _, nodes = index[tab + 1:line_end].partition(b"\t")
+            ranges = [tuple(int(position) for position in pair.split(b":")) for pair in pairs.split()]
+            return ranges, [node.decode("utf-8") for node in nodes.split()]
+        if line_key < key:
+            low = line_end + 1
+        else:
+            high = line_start
+    return [], []
+
+def find_patient_ranges(index, patient_id):
+    """
+    This fuction looks up the ranges of the entities of a patient in the index
+    Args:
+        index (mmap): the mmapped index file
+        patient_id (string): the patient id
+    Returns:
+        list: (start, end) byte ranges in the output, empty when the patient has no entities
+    """
+    return find_entry(index, patient_id)[0]
+
+def extract_patient(patient_id, output_path="fhir_final_script.ttl"):
+    """
+    This fuction cuts the entities of one patient out of an output file written with patient_index=True, followed by the
+    statements of the shared nodes they link to
+    Args:
+        patient_id (string): the patient id
+        output_path (string): the output file, its index is the same name with PATIENT_INDEX_EXTENSION added
+    Returns:
+        str: the prefixes of the output followed by the entities of the patient, only the prefixes when it has none
+    """
+    with open(output_path + PATIENT_INDEX_EXTENSION, "rb") as index_file, mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ) as index:
+        header_size = int(index[1:index.find(b"\n")])
+        ranges, nodes = find_entry(index, patient_id)
+        #the shared nodes in the order they are in the output
+        definitions = sorted(set(shared for node in nodes for shared in find_entry(index, "se:" + node)[0]))
+    with open(output_path, "rb") as output_file, mmap.mmap(output_file.fileno(), 0, access=mmap.ACCESS_READ) as output:
+        header = output[:header_size].decode("utf-8")
+        prefixes = "".join(f"@prefix {match.group(1)}: <{match.group(2)}> .\n" for match in PREFIX_LINE.finditer(header))
+        fragment = b"".join(output[start:end] for start, end in ranges + definitions).decode("utf-8")
+    return prefixes + ("\n" if prefixes else "") + fragment
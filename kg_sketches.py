@@ -0,0 +1,224 @@
+#--------------------------------------------------------------
+#
+# This python file holds the fixed memory summaries the profiling functions use on fields with too many values to keep
+#
+#   HyperLogLog     estimates the number of distinct values, 2**precision bytes whatever the number of values
+#   SpaceSaving     keeps the most frequent values with an upper bound on their counts, capacity values at most
+#   BloomFilter     answers whether a hash was added, never no for one that was, size bits whatever the number of hashes
+#
+# All of them take the values one by one with add() and can be merged, so values streamed out of mongoDB or read by worker
+# processes can be summarised in pieces and joined
+#
+#----------------------------------------------------------------
+
+from array import array
+import hashlib
+import heapq
+import math
+
+#the two bits of a 64 bit word that 12 bits of a hash pick, looked up instead of shifted one at a time
+BIT_PAIRS = [(1 << (bits & 63)) | (1 << (bits >> 6)) for bits in range(4096)]
+
+
+class HyperLogLog:
+    """
+    This class estimates the number of distinct values added to it, the standard error is about 1.04 / sqrt(2**precision)
+    Args:
+        precision (int): bits of the hash that pick a register, 4 to 18, 14 gives 16384 registers and about 0.8% error
+    """
+    def __init__(self, precision=14):
+        if not 4 <= precision <= 18:
+            raise ValueError("the precision of a HyperLogLog has to be between 4 and 18")
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        """
+        This fuction adds a value, values are told apart by their repr so 1 and "1" are two values
+        Args:
+            value (object): a str, number or anything else with a stable repr
+        """
+        hashed = int.from_bytes(hashlib.blake2b(repr(value).encode("utf-8"), digest_size=8).digest(), "big")
+        bits = 64 - self.precision
+        index = hashed >> bits
+        #the position of the first 1 bit in the bits that are left, runs of zeros get rarer the more values there are
+        rank = bits - (hashed & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """
+        This fuction adds the values of another HyperLogLog with the same precision
+        Args:
+            other (HyperLogLog): the other estimate
+        """
+        if other.precision != self.precision:
+            raise ValueError("only HyperLogLogs with the same precision can be merged")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        """
+        This fuction estimates the number of distinct values added so far
+        Returns:
+            int: the estimate
+        """
+        registers = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / registers)
+        estimate = alpha * registers * registers / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        #few values leave most registers empty, counting the empty ones is more exact then
+        if estimate <= 2.5 * registers and zeros:
+            estimate = registers * math.log(registers / zeros)
+        return round(estimate)
+
+    def error(self):
+        """
+        This fuction gives the relative standard error of the estimate
+        Returns:
+            float: the error as a fraction of the count
+        """
+        return 1.04 / math.sqrt(len(self.registers))
+
+
+class SpaceSaving:
+    """
+    This class keeps the most frequent values added to it in a fixed number of counters (the space-saving algorithm)
+    A value that is more frequent than 1 / capacity of everything added is always kept, its count is at most error too high
+    Args:
+        capacity (int): the number of values counted at once
+    """
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        #value -> [count, error], the error is the count the value took over when it replaced another
+        self.counters = {}
+        #(count, value) of every counter, counts that went up since they were pushed are fixed when they reach the top
+        self.heap = []
+
+    def add(self, value, count=1):
+        """
+        This fuction counts a value, when every counter is taken the value replaces the least frequent one
+        Args:
+            value (object): a hashable value
+            count (int): the number of times the value is counted
+        """
+        counter = self.counters.get(value)
+        if counter is not None:
+            counter[0] += count
+            return
+        if len(self.counters) < self.capacity:
+            self.counters[value] = [count, 0]
+            heapq.heappush(self.heap, (count, id(value), value))
+            return
+        while True:
+            smallest, _, old_value = heapq.heappop(self.heap)
+            current = self.counters[old_value][0]
+            if current == smallest:
+                break
+            heapq.heappush(self.heap, (current, id(old_value), old_value))
+        del self.counters[old_value]
+        self.counters[value] = [smallest + count, smallest]
+        heapq.heappush(self.heap, (smallest + count, id(value), value))
+
+    def merge(self, other):
+        """
+        This fuction adds the counts of another SpaceSaving, the errors of both are kept
+        Args:
+            other (SpaceSaving): the other summary
+        """
+        for value, (count, error) in other.counters.items():
+            self.add(value, count)
+            self.counters[value][1] += error
+
+    def top(self, number=10):
+        """
+        This fuction returns the most frequent values
+        Args:
+            number (int): how many values
+        Returns:
+            list: (value, count, error) tuples, most frequent first, the real count is between count - error and count
+        """
+        ranked = sorted(self.counters.items(), key=lambda item: item[1][0], reverse=True)[:number]
+        return [(value, count, error) for value, (count, error) in ranked]
+
+
+class BloomFilter:
+    """
+    This class remembers 64 bit hashes in a fixed number of bits, a hash that was added is always found and one that was not
+    is found with the false_positive_rate()
+    All the bits of a hash are in one 64 bit word (a blocked bloom filter), so a hash costs one lookup and not one per bit
+    Args:
+        size (int): the number of bits, 10 per hash keep the false positives under 2% and 16 under 0.5%
+        hashes (int): the number of bits set per hash, 1 to 10
+    """
+    def __init__(self, size=8 * 1024 * 1024, hashes=5):
+        if not 1 <= hashes <= 10:
+            raise ValueError("a BloomFilter sets 1 to 10 bits per hash")
+        self.hashes = hashes
+        self.words = array("Q", [0]) * max(size // 64, 1)
+        self.size = len(self.words) * 64
+
+    def locate(self, hashed):
+        """
+        This fuction gives the word of a hash and the bits it has in it, every 12 low bits of the hash pick two bits and the
+        high bits pick the word
+        Args:
+            hashed (int): a 64 bit hash
+        Returns:
+            tuple: the index of the word and the mask of the bits
+        """
+        mask = 0
+        bits = hashed
+        for _ in range(self.hashes >> 1):
+            mask |= BIT_PAIRS[bits & 4095]
+            bits >>= 12
+        if self.hashes & 1:
+            mask |= 1 << (bits & 63)
+        return (hashed * len(self.words)) >> 64, mask
+
+    def add(self, hashed):
+        """
+        This fuction adds a hash
+        Args:
+            hashed (int): a 64 bit hash
+        Returns:
+            bool: True when every bit of the hash was set already, so the hash was probably added before
+        """
+        index, mask = self.locate(hashed)
+        word = self.words[index]
+        if word & mask == mask:
+            return True
+        self.words[index] = word | mask
+        return False
+
+    def contains(self, hashed):
+        """
+        This fuction checks whether a hash was added
+        Args:
+            hashed (int): a 64 bit hash
+        Returns:
+            bool: True when it was added, or for the false positives
+        """
+        index, mask = self.locate(hashed)
+        return self.words[index] & mask == mask
+
+    def merge(self, other):
+        """
+        This fuction adds the hashes of another BloomFilter with the same size and number of hashes
+        Args:
+            other (BloomFilter): the other filter
+        """
+        if other.size != self.size or other.hashes != self.hashes:
+            raise ValueError("only BloomFilters with the same size and number of hashes can be merged")
+        self.words = array("Q", map(int.__or__, self.words, other.words))
+
+    def false_positive_rate(self):
+        """
+        This fuction estimates the chance that a hash that was never added is found, from the share of bits set in every word
+        Returns:
+            float: the chance
+        """
+        #words with the same number of bits set are counted together, there are only 65 such numbers
+        counts = [0] * 65
+        for word in self.words:
+            counts[word.bit_count()] += 1
+        return sum(count * (bits / 64) ** self.hashes for bits, count in enumerate(counts)) / len(self.words)
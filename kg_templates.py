@@ -0,0 +1,608 @@
+#--------------------------------------------------------------
+#
+# This python file holds the template engine the entity renderers use
+#
+# A Template is compiled once from a layout like
+#
+#   se:{id} a fhir:Observation ;
+#               fhir:status [ fhir:v "{status}" ] ;
+#   {valueQuantity}
+#
+# into literal chunks and field extractors, which are turned into a single python function that builds the entity as one
+# f-string, so rendering a document costs one string build instead of a string per nested block
+#
+#   {status}                  the value at a dotted path of the document, numbers index into lists ({coding.0.code})
+#   {subject.reference|ref}   the value passed through a filter (see FILTERS in fhir_kg_creation.py), fields take filters too
+#   {.|literal}               the document itself, for templates rendered on a single value
+#   {valueQuantity}           or whatever the field given to the Template returns, a function, a Template, a Section or Each
+#
+# A Section renders another template on a part of the document only when that part is there, so optional blocks cost one lookup
+# when they are missing, Each renders it once for every item of a list. compact=True drops the indentation, the blank lines
+# and the runs of spaces of the layout, a layout placed in the middle of a line has to start with punctuation or a newline
+#
+# The same layout compiles into an emitter too, template.emitter(prefixes) adds the triples of a document to a TripleBuilder
+# (see kg_triples.py) instead of building its text, so the N-Triples and N-Quads outputs come from the layouts without any
+# turtle being parsed. The layout is read as turtle once, when the emitter is compiled:
+#
+#   se:{id}  "{status|literal}"   a placeholder in a name or a literal is the text of that term, the literal filter is left
+#                                 out because the serializers escape the literals they write
+#   fhir:coding {concept}         a placeholder in the object position is a whole term, the prefixed name the field returns
+#   {valueQuantity}               a Template, Section or Each between the predicates adds its own predicates to the subject,
+#                                 and one between statements its own statements, a function there may only return punctuation
+#
+# Blank nodes are labelled when the emitter makes them, from the subject of their statement, and a layout that is not turtle
+# (an unclosed bracket, a dot inside a blank node, a collection) raises a ValueError when it is compiled
+#
+#----------------------------------------------------------------
+
+import re
+
+from kg_triples import RDF, Triple, escape_string, unescape
+
+
+PLACEHOLDER = re.compile(r"\{([^{}]+)\}")
+
+#where the turtle of a layout starts and ends, before a subject, in the predicates of a subject or in those of a blank node
+STATEMENT = "statement"
+PREDICATES = "predicates"
+NESTED = "nested"
+
+#the tokens of a layout read as turtle, a placeholder can be part of a name, literals are read by read_literal
+LAYOUT_TOKEN = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<name>(?:[A-Za-z][\w-]*)?:(?:[\w%-]|\{[^{}]+\}|\.(?=[\w%{-]))*)
+  | (?P<field>\{[^{}]+\})
+  | (?P<keyword>a(?=[\s\[]))
+  | (?P<language>@[a-zA-Z]+(?:-[a-zA-Z0-9]+)*)
+  | (?P<punctuation>\^\^|[;,.\[\]()])
+  | (?P<quote>")
+""", re.VERBOSE)
+
+
+class Template:
+    """
+    This class compiles a layout into a render(document) function that returns the filled in text
+    Args:
+        layout (string): the text of the entity with {placeholders}
+        fields (dict): placeholder -> function of the document, Template, Section or Each, placeholders not in it are dotted paths
+        filters (dict): filter name -> function applied to a path value, for {path|filter} placeholders
+        compact (bool): drop the cosmetic whitespace of the layout, a placeholder on a line of its own leaves no blank line when it is empty
+    """
+    def __init__(self, layout, fields=None, filters=None, compact=False):
+        fields = fields or {}
+        filters = filters or {}
+        self.compact = compact
+        self.layout = layout
+        self.fields = fields
+        self.filters = filters
+        #(prefixes, state) -> compiled emitter, see emitter()
+        self.emitters = {}
+        #literal text and the python expressions of the fields, in layout order
+        pieces = []
+        #names the expressions use, handed to the compiled function
+        namespace = {}
+
+        def add_literal(text):
+            if text:
+                pieces.append(repr(text))
+
+        def add_field(name, wrapper=None):
+            expression = compile_field(name, fields, filters, namespace)
+            if wrapper:
+                wrapper_name = f"w{len(namespace)}"
+                namespace[wrapper_name] = wrapper
+                expression = f"{wrapper_name}({expression})"
+            pieces.append(f"f'{{{expression}}}'")
+
+        if compact:
+            in_quote = False
+            lines = layout.split("\n")
+            for number, line in enumerate(lines):
+                #the last line has no newline of its own, the text after it continues it
+                newline = "\n" if number < len(lines) - 1 else ""
+                stripped = line.strip(" \t")
+                if not stripped:
+                    #a layout that starts with a newline is placed after text that the newline ends
+                    if number == 0 and newline:
+                        add_literal(newline)
+                    continue
+                matches = list(PLACEHOLDER.finditer(stripped))
+                if newline and not in_quote and len(matches) == 1 and matches[0].group(0) == stripped:
+                    add_field(matches[0].group(1), line_of)
+                    continue
+                position = 0
+                for match in matches:
+                    literal, in_quote = squeeze_spaces(stripped[position:match.start()], in_quote)
+                    add_literal(literal)
+                    position = match.end()
+                    #a value that ends the line and ends with a newline itself would leave a blank line
+                    ends_line = newline and not in_quote and position == len(stripped)
+                    add_field(match.group(1), line_end if ends_line else None)
+                    if ends_line:
+                        break
+                else:
+                    literal, in_quote = squeeze_spaces(stripped[position:], in_quote)
+                    add_literal(literal + newline)
+        else:
+            position = 0
+            for match in PLACEHOLDER.finditer(layout):
+                add_literal(layout[position:match.start()])
+                add_field(match.group(1))
+                position = match.end()
+            add_literal(layout[position:])
+        #adjacent string literals and f-strings join into one f-string, which python builds in a single step
+        self.render = compile_function("render", f"return {' '.join(pieces) or repr('')}", namespace)
+
+    def emitter(self, prefixes, state=STATEMENT):
+        """
+        This fuction compiles the layout into a function that adds the triples of a document to a TripleBuilder, once per prefixes and state
+        Args:
+            prefixes (dict): prefix -> namespace IRI of the names in the layout
+            state (string): where the layout is placed, STATEMENT before a subject, PREDICATES in the predicates of a subject or
+                NESTED in the predicates of a blank node
+        Returns:
+            function: emit(document, out, s=None) that adds the triples to out and returns the subject it ends on, its end_state
+                attribute is the state the layout leaves the turtle in
+        """
+        key = (tuple(sorted(prefixes.items())), state)
+        emit = self.emitters.get(key)
+        if emit is None:
+            emit = self.emitters[key] = compile_emitter(self, prefixes, state)
+        return emit
+
+    def __reduce__(self):
+        #a worker process gets the template as its layout, fields and filters and compiles it again
+        return Template, (self.layout, self.fields, self.filters, self.compact)
+
+
+class Section:
+    """
+    This class is an optional block of a template, rendered only when a part of the document is there
+    Args:
+        path (string): dotted path of the part, the block is empty when it is missing or empty, or a function of the document
+            that returns the part
+        template (Template): the block, rendered on the part
+    """
+    def __init__(self, path, template):
+        self.path = path
+        self.template = template
+        self.extract = compile_lookup(path, "return render(value)", template.render)
+
+    def __reduce__(self):
+        return Section, (self.path, self.template)
+
+
+class Each:
+    """
+    This class is a repeated block of a template, rendered once for every item of a list in the document
+    Args:
+        path (string): dotted path of the list, the block is empty when it is missing or empty, or a function of the document
+            that returns the list
+        template (Template): the block, rendered on each item
+    """
+    def __init__(self, path, template):
+        self.path = path
+        self.template = template
+        self.extract = compile_lookup(path, "return ''.join([render(item) for item in value])", template.render)
+
+    def __reduce__(self):
+        return Each, (self.path, self.template)
+
+
+def path_steps(path):
+    """
+    This fuction splits a dotted path into the keys and list indexes it walks through
+    Args:
+        path (string): a path like code.coding.0.system, . is the document itself
+    Returns:
+        tuple: the steps, numbers as ints
+    """
+    if path == ".":
+        return ()
+    return tuple(int(step) if step.isdigit() else step for step in path.split("."))
+
+def compile_field(name, fields, filters, namespace):
+    """
+    This fuction turns a placeholder into the python expression that extracts its text from the document
+    Args:
+        name (string): the text between the braces, a path or field name with an optional |filter
+        fields (dict): placeholder -> function of the document, Template, Section or Each
+        filters (dict): filter name -> function applied to a path value, None leaves the value as it is
+        namespace (dict): the names the expressions use, the names this expression needs are added to it
+    Returns:
+        string: the expression, values that are not strings are formatted by the f-string
+    """
+    number = len(namespace)
+    path, _, filter_name = name.partition("|")
+    if path in fields:
+        field = fields[path]
+        #a Template field is rendered on the same document as the template it sits in
+        if isinstance(field, Template):
+            field = field.render
+        elif isinstance(field, (Section, Each)):
+            field = field.extract
+        namespace[f"f{number}"] = field
+        expression = f"f{number}(document)"
+    else:
+        expression = "document"
+        for index, step in enumerate(path_steps(path)):
+            if isinstance(step, int):
+                expression += f"[{step}]"
+            else:
+                namespace[f"k{number}_{index}"] = step
+                expression += f"[k{number}_{index}]"
+    if filter_name and filters[filter_name] is not None:
+        namespace[f"g{number}"] = filters[filter_name]
+        expression = f"g{number}({expression})"
+    return expression
+
+def compile_lookup(path, body, render):
+    """
+    This fuction builds the extractor of a Section or Each, it finds the part at the path and renders it when it is there
+    Args:
+        path (string): dotted path of the part, or a function of the document that returns it
+        body (string): the python statement that returns the text from value, the part found
+        render (function): the render function of the block
+    Returns:
+        function: extractor(document) that returns a string, empty when the part is missing or empty
+    """
+    namespace = {"render": render}
+    statements = lookup_statements(path, "value", "return ''", namespace)
+    statements += [
+        "if not value:",
+        "    return ''",
+        body,
+    ]
+    return compile_function("extract", "\n    ".join(statements), namespace)
+
+def lookup_statements(path, target, missing, namespace):
+    """
+    This fuction writes the python statements that find the part of the document at a path
+    Args:
+        path (string): dotted path of the part, or a function of the document that returns it
+        target (string): the variable the part is put in
+        missing (string): the statement run when a step of the path is missing
+        namespace (dict): the names the statements use, the names they need are added to it
+    Returns:
+        list: the statements
+    """
+    number = len(namespace)
+    if callable(path):
+        namespace[f"p{number}"] = path
+        return [f"{target} = p{number}(document)"]
+    lookup = "document"
+    for index, step in enumerate(path_steps(path)):
+        if isinstance(step, int):
+            lookup += f"[{step}]"
+        else:
+            namespace[f"k{number}_{index}"] = step
+            lookup += f".get(k{number}_{index})"
+    #a missing key gives None, which fails the next step or the empty check
+    return [
+        "try:",
+        f"    {target} = {lookup}",
+        "except (AttributeError, IndexError, KeyError, TypeError):",
+        f"    {missing}",
+    ]
+
+def compile_emitter(template, prefixes, state):
+    """
+    This fuction reads the layout of a template as turtle and compiles the function that emits its triples (see Template.emitter)
+    Args:
+        template (Template): the template
+        prefixes (dict): prefix -> namespace IRI of the names in the layout
+        state (string): STATEMENT, PREDICATES or NESTED, where the layout is placed
+    Returns:
+        function: emit(document, out, s=None), with the state the layout ends in as its end_state attribute
+    """
+    fields = template.fields
+    #the literals are escaped by the serializers, so the emitter leaves out the escaping filter
+    filters = {name: None if function is escape_string else function for name, function in template.filters.items()}
+    namespace = {"new": tuple.__new__, "Triple": Triple, "punctuation": punctuation}
+    constants = {}
+    lines = ["add = out.triples.append"]
+    #the subject variable and predicate of the blank nodes that are open, the innermost last
+    stack = []
+    subject = "s"
+    predicate = None
+    expect = "subject" if state == STATEMENT else "predicate"
+    after_object = False
+
+    def fail(message):
+        raise ValueError(f"{message} in the layout {template.layout[:80]!r}")
+
+    def constant(value):
+        name = constants.get(value)
+        if name is None:
+            name = constants[value] = f"c{len(namespace)}"
+            namespace[name] = value
+        return name
+
+    def namespace_of(prefix):
+        if prefix not in prefixes:
+            fail(f"the prefix {prefix}: is not defined")
+        return prefixes[prefix]
+
+    def text_source(pieces):
+        #the literal text and the placeholders of a term as one f-string
+        parts = []
+        for is_field, text in pieces:
+            if not is_field:
+                if text:
+                    parts.append(repr(text))
+                continue
+            field = fields.get(text.partition("|")[0])
+            if isinstance(field, (Template, Section, Each)):
+                fail(f"the block {{{text}}} stands in a name or a literal")
+            parts.append(f"f'{{{compile_field(text, fields, filters, namespace)}}}'")
+        return " ".join(parts) or repr("")
+
+    def constant_name(pieces):
+        prefix, local = pieces
+        if any(is_field for is_field, _ in local):
+            fail("a predicate or datatype has a placeholder")
+        return namespace_of(prefix) + "".join(text for _, text in local)
+
+    def add(value, datatype):
+        lines.append(f"add(new(Triple, ({subject}, {predicate}, {value}, {datatype})))")
+
+    def field_state():
+        if expect == "subject":
+            return STATEMENT
+        return NESTED if stack or state == NESTED else PREDICATES
+
+    tokens = tokenize_layout(template.layout, fail)
+    position = 0
+    while position < len(tokens):
+        kind, value = tokens[position]
+        position += 1
+        if kind == "name" and expect == "subject":
+            prefix, local = value
+            if any(is_field for is_field, _ in local):
+                lines.append(f"v = {text_source(local)}")
+                lines.append(f"s = {constant(namespace_of(prefix))} + v")
+                lines.append(f"out.start({constant(prefix + ':')} + v)")
+            else:
+                lines.append(f"s = {constant(constant_name(value))}")
+                lines.append(f"out.start({constant(prefix + ':' + ''.join(text for _, text in local))})")
+            subject = "s"
+            expect = "predicate"
+            after_object = False
+        elif (kind == "name" or kind == "keyword") and expect == "predicate":
+            predicate = constant(RDF + "type" if kind == "keyword" else constant_name(value))
+            expect = "object"
+        elif kind == "name" and expect == "object":
+            prefix, local = value
+            if any(is_field for is_field, _ in local):
+                add(f"{constant(namespace_of(prefix))} + {text_source(local)}", "None")
+            else:
+                add(constant(constant_name(value)), "None")
+            expect = "predicate"
+            after_object = True
+        elif kind == "literal" and expect == "object":
+            datatype = constant("")
+            if position < len(tokens) and tokens[position] == ("punctuation", "^^"):
+                if position + 1 >= len(tokens) or tokens[position + 1][0] != "name":
+                    fail("^^ is not followed by a datatype")
+                datatype = constant(constant_name(tokens[position + 1][1]))
+                position += 2
+            elif position < len(tokens) and tokens[position][0] == "language":
+                datatype = constant(tokens[position][1])
+                position += 1
+            add(text_source(value), datatype)
+            expect = "predicate"
+            after_object = True
+        elif kind == "punctuation" and value == "[" and expect == "object":
+            blank = f"b{len(stack)}_{len(lines)}"
+            lines.append(f"{blank} = out.blank()")
+            add(blank, "None")
+            stack.append((subject, predicate))
+            subject = blank
+            expect = "predicate"
+            after_object = False
+        elif kind == "punctuation" and value == "]" and expect == "predicate" and stack:
+            subject, predicate = stack.pop()
+            after_object = True
+        elif kind == "punctuation" and value == ";" and expect == "predicate":
+            after_object = False
+        elif kind == "punctuation" and value == "," and expect == "predicate" and after_object:
+            expect = "object"
+        elif kind == "punctuation" and value == "." and expect == "predicate" and not stack and state != NESTED:
+            expect = "subject"
+            after_object = False
+        elif kind == "field":
+            path = value.partition("|")[0]
+            field = fields.get(path)
+            if expect == "object":
+                if isinstance(field, (Section, Each)):
+                    fail(f"the block {{{value}}} stands in the object position")
+                if isinstance(field, Template):
+                    namespace[f"f{len(namespace)}"] = field.render
+                    source = f"f{len(namespace) - 1}(document)"
+                else:
+                    source = compile_field(value, fields, filters, namespace)
+                add(f"out.expand({source})", "None")
+                expect = "predicate"
+                after_object = True
+                continue
+            if field is None:
+                fail(f"the path {{{value}}} stands between the predicates")
+            inner_state = field_state()
+            if isinstance(field, (Template, Section, Each)):
+                block = field if isinstance(field, Template) else field.template
+                emit = block.emitter(prefixes, inner_state)
+                name = f"e{len(namespace)}"
+                namespace[name] = emit
+                call = f"{subject} = {name}({{}}, out, {subject})"
+                if isinstance(field, Template):
+                    lines.append(call.format("document"))
+                else:
+                    if emit.end_state != inner_state:
+                        fail(f"the block {{{value}}} does not end where it starts")
+                    lines.extend(lookup_statements(field.path, "v", "v = None", namespace))
+                    if isinstance(field, Section):
+                        lines.extend(["if v:", "    " + call.format("v")])
+                    else:
+                        lines.extend(["if v:", "    for item in v:", "        " + call.format("item")])
+                if emit.end_state == STATEMENT:
+                    expect = "subject"
+                    subject = "s"
+                else:
+                    expect = "predicate"
+            else:
+                lines.append(f"punctuation({compile_field(value, fields, filters, namespace)})")
+            after_object = False
+        else:
+            fail(f"unexpected {value if kind != 'name' else value[0] + ':'!r} where a {expect} belongs")
+    if stack:
+        fail("a [ is not closed")
+    if expect == "object":
+        fail("a predicate has no object")
+    lines.append("return s")
+    emit = compile_function("emit", "\n    ".join(lines), namespace, "document, out, s=None")
+    emit.end_state = STATEMENT if expect == "subject" else state if state != STATEMENT else PREDICATES
+    return emit
+
+def tokenize_layout(layout, fail):
+    """
+    This fuction splits a layout into turtle tokens, a name is (prefix, pieces) and a literal its pieces, the pieces are
+    (is_field, text) pairs of the literal text and the placeholders
+    Args:
+        layout (string): the layout
+        fail (function): raises the error of a layout that is not turtle
+    Returns:
+        list: (kind, value) tokens without the white space
+    """
+    tokens = []
+    position = 0
+    while position < len(layout):
+        match = LAYOUT_TOKEN.match(layout, position)
+        if not match:
+            fail(f"cannot read {layout[position:position + 20]!r}")
+        kind = match.lastgroup
+        if kind == "quote":
+            pieces, position = read_literal(layout, position + 1, fail)
+            tokens.append(("literal", pieces))
+            continue
+        position = match.end()
+        text = match.group(kind)
+        if kind == "name":
+            prefix, _, local = text.partition(":")
+            pieces = []
+            start = 0
+            for placeholder in PLACEHOLDER.finditer(local):
+                pieces.append((False, local[start:placeholder.start()]))
+                pieces.append((True, placeholder.group(1)))
+                start = placeholder.end()
+            pieces.append((False, local[start:]))
+            tokens.append(("name", (prefix, pieces)))
+        elif kind == "field":
+            tokens.append(("field", text[1:-1]))
+        elif kind != "space":
+            tokens.append((kind, text))
+    return tokens
+
+def read_literal(layout, position, fail):
+    """
+    This fuction reads the text of a quoted literal of a layout, its escapes are resolved
+    Args:
+        layout (string): the layout
+        position (int): the position after the opening quote
+        fail (function): raises the error of a layout that is not turtle
+    Returns:
+        tuple: the (is_field, text) pieces of the literal and the position after the closing quote
+    """
+    pieces = []
+    text = []
+    while True:
+        if position >= len(layout) or layout[position] in "\r\n":
+            fail("a literal is not closed on its line")
+        character = layout[position]
+        if character == '"':
+            pieces.append((False, unescape("".join(text))))
+            return pieces, position + 1
+        if character == "\\":
+            text.append(layout[position:position + 2])
+            position += 2
+        elif character == "{":
+            end = layout.find("}", position)
+            pieces.append((False, unescape("".join(text))))
+            pieces.append((True, layout[position + 1:end]))
+            text = []
+            position = end + 1
+        else:
+            text.append(character)
+            position += 1
+
+def punctuation(text):
+    """
+    This fuction checks what a function placeholder between the predicates returned, it can only be punctuation because the
+    emitter does not read it
+    Args:
+        text (string): the value of the placeholder
+    """
+    if text.strip(" \t\r\n;"):
+        raise ValueError(f"a function placeholder between the predicates returned {text!r}, use a Template or Section for turtle")
+
+def compile_function(name, body, namespace, parameters="document"):
+    """
+    This fuction compiles generated python source into a function of the document, the names it uses become default arguments so they are local
+    Args:
+        name (string): name of the function
+        body (string): the statements of the function, the lines after the first indented by four spaces
+        namespace (dict): the names the body uses
+        parameters (string): the parameters of the function before the names
+    Returns:
+        function: the compiled function
+    """
+    arguments = "".join(f", {key}={key}" for key in namespace)
+    source = f"def {name}({parameters}{arguments}):\n    {body}\n"
+    compiled = {}
+    exec(compile(source, "<template>", "exec"), dict(namespace), compiled)
+    return compiled[name]
+
+def line_of(text):
+    """
+    This fuction ends the value of a placeholder that sits on a line of its own, an empty value leaves no blank line behind
+    Args:
+        text (string): the value of the placeholder
+    Returns:
+        str: the value ending with a newline, or empty
+    """
+    if not text or text[-1] == "\n":
+        return text
+    return text + "\n"
+
+def line_end(text):
+    """
+    This fuction ends the value of a placeholder that ends a line with text before it, the line ends with one newline
+    Args:
+        text (string): the value of the placeholder
+    Returns:
+        str: the value ending with a newline
+    """
+    if text[-1:] == "\n":
+        return text
+    return text + "\n"
+
+def squeeze_spaces(text, in_quote):
+    """
+    This fuction turns runs of spaces and tabs outside of quoted strings into one space
+    Args:
+        text (string): literal text of a layout line
+        in_quote (bool): True when the text starts inside a quoted string
+    Returns:
+        tuple: the squeezed text and whether it ends inside a quoted string
+    """
+    squeezed = []
+    last = ""
+    for character in text:
+        if character == '"':
+            in_quote = not in_quote
+        elif not in_quote and character in " \t":
+            if last == " ":
+                continue
+            character = " "
+        squeezed.append(character)
+        last = character
+    return "".join(squeezed), in_quote
@@ -0,0 +1,921 @@
+#--------------------------------------------------------------
+#
+# This python file holds the triple level form of the knowledge graphs and the serializers that write it
+#
+# A Triple is a tuple (subject, predicate, object, datatype) of full IRIs:
+#
+#   subject     an IRI, or _:label for a blank node
+#   predicate   an IRI
+#   object      an IRI or _:label when datatype is NODE, otherwise the (unescaped) text of a literal
+#   datatype    NODE for IRIs and blank nodes, PLAIN for a string literal without a datatype, the datatype IRI
+#               or @language of any other literal
+#
+# The entity templates emit the triples of a document straight into a TripleBuilder (see Template.emitter in kg_templates.py),
+# the blank nodes get their labels as they are made, and the serializers write them out as Turtle, N-Triples, N-Quads or a
+# binary stream (read it again with read_binary):
+#
+#   builder = TripleBuilder(read_prefixes(header))
+#   serializer = NTriplesSerializer(file)
+#   for result in aggregate_resources(OBSERVATION_PIPELINE):
+#       serializer.write(builder.emit(observation_renderer(), result))
+#
+# TripleConverter does this for the writer of create_ttl_script(output_format="nt"/"nq") and keeps every triple of an entity
+# once. The same triple can still come from two entities: the LocationEncounter nodes of the flattened graph are named by
+# their position in the location list of the encounter, so every encounter writes the triples of the same
+# se:*generate_id("locationEncounter0")* node. They are written as often as the turtle output writes them, a store keeps
+# them once. The turtle output is written by the render functions compiled from the same layouts, which keep the layout
+# of the turtle, TurtleSerializer writes any triples as flat turtle. Stats, validation or loading into a store only need a
+# function of the triples
+#
+# TurtleParser reads turtle that is already text, the ontology headers and written files, it is not used while the
+# entities are converted. It reads the subset the renderers and the headers use (prefixes, blank nodes, collections,
+# literals with datatypes) and is strict, a literal that is not closed, a quote that is not escaped or an unknown escape
+# raise a ValueError. read_nquads reads written N-Triples and N-Quads lines back just as strictly
+#
+#----------------------------------------------------------------
+
+import hashlib
+import re
+from collections import namedtuple
+
+
+RDF = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+XSD = "http://www.w3.org/2001/XMLSchema#"
+FHIR = "http://hl7.org/fhir/"
+
+#blank nodes of the line based outputs become IRIs under this base, the /.well-known/genid/ path marks them as skolem IRIs
+SKOLEM_BASE = "http://example.org/.well-known/genid/"
+#the named graphs of the N-Quads output, *GRAPH_BASE**resource type*, *GRAPH_BASE*patient/*id* and the ontology header
+GRAPH_BASE = "http://example.org/myontology/graph/"
+ONTOLOGY_GRAPH = GRAPH_BASE + "ontology"
+#the predicates that tie an entity to its patient when the N-Quads graphs are per patient
+PATIENT_PREDICATES = frozenset([FHIR + "subject", FHIR + "subjectReference"])
+
+#output_format of create_ttl_script -> extension of the output file
+OUTPUT_FORMATS = {"ttl": ".ttl", "nt": ".nt", "nq": ".nq"}
+
+Triple = namedtuple("Triple", ["subject", "predicate", "object", "datatype"])
+
+#datatype of a triple whose object is an IRI or a blank node
+NODE = None
+#datatype of a string literal written without one
+PLAIN = ""
+
+#the tokens of the turtle subset, strings are scanned by TurtleParser.read_string
+TOKEN = re.compile(r"""
+    (?P<space>\s+|\#[^\n]*)
+  | (?P<iri><[^<>"{}|^`\\\s]*>)
+  | (?P<blank>_:[\w.-]*\w)
+  | (?P<directive>@prefix|@base|PREFIX\b|BASE\b)
+  | (?P<language>@[a-zA-Z]+(?:-[a-zA-Z0-9]+)*)
+  | (?P<number>[+-]?(?:\d+\.\d*(?:[eE][+-]?\d+)?|\.?\d+(?:[eE][+-]?\d+)?))
+  | (?P<name>(?:[A-Za-z][\w.-]*)?:(?:[\w%:-]|\.(?=[\w%:-]))*|a\b|true\b|false\b)
+  | (?P<punctuation>\^\^|[;,.\[\]()])
+  | (?P<quote>"|')
+""", re.VERBOSE)
+
+TURTLE_ESCAPES = {"t": "\t", "b": "\b", "n": "\n", "r": "\r", "f": "\f", '"': '"', "'": "'", "\\": "\\"}
+ESCAPE = re.compile(r"\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))", re.DOTALL)
+
+#an N-Triples or N-Quads line: subject, predicate, object as an IRI, a blank node or a literal with its datatype or language, graph
+NQUADS_LINE = re.compile(r"""
+    (<[^<>"\s]*>|_:\S+)[ \t]+<([^<>"\s]*)>[ \t]+
+    (?:<(?P<iri>[^<>"\s]*)>|(?P<blank>_:\S+)|"(?P<literal>(?:[^"\\\n\r]|\\.)*)"(?:\^\^<(?P<datatype>[^<>"\s]*)>|(?P<language>@[a-zA-Z]+(?:-[a-zA-Z0-9]+)*))?)
+    (?:[ \t]+(<[^<>"\s]*>|_:\S+))?[ \t]*\.[ \t]*(?:\#.*)?$
+""", re.VERBOSE)
+
+PREFIX_LINE = re.compile(r"^[ \t]*(?:@prefix|PREFIX)[ \t]+([\w.-]*):[ \t]*<([^>]*)>", re.MULTILINE)
+
+#local names the turtle serializer writes as prefixed names, anything else is written as a full IRI
+LOCAL_NAME = re.compile(r"(?:\w[\w-]*(?:\.+[\w-]+)*)?")
+
+#the control characters of a literal as turtle and N-Triples escapes, the ones without a short escape as \u00XX
+CONTROL_ESCAPES = {character: f"\\u{character:04X}" for character in list(range(0x20)) + [0x7f]}
+CONTROL_ESCAPES.update(str.maketrans({"\t": "\\t", "\b": "\\b", "\n": "\\n", "\r": "\\r", "\f": "\\f"}))
+
+BINARY_MAGIC = b"KGT\x01"
+BINARY_TERM = 1
+BINARY_TRIPLE = 2
+
+
+class TurtleParser:
+    """
+    This class turns turtle text into triples, the prefixes it has seen are kept for the next texts
+    Args:
+        prefixes (dict): prefix -> namespace IRI known before the first text, the @prefix lines of a header are added as they are parsed
+        skolem (string): base IRI the blank nodes are turned into IRIs under (skolemized), None keeps them as _:labels
+    """
+    def __init__(self, prefixes=None, skolem=None):
+        self.prefixes = dict(prefixes or {})
+        self.skolem = skolem
+        self.anonymous = 0
+
+    def parse(self, text):
+        """
+        This fuction parses complete turtle statements
+        Args:
+            text (string): one or more statements, for example a header or a rendered entity
+        Returns:
+            list: the Triples of the statements in the order they are written
+        """
+        self.tokens = self.tokenize(text)
+        self.position = 0
+        triples = []
+        self.triples = triples
+        while self.position < len(self.tokens):
+            kind, value = self.tokens[self.position]
+            if kind == "directive":
+                self.read_directive(value)
+                continue
+            self.read_statement()
+        #nothing of the text is kept, so a parser handed to a worker process stays small
+        self.tokens = []
+        self.triples = []
+        return triples
+
+    def tokenize(self, text):
+        """
+        This fuction splits turtle text into (kind, value) tokens, dropping white space and comments
+        Args:
+            text (string): turtle text
+        Returns:
+            list: the tokens, a literal is ("literal", its unescaped text)
+        """
+        tokens = []
+        position = 0
+        length = len(text)
+        while position < length:
+            match = TOKEN.match(text, position)
+            if not match:
+                raise ValueError(f"cannot read the turtle at {text[position:position + 40]!r}")
+            kind = match.lastgroup
+            if kind == "quote":
+                value, position = self.read_string(text, position)
+                tokens.append(("literal", value))
+                continue
+            position = match.end()
+            if kind != "space":
+                tokens.append((kind, match.group(kind)))
+        return tokens
+
+    def read_string(self, text, start):
+        """
+        This fuction reads a quoted literal, the first quote that is not escaped closes it
+        Args:
+            text (string): turtle text
+            start (int): position of the opening quote
+        Returns:
+            tuple: the unescaped text of the literal and the position after the closing quote
+        """
+        quote = text[start]
+        if text.startswith(quote * 3, start):
+            end = text.find(quote * 3, start + 3)
+            if end < 0:
+                raise ValueError(f"unterminated long literal at {text[start:start + 40]!r}")
+            #a long literal can end in quotes, the last three close it
+            while text.startswith(quote, end + 3):
+                end += 1
+            return unescape(text[start + 3:end]), end + 3
+        position = start + 1
+        while True:
+            end = text.find(quote, position)
+            if end < 0:
+                raise ValueError(f"unterminated literal at {text[start:start + 40]!r}")
+            #count the backslashes in front of the quote, an odd number escapes it
+            backslash = end
+            while backslash > position and text[backslash - 1] == "\\":
+                backslash -= 1
+            if (end - backslash) % 2 == 0:
+                break
+            position = end + 1
+        value = text[start + 1:end]
+        if "\n" in value or "\r" in value:
+            raise ValueError(f"a line break in the literal at {text[start:start + 40]!r}, it has to be escaped")
+        following = TOKEN.match(text, end + 1)
+        if end + 1 < len(text) and (following is None or following.lastgroup in ("quote", "name", "iri", "blank", "number")):
+            raise ValueError(f"the literal at {text[start:end + 20]!r} is followed by {text[end + 1:end + 20]!r}, an unescaped quote?")
+        return unescape(value), end + 1
+
+    def read_directive(self, directive):
+        """
+        This fuction reads a @prefix / PREFIX line, @base is skipped because the renderers never write relative IRIs
+        Args:
+            directive (string): the directive token
+        """
+        self.position += 1
+        if directive in ("@prefix", "PREFIX"):
+            name = self.next_token("name")
+            iri = self.next_token("iri")
+            self.prefixes[name[:-1]] = iri[1:-1]
+        else:
+            self.next_token("iri")
+        if directive.startswith("@"):
+            self.next_token("punctuation", ".")
+
+    def read_statement(self):
+        """
+        This fuction reads one subject with its predicates and objects up to the closing dot
+        """
+        kind, value = self.tokens[self.position]
+        #blank nodes of a statement are labelled from its subject, so the labels are the same every run and in every worker
+        self.statement_key = hashlib.blake2b(value.encode("utf-8"), digest_size=8).hexdigest() if kind != "punctuation" else f"anonymous{self.anonymous}"
+        self.blank_count = 0
+        if kind == "punctuation" and value == "[":
+            self.anonymous += 1
+            subject = self.read_object()
+            if self.peek() == (".", "punctuation"):
+                self.position += 1
+                return
+        else:
+            subject = self.read_term()
+        self.read_predicates(subject, ".")
+        self.next_token("punctuation", ".")
+
+    def read_predicates(self, subject, closing):
+        """
+        This fuction reads the predicate object list of a subject, it stops in front of the closing punctuation
+        Args:
+            subject (string): the subject IRI or blank node
+            closing (string): "." for a statement, "]" for a blank node
+        """
+        while True:
+            value, kind = self.peek()
+            if kind == "punctuation" and value == ";":
+                self.position += 1
+                continue
+            if kind == "punctuation" and value == closing:
+                return
+            if kind == "name" and value == "a":
+                self.position += 1
+                predicate = RDF + "type"
+            else:
+                predicate = self.read_term()
+            while True:
+                self.add_object(subject, predicate)
+                if self.peek() != (",", "punctuation"):
+                    break
+                self.position += 1
+            value, kind = self.peek()
+            if kind != "punctuation" or value not in (";", closing):
+                raise ValueError(f"expected ; or {closing} after an object, found {value!r}")
+
+    def add_object(self, subject, predicate):
+        """
+        This fuction reads one object and adds its triple
+        Args:
+            subject (string): the subject IRI or blank node
+            predicate (string): the predicate IRI
+        """
+        kind, value = self.tokens[self.position]
+        if kind == "literal":
+            self.position += 1
+            datatype = PLAIN
+            next_value, next_kind = self.peek()
+            if next_kind == "punctuation" and next_value == "^^":
+                self.position += 1
+                datatype = self.read_term()
+            elif next_kind == "language":
+                self.position += 1
+                datatype = next_value
+            self.triples.append(Triple(subject, predicate, value, datatype))
+        elif kind == "number":
+            self.position += 1
+            datatype = XSD + ("decimal" if "." in value and "e" not in value.lower() else "double" if "e" in value.lower() else "integer")
+            self.triples.append(Triple(subject, predicate, value, datatype))
+        elif kind == "name" and value in ("true", "false"):
+            self.position += 1
+            self.triples.append(Triple(subject, predicate, value, XSD + "boolean"))
+        else:
+            #the triple of a nested blank node comes before the triples inside it
+            index = len(self.triples)
+            self.triples.append(None)
+            self.triples[index] = Triple(subject, predicate, self.read_object(), NODE)
+
+    def read_object(self):
+        """
+        This fuction reads an object that is a node, a [ ] blank node and a ( ) collection add their own triples
+        Returns:
+            string: the IRI or blank node label of the object
+        """
+        kind, value = self.tokens[self.position]
+        if kind == "punctuation" and value == "[":
+            self.position += 1
+            node = self.new_blank()
+            self.read_predicates(node, "]")
+            self.position += 1
+            return node
+        if kind == "punctuation" and value == "(":
+            self.position += 1
+            head = RDF + "nil"
+            previous = None
+            while self.peek() != (")", "punctuation"):
+                item = self.new_blank()
+                if previous is None:
+                    head = item
+                else:
+                    self.triples.append(Triple(previous, RDF + "rest", item, NODE))
+                self.add_object(item, RDF + "first")
+                previous = item
+            self.position += 1
+            if previous is not None:
+                self.triples.append(Triple(previous, RDF + "rest", RDF + "nil", NODE))
+            return head
+        return self.read_term()
+
+    def read_term(self):
+        """
+        This fuction reads an IRI, a prefixed name or a blank node label
+        Returns:
+            string: the full IRI or the _:label
+        """
+        kind, value = self.tokens[self.position]
+        self.position += 1
+        if kind == "iri":
+            return value[1:-1]
+        if kind == "blank":
+            return value
+        if kind == "name" and ":" in value:
+            prefix, _, local = value.partition(":")
+            try:
+                return self.prefixes[prefix] + local
+            except KeyError:
+                raise ValueError(f"the prefix {prefix}: is not defined") from None
+        raise ValueError(f"expected an IRI, found {value!r}")
+
+    def new_blank(self):
+        """
+        This fuction makes the label of the next blank node of the statement
+        Returns:
+            string: _:b*statement key*_*number*, or the skolem IRI *skolem*b*statement key*_*number*
+        """
+        self.blank_count += 1
+        if self.skolem:
+            return f"{self.skolem}b{self.statement_key}_{self.blank_count}"
+        return f"_:b{self.statement_key}_{self.blank_count}"
+
+    def peek(self):
+        """
+        This fuction looks at the next token without reading it
+        Returns:
+            tuple: (value, kind) of the token, (None, None) at the end of the text
+        """
+        if self.position < len(self.tokens):
+            kind, value = self.tokens[self.position]
+            return value, kind
+        return None, None
+
+    def next_token(self, kind, value=None):
+        """
+        This fuction reads a token that has to be there
+        Args:
+            kind (string): the kind of token expected
+            value (string): the text expected, any when None
+        Returns:
+            string: the text of the token
+        """
+        found_value, found_kind = self.peek()
+        if found_kind != kind or (value is not None and found_value != value):
+            raise ValueError(f"expected {value or kind}, found {found_value!r}")
+        self.position += 1
+        return found_value
+
+
+class TripleBuilder:
+    """
+    This class collects the triples the compiled templates emit (see Template.emitter in kg_templates.py), the blank nodes are
+    labelled as they are made, from the subject of their statement, so the labels are the same every run and in every worker
+    Args:
+        prefixes (dict): prefix -> namespace IRI of the names the templates write, read from the ontology header
+        skolem (string): base IRI the blank nodes are made under (skolemized), None makes them _:labels
+    """
+    def __init__(self, prefixes=None, skolem=None):
+        self.prefixes = dict(prefixes or {})
+        self.blank_base = (skolem or "_:") + "b"
+        self.triples = []
+        #template -> its compiled emitter
+        self.emitters = {}
+        #the subject of the statement being emitted as it is written, the start of the labels of its blank nodes and their number
+        self.token = ""
+        self.label = None
+        self.count = 0
+
+    def emit(self, template, document):
+        """
+        This fuction emits the triples of a document
+        Args:
+            template (Template): the entity template, compiled for the prefixes the first time it is used
+            document (dict): the document
+        Returns:
+            list: the Triples in the order the layout writes them, the triple of a blank node before the triples inside it
+        """
+        emit = self.emitters.get(template)
+        if emit is None:
+            emit = self.emitters[template] = template.emitter(self.prefixes)
+        emit(document, self)
+        triples = self.triples
+        self.triples = []
+        return triples
+
+    def start(self, token):
+        """
+        This fuction starts a statement, its blank nodes are numbered from 1
+        Args:
+            token (string): the subject as the turtle writes it, like se:*id*
+        """
+        self.token = token
+        self.label = None
+        self.count = 0
+
+    def blank(self):
+        """
+        This fuction makes the label of the next blank node of the statement
+        Returns:
+            string: _:b*hash of the subject*_*number*, or the skolem IRI *skolem*b*hash of the subject*_*number*
+        """
+        self.count += 1
+        if self.label is None:
+            self.label = f"{self.blank_base}{hashlib.blake2b(self.token.encode('utf-8'), digest_size=8).hexdigest()}_"
+        return self.label + str(self.count)
+
+    def expand(self, name):
+        """
+        This fuction turns the prefixed name a template field returned into its IRI
+        Args:
+            name (string): a prefixed name like se:concept_*hash*, or an <IRI>
+        Returns:
+            str: the full IRI
+        """
+        if name.startswith("<"):
+            return name[1:-1]
+        prefix, _, local = name.partition(":")
+        try:
+            return self.prefixes[prefix] + local
+        except KeyError:
+            raise ValueError(f"the prefix {prefix}: of {name!r} is not defined") from None
+
+
+class TripleConverter:
+    """
+    This class turns the documents of the entity passes into N-Triples or N-Quads lines, the triples come from the emitters of
+    the entity templates and the blank nodes are skolemized so every line stands on its own and a file can be split at any newline
+    Args:
+        output_format (string): "nt" or "nq"
+        graph (string): the named graphs of "nq", "resource_type" for one per resource type or "patient" for one per patient,
+            entities without a patient (organizations, locations, medications) stay in the default graph
+        prefixes (dict): prefix -> namespace IRI of the templates, read from the ontology header
+        skolem (string): base IRI of the skolemized blank nodes
+    """
+    def __init__(self, output_format="nt", graph="resource_type", prefixes=None, skolem=SKOLEM_BASE):
+        if output_format not in ("nt", "nq"):
+            raise ValueError(f"unknown triple output format {output_format}, use nt or nq")
+        if graph not in ("resource_type", "patient"):
+            raise ValueError(f"unknown graph {graph}, use resource_type or patient")
+        self.output_format = output_format
+        self.graph = graph
+        self.skolem = skolem
+        self.builder = TripleBuilder(prefixes, skolem)
+
+    def triples(self, template, document):
+        """
+        This fuction emits the triples of a document, a triple the layout writes twice is kept once
+        Args:
+            template (Template): the entity template
+            document (dict): the document
+        Returns:
+            list: the Triples in the order they were first written
+        """
+        return list(dict.fromkeys(self.builder.emit(template, document)))
+
+    def convert(self, triples, graph=None):
+        """
+        This fuction writes triples as lines
+        Args:
+            triples (list): the Triples, all of one document when the graph is found from them
+            graph (string): IRI of the named graph for "nq", found from the triples when None
+        Returns:
+            str: the N-Triples or N-Quads lines
+        """
+        if self.output_format == "nt":
+            return ntriples_lines(triples)
+        graph = graph or self.graph_of(triples)
+        return ntriples_lines(triples, graph)
+
+    def convert_header(self, header):
+        """
+        This fuction converts the ontology header, the only turtle that is parsed, its triples go into ONTOLOGY_GRAPH
+        Args:
+            header (string): the ontology header
+        Returns:
+            str: the N-Triples or N-Quads lines
+        """
+        parser = TurtleParser(self.builder.prefixes, self.skolem)
+        return self.convert(parser.parse(header), ONTOLOGY_GRAPH)
+
+    def graph_of(self, triples):
+        """
+        This fuction finds the named graph of the triples of a document
+        Args:
+            triples (list): the Triples of one document, its own entity first
+        Returns:
+            str: IRI of the graph, None for the default graph
+        """
+        if not triples:
+            return None
+        subject = triples[0].subject
+        for triple in triples:
+            if self.graph == "resource_type":
+                if triple.subject == subject and triple.predicate == RDF + "type":
+                    return GRAPH_BASE + local_name(triple.object)
+            elif triple.predicate in PATIENT_PREDICATES and triple.datatype is NODE:
+                return GRAPH_BASE + "patient/" + local_name(triple.object)
+            elif triple.predicate == RDF + "type" and triple.object == FHIR + "Patient":
+                return GRAPH_BASE + "patient/" + local_name(triple.subject)
+        return None
+
+
+class NTriplesSerializer:
+    """
+    This class writes triples as N-Triples, one triple per line
+    Args:
+        output (object): anything with a write(string) method, an open text file or a TtlWriter
+    """
+    def __init__(self, output):
+        self.output = output
+
+    def write(self, triples):
+        """
+        This fuction writes triples
+        Args:
+            triples (list): Triples
+        """
+        self.output.write(ntriples_lines(triples))
+
+
+class NQuadsSerializer:
+    """
+    This class writes triples as N-Quads, one quad per line, every write puts its triples into one named graph
+    Args:
+        output (object): anything with a write(string) method, an open text file or a TtlWriter
+    """
+    def __init__(self, output):
+        self.output = output
+
+    def write(self, triples, graph=None):
+        """
+        This fuction writes triples into a named graph
+        Args:
+            triples (list): Triples
+            graph (string): IRI of the graph, the default graph when None
+        """
+        self.output.write(ntriples_lines(triples, graph))
+
+
+class TurtleSerializer:
+    """
+    This class writes triples as flat turtle, one block per subject with the IRIs shortened by the prefixes
+    Args:
+        output (object): anything with a write(string) method, an open text file or a TtlWriter
+        prefixes (dict): prefix -> namespace IRI used to shorten the IRIs
+    """
+    def __init__(self, output, prefixes=None):
+        self.output = output
+        #the longest namespaces are tried first so se: wins over a shorter namespace it starts with
+        self.prefixes = sorted((prefixes or {}).items(), key=lambda item: len(item[1]), reverse=True)
+        self.prefixes_written = False
+
+    def write(self, triples):
+        """
+        This fuction writes triples, the @prefix lines are written before the first ones
+        Args:
+            triples (list): Triples
+        """
+        lines = []
+        if not self.prefixes_written:
+            lines.extend(f"@prefix {prefix}: <{namespace}> .\n" for prefix, namespace in sorted(self.prefixes))
+            lines.append("\n")
+            self.prefixes_written = True
+        subject = None
+        for triple in triples:
+            if triple.subject != subject:
+                if subject is not None:
+                    lines.append(" .\n")
+                subject = triple.subject
+                lines.append(f"{self.term(subject)} {self.predicate(triple.predicate)} {self.object(triple)}")
+            else:
+                lines.append(f" ;\n    {self.predicate(triple.predicate)} {self.object(triple)}")
+        if subject is not None:
+            lines.append(" .\n")
+        self.output.write("".join(lines))
+
+    def term(self, iri):
+        """
+        This fuction writes an IRI as a prefixed name when a prefix fits it
+        Args:
+            iri (string): full IRI or _:label
+        Returns:
+            str: the turtle term
+        """
+        if iri.startswith("_:"):
+            return iri
+        for prefix, namespace in self.prefixes:
+            if iri.startswith(namespace) and LOCAL_NAME.fullmatch(iri[len(namespace):]):
+                return f"{prefix}:{iri[len(namespace):]}"
+        return f"<{iri}>"
+
+    def predicate(self, iri):
+        """
+        This fuction writes the predicate of a triple, rdf:type is written as a
+        Args:
+            iri (string): full IRI
+        Returns:
+            str: the turtle term
+        """
+        if iri == RDF + "type":
+            return "a"
+        return self.term(iri)
+
+    def object(self, triple):
+        """
+        This fuction writes the object of a triple
+        Args:
+            triple (Triple): the triple
+        Returns:
+            str: the turtle term or literal
+        """
+        if triple.datatype is NODE:
+            return self.term(triple.object)
+        literal = '"' + escape_string(triple.object) + '"'
+        if triple.datatype == PLAIN:
+            return literal
+        if triple.datatype.startswith("@"):
+            return literal + triple.datatype
+        return f"{literal}^^{self.term(triple.datatype)}"
+
+
+class BinarySerializer:
+    """
+    This class writes triples as a compact binary stream, every term is written once and triples refer to it by number
+    The stream starts with BINARY_MAGIC, then records: BINARY_TERM length text, or BINARY_TRIPLE subject predicate object datatype,
+    all numbers unsigned LEB128 varints, datatype 0 is NODE
+    Args:
+        output (object): a file opened in binary mode
+    """
+    def __init__(self, output):
+        self.output = output
+        self.terms = {}
+        self.output.write(BINARY_MAGIC)
+
+    def write(self, triples):
+        """
+        This fuction writes triples
+        Args:
+            triples (list): Triples
+        """
+        buffer = bytearray()
+        terms = self.terms
+
+        def term_number(term):
+            number = terms.get(term)
+            if number is None:
+                number = len(terms) + 1
+                terms[term] = number
+                encoded = term.encode("utf-8")
+                buffer.append(BINARY_TERM)
+                buffer.extend(varint(len(encoded)))
+                buffer.extend(encoded)
+            return number
+
+        for triple in triples:
+            numbers = (term_number(triple.subject), term_number(triple.predicate), term_number(triple.object),
+                       0 if triple.datatype is NODE else term_number(triple.datatype))
+            buffer.append(BINARY_TRIPLE)
+            for number in numbers:
+                buffer.extend(varint(number))
+        self.output.write(bytes(buffer))
+
+
+def escape_string(text):
+    """
+    This fuction escapes text for a turtle or N-Triples string literal, every literal the converters write goes through it
+    Args:
+        text (string): the text, anything else is turned into a string first
+    Returns:
+        str: the text with quotes, backslashes and control characters escaped
+    """
+    if not isinstance(text, str):
+        text = str(text)
+    #almost every value needs no escaping, three scans in C find that out
+    if text.isprintable() and '"' not in text and "\\" not in text:
+        return text
+    text = text.replace("\\", "\\\\").replace('"', '\\"')
+    if not text.isprintable():
+        #line breaks and tabs are the control characters free text has, replace is much faster than translate
+        text = text.replace("\n", "\\n").replace("\r", "\\r").replace("\t", "\\t")
+        #isprintable is also False for some characters outside ascii, which the table leaves alone
+        if not text.isprintable():
+            text = text.translate(CONTROL_ESCAPES)
+    return text
+
+def unescape(text):
+    """
+    This fuction resolves the escapes of a turtle literal, an escape turtle does not have raises a ValueError
+    Args:
+        text (string): the text between the quotes
+    Returns:
+        str: the literal text
+    """
+    if "\\" not in text:
+        return text
+
+    def replace(match):
+        short, long, character = match.groups()
+        if short or long:
+            return chr(int(short or long, 16))
+        if character not in TURTLE_ESCAPES:
+            raise ValueError(f"unknown escape \\{character} in the literal {text[:40]!r}")
+        return TURTLE_ESCAPES[character]
+    return ESCAPE.sub(replace, text)
+
+def ntriples_line(triple):
+    """
+    This fuction writes a triple as an N-Triples line
+    Args:
+        triple (Triple): the triple
+    Returns:
+        str: the line, ending with " .\\n"
+    """
+    subject = triple.subject if triple.subject.startswith("_:") else f"<{triple.subject}>"
+    if triple.datatype is NODE:
+        value = triple.object if triple.object.startswith("_:") else f"<{triple.object}>"
+    else:
+        value = '"' + escape_string(triple.object) + '"'
+        if triple.datatype.startswith("@"):
+            value += triple.datatype
+        elif triple.datatype != PLAIN:
+            value += f"^^<{triple.datatype}>"
+    return f"{subject} <{triple.predicate}> {value} .\n"
+
+def ntriples_lines(triples, graph=None):
+    """
+    This fuction writes triples as N-Triples lines, or as the N-Quads lines of one graph, the same lines as ntriples_line and
+    nquads_line give but the subject is written once for the triples that follow each other with it
+    Args:
+        triples (iterable): the Triples
+        graph (string): IRI of the named graph of N-Quads lines, None for N-Triples or the default graph
+    Returns:
+        str: the lines, each ending with " .\\n"
+    """
+    end = " .\n" if graph is None else f" <{graph}> .\n"
+    lines = []
+    last_subject = None
+    for subject, predicate, value, datatype in triples:
+        if subject != last_subject:
+            last_subject = subject
+            subject_term = subject + " <" if subject.startswith("_:") else f"<{subject}> <"
+        if datatype is NODE:
+            if value.startswith("_:"):
+                lines.append(f"{subject_term}{predicate}> {value}{end}")
+            else:
+                lines.append(f"{subject_term}{predicate}> <{value}>{end}")
+        elif datatype == PLAIN:
+            lines.append(f'{subject_term}{predicate}> "{escape_string(value)}"{end}')
+        elif datatype.startswith("@"):
+            lines.append(f'{subject_term}{predicate}> "{escape_string(value)}"{datatype}{end}')
+        else:
+            lines.append(f'{subject_term}{predicate}> "{escape_string(value)}"^^<{datatype}>{end}')
+    return "".join(lines)
+
+def read_nquads(text):
+    """
+    This fuction reads N-Triples or N-Quads lines, a line that is neither raises a ValueError
+    Args:
+        text (string): whole lines
+    Returns:
+        list: the Triples of the lines in their order, the graphs are left out
+    """
+    triples = []
+    for line in text.splitlines():
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+        match = NQUADS_LINE.match(line)
+        if match is None:
+            raise ValueError(f"not an N-Triples or N-Quads line: {line[:80]!r}")
+        subject = match.group(1)
+        subject = subject[1:-1] if subject.startswith("<") else subject
+        if match.group("iri") is not None:
+            triples.append(Triple(subject, match.group(2), match.group("iri"), NODE))
+        elif match.group("blank") is not None:
+            triples.append(Triple(subject, match.group(2), match.group("blank"), NODE))
+        else:
+            datatype = match.group("datatype") or match.group("language") or PLAIN
+            triples.append(Triple(subject, match.group(2), unescape(match.group("literal")), datatype))
+    return triples
+
+def local_name(iri):
+    """
+    This fuction returns the part of an IRI after its namespace
+    Args:
+        iri (string): full IRI
+    Returns:
+        str: the text after the last # or /
+    """
+    return iri[max(iri.rfind("#"), iri.rfind("/")) + 1:]
+
+def nquads_line(triple, graph=None):
+    """
+    This fuction writes a triple as an N-Quads line
+    Args:
+        triple (Triple): the triple
+        graph (string): IRI of the named graph, the default graph when None
+    Returns:
+        str: the line, ending with " .\\n"
+    """
+    if graph is None:
+        return ntriples_line(triple)
+    return f"{ntriples_line(triple)[:-2]}<{graph}> .\n"
+
+def read_prefixes(text):
+    """
+    This fuction reads the @prefix lines of turtle text, the ontology header for example
+    Args:
+        text (string): turtle text
+    Returns:
+        dict: prefix -> namespace IRI
+    """
+    return {match.group(1): match.group(2) for match in PREFIX_LINE.finditer(text)}
+
+def varint(number):
+    """
+    This fuction encodes an unsigned number as a LEB128 varint
+    Args:
+        number (int): the number
+    Returns:
+        bytes: the encoding, 7 bits per byte with the high bit set on all but the last
+    """
+    if number < 0x80:
+        return bytes((number,))
+    encoded = bytearray()
+    while number >= 0x80:
+        encoded.append((number & 0x7F) | 0x80)
+        number >>= 7
+    encoded.append(number)
+    return bytes(encoded)
+
+def read_binary(file, chunk_size=1024 * 1024):
+    """
+    This fuction reads the triples a BinarySerializer wrote
+    Args:
+        file (object): the stream, opened in binary mode
+        chunk_size (int): bytes read at a time
+    Returns:
+        generator: the Triples in the order they were written
+    """
+    if file.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+        raise ValueError("not a binary triple stream")
+    terms = [None]
+    data = b""
+    position = 0
+
+    def read_varint():
+        nonlocal position
+        number = 0
+        shift = 0
+        while True:
+            byte = data[position]
+            position += 1
+            number |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return number
+            shift += 7
+
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk and position >= len(data):
+            return
+        data = data[position:] + chunk
+        position = 0
+        while position < len(data):
+            start = position
+            triple = None
+            try:
+                record = data[position]
+                position += 1
+                if record == BINARY_TERM:
+                    length = read_varint()
+                    if position + length > len(data):
+                        raise IndexError
+                    terms.append(data[position:position + length].decode("utf-8"))
+                    position += length
+                elif record == BINARY_TRIPLE:
+                    subject, predicate, value, datatype = read_varint(), read_varint(), read_varint(), read_varint()
+                    triple = Triple(terms[subject], terms[predicate], terms[value], terms[datatype] if datatype else NODE)
+                else:
+                    raise ValueError(f"unknown record {record} in the binary triple stream")
+            except IndexError:
+                #the record runs past the end of the chunk, it is read again with the next one
+                if not chunk:
+                    raise ValueError("the binary triple stream ends in the middle of a record") from None
+                position = start
+                break
+            if triple:
+                yield triple
@@ -0,0 +1,489 @@
+#--------------------------------------------------------------
+#
+# This python file reads the MIMIC IV FHIR ndjson files directly so the knowledge graphs can be created without mongoDB
+#
+# An NdjsonSource answers the same aggregate / find calls the entity functions make on the mongoDB collection,
+# pass one to create_ttl_script(source=...) in fhir_kg_creation.py or flattened_kg_creation.py
+#
+#   source = NdjsonSource("mimic-iv-clinical-database-demo-on-fhir/fhir")
+#   create_ttl_script(source=source)
+#
+# Only the pipeline stages the converters use are supported ($match, $project, $sort on one field, $limit). The filters match
+# like mongoDB's: a path through a list looks into every object of it, a list matches when it or one of its items does and
+# a comparison with a value of another type is false
+#
+# A document without an _id gets one from the position of its file in the list and its line in the file, so the _ids only
+# stay the same while the files do. Checkpoints and _id watermarks keep the fingerprint() of the files they were taken on
+# and are not used on files that changed
+#
+#----------------------------------------------------------------
+
+import gzip
+import hashlib
+import json
+import os
+from operator import ge, gt, le, lt
+
+
+#bytes at the start of every file that are hashed into the fingerprint, with the size of the file
+FINGERPRINT_BYTES = 1024 * 1024
+
+#the comparison operators of the filters
+COMPARISONS = {"$gt": gt, "$gte": ge, "$lt": lt, "$lte": le}
+
+
+class NdjsonSource:
+    """
+    This class streams fhir documents line by line out of *.ndjson and *.ndjson.gz files
+    Args:
+        paths (string or list): ndjson files, or directories that hold them
+        one_type_per_file (bool): True when every file holds a single resource type (like the MIMIC IV FHIR export),
+            then the first line of a file decides which passes read it, otherwise every file is scanned once to find out
+    """
+    def __init__(self, paths, one_type_per_file=False):
+        if isinstance(paths, str):
+            paths = [paths]
+        self.files = []
+        for path in paths:
+            if os.path.isdir(path):
+                for name in sorted(os.listdir(path)):
+                    if name.endswith(".ndjson") or name.endswith(".ndjson.gz"):
+                        self.files.append(os.path.join(path, name))
+            else:
+                self.files.append(path)
+        self.one_type_per_file = one_type_per_file
+        #file -> set of resource types in that file, filled in as the files are read
+        self.file_resource_types = {}
+
+    def fingerprint(self):
+        """
+        This fuction identifies the files and their order, the _ids of the documents stay the same as long as it does
+        A change that keeps the size of a file and its first FINGERPRINT_BYTES is not noticed
+        Returns:
+            list: [file name, size, hash of the first FINGERPRINT_BYTES] of every file in the order they are read
+        """
+        fingerprint = []
+        for path in self.files:
+            with open(path, "rb") as file:
+                head = hashlib.blake2b(file.read(FINGERPRINT_BYTES), digest_size=16).hexdigest()
+            fingerprint.append([os.path.basename(path), os.path.getsize(path), head])
+        return fingerprint
+
+    def aggregate(self, pipeline, **kwargs):
+        """
+        This fuction runs a mongoDB style pipeline over the ndjson files
+        Args:
+            pipeline (list): $match, $project, $sort and $limit stages
+        Returns:
+            iterator: the resulting documents
+        """
+        match = {}
+        stages = pipeline
+        if stages and "$match" in stages[0]:
+            match = stages[0]["$match"]
+            stages = stages[1:]
+        documents = self.find(match)
+        for stage in stages:
+            if "$match" in stage:
+                documents = match_documents(documents, stage["$match"])
+            elif "$project" in stage:
+                documents = project_documents(documents, stage["$project"])
+            elif "$sort" in stage:
+                documents = sort_documents(documents, stage["$sort"])
+            elif "$limit" in stage:
+                documents = limit_documents(documents, stage["$limit"])
+            else:
+                raise NotImplementedError(f"NdjsonSource does not support the pipeline stage {list(stage)[0]}")
+        return documents
+
+    def find(self, filter=None, projection=None):
+        """
+        This fuction streams every document that matches a mongoDB style filter
+        Args:
+            filter (dict): equality, $exists, $in, $nin, $ne, $gt, $gte, $lt, $lte, $and and $or conditions
+            projection (dict): fields to keep, like a $project stage
+        Returns:
+            iterator: the matching documents
+        """
+        filter = prepare_query(filter or {})
+        documents = (doc for doc in self.read_documents(filter.get("resourceType")) if matches(doc, filter))
+        if projection:
+            documents = project_documents(documents, projection)
+        return documents
+
+    def find_one(self, filter=None, projection=None):
+        """
+        This fuction returns the first document that matches a mongoDB style filter
+        Args:
+            filter (dict): conditions the document has to meet
+            projection (dict): fields to keep
+        Returns:
+            dict: the document, or None when nothing matches
+        """
+        return next(iter(self.find(filter, projection)), None)
+
+    def count_documents(self, filter=None):
+        """
+        This fuction counts the documents that match a mongoDB style filter
+        Args:
+            filter (dict): conditions the documents have to meet
+        Returns:
+            int: the number of matching documents
+        """
+        return sum(1 for _ in self.find(filter))
+
+    def read_documents(self, resource_type=None):
+        """
+        This fuction parses the ndjson files line by line, skipping the files and lines that cannot hold the resource type
+        Every document gets an _id built from the file and line number so the order is stable between runs on the same
+        files (see fingerprint)
+        Args:
+            resource_type (string): only documents of this resource type are parsed, all documents when None
+        Returns:
+            iterator: the parsed documents
+        """
+        if not isinstance(resource_type, str):
+            resource_type = None
+        #a cheap test on the raw line before paying for json.loads, references look like "Type/id" so they never match
+        needle = f'"{resource_type}"'.encode("utf-8") if resource_type else None
+        for file_index, path in enumerate(self.files):
+            types_in_file = self.file_resource_types.get(path)
+            if resource_type and types_in_file is not None and resource_type not in types_in_file:
+                continue
+            seen_types = set()
+            with open_ndjson(path) as file:
+                for line_number, line in enumerate(file):
+                    if needle is not None and types_in_file is not None and needle not in line:
+                        continue
+                    line = line.strip()
+                    if not line:
+                        continue
+                    doc = json.loads(line)
+                    doc_type = doc.get("resourceType")
+                    if types_in_file is None:
+                        seen_types.add(doc_type)
+                        if self.one_type_per_file:
+                            self.file_resource_types[path] = types_in_file = seen_types
+                            if resource_type and doc_type != resource_type:
+                                break
+                    if resource_type and doc_type != resource_type:
+                        continue
+                    if "_id" not in doc:
+                        doc["_id"] = (file_index << 32) | line_number
+                    yield doc
+            if types_in_file is None:
+                self.file_resource_types[path] = seen_types
+
+
+def source_fingerprint(source):
+    """
+    This fuction returns the fingerprint of the ndjson files of a source
+    Args:
+        source (object): the document source, the mongoDB collection when None
+    Returns:
+        list: the NdjsonSource fingerprint, None for mongoDB whose _ids do not depend on where the documents are stored
+    """
+    if isinstance(source, NdjsonSource):
+        return source.fingerprint()
+    return None
+
+def open_ndjson(path):
+    """
+    This fuction opens a plain or gzip compressed ndjson file for reading in binary mode
+    Args:
+        path (string): the ndjson file
+    Returns:
+        file: the open file
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+def get_path(doc, path):
+    """
+    This fuction walks a dotted path through a document, number keys index into lists
+    Args:
+        doc (dict): a fhir document
+        path (string): a dotted path like code.coding.0.code
+    Returns:
+        tuple: (True, value) when the path exists, (False, None) otherwise
+    """
+    value = doc
+    for key in path.split("."):
+        if isinstance(value, dict):
+            if key not in value:
+                return False, None
+            value = value[key]
+        elif isinstance(value, list):
+            try:
+                value = value[int(key)]
+            except (ValueError, IndexError):
+                return False, None
+        else:
+            return False, None
+    return True, value
+
+def path_values(doc, path):
+    """
+    This fuction walks a dotted path the way mongoDB queries do, a key on a list is looked up in every object of the list
+    Args:
+        doc (dict): a fhir document
+        path (string): a dotted path like authorizingPrescription.reference
+    Returns:
+        list: every value found at the path
+    """
+    values = [doc]
+    for key in path.split("."):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if key in value:
+                    found.append(value[key])
+            elif isinstance(value, list):
+                if key.isdigit():
+                    if int(key) < len(value):
+                        found.append(value[int(key)])
+                else:
+                    found.extend(item[key] for item in value if isinstance(item, dict) and key in item)
+        values = found
+    return values
+
+def prepare_query(query):
+    """
+    This fuction turns the lists of $in and $nin conditions into sets once, so a long list does not slow down every document
+    Args:
+        query (dict): a mongoDB style filter
+    Returns:
+        dict: the same filter with sets in place of the lists it could turn
+    """
+    prepared = {}
+    for field, condition in query.items():
+        if field in ("$and", "$or"):
+            condition = [prepare_query(part) for part in condition]
+        elif isinstance(condition, dict):
+            condition = dict(condition)
+            for operator in ("$in", "$nin"):
+                if operator in condition:
+                    try:
+                        condition[operator] = frozenset(condition[operator])
+                    except TypeError:
+                        pass
+        prepared[field] = condition
+    return prepared
+
+def query_values(doc, path):
+    """
+    This fuction finds the values a condition on a path is tested against, the way mongoDB does: a key on a list is looked up in
+    every object of the list, and a list is tested as a whole and item by item
+    Args:
+        doc (dict): a fhir document
+        path (string): a dotted path like identifier.value
+    Returns:
+        list: the values, empty when the path is missing
+    """
+    exists, value = get_path(doc, path)
+    if exists and not isinstance(value, list):
+        return [value]
+    values = []
+    for found in path_values(doc, path):
+        values.append(found)
+        if isinstance(found, list):
+            values.extend(found)
+    return values
+
+def path_missing(doc, path):
+    """
+    This fuction checks if a path is missing from a document or from one of the objects of a list it goes through, where a
+    null condition matches it like in mongoDB
+    Args:
+        doc (dict): a fhir document
+        path (string): a dotted path like identifier.system
+    Returns:
+        bool: True when the path is missing somewhere
+    """
+    values = [doc]
+    for key in path.split("."):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if key not in value:
+                    return True
+                found.append(value[key])
+            elif isinstance(value, list):
+                if key.isdigit():
+                    if int(key) >= len(value):
+                        return True
+                    found.append(value[int(key)])
+                else:
+                    for item in value:
+                        if isinstance(item, dict):
+                            if key not in item:
+                                return True
+                            found.append(item[key])
+            else:
+                return True
+        values = found
+    return False
+
+def contains(operand, value):
+    """
+    This fuction checks if the list or set of an $in or $nin condition holds a value
+    Args:
+        operand (object): the list or set of the condition
+        value (object): a value of the document
+    Returns:
+        bool: True when the value is in it
+    """
+    try:
+        return value in operand
+    except TypeError:
+        #a dict or list can not be looked up in a set
+        return any(value == item for item in operand)
+
+def equals(doc, path, values, operand):
+    """
+    This fuction checks an equality condition, null matches a missing path like in mongoDB
+    Args:
+        doc (dict): a fhir document
+        path (string): the dotted path of the condition
+        values (list): the query_values of the path
+        operand (object): the value the condition asks for
+    Returns:
+        bool: True when one of the values is equal to it
+    """
+    if operand is None and path_missing(doc, path):
+        return True
+    return operand in values
+
+def any_in(doc, path, values, operand):
+    """
+    This fuction checks an $in condition, null in the list matches a missing path like in mongoDB
+    Args:
+        doc (dict): a fhir document
+        path (string): the dotted path of the condition
+        values (list): the query_values of the path
+        operand (object): the list or set of the condition
+    Returns:
+        bool: True when one of the values is in it
+    """
+    if any(contains(operand, value) for value in values):
+        return True
+    return contains(operand, None) and path_missing(doc, path)
+
+def compare(value, operator, operand):
+    """
+    This fuction checks a $gt, $gte, $lt or $lte condition on one value, values of another type than the operand never match,
+    like the type bracketing of mongoDB, and null never does
+    Args:
+        value (object): a value of the document
+        operator (string): the comparison
+        operand (object): the value of the condition
+    Returns:
+        bool: True when the value meets the condition
+    """
+    if value is None or isinstance(value, bool) != isinstance(operand, bool):
+        return False
+    try:
+        return COMPARISONS[operator](value, operand)
+    except TypeError:
+        return False
+
+def matches(doc, query):
+    """
+    This fuction checks a document against a mongoDB style filter
+    Args:
+        doc (dict): a fhir document
+        query (dict): equality, $exists, $in, $nin, $ne, $gt, $gte, $lt, $lte, $and and $or conditions
+    Returns:
+        bool: True when the document meets every condition
+    """
+    for field, condition in query.items():
+        if field == "$and":
+            if not all(matches(doc, part) for part in condition):
+                return False
+            continue
+        if field == "$or":
+            if not any(matches(doc, part) for part in condition):
+                return False
+            continue
+        values = query_values(doc, field)
+        if not isinstance(condition, dict):
+            if not equals(doc, field, values, condition):
+                return False
+            continue
+        for operator, operand in condition.items():
+            if operator == "$exists":
+                if bool(values) != bool(operand):
+                    return False
+            elif operator == "$in":
+                if not any_in(doc, field, values, operand):
+                    return False
+            elif operator == "$nin":
+                if any_in(doc, field, values, operand):
+                    return False
+            elif operator == "$ne":
+                if equals(doc, field, values, operand):
+                    return False
+            elif operator in COMPARISONS:
+                if not any(compare(value, operator, operand) for value in values):
+                    return False
+            else:
+                raise NotImplementedError(f"NdjsonSource does not support the query operator {operator}")
+    return True
+
+def match_documents(documents, query):
+    """
+    This fuction keeps the documents that match a mongoDB style filter
+    Args:
+        documents (iterator): fhir documents
+        query (dict): the conditions of a $match stage
+    Returns:
+        iterator: the matching documents
+    """
+    query = prepare_query(query)
+    for doc in documents:
+        if matches(doc, query):
+            yield doc
+
+def project_documents(documents, projection):
+    """
+    This fuction keeps only the top level fields named in an inclusion projection (_id is kept unless it is set to 0)
+    Args:
+        documents (iterator): fhir documents
+        projection (dict): a $project stage like {"id":1,"code":1}
+    Returns:
+        iterator: the projected documents
+    """
+    fields = [field for field, keep in projection.items() if keep and field != "_id"]
+    keep_id = projection.get("_id", 1)
+    for doc in documents:
+        projected = {field: doc[field] for field in fields if field in doc}
+        if keep_id and "_id" in doc:
+            projected["_id"] = doc["_id"]
+        yield projected
+
+def sort_documents(documents, sort):
+    """
+    This fuction sorts documents on a single field
+    Args:
+        documents (iterator): fhir documents
+        sort (dict): a $sort stage with one field, 1 for ascending and -1 for descending
+    Returns:
+        list: the sorted documents
+    """
+    (field, direction), = sort.items()
+    return sorted(documents, key=lambda doc: get_path(doc, field)[1], reverse=direction == -1)
+
+def limit_documents(documents, limit):
+    """
+    This fuction stops after the first limit documents
+    Args:
+        documents (iterator): fhir documents
+        limit (int): how many documents to keep
+    Returns:
+        iterator: at most limit documents
+    """
+    for count, doc in enumerate(documents):
+        if count >= limit:
+            return
+        yield doc
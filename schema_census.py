@@ -0,0 +1,204 @@
+#--------------------------------------------------------------
+#
+# This python file takes a census of the whole collection in one scan and keeps it in a json snapshot, the exploration
+# functions of fhir_kg_creation.py answer from the snapshot instead of scanning the collection again
+#
+#   get_schema_census()                                   one scan of the mongoDB collection, saved in schema_census.json
+#   get_schema_census(source=NdjsonSource(folder))        one streaming pass over the ndjson files
+#
+#   get_resource_type_list()                              the resource types and their counts
+#   get_fields_in_all_documents()                         the top level fields every document has
+#   get_distinct_fields("Observation")                    the field paths of a resource type
+#
+# The census is one aggregation, the documents are expanded into their field paths (see field_profiling.py) and a $facet
+# counts the documents of every resource type and the documents of every resource type that have each path. The fields in
+# all documents are the top level paths whose counts add up to every document, so they need no scan of their own
+#
+# The snapshot records the document count and the largest _id of the collection (the size and modification time of every
+# file for ndjson files). While they are the same the snapshot is used as it is, once they change the next exploration
+# call takes a new census. Without a snapshot the exploration functions query the collection like before
+#
+#----------------------------------------------------------------
+
+import json
+import os
+import time
+
+from fhir_kg_creation import get_mongo_collection
+from field_profiling import PROFILE_DEPTH, TRUNCATED, document_paths, path_expansion_stages
+from ndjson_source import NdjsonSource, open_ndjson
+
+
+#the snapshot file the exploration functions look for
+CENSUS_PATH = "schema_census.json"
+
+
+def take_census(collection=None, path=CENSUS_PATH, depth=PROFILE_DEPTH):
+    """
+    This fuction counts the resource types and the field paths of every resource type in one scan and saves the snapshot
+    Args:
+        collection (object): the mongoDB collection, the one in MONGO_SETTINGS when None, or an NdjsonSource
+        path (string): the snapshot file
+        depth (int): levels of nesting expanded in mongoDB, deeper fields are left out
+    Returns:
+        dict: the census, stamp, depth, documents and types (a list of {resource_type, documents, truncated, fields}, most
+            documents first)
+    """
+    collection = collection if collection is not None else get_mongo_collection()
+    #stamped before the scan, documents added while it runs make the snapshot stale instead of being missed
+    stamp = collection_stamp(collection)
+    if isinstance(collection, NdjsonSource):
+        types = census_ndjson(collection)
+    else:
+        types = census_mongo(collection, depth)
+    census = {
+        "stamp": stamp,
+        "taken": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "depth": depth,
+        "documents": sum(entry["documents"] for entry in types),
+        "types": types,
+    }
+    save_census(census, path)
+    return census
+
+def census_mongo(collection, depth=PROFILE_DEPTH):
+    """
+    This fuction runs the census aggregation, only the counts leave the server
+    Args:
+        collection (Collection): the mongoDB collection
+        depth (int): levels of nesting expanded
+    Returns:
+        list: {resource_type, documents, truncated, fields (path -> count)} of every resource type, most documents first
+    """
+    stages = path_expansion_stages(depth, keep={"type": "$resourceType"})
+    stages.append({"$facet": {
+        "types": [{"$group": {"_id": "$type", "documents": {"$sum": 1}, "truncated": {"$sum": TRUNCATED}}}],
+        "fields": [{"$unwind": "$paths"}, {"$group": {"_id": {"type": "$type", "path": "$paths"}, "count": {"$sum": 1}}}],
+    }})
+    result = next(collection.aggregate(stages, allowDiskUse=True))
+    types = {group["_id"]: {"resource_type": group["_id"], "documents": group["documents"], "truncated": group["truncated"], "fields": {}} for group in result["types"]}
+    for group in result["fields"]:
+        types[group["_id"].get("type")]["fields"][group["_id"]["path"]] = group["count"]
+    return sorted(types.values(), key=lambda entry: entry["documents"], reverse=True)
+
+def census_ndjson(source):
+    """
+    This fuction streams every line of the ndjson files once and counts the resource type and field paths of its document
+    The lines are parsed here and not by read_documents, the _id it adds to the documents is not a field of the files
+    Args:
+        source (NdjsonSource): the ndjson files
+    Returns:
+        list: {resource_type, documents, truncated, fields (path -> count)} of every resource type, most documents first
+    """
+    types = {}
+
+    def read_lines():
+        for path in source.files:
+            with open_ndjson(path) as file:
+                for line in file:
+                    if line.strip():
+                        yield json.loads(line)
+
+    for doc in read_lines():
+        resource_type = doc.get("resourceType")
+        entry = types.get(resource_type)
+        if entry is None:
+            entry = types[resource_type] = {"resource_type": resource_type, "documents": 0, "truncated": 0, "fields": {}}
+        entry["documents"] += 1
+        fields = entry["fields"]
+        for field_path in document_paths(doc):
+            fields[field_path] = fields.get(field_path, 0) + 1
+    return sorted(types.values(), key=lambda entry: entry["documents"], reverse=True)
+
+def collection_stamp(collection):
+    """
+    This fuction gives what the snapshot of a collection is checked against, cheap enough to check on every call
+    Args:
+        collection (object): the mongoDB collection or an NdjsonSource
+    Returns:
+        dict: the document count and largest _id of a collection, or the size and modification time of every ndjson file
+    """
+    if isinstance(collection, NdjsonSource):
+        return {"files": [[path, os.path.getsize(path), os.path.getmtime(path)] for path in collection.files]}
+    #the count from the collection metadata and the last entry of the _id index, neither one reads the documents
+    last = collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+    return {
+        "database": collection.database.name,
+        "collection": collection.name,
+        "documents": collection.estimated_document_count(),
+        "max_id": last["_id"] if last is not None else None,
+    }
+
+def save_census(census, path=CENSUS_PATH):
+    """
+    This fuction replaces the snapshot file in one step
+    Args:
+        census (dict): the census
+        path (string): the snapshot file
+    """
+    from bson import json_util
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        file.write(json_util.dumps(census, indent=1))
+    os.replace(temp_path, path)
+
+def load_census(path=CENSUS_PATH):
+    """
+    This fuction reads the snapshot file
+    Args:
+        path (string): the snapshot file
+    Returns:
+        dict: the census, or None when there is no snapshot
+    """
+    from bson import json_util
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as file:
+        return json_util.loads(file.read())
+
+def cached_census(collection=None, path=CENSUS_PATH):
+    """
+    This fuction returns the snapshot while the collection is unchanged and takes a new census once it changed
+    Args:
+        collection (object): the mongoDB collection, the one in MONGO_SETTINGS when None, or an NdjsonSource
+        path (string): the snapshot file
+    Returns:
+        dict: the census, or None when no census was ever taken, then the caller queries the collection itself
+    """
+    census = load_census(path)
+    if census is None:
+        return None
+    collection = collection if collection is not None else get_mongo_collection()
+    if census["stamp"] == collection_stamp(collection):
+        return census
+    print(f"The collection changed since the census in {path} was taken, taking a new one")
+    return take_census(collection, path, census["depth"])
+
+def fields_in_all_documents(census):
+    """
+    This fuction finds the top level fields that every document has, the paths without a dot are the top level fields
+    Args:
+        census (dict): the census
+    Returns:
+        list: {_id: field, count} like the $group of get_fields_in_all_documents
+    """
+    counts = {}
+    for entry in census["types"]:
+        for field_path, count in entry["fields"].items():
+            if "." not in field_path:
+                counts[field_path] = counts.get(field_path, 0) + count
+    return [{"_id": field, "count": count} for field, count in counts.items() if count == census["documents"]]
+
+def census_profile(census, resource_type):
+    """
+    This fuction gives the field profile of a resource type out of the census, the profile print_field_table prints
+    Args:
+        census (dict): the census
+        resource_type (string): a value each document has that turns into classes in the knowledge graph
+    Returns:
+        dict: the profile, no documents when the resource type is not in the census
+    """
+    for entry in census["types"]:
+        if entry["resource_type"] == resource_type:
+            return {"resource_type": resource_type, "documents": entry["documents"], "population": None, "truncated": entry["truncated"], "fields": dict(entry["fields"])}
+    return {"resource_type": resource_type, "documents": 0, "population": None, "truncated": 0, "fields": {}}
@@ -0,0 +1,69 @@
+#--------------------------------------------------------------
+#
+# The modules of the repo are flat python files in its root, the tests import them from there
+#
+#   python -m pytest -q
+#
+# The end to end tests convert a few synthetic patients (see benchmarks/synthetic_data.py) read through an NdjsonSource,
+# so they need neither mongoDB nor the MIMIC IV FHIR files
+#
+#----------------------------------------------------------------
+
+import json
+import os
+import shutil
+import sys
+
+import pytest
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+#patients of the synthetic documents the end to end tests convert
+SYNTHETIC_SCALE = 0.02
+SYNTHETIC_SEED = 3
+#specimens per encounter and observations per specimen kept, the rest is left out to keep the runs short
+SYNTHETIC_KEEP = 2
+
+
+@pytest.fixture(scope="session")
+def synthetic_ndjson(tmp_path_factory):
+    """
+    This fuction writes a small set of synthetic MIMIC IV FHIR documents to ndjson files, once per test session
+    Returns:
+        str: the folder of the ndjson files
+    """
+    from benchmarks.synthetic_data import NDJSON_FILES, generate_documents
+    directory = tmp_path_factory.mktemp("ndjson")
+    lines = {}
+    for doc in generate_documents(SYNTHETIC_SCALE, SYNTHETIC_SEED):
+        if doc["resourceType"] in ("Specimen", "Observation") and int(doc["id"].rsplit("-", 1)[1]) >= SYNTHETIC_KEEP:
+            continue
+        lines.setdefault(doc["resourceType"], []).append(json.dumps(doc) + "\n")
+    for resource_type, documents in lines.items():
+        with open(directory / NDJSON_FILES[resource_type], "w", encoding="utf-8") as file:
+            file.writelines(documents)
+    return str(directory)
+
+@pytest.fixture
+def convert(synthetic_ndjson, tmp_path, monkeypatch):
+    """
+    This fuction returns a function that runs create_ttl_script of a converter on the synthetic documents, every run in a
+    folder of its own
+    Returns:
+        function: takes the converter module and create_ttl_script arguments, returns the path of the output
+    """
+    from ndjson_source import NdjsonSource
+    runs = []
+
+    def run(module, **kwargs):
+        workdir = tmp_path / f"run{len(runs)}"
+        workdir.mkdir()
+        shutil.copy(os.path.join(REPO_DIR, "fhir_kg_script.ttl"), workdir)
+        shutil.copy(os.path.join(REPO_DIR, "flattened_kg_script.ttl"), workdir)
+        monkeypatch.chdir(workdir)
+        metrics = module.create_ttl_script(source=NdjsonSource(synthetic_ndjson, one_type_per_file=True), **kwargs)
+        runs.append(metrics)
+        return str(workdir / metrics.output_path)
+    return run
@@ -0,0 +1,69 @@
+#--------------------------------------------------------------
+#
+# Tests of escape_string, the escaping every literal of the turtle, N-Triples and N-Quads outputs goes through
+#
+#----------------------------------------------------------------
+
+import pytest
+
+from flattened_kg_creation import escape_turtle_string, sanatize_quotes, sanitize_for_kg_literal
+from kg_triples import PLAIN, XSD, Triple, escape_string, ntriples_lines, read_nquads, unescape
+
+
+def test_plain_text_is_returned_unchanged():
+    assert escape_string("Sodium Chloride 0.9%  Flush") == "Sodium Chloride 0.9%  Flush"
+    assert escape_string("") == ""
+
+def test_quotes_and_backslashes():
+    assert escape_string('say "hi"') == 'say \\"hi\\"'
+    assert escape_string("C:\\temp") == "C:\\\\temp"
+    #the backslash is escaped first so the one in front of a quote is not doubled
+    assert escape_string('\\"') == '\\\\\\"'
+
+def test_line_breaks_and_tabs():
+    assert escape_string("a\nb\r\nc\td") == "a\\nb\\r\\nc\\td"
+
+def test_other_control_characters():
+    assert escape_string("a\x01b") == "a\\u0001b"
+    assert escape_string("\x7f") == "\\u007F"
+    assert escape_string("\b\f") == "\\b\\f"
+
+def test_text_outside_ascii_is_left_alone():
+    assert escape_string("Ménière") == "Ménière"
+    #not printable for python but allowed in a turtle literal
+    assert escape_string("a\u2028b") == "a\u2028b"
+
+def test_values_that_are_not_strings():
+    assert escape_string(12.5) == "12.5"
+    assert escape_string(True) == "True"
+
+@pytest.mark.parametrize("text", ["", "plain", 'q"uote', "back\\slash", "line\nbreak\ttab\r", "\x00\x1f\x7f", 'mixed \\n "\n" é'])
+def test_unescape_reverses_escape_string(text):
+    assert unescape(escape_string(text)) == text
+
+def test_unknown_escape_is_rejected():
+    with pytest.raises(ValueError):
+        unescape("\\q")
+
+def test_old_helpers_keep_their_output():
+    #the helpers the converters used before escape_string, on text without control characters
+    text = 'dose "as directed" \\ daily'
+    assert escape_turtle_string(text) == text.replace("\\", "\\\\").replace('"', '\\"')
+    assert sanitize_for_kg_literal(text) == text.replace("\\", "\\\\").replace('"', '\\"')
+    assert sanatize_quotes('say "hi"') == 'say \\"hi\\"'
+
+def test_ntriples_round_trip():
+    triples = [
+        Triple("http://example.org/a", "http://hl7.org/fhir/text", 'two\nlines "quoted" \\ \x01', PLAIN),
+        Triple("http://example.org/a", "http://hl7.org/fhir/value", "7.5", XSD + "decimal"),
+    ]
+    assert read_nquads(ntriples_lines(triples)) == triples
+    assert read_nquads(ntriples_lines(triples, graph="http://example.org/graph")) == triples
+
+def test_escaped_literals_parse_in_rdflib():
+    rdflib = pytest.importorskip("rdflib")
+    text = 'all "the" \\ characters\n\r\t\x00\x7f é'
+    graph = rdflib.Graph()
+    graph.parse(data=f'<http://example.org/a> <http://example.org/p> "{escape_string(text)}" .\n', format="turtle")
+    (value,) = graph.objects()
+    assert str(value) == text
@@ -0,0 +1,46 @@
+#--------------------------------------------------------------
+#
+# Tests of generate_id, the uuid5 scheme has to give the ids uuid.uuid5 gave before so the graphs stay joinable
+#
+#----------------------------------------------------------------
+
+import uuid
+
+import pytest
+
+from flattened_kg_creation import ID_NAMESPACE, generate_id
+
+
+#the namespace of the ids of earlier graphs, written out so a change of ID_NAMESPACE is noticed too
+EARLIER_NAMESPACE = uuid.UUID("ee172322-118b-5716-abbc-18e4c5437e15")
+
+UNIQUE_STRINGS = ["locationEncounter0", "locationEncounter12345", "md dosage7e2c0f6a-55b3-5f1a-9b55-1a1a7ff9f9f2",
+                  "mr dosageNone", "", "Ménière ü 漢字", "a" * 1000]
+
+
+def test_namespace_is_the_one_of_earlier_graphs():
+    assert ID_NAMESPACE == EARLIER_NAMESPACE
+
+@pytest.mark.parametrize("unique_string", UNIQUE_STRINGS)
+def test_uuid5_ids_are_those_of_uuid5(unique_string):
+    assert generate_id(unique_string) == str(uuid.uuid5(EARLIER_NAMESPACE, unique_string))
+    assert generate_id(unique_string, "uuid5") == str(uuid.uuid5(EARLIER_NAMESPACE, unique_string))
+
+def test_repeated_strings_give_the_same_id():
+    generate_id.cache_clear()
+    first = generate_id("locationEncounter7")
+    assert generate_id("locationEncounter7") == first
+    assert generate_id.cache_info().hits == 1
+    assert generate_id("locationEncounter8") != first
+
+@pytest.mark.parametrize("unique_string", UNIQUE_STRINGS)
+def test_blake2b_ids_are_version_8_uuids(unique_string):
+    id = uuid.UUID(generate_id(unique_string, "blake2b"))
+    assert id.version == 8
+    assert id.variant == uuid.RFC_4122
+    assert str(id) == generate_id(unique_string, "blake2b")
+    assert str(id) != generate_id(unique_string)
+
+def test_unknown_scheme_is_rejected():
+    with pytest.raises(ValueError):
+        generate_id("locationEncounter0", "md5")
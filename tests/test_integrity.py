@@ -0,0 +1,143 @@
+#--------------------------------------------------------------
+#
+# Tests of the integrity check of the links to se: nodes, and of the BloomFilter it keeps the defined subjects in
+#
+#----------------------------------------------------------------
+
+import json
+import random
+
+import pytest
+
+import fhir_kg_creation
+import flattened_kg_creation
+from kg_integrity import INTEGRITY_EXTENSION, IntegrityCheck, check_integrity, node_hash
+from kg_sketches import BloomFilter
+from kg_triples import NODE, SKOLEM_BASE, Triple, TurtleParser, ntriples_lines
+
+
+SE = "http://example.org/myontology#"
+FHIR = "http://hl7.org/fhir/"
+
+TURTLE = """@prefix se: <http://example.org/myontology#> .
+@prefix fhir: <http://hl7.org/fhir/> .
+
+se:md1 a fhir:MedicationDispense ;
+    fhir:authorizingPrescription se:mr1 ;
+    fhir:subject se:p1 ;
+    fhir:dosage [ fhir:route se:route-missing ] .
+
+se:mr1 a fhir:MedicationRequest ;
+    fhir:subject se:p2 ;
+    <http://example.org/other#see> se:md1 .
+
+se:p1 a fhir:Patient .
+
+se:mr1 fhir:status "active" .
+"""
+
+
+def links_of(triples):
+    """
+    This fuction finds the dangling links of triples without hashing anything
+    Returns:
+        tuple: the se: subjects and the links to se: nodes that are not one of them
+    """
+    subjects = {triple.subject for triple in triples if triple.subject.startswith(SE)}
+    links = [triple for triple in triples if triple.datatype is NODE and triple.object.startswith(SE)]
+    return subjects, links, [triple for triple in links if triple.object not in subjects]
+
+@pytest.mark.parametrize("extension", [".ttl", ".nt"])
+def test_check_integrity(tmp_path, extension):
+    path = tmp_path / ("out" + extension)
+    if extension == ".ttl":
+        path.write_text(TURTLE, encoding="utf-8")
+    else:
+        path.write_text(ntriples_lines(TurtleParser(skolem=SKOLEM_BASE).parse(TURTLE)), encoding="utf-8")
+    report = check_integrity(str(path))
+    assert report == json.loads((tmp_path / ("out" + extension + INTEGRITY_EXTENSION)).read_text())
+    assert (report["subjects"], report["redefined"], report["links"], report["dangling"], report["estimated"]) == (4, 1, 5, 2, False)
+    assert report["predicates"] == {
+        "fhir:route": {"links": 1, "dangling": 1, "samples": ["se:route-missing"]},
+        "fhir:subject": {"links": 2, "dangling": 1, "samples": ["se:p2"]},
+        "<http://example.org/other#see>": {"links": 1, "dangling": 0, "samples": []},
+        "fhir:authorizingPrescription": {"links": 1, "dangling": 0, "samples": []},
+    }
+
+def test_statement_split_over_two_scans_is_one_subject():
+    check = IntegrityCheck()
+    triples = TurtleParser().parse(TURTLE)
+    for triple in triples:
+        check.scan([triple])
+    assert check.finish()["subjects"] == 4
+
+@pytest.mark.parametrize("spill", [1 << 20, 0])
+def test_links_that_wait_past_the_memory(spill):
+    generator = random.Random(1)
+    nodes = [f"node-{number}" for number in range(30000)]
+    #two thirds of the links point forward to nodes defined later, the rest dangle
+    triples = [Triple(SE + f"entity-{number}", FHIR + "subject", SE + node, NODE) for number, node in enumerate(nodes)]
+    triples += [Triple(SE + node, FHIR + "status", "final", "") for node in nodes if generator.random() < 2 / 3]
+    #the filter gets 24 bits per subject, the buffer of waiting links holds a sixth of them
+    check = IntegrityCheck(memory=200000, samples=3, spill=spill)
+    for start in range(0, len(triples), 1000):
+        check.scan(triples[start:start + 1000])
+    report = check.finish()
+    _, _, dangling = links_of(triples)
+    assert report["links"] == 30000
+    if spill:
+        assert check.spilled > 0
+        #a dangling link is missed only when the filter holds its hash by chance
+        missed = len(dangling) - report["dangling"]
+        assert 0 <= missed <= 3 * report["false_positive_rate"] * len(dangling) + 3
+        assert not report["estimated"]
+    else:
+        #the links that found the file full are only sampled, the dangling count is estimated from the sample
+        assert report["estimated"] and report["predicates"]["fhir:subject"]["estimated"]
+        assert abs(report["dangling"] - len(dangling)) < 0.05 * len(dangling)
+    assert set(report["predicates"]["fhir:subject"]["samples"]) <= {"se:" + triple.object[len(SE):] for triple in dangling}
+
+@pytest.mark.parametrize("module", [fhir_kg_creation, flattened_kg_creation])
+def test_report_of_a_run(convert, module):
+    output_path = convert(module, integrity=True)
+    with open(output_path, encoding="utf-8") as file:
+        text = file.read()
+    with open(output_path + INTEGRITY_EXTENSION, encoding="utf-8") as file:
+        report = json.load(file)
+    #the check does not change the output
+    with open(convert(module), encoding="utf-8") as file:
+        assert file.read() == text
+    subjects, links, dangling = links_of(TurtleParser().parse(text))
+    assert report["links"] == len(links)
+    assert report["dangling"] == len(dangling)
+    assert report["dangling"] > 0
+    for predicate, entry in report["predicates"].items():
+        targets = {triple.object for triple in dangling if "fhir:" + triple.predicate[len(FHIR):] == predicate}
+        assert entry["dangling"] == sum(1 for triple in dangling if "fhir:" + triple.predicate[len(FHIR):] == predicate)
+        assert {SE + sample[3:] for sample in entry["samples"]} <= targets
+    #checking the file that was written gives the same report
+    assert check_integrity(output_path) == report
+
+def test_bloom_filter_finds_every_hash_added():
+    generator = random.Random(2)
+    bloom = BloomFilter(size=10 * 20000, hashes=7)
+    added = [generator.getrandbits(64) for _ in range(20000)]
+    for hashed in added:
+        bloom.add(hashed)
+    assert all(bloom.contains(hashed) for hashed in added)
+    assert bloom.add(added[0])
+    false_positives = sum(bloom.contains(generator.getrandbits(64)) for _ in range(20000)) / 20000
+    #10 bits per hash, about 1% for a bloom filter of single bits and somewhat more for one of 64 bit words
+    assert false_positives < 0.04
+    assert abs(false_positives - bloom.false_positive_rate()) < 0.01
+
+def test_bloom_filter_merge():
+    first, second = BloomFilter(size=1 << 16), BloomFilter(size=1 << 16)
+    first.add(node_hash("a"))
+    second.add(node_hash("b"))
+    first.merge(second)
+    assert first.contains(node_hash("a")) and first.contains(node_hash("b"))
+    with pytest.raises(ValueError):
+        first.merge(BloomFilter(size=1 << 17))
+    with pytest.raises(ValueError):
+        BloomFilter(hashes=11)
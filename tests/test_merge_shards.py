@@ -0,0 +1,97 @@
+#--------------------------------------------------------------
+#
+# Tests of merge_shards, the shards of a parallel run are joined behind the header in the order of the passes
+#
+#----------------------------------------------------------------
+
+import gzip
+import os
+
+import pytest
+
+from fhir_kg_creation import append_shard, merge_shards
+from kg_compression import compress_text
+
+
+HEADER = "@prefix se: <http://example.org/myontology#> .\n"
+
+SHARDS = ["\nse:o1 a fhir:Organization .\n", "", "\nse:p1 a fhir:Patient ;\n    fhir:name \"Ménière\" .\n", "se:x fhir:v \"1\" .\n" * 200000]
+
+
+def write_shards(directory, shards, compression=None):
+    paths = []
+    for index, text in enumerate(shards):
+        path = os.path.join(directory, f"{index:02d}_000_shard.ttl")
+        with open(path, "wb") as file:
+            file.write(compress_text(text, compression))
+        paths.append(path)
+    return paths
+
+def test_merge_shards(tmp_path):
+    output_path = str(tmp_path / "out.ttl")
+    merge_shards(output_path, HEADER, write_shards(tmp_path, SHARDS))
+    with open(output_path, encoding="utf-8") as file:
+        assert file.read() == HEADER + "".join(SHARDS)
+
+def test_merge_shards_keeps_the_given_order(tmp_path):
+    output_path = str(tmp_path / "out.ttl")
+    merge_shards(output_path, HEADER, list(reversed(write_shards(tmp_path, SHARDS[:3]))))
+    with open(output_path, encoding="utf-8") as file:
+        assert file.read() == HEADER + "".join(reversed(SHARDS[:3]))
+
+def test_merge_compressed_shards(tmp_path):
+    output_path = str(tmp_path / "out.ttl.gz")
+    merge_shards(output_path, HEADER, write_shards(tmp_path, SHARDS, "gzip"))
+    #the header and every shard are gzip members of their own, read as one stream
+    with gzip.open(output_path, "rt", encoding="utf-8") as file:
+        assert file.read() == HEADER + "".join(SHARDS)
+
+@pytest.mark.parametrize("compression", [None, "gzip"])
+def test_merge_shards_inserts_text_where_the_shards_were_cut(tmp_path, compression):
+    output_path = str(tmp_path / ("out.ttl.gz" if compression else "out.ttl"))
+    first, second = "se:a fhir:v se:c1 .\n", "se:b fhir:v se:c1 .\n"
+    #a compressed shard is cut between two members
+    cut = len(compress_text(first, compression))
+    path = str(tmp_path / "00_000_shard.ttl")
+    with open(path, "wb") as file:
+        file.write(compress_text(first, compression) + compress_text(second, compression))
+    merge_shards(output_path, HEADER, [path, path], [[(cut, "se:c1 a fhir:Coding .\n")], [(0, "se:c2 a fhir:Coding .\n")]])
+    with (gzip.open(output_path) if compression else open(output_path, "rb")) as file:
+        text = file.read().decode("utf-8")
+    assert text == HEADER + first + "se:c1 a fhir:Coding .\n" + second + "se:c2 a fhir:Coding .\n" + first + second
+
+def copy_behaviour(kind, real_sendfile):
+    """
+    This fuction makes a stand in for os.copy_file_range or os.sendfile
+    Args:
+        kind (string): "work" copies like the kernel, "fail" raises, "partly" copies the first 1000 bytes and then raises,
+            "nothing" copies nothing
+        real_sendfile (function): os.sendfile, the copies are made with it
+    Returns:
+        function: copy(source, target, offset, count) -> bytes copied
+    """
+    def copy(source, target, offset, count):
+        if kind == "fail" or kind == "partly" and offset > 0:
+            raise OSError("not supported")
+        if kind == "nothing":
+            return 0
+        return real_sendfile(target, source, offset, min(count, 1000) if kind == "partly" else count)
+    return copy
+
+@pytest.mark.parametrize("copy_file_range,sendfile", [("fail", "work"), ("fail", "fail"), ("partly", "fail"), ("partly", "nothing"), ("nothing", "partly")])
+def test_append_shard_falls_back(tmp_path, monkeypatch, copy_file_range, sendfile):
+    copy = copy_behaviour(copy_file_range, os.sendfile)
+    send = copy_behaviour(sendfile, os.sendfile)
+    monkeypatch.setattr(os, "copy_file_range", lambda source, target, count, offset: copy(source, target, offset, count), raising=False)
+    monkeypatch.setattr(os, "sendfile", lambda target, source, offset, count: send(source, target, offset, count))
+    shard_path, = write_shards(tmp_path, SHARDS[3:])
+    with open(tmp_path / "out.ttl", "wb") as output:
+        output.write(HEADER.encode("utf-8"))
+        append_shard(shard_path, output)
+    assert (tmp_path / "out.ttl").read_text(encoding="utf-8") == HEADER + SHARDS[3]
+
+def test_append_part_of_a_shard(tmp_path):
+    shard_path, = write_shards(tmp_path, SHARDS[3:])
+    with open(tmp_path / "out.ttl", "wb") as output:
+        append_shard(shard_path, output, 18, 36)
+    assert (tmp_path / "out.ttl").read_text(encoding="utf-8") == SHARDS[3][18:36]
@@ -0,0 +1,206 @@
+#--------------------------------------------------------------
+#
+# Tests of NdjsonSource, the mongoDB style queries the converters make have to find the same documents mongoDB finds
+#
+#----------------------------------------------------------------
+
+import gzip
+import json
+
+import pytest
+
+from ndjson_source import NdjsonSource, matches, prepare_query
+
+
+DOCUMENTS = [
+    {"resourceType": "Patient", "id": "p1", "gender": "female", "birthDate": "1950-02-01"},
+    {"resourceType": "Patient", "id": "p2", "gender": "male", "birthDate": "1981-11-30"},
+    {"resourceType": "Encounter", "id": "e1", "subject": {"reference": "Patient/p1"}, "length": 3,
+     "location": [{"location": {"reference": "Location/l1"}}, {"location": {"reference": "Location/l2"}}]},
+    {"resourceType": "Encounter", "id": "e2", "subject": {"reference": "Patient/p2"}, "length": 12,
+     "serviceType": {"coding": [{"code": "MED"}]}},
+    {"resourceType": "Observation", "id": "o1", "subject": {"reference": "Patient/p1"}, "valueQuantity": {"value": 7.5},
+     "code": {"coding": [{"system": "http://loinc.org", "code": "2345-7"}]}},
+    {"resourceType": "Observation", "id": "o2", "subject": {"reference": "Patient/p2"}, "valueQuantity": {"value": None},
+     "code": {"coding": [{"system": "http://loinc.org", "code": "718-7"}]}},
+]
+
+QUERIES = [
+    {"resourceType": "Patient"},
+    {"resourceType": "Encounter", "length": {"$gt": 3}},
+    {"length": {"$gte": 3, "$lt": 12}},
+    {"valueQuantity.value": {"$gt": 5}},
+    {"valueQuantity.value": {"$lte": 100}},
+    {"id": {"$in": ["p2", "e1", "missing"]}},
+    {"id": {"$nin": ["p2", "e1"]}},
+    {"gender": {"$ne": "male"}},
+    {"serviceType": {"$exists": True}},
+    {"serviceType": {"$exists": False}, "resourceType": "Encounter"},
+    {"$or": [{"gender": "male"}, {"length": {"$gt": 10}}]},
+    {"$or": [{"id": {"$in": ["o1"]}}, {"birthDate": {"$lt": "1960-01-01"}}]},
+    {"$and": [{"resourceType": "Encounter"}, {"$or": [{"id": "e1"}, {"id": "p1"}]}]},
+    {"location.location.reference": {"$in": ["Location/l2"]}},
+    {"code.coding.0.code": "718-7"},
+    {"subject.reference": "Patient/p1", "resourceType": {"$in": ["Encounter", "Observation"]}},
+]
+
+
+def ids(documents):
+    return [doc["id"] for doc in documents]
+
+@pytest.fixture
+def source(tmp_path):
+    #the patients in a gzip file, the rest in plain ndjson with an empty line
+    with gzip.open(tmp_path / "Patient.ndjson.gz", "wt", encoding="utf-8") as file:
+        file.writelines(json.dumps(doc) + "\n" for doc in DOCUMENTS[:2])
+    with open(tmp_path / "Resources.ndjson", "w", encoding="utf-8") as file:
+        file.writelines(json.dumps(doc) + "\n" for doc in DOCUMENTS[2:4])
+        file.write("\n")
+        file.writelines(json.dumps(doc) + "\n" for doc in DOCUMENTS[4:])
+    (tmp_path / "notes.txt").write_text("not read")
+    return NdjsonSource(str(tmp_path))
+
+def test_files_of_a_directory(source):
+    assert [path.rsplit("/", 1)[1] for path in source.files] == ["Patient.ndjson.gz", "Resources.ndjson"]
+    assert ids(source.find()) == [doc["id"] for doc in DOCUMENTS]
+
+def test_or(source):
+    assert ids(source.find({"$or": [{"gender": "male"}, {"length": {"$gt": 10}}]})) == ["p2", "e2"]
+    assert ids(source.find({"$or": [{"id": "missing"}]})) == []
+
+def test_in(source):
+    assert ids(source.find({"id": {"$in": ["p2", "e1", "missing"]}})) == ["p2", "e1"]
+    #a path through a list of objects matches when any of its values is in the list
+    assert ids(source.find({"location.location.reference": {"$in": ["Location/l2"]}})) == ["e1"]
+    assert ids(source.find({"id": {"$in": []}})) == []
+
+def test_gt(source):
+    assert ids(source.find({"length": {"$gt": 3}})) == ["e2"]
+    #missing fields and nulls never compare
+    assert ids(source.find({"valueQuantity.value": {"$gt": 0}})) == ["o1"]
+    assert ids(source.find({"birthDate": {"$gt": "1960-01-01"}})) == ["p2"]
+
+def test_unsupported_operator(source):
+    with pytest.raises(NotImplementedError):
+        list(source.find({"id": {"$regex": "^p"}}))
+
+def test_in_lists_become_sets():
+    prepared = prepare_query({"id": {"$in": ["a", "b"]}, "$or": [{"code": {"$nin": ["c"]}}]})
+    assert prepared["id"]["$in"] == frozenset(["a", "b"])
+    assert prepared["$or"][0]["code"]["$nin"] == frozenset(["c"])
+    #a list of dicts can not be a set and is compared item by item
+    assert matches({"code": {"a": 1}}, prepare_query({"code": {"$in": [{"a": 1}]}}))
+
+def test_aggregate(source):
+    pipeline = [{"$match": {"resourceType": "Encounter"}}, {"$project": {"id": 1, "length": 1, "_id": 0}},
+                {"$sort": {"length": -1}}, {"$limit": 1}]
+    assert list(source.aggregate(pipeline)) == [{"id": "e2", "length": 12}]
+    with pytest.raises(NotImplementedError):
+        list(source.aggregate([{"$group": {"_id": "$id"}}]))
+
+def test_find_one_and_count(source):
+    assert source.find_one({"resourceType": "Observation"})["id"] == "o1"
+    assert source.find_one({"resourceType": "Medication"}) is None
+    assert source.count_documents({"resourceType": "Encounter"}) == 2
+
+def test_ids_follow_file_and_line(source):
+    assert [doc["_id"] for doc in source.find({"resourceType": "Observation"})] == [(1 << 32) | 3, (1 << 32) | 4]
+    assert [doc["_id"] for doc in source.find({"resourceType": {"$in": ["Observation"]}})] == [(1 << 32) | 3, (1 << 32) | 4]
+
+def test_one_type_per_file(tmp_path):
+    for resource_type in ("Patient", "Encounter"):
+        with open(tmp_path / f"{resource_type}.ndjson", "w", encoding="utf-8") as file:
+            file.writelines(json.dumps(doc) + "\n" for doc in DOCUMENTS if doc["resourceType"] == resource_type)
+    source = NdjsonSource(str(tmp_path), one_type_per_file=True)
+    assert ids(source.find({"resourceType": "Patient"})) == ["p1", "p2"]
+    assert source.file_resource_types == {str(tmp_path / "Encounter.ndjson"): {"Encounter"}, str(tmp_path / "Patient.ndjson"): {"Patient"}}
+    assert ids(source.find({"resourceType": "Encounter"})) == ["e1", "e2"]
+
+def test_fingerprint_notices_changed_files(source, tmp_path):
+    fingerprint = source.fingerprint()
+    assert fingerprint == NdjsonSource(str(tmp_path)).fingerprint()
+    with open(tmp_path / "Resources.ndjson", "a", encoding="utf-8") as file:
+        file.write(json.dumps({"resourceType": "Patient", "id": "p3"}) + "\n")
+    assert source.fingerprint() != fingerprint
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_same_documents_as_mongodb(source, query):
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().db.collection
+    collection.insert_many([dict(doc) for doc in DOCUMENTS])
+    assert ids(source.find(query)) == ids(collection.find(query))
+
+#documents whose paths go through lists, where a filter looks into every item like in mongoDB
+ARRAY_DOCUMENTS = [
+    {"resourceType": "Patient", "id": "a1", "identifier": [{"system": "mrn", "value": "123"}, {"value": "456"}],
+     "extension": [{"url": "race"}], "tags": [1, 2], "score": "high"},
+    {"resourceType": "Patient", "id": "a2", "identifier": [{"value": "789"}], "tags": 3, "score": 5},
+    {"resourceType": "Patient", "id": "a3", "tags": [[2]], "score": None},
+    {"resourceType": "Patient", "id": "a4", "score": True},
+]
+
+ARRAY_QUERIES = [
+    {"identifier.value": "123"},
+    {"identifier.value": {"$ne": "123"}},
+    {"identifier.value": {"$nin": ["123", "789"]}},
+    {"identifier.system": {"$exists": True}},
+    {"extension.url": {"$exists": True}},
+    {"extension.url": {"$exists": False}},
+    {"tags": 2},
+    {"tags": [2]},
+    {"tags": [1, 2]},
+    {"tags": {"$in": [2]}},
+    {"tags": {"$nin": [2]}},
+    {"tags": {"$ne": 2}},
+    {"tags": {"$gt": 1}},
+    {"score": {"$gt": 3}},
+    {"score": {"$gte": "a"}},
+    {"score": {"$gte": 1}},
+    {"score": None},
+    {"missing": None},
+    {"identifier.system": None},
+    {"identifier.value": {"$ne": None}},
+    {"identifier.system": {"$in": [None]}},
+    {"missing": {"$in": [None, "x"]}},
+    {"identifier.value": {"$in": ["456"]}, "extension.url": "race"},
+]
+
+@pytest.fixture
+def array_source(tmp_path):
+    with open(tmp_path / "Patient.ndjson", "w", encoding="utf-8") as file:
+        file.writelines(json.dumps(doc) + "\n" for doc in ARRAY_DOCUMENTS)
+    return NdjsonSource(str(tmp_path))
+
+def test_equality_through_lists(array_source):
+    assert ids(array_source.find({"identifier.value": "123"})) == ["a1"]
+    assert ids(array_source.find({"identifier.value": {"$ne": "123"}})) == ["a2", "a3", "a4"]
+    #a list of scalars matches when one of its items does
+    assert ids(array_source.find({"tags": 2})) == ["a1"]
+    assert ids(array_source.find({"tags": {"$in": [2]}})) == ["a1"]
+
+def test_exists_through_lists(array_source):
+    assert ids(array_source.find({"extension.url": {"$exists": True}})) == ["a1"]
+    assert ids(array_source.find({"extension.url": {"$exists": False}})) == ["a2", "a3", "a4"]
+
+def test_nin_through_lists(array_source):
+    assert ids(array_source.find({"identifier.value": {"$nin": ["456"]}})) == ["a2", "a3", "a4"]
+    assert ids(array_source.find({"tags": {"$nin": [2]}})) == ["a2", "a3", "a4"]
+
+def test_comparisons_of_other_types_are_false(array_source):
+    assert ids(array_source.find({"score": {"$gt": 3}})) == ["a2"]
+    assert ids(array_source.find({"score": {"$lt": "z"}})) == ["a1"]
+    #true is no number
+    assert ids(array_source.find({"score": {"$gte": 0}})) == ["a2"]
+
+def test_null_matches_missing_paths(array_source):
+    assert ids(array_source.find({"score": None})) == ["a3"]
+    #and so does an object of a list without it
+    assert ids(array_source.find({"identifier.system": None})) == ["a1", "a2", "a3", "a4"]
+    assert ids(array_source.find({"identifier.system": {"$ne": None}})) == []
+
+@pytest.mark.parametrize("query", ARRAY_QUERIES)
+def test_same_documents_as_mongodb_through_lists(array_source, query):
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().db.collection
+    collection.insert_many([dict(doc) for doc in ARRAY_DOCUMENTS])
+    assert ids(array_source.find(query)) == ids(collection.find(query))
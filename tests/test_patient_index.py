@@ -0,0 +1,178 @@
+#--------------------------------------------------------------
+#
+# Tests of the patient index, the lookup of a patient in the index file and the fragments extract_patient cuts out
+#
+#----------------------------------------------------------------
+
+import mmap
+import re
+
+import pytest
+
+import fhir_kg_creation
+import flattened_kg_creation
+from kg_patient_index import PATIENT_INDEX_EXTENSION, PatientIndex, extract_patient, find_entry, find_patient_ranges, subject_patient
+from kg_triples import NODE, TurtleParser
+
+
+HEADER = "@prefix se: <http://example.org/myontology#> .\n@prefix fhir: <http://hl7.org/fhir/> .\n\n"
+SE = "http://example.org/myontology#"
+
+
+def write_output(path, entities):
+    """
+    This fuction writes an output and its index the way a TtlWriter does
+    Args:
+        path (string): the output file
+        entities (list): (text, patient, node, linked nodes) of every entity in the order they are written
+    """
+    index = PatientIndex(str(path) + PATIENT_INDEX_EXTENSION)
+    index.header(HEADER)
+    index.advance(HEADER)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(HEADER)
+        for text, patient, node, links in entities:
+            file.write(text)
+            index.advance(text, patient, node)
+            index.link(patient, links)
+    index.save()
+
+def lookup(path, key):
+    with open(str(path) + PATIENT_INDEX_EXTENSION, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as index:
+        return find_patient_ranges(index, key), find_entry(index, key)
+
+@pytest.fixture
+def output(tmp_path):
+    path = tmp_path / "out.ttl"
+    write_output(path, [
+        ("se:p1 a fhir:Patient .\n", "p1", None, None),
+        ("se:e1 fhir:subject se:p1 ; fhir:codeCoding se:concept_a .\n", "p1", None, ["concept_a"]),
+        ("se:concept_a fhir:code \"a\" .\n", None, "concept_a", None),
+        ("se:p10 a fhir:Patient .\n", "p10", None, None),
+        ("se:org a fhir:Organization .\n", None, None, None),
+        ("se:e2 fhir:subject se:p1 ; fhir:codeCoding se:concept_b .\n", "p1", None, ["concept_b"]),
+        ("se:concept_b fhir:code \"b\" .\n", None, "concept_b", None),
+        ("se:e3 fhir:subject se:p10 ; fhir:codeCoding se:concept_a, se:concept_b .\n", "p10", None, ["concept_b", "concept_a"]),
+        ("se:p2 a fhir:Patient ; fhir:name \"Ménière\" .\n", "p2", None, None),
+    ])
+    return path
+
+def test_index_lines_are_sorted(output):
+    with open(str(output) + PATIENT_INDEX_EXTENSION, "rb") as file:
+        lines = file.read().split(b"\n")[:-1]
+    assert lines[0] == f"\t{len(HEADER)}".encode("utf-8")
+    assert lines[1:] == sorted(lines[1:])
+    assert [line.split(b"\t")[0] for line in lines[1:]] == [b"p1", b"p10", b"p2", b"se:concept_a", b"se:concept_b"]
+
+def test_find_patient_ranges(output):
+    text = output.read_bytes()
+    ranges, (entry_ranges, nodes) = lookup(output, "p1")
+    assert ranges == entry_ranges
+    #the two entities that follow each other are one range
+    assert [text[start:end] for start, end in ranges] == [
+        b"se:p1 a fhir:Patient .\nse:e1 fhir:subject se:p1 ; fhir:codeCoding se:concept_a .\n",
+        b"se:e2 fhir:subject se:p1 ; fhir:codeCoding se:concept_b .\n",
+    ]
+    assert nodes == ["concept_a", "concept_b"]
+    #ranges count bytes, not characters
+    ranges, _ = lookup(output, "p2")
+    assert [text[start:end].decode("utf-8") for start, end in ranges] == ["se:p2 a fhir:Patient ; fhir:name \"Ménière\" .\n"]
+
+def test_find_patient_ranges_of_unknown_patients(output):
+    #before the first, between and after the last key, and a prefix of a key
+    for patient in ("", "a", "p", "p0", "p11", "p3", "zz"):
+        assert lookup(output, patient) == ([], ([], []))
+
+def test_find_shared_node(output):
+    text = output.read_bytes()
+    _, (ranges, nodes) = lookup(output, "se:concept_b")
+    assert [text[start:end] for start, end in ranges] == [b"se:concept_b fhir:code \"b\" .\n"]
+    assert nodes == []
+
+def test_extract_patient_adds_the_shared_nodes(output):
+    fragment = extract_patient("p10", str(output))
+    assert fragment == HEADER.rstrip("\n") + "\n\n" + (
+        "se:p10 a fhir:Patient .\n"
+        "se:e3 fhir:subject se:p10 ; fhir:codeCoding se:concept_a, se:concept_b .\n"
+        "se:concept_a fhir:code \"a\" .\n"
+        "se:concept_b fhir:code \"b\" .\n")
+
+def test_extract_unknown_patient(output):
+    assert extract_patient("p3", str(output)) == HEADER.rstrip("\n") + "\n\n"
+
+def test_merge_shards(tmp_path):
+    first = PatientIndex()
+    first.advance("aa", "p1")
+    first.advance("bb", None, "concept_a")
+    first.link("p1", ["concept_a"])
+    second = PatientIndex()
+    second.advance("cc", "p1")
+    second.advance("dd", "p2")
+    second.advance("ee", None, "concept_a")
+    second.link("p2", ["concept_a"])
+    index = PatientIndex(str(tmp_path / "out.ttl.patients"))
+    index.merge(first, 10)
+    index.merge(second, 14)
+    assert index.ranges == {"p1": [10, 12, 14, 16], "p2": [16, 18]}
+    #the statement of a shared node written by both shards is taken from the first
+    assert index.definitions == {"concept_a": (12, 14)}
+    assert index.links == {"p1": {"concept_a"}, "p2": {"concept_a"}}
+    #a shard that goes on where the last one stopped joins the ranges
+    third = PatientIndex()
+    third.advance("ff", "p2")
+    index.merge(third, 18)
+    assert index.ranges["p2"] == [16, 20]
+
+def test_merge_shards_with_insertions(tmp_path):
+    shard = PatientIndex()
+    shard.advance("aa", "p1")
+    shard.advance("bb", "p1")
+    shard.advance("cc", "p2")
+    shard.link("p1", ["concept_a"])
+    index = PatientIndex(str(tmp_path / "out.ttl.patients"))
+    #statements of shared nodes are put in behind the first and the last entity
+    index.merge(shard, 10, [(2, 5), (6, 3)])
+    assert index.ranges == {"p1": [10, 12, 17, 19], "p2": [19, 21]}
+    assert index.links == {"p1": {"concept_a"}}
+
+@pytest.mark.parametrize("module,kwargs", [
+    (fhir_kg_creation, {"concepts": True}),
+    (flattened_kg_creation, {"concepts": True, "shared_dosages": True}),
+])
+def test_parallel_index_is_the_serial_index(convert, module, kwargs):
+    serial = convert(module, patient_index=True, **kwargs)
+    parallel = convert(module, patient_index=True, workers=3, **kwargs)
+    with open(serial + PATIENT_INDEX_EXTENSION, "rb") as serial_index, open(parallel + PATIENT_INDEX_EXTENSION, "rb") as parallel_index:
+        assert parallel_index.read() == serial_index.read()
+
+def test_subject_patient():
+    assert subject_patient({"subject": {"reference": "Patient/p1"}}) == "p1"
+    assert subject_patient({"subject": {"reference": "Group/g1"}}) is None
+    assert subject_patient({"subject": {}}) is None
+    assert subject_patient({"id": "org"}) is None
+
+@pytest.mark.parametrize("module,kwargs", [
+    (fhir_kg_creation, {"concepts": True}),
+    (flattened_kg_creation, {"concepts": True, "shared_dosages": True}),
+    (flattened_kg_creation, {"concepts": True, "shared_dosages": True, "workers": 2}),
+])
+def test_patient_fragments_of_a_run(convert, module, kwargs):
+    output_path = convert(module, patient_index=True, **kwargs)
+    with open(output_path, encoding="utf-8") as file:
+        text = file.read()
+    patients = re.findall(r"^se:(\S+) a fhir:Patient", text, re.MULTILINE)
+    assert len(patients) == 2
+    for patient in patients:
+        fragment = extract_patient(patient, output_path)
+        #every mention of the patient is in its fragment and none of the other patient
+        mention = re.compile(rf"se:{re.escape(patient)}\b")
+        assert len(mention.findall(fragment)) == len(mention.findall(text))
+        for other in patients:
+            if other != patient:
+                assert not re.search(rf"se:{re.escape(other)}\b", fragment)
+        #the fragment defines every concept and shared dosage it links to
+        triples = TurtleParser().parse(fragment)
+        subjects = {triple.subject for triple in triples}
+        linked = {triple.object for triple in triples if triple.datatype is NODE and re.match(SE + "(concept_|dosage-)", triple.object)}
+        assert linked
+        assert linked <= subjects
@@ -0,0 +1,88 @@
+#--------------------------------------------------------------
+#
+# Tests of the fixed memory summaries of kg_sketches.py
+#
+#----------------------------------------------------------------
+
+import random
+from collections import Counter
+
+import pytest
+
+from kg_sketches import HyperLogLog, SpaceSaving
+
+
+@pytest.mark.parametrize("distinct", [0, 1, 100, 5000, 200000])
+def test_hyperloglog_count(distinct):
+    sketch = HyperLogLog()
+    for number in range(distinct):
+        sketch.add(f"value {number}")
+    #three standard errors
+    assert abs(sketch.count() - distinct) <= 3 * sketch.error() * distinct + 1
+
+def test_hyperloglog_ignores_repeated_values():
+    sketch = HyperLogLog(10)
+    for _ in range(50):
+        for number in range(300):
+            sketch.add(number)
+    once = HyperLogLog(10)
+    for number in range(300):
+        once.add(number)
+    assert sketch.registers == once.registers
+
+def test_hyperloglog_tells_values_apart_by_repr():
+    sketch = HyperLogLog()
+    sketch.add(1)
+    sketch.add("1")
+    sketch.add(1.0)
+    assert sketch.count() == 3
+
+def test_hyperloglog_merge_is_the_union():
+    first, second, both = HyperLogLog(12), HyperLogLog(12), HyperLogLog(12)
+    for number in range(0, 30000):
+        first.add(number)
+        both.add(number)
+    for number in range(20000, 50000):
+        second.add(number)
+        both.add(number)
+    first.merge(second)
+    assert first.registers == both.registers
+    with pytest.raises(ValueError):
+        first.merge(HyperLogLog(13))
+
+@pytest.mark.parametrize("precision", [3, 19])
+def test_hyperloglog_precision_is_checked(precision):
+    with pytest.raises(ValueError):
+        HyperLogLog(precision)
+
+def test_space_saving_is_exact_below_its_capacity():
+    values = ["a"] * 5 + ["b"] * 3 + ["c"]
+    sketch = SpaceSaving(3)
+    for value in values:
+        sketch.add(value)
+    assert sketch.top() == [("a", 5, 0), ("b", 3, 0), ("c", 1, 0)]
+    assert sketch.top(1) == [("a", 5, 0)]
+
+def test_space_saving_keeps_the_frequent_values():
+    generator = random.Random(0)
+    #a skewed stream, every frequent value is more than 1 / capacity of it
+    values = [f"frequent {generator.randrange(10)}" for _ in range(20000)] + [f"rare {generator.randrange(5000)}" for _ in range(20000)]
+    generator.shuffle(values)
+    counts = Counter(values)
+    sketch = SpaceSaving(100)
+    for value in values:
+        sketch.add(value)
+    assert len(sketch.counters) == 100
+    top = sketch.top(10)
+    assert {value for value, _, _ in top} == {f"frequent {number}" for number in range(10)}
+    for value, count, error in top:
+        assert count - error <= counts[value] <= count
+
+def test_space_saving_merge():
+    first, second = SpaceSaving(50), SpaceSaving(50)
+    for number in range(1000):
+        first.add(f"value {number % 7}")
+        second.add(f"value {number % 5}")
+    first.merge(second)
+    counts = Counter([f"value {number % 7}" for number in range(1000)] + [f"value {number % 5}" for number in range(1000)])
+    assert {value: count for value, count, _ in first.top(12)} == counts
@@ -0,0 +1,90 @@
+#--------------------------------------------------------------
+#
+# Tests of the compiled templates, the text they render and the compact mode
+#
+#----------------------------------------------------------------
+
+import pytest
+
+import fhir_kg_creation
+import flattened_kg_creation
+from kg_templates import Each, Section, Template
+from kg_triples import TurtleParser
+
+
+DOCUMENT = {
+    "id": "o1",
+    "status": "final",
+    "subject": {"reference": "Patient/p1"},
+    "code": {"coding": [{"system": "http://loinc.org", "code": "2345-7"}, {"system": "http://snomed.info/sct", "code": "1"}]},
+    "valueQuantity": {"value": 7.5, "unit": "mg/dL"},
+    "note": 'said "ok"',
+}
+
+FILTERS = {"ref": lambda reference: reference.rpartition("/")[2], "literal": lambda text: text.replace('"', '\\"')}
+
+PREFIXES = "@prefix se: <http://example.org/myontology#> .\n@prefix fhir: <http://hl7.org/fhir/> .\n"
+
+
+def observation(compact=False):
+    coding = Template("""
+            fhir:codeCoding [ fhir:system "{system}" ;   fhir:code "{code}" ] ;""", compact=compact)
+    quantity = Template("""
+            fhir:valueQuantity [ fhir:value "{value}" ;
+                                 fhir:unit "{unit}" ] ;""", compact=compact)
+    return Template("""se:{id} a fhir:Observation ;
+            fhir:status "{status}" ;{coding}{quantity}
+            {interpretation}
+            fhir:note "{note|literal}" ;
+            fhir:subject se:{subject.reference|ref}  .
+
+""", fields={"coding": Each("code.coding", coding), "quantity": Section("valueQuantity", quantity),
+             "interpretation": lambda document: ""}, filters=FILTERS, compact=compact)
+
+def test_render():
+    assert observation().render(DOCUMENT) == """se:o1 a fhir:Observation ;
+            fhir:status "final" ;
+            fhir:codeCoding [ fhir:system "http://loinc.org" ;   fhir:code "2345-7" ] ;
+            fhir:codeCoding [ fhir:system "http://snomed.info/sct" ;   fhir:code "1" ] ;
+            fhir:valueQuantity [ fhir:value "7.5" ;
+                                 fhir:unit "mg/dL" ] ;
+            
+            fhir:note "said \\"ok\\"" ;
+            fhir:subject se:p1  .
+
+"""
+
+def test_sections_of_missing_parts_are_empty():
+    document = {key: value for key, value in DOCUMENT.items() if key not in ("code", "valueQuantity")}
+    assert observation().render(document).startswith('se:o1 a fhir:Observation ;\n            fhir:status "final" ;\n            \n')
+    assert observation().render(dict(document, code={"coding": []})) == observation().render(document)
+
+def test_compact_drops_the_cosmetic_whitespace():
+    assert observation(compact=True).render(DOCUMENT) == """se:o1 a fhir:Observation ;
+fhir:status "final" ;
+fhir:codeCoding [ fhir:system "http://loinc.org" ; fhir:code "2345-7" ] ;
+fhir:codeCoding [ fhir:system "http://snomed.info/sct" ; fhir:code "1" ] ;
+fhir:valueQuantity [ fhir:value "7.5" ;
+fhir:unit "mg/dL" ] ;
+fhir:note "said \\"ok\\"" ;
+fhir:subject se:p1 .
+"""
+
+def test_compact_keeps_the_spaces_in_literals():
+    template = Template('se:{id} fhir:text "two  spaces\tand a tab" ;\n    fhir:value "{value}"  .\n', compact=True)
+    assert template.render({"id": "a", "value": "x  y"}) == 'se:a fhir:text "two  spaces\tand a tab" ;\nfhir:value "x  y" .\n'
+
+@pytest.mark.parametrize("document", [DOCUMENT, {key: value for key, value in DOCUMENT.items() if key != "code"}])
+def test_compact_has_the_same_triples(document):
+    full = TurtleParser().parse(PREFIXES + observation().render(document))
+    compact = TurtleParser().parse(PREFIXES + observation(compact=True).render(document))
+    assert compact == full
+
+@pytest.mark.parametrize("module", [fhir_kg_creation, flattened_kg_creation])
+def test_compact_run_has_the_same_triples(convert, module):
+    with open(convert(module), encoding="utf-8") as file:
+        full = file.read()
+    with open(convert(module, compact=True), encoding="utf-8") as file:
+        compact = file.read()
+    assert len(compact) < len(full)
+    assert TurtleParser().parse(compact) == TurtleParser().parse(full)
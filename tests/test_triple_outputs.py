@@ -0,0 +1,62 @@
+#--------------------------------------------------------------
+#
+# Tests of the N-Triples and N-Quads outputs, they hold the triples of the turtle output of the same run
+#
+#----------------------------------------------------------------
+
+import pytest
+
+import fhir_kg_creation
+import flattened_kg_creation
+from kg_triples import FHIR, GRAPH_BASE, NQUADS_LINE, ONTOLOGY_GRAPH, PATIENT_PREDICATES, RDF, SKOLEM_BASE, TurtleParser, local_name, read_nquads
+
+
+#the resource types of the entity passes, each one is the graph of its entities with graph="resource_type"
+RESOURCE_TYPES = ["Organization", "Location", "Patient", "Encounter", "Procedure", "Condition", "MedicationDispense",
+                  "MedicationRequest", "Specimen", "Medication", "MedicationAdministration", "Observation"]
+
+
+def read(path):
+    with open(path, encoding="utf-8") as file:
+        return file.read()
+
+def quads(text):
+    """
+    This fuction reads N-Quads lines with their graphs
+    Args:
+        text (string): the lines
+    Returns:
+        list: (Triple, graph IRI or None) of every line
+    """
+    graphs = [NQUADS_LINE.match(line).group(8) for line in text.splitlines()]
+    return list(zip(read_nquads(text), [graph and graph[1:-1] for graph in graphs]))
+
+@pytest.mark.parametrize("module", [fhir_kg_creation, flattened_kg_creation])
+def test_ntriples_are_the_triples_of_the_turtle(convert, module):
+    turtle = TurtleParser(skolem=SKOLEM_BASE).parse(read(convert(module)))
+    assert read_nquads(read(convert(module, output_format="nt"))) == turtle
+    assert read_nquads(read(convert(module, output_format="nt", workers=2))) == turtle
+
+def test_nquads_of_every_resource_type(convert):
+    ntriples = read_nquads(read(convert(flattened_kg_creation, output_format="nt")))
+    lines = quads(read(convert(flattened_kg_creation, output_format="nq")))
+    assert [triple for triple, _ in lines] == ntriples
+    assert {graph for _, graph in lines} == {ONTOLOGY_GRAPH} | {GRAPH_BASE + resource_type for resource_type in RESOURCE_TYPES}
+    #the header comes first and every entity is in the graph of its type
+    header = [graph for _, graph in lines].index(GRAPH_BASE + "Organization")
+    assert all(graph == ONTOLOGY_GRAPH for _, graph in lines[:header])
+    for triple, graph in lines[header:]:
+        if triple.predicate == RDF + "type" and local_name(triple.object) in RESOURCE_TYPES and triple.subject.startswith("http://example.org/myontology#"):
+            assert graph == GRAPH_BASE + local_name(triple.object)
+
+def test_nquads_of_every_patient(convert):
+    lines = quads(read(convert(flattened_kg_creation, output_format="nq", graph="patient")))
+    graphs = {graph for _, graph in lines}
+    assert graphs == {ONTOLOGY_GRAPH, None, GRAPH_BASE + "patient/pat-0", GRAPH_BASE + "patient/pat-1"}
+    for triple, graph in lines:
+        if triple.predicate in PATIENT_PREDICATES:
+            assert graph == GRAPH_BASE + "patient/" + local_name(triple.object)
+        elif triple.predicate == RDF + "type" and triple.object == FHIR + "Patient":
+            assert graph == GRAPH_BASE + "patient/" + local_name(triple.subject)
+        elif triple.predicate == RDF + "type" and triple.object in (FHIR + "Organization", FHIR + "Location", FHIR + "Medication"):
+            assert graph is None
@@ -0,0 +1,116 @@
+#--------------------------------------------------------------
+#
+# Tests of the triples the templates emit for the N-Triples and N-Quads outputs, and of the strict turtle parser
+#
+#----------------------------------------------------------------
+
+import pickle
+
+import pytest
+
+from fhir_kg_creation import FILTERS
+from kg_templates import Each, Section, Template
+from kg_triples import NODE, PLAIN, SKOLEM_BASE, XSD, Triple, TripleBuilder, TripleConverter, TurtleParser, read_prefixes
+
+
+HEADER = "@prefix se: <http://example.org/myontology#> .\n@prefix fhir: <http://hl7.org/fhir/> .\n@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .\n"
+PREFIXES = read_prefixes(HEADER)
+SE = "http://example.org/myontology#"
+FHIR = "http://hl7.org/fhir/"
+
+DOCUMENT = {
+    "id": "m1",
+    "status": "completed",
+    "subject": {"reference": "Patient/p1"},
+    "dosage": [{"text": 'take "two"\n daily', "dose": {"value": 2}}, {"text": "then one"}],
+    "code": {"system": "http://loinc.org", "code": "2345-7"},
+}
+
+
+def concept(document):
+    return "se:concept_" + document["code"]["code"]
+
+def administration(compact=False):
+    dose = Template("""
+                fhir:dose [ fhir:value "{value}"^^xsd:decimal ] ;""", compact=compact)
+    dosage = Template("""
+            fhir:dosage [ fhir:text "{text|literal}"@en ;{dose}
+                          fhir:rank "1" ] ;""", fields={"dose": Section("dose", dose)}, filters=FILTERS, compact=compact)
+    return Template("""se:{id} a fhir:MedicationAdministration ;
+            fhir:status "{status}" ;{dosage}
+            fhir:codeCoding {concept} ;
+            fhir:subject se:{subject.reference|ref}  .
+
+se:{id} fhir:status "{status}" .
+
+""", fields={"dosage": Each("dosage", dosage), "concept": concept}, filters=FILTERS, compact=compact)
+
+@pytest.mark.parametrize("compact", [False, True])
+@pytest.mark.parametrize("document", [DOCUMENT, dict(DOCUMENT, dosage=[]), dict(DOCUMENT, dosage=[{"text": "x"}])])
+def test_emitted_triples_are_those_of_the_turtle(compact, document):
+    template = administration(compact)
+    emitted = TripleBuilder(PREFIXES).emit(template, document)
+    parsed = TurtleParser(PREFIXES).parse(template.render(document))
+    assert emitted == parsed
+
+def test_emitted_triples():
+    triples = TripleBuilder(PREFIXES, SKOLEM_BASE).emit(administration(), DOCUMENT)
+    subject = SE + "m1"
+    first = triples[2].object
+    assert first.startswith(SKOLEM_BASE + "b") and first.endswith("_1")
+    assert triples[:9] == [
+        Triple(subject, "http://www.w3.org/1999/02/22-rdf-syntax-ns#type", FHIR + "MedicationAdministration", NODE),
+        Triple(subject, FHIR + "status", "completed", PLAIN),
+        Triple(subject, FHIR + "dosage", first, NODE),
+        Triple(first, FHIR + "text", 'take "two"\n daily', "@en"),
+        Triple(first, FHIR + "dose", first[:-1] + "2", NODE),
+        Triple(first[:-1] + "2", FHIR + "value", "2", XSD + "decimal"),
+        Triple(first, FHIR + "rank", "1", PLAIN),
+        Triple(subject, FHIR + "dosage", first[:-1] + "3", NODE),
+        Triple(first[:-1] + "3", FHIR + "text", "then one", "@en"),
+    ]
+    assert triples[-3:-1] == [Triple(subject, FHIR + "codeCoding", SE + "concept_2345-7", NODE), Triple(subject, FHIR + "subject", SE + "p1", NODE)]
+
+def test_blank_labels_are_the_same_every_run():
+    assert TripleBuilder(PREFIXES).emit(administration(), DOCUMENT) == TripleBuilder(PREFIXES).emit(administration(), DOCUMENT)
+    other = TripleBuilder(PREFIXES).emit(administration(), dict(DOCUMENT, id="m2"))
+    assert other[2].object != TripleBuilder(PREFIXES).emit(administration(), DOCUMENT)[2].object
+
+def test_converter_keeps_a_repeated_triple_once():
+    converter = TripleConverter("nt", prefixes=PREFIXES)
+    emitted = TripleBuilder(PREFIXES, SKOLEM_BASE).emit(administration(), DOCUMENT)
+    triples = converter.triples(administration(), DOCUMENT)
+    assert len(emitted) == len(triples) + 1
+    assert triples == list(dict.fromkeys(emitted))
+
+def test_pickled_templates_render_the_same():
+    template = pickle.loads(pickle.dumps(administration()))
+    assert template.render(DOCUMENT) == administration().render(DOCUMENT)
+    assert TripleBuilder(PREFIXES).emit(template, DOCUMENT) == TripleBuilder(PREFIXES).emit(administration(), DOCUMENT)
+
+@pytest.mark.parametrize("layout", [
+    "se:{id} fhir:dosage [ fhir:text \"{text}\" . ] .\n",
+    "se:{id} fhir:dosage [ fhir:text \"{text}\" ;\n",
+    "se:{id} fhir:list ( \"{text}\" ) .\n",
+])
+def test_layouts_that_are_not_turtle_are_rejected(layout):
+    with pytest.raises(ValueError):
+        Template(layout).emitter(PREFIXES)
+
+@pytest.mark.parametrize("text", [
+    'se:a fhir:text "no end .\n',
+    'se:a fhir:text "a "quote" inside" .\n',
+    'se:a fhir:text "a line\nbreak" .\n',
+    'se:a fhir:text "\\q" .\n',
+    'se:a other:text "x" .\n',
+    'se:a fhir:text "x" se:b fhir:text "y" .\n',
+    'se:a fhir:text "x" ; .. \n',
+])
+def test_parser_is_strict(text):
+    with pytest.raises(ValueError):
+        TurtleParser(PREFIXES).parse(text)
+
+def test_parser_reads_the_prefixes_of_the_header():
+    parser = TurtleParser()
+    assert parser.parse(HEADER) == []
+    assert parser.parse('se:a fhir:value "1.5"^^xsd:decimal .\n') == [Triple(SE + "a", FHIR + "value", "1.5", XSD + "decimal")]
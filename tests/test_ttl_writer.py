@@ -0,0 +1,145 @@
+#--------------------------------------------------------------
+#
+# Tests of the TtlWriter, and that the converters writing through it give the bytes the converters gave when they wrote
+# every entity through middle_man.txt
+#
+#----------------------------------------------------------------
+
+import gzip
+import hashlib
+import os
+import re
+import shutil
+
+import pytest
+
+import fhir_kg_creation
+import flattened_kg_creation
+from conftest import REPO_DIR
+from fhir_kg_creation import CONCEPT_DEFINITION, PARTITIONED_RESOURCE_TYPES, ConceptNodes, SharedStatements, TtlWriter, read_shared_statements
+
+
+#sha256 of the outputs the converters of the first commit wrote for the synthetic documents of conftest.py (loaded into
+#mongoDB in the order of the ndjson files), they change when those documents do
+BASELINE_OUTPUTS = {
+    "fhir_final_script.ttl": "9f6730495517c076dc341a999a7f9eb6d6990a33ba272d4d8c1608278d9b9d9b",
+    "flattened_final_script.ttl": "afa173f96b71433e37377ce6d400b20269ac9f80712c369df47915220e09a46c",
+}
+
+
+def test_summary_counts_what_is_written(tmp_path):
+    path = str(tmp_path / "out.ttl")
+    with TtlWriter(path) as writer:
+        writer.write_header("@prefix se: <http://example.org/myontology#> .\n")
+        writer.start_section()
+        writer.write('se:p1 a fhir:Patient ;\n    fhir:name "Ménière" .\n')
+        summary = writer.summary()
+    text = open(path, encoding="utf-8").read()
+    assert summary["characters"] == len(text)
+    assert summary["lines"] == text.count("\n") == 4
+    assert summary["last_character"] == "\n"
+    assert summary["bytes"] == len(text.encode("utf-8"))
+    assert summary["passes"] == []
+
+def test_append_mode(tmp_path):
+    path = str(tmp_path / "out.ttl")
+    with TtlWriter(path) as writer:
+        writer.write("se:a a fhir:Patient .\n")
+    with TtlWriter(path, mode="a") as writer:
+        writer.write("se:b a fhir:Patient .\n")
+        assert writer.characters == 22
+    assert open(path, encoding="utf-8").read() == "se:a a fhir:Patient .\nse:b a fhir:Patient .\n"
+
+def test_buffer_is_flushed_on_close(tmp_path):
+    path = str(tmp_path / "out.ttl.gz")
+    writer = TtlWriter(path, buffer_size=1 << 20)
+    writer.write("se:a a fhir:Patient .\n" * 1000)
+    writer.close()
+    assert gzip.open(path, "rt", encoding="utf-8").read() == "se:a a fhir:Patient .\n" * 1000
+
+@pytest.mark.parametrize("module", [fhir_kg_creation, flattened_kg_creation])
+@pytest.mark.parametrize("kwargs", [{}, {"buffer_size": 64}, {"workers": 2}])
+def test_output_is_the_baseline_output(convert, module, kwargs):
+    output_path = convert(module, **kwargs)
+    with open(output_path, "rb") as file:
+        output = file.read()
+    assert hashlib.sha256(output).hexdigest() == BASELINE_OUTPUTS[output_path.rsplit("/", 1)[1]]
+
+def read_output(path):
+    with (gzip.open(path) if path.endswith(".gz") else open(path, "rb")) as file:
+        return file.read()
+
+def test_shard_keeps_shared_statements_apart(tmp_path):
+    path = str(tmp_path / "shard.ttl")
+    concepts = ConceptNodes(CONCEPT_DEFINITION)
+    with TtlWriter(path, concepts=concepts) as writer:
+        writer.shared = SharedStatements(path + ".shared")
+        writer.write("se:a fhir:code se:" + concepts.link({"system": "s", "code": "1"}) + " .\n")
+        writer.write("se:b fhir:code se:" + concepts.link({"system": "s", "code": "1"}) + " .\n")
+    text = open(path, encoding="utf-8").read()
+    #the shard holds the entities only, the statement is kept with the place it belongs
+    assert "fhir:Coding" not in text
+    (position, file_position, node, statement), = read_shared_statements(path + ".shared")
+    assert position == file_position == text.index("se:b")
+    assert statement.startswith(f"se:{node} a fhir:Coding ;")
+
+@pytest.mark.parametrize("module,kwargs", [
+    (fhir_kg_creation, {"concepts": True}),
+    (flattened_kg_creation, {"concepts": True, "shared_dosages": True}),
+    (flattened_kg_creation, {"concepts": True, "shared_dosages": True, "compression": "gzip"}),
+])
+def test_parallel_output_is_the_serial_output(convert, module, kwargs):
+    serial = read_output(convert(module, **kwargs))
+    parallel = read_output(convert(module, workers=3, **kwargs))
+    assert parallel == serial
+    #every concept and shared dosage is defined once
+    defined = re.findall(rb"^se:(?:concept_|dosage-)\w+(?= a )", parallel, re.MULTILINE)
+    assert defined
+    assert len(defined) == len(set(defined))
+
+def id_partitions(source, split):
+    """
+    This fuction makes a stand in for get_id_partitions that splits the documents of a source into _id ranges
+    Args:
+        source (NdjsonSource): the documents
+        split (list): the resource types that are split are added to it
+    Returns:
+        function: get_id_partitions(resource_type, partitions) -> one query per _id range
+    """
+    def get_id_partitions(resource_type, partitions):
+        split.append(resource_type)
+        ids = sorted(doc["_id"] for doc in source.aggregate([{"$match": {"resourceType": resource_type}}, {"$project": {"_id": 1}}]))
+        split_points = [ids[len(ids) * part // partitions] for part in range(1, partitions)]
+        queries = [{"_id": {"$lt": split_points[0]}}]
+        for low, high in zip(split_points, split_points[1:]):
+            queries.append({"_id": {"$gte": low, "$lt": high}})
+        queries.append({"_id": {"$gte": split_points[-1]}})
+        return queries
+    return get_id_partitions
+
+@pytest.mark.parametrize("module,kwargs", [
+    (fhir_kg_creation, {"concepts": True}),
+    (flattened_kg_creation, {"concepts": True, "shared_dosages": True}),
+])
+def test_partitioned_output_is_the_serial_output(convert, synthetic_ndjson, tmp_path, monkeypatch, module, kwargs):
+    from ndjson_source import NdjsonSource
+    serial = read_output(convert(module, **kwargs))
+    source = NdjsonSource(synthetic_ndjson, one_type_per_file=True)
+    #the passes are split into _id ranges when they read from mongoDB, the collection is the ndjson files here and the
+    #forked workers keep reading from them
+    monkeypatch.setattr(fhir_kg_creation, "PROCESS_START_METHOD", "fork")
+    monkeypatch.setattr(fhir_kg_creation, "get_entity_collection", lambda: source)
+    split = []
+    monkeypatch.setattr(fhir_kg_creation, "get_id_partitions", id_partitions(source, split))
+    workdir = tmp_path / "partitioned"
+    workdir.mkdir()
+    shutil.copy(os.path.join(REPO_DIR, "fhir_kg_script.ttl"), workdir)
+    shutil.copy(os.path.join(REPO_DIR, "flattened_kg_script.ttl"), workdir)
+    monkeypatch.chdir(workdir)
+    metrics = module.create_ttl_script(workers=3, **kwargs)
+    assert sorted(split) == sorted(PARTITIONED_RESOURCE_TYPES.values())
+    parallel = read_output(str(workdir / metrics.output_path))
+    assert parallel == serial
+    defined = re.findall(rb"^se:(?:concept_|dosage-)\w+(?= a )", parallel, re.MULTILINE)
+    assert defined
+    assert len(defined) == len(set(defined))